@@ -7,13 +7,20 @@ import streamlit as st
 import google.generativeai as genai
 from supabase import create_client, Client
 import hashlib
+import functools
 import time
 import random
 import math
+import json
+import io
+import csv
+import threading
+from dataclasses import dataclass, field, replace
 
 
 
 MAX_AI_QUOTA = 10
+CLASS_AI_QUOTA = {}  # hạn mức riêng theo lớp, vd {"FIN01": 15}; lớp không có trong đây dùng MAX_AI_QUOTA
 
 # Đặt đoạn này ở ngay đầu file app.py (sau các lệnh import)
 st.set_page_config(
@@ -45,49 +52,245 @@ def init_supabase():
 
 supabase_client = init_supabase()
 
-@st.cache_data(show_spinner=False)
-def load_student_registry():
-    """
-    Đọc dssv.xlsx và trả về dict:
-    REG[mssv] = {"hoten": "...", "pin": "..."}
-    """
-    try:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        file_path = os.path.join(current_dir, "dssv.xlsx")
-        df = pd.read_excel(file_path, dtype=str).fillna("")
+# =========================
+# DANH SÁCH LỚP (dssv.xlsx + rosters/): NHIỀU LỚP, TỰ NẠP LẠI KHI FILE ĐỔI
+# =========================
+# Nguồn: dssv.xlsx (danh sách gốc) + mọi file .xlsx/.csv/.parquet trong thư mục rosters/.
+# - Lớp lấy từ cột lop/class nếu có; không có thì file trong rosters/ lấy tên file (rosters/FIN01.csv -> FIN01),
+#   dssv.xlsx để trống. MSSV trùng giữa các file: file đứng sau (theo tên) thắng, có đếm trong báo cáo.
+# - Đọc từng dòng (openpyxl read_only / csv / pyarrow theo batch) chỉ lấy 4 cột cần dùng,
+#   rồi kiểm tra MSSV / lớp cả cột một lượt bằng pandas; dòng sai bị loại và được đếm theo file.
+# - RosterWatcher (1 bản / tiến trình) so (mtime, size) từng file mỗi lần đọc -> chỉ file nào khác mới đọc lại,
+#   so sha256 (đổi mtime mà nội dung như cũ thì thôi), rồi parse và so từng dòng với bản cũ.
+# - Chỉ dòng thêm/sửa/xóa mới được áp vào bản sao của index cũ; index mới (bất biến) được tráo
+#   vào 1 phép gán -> phiên nào đang đọc bản cũ vẫn an toàn, không có lúc danh sách rỗng.
+# - File lỗi/thiếu cột: giữ nguyên phần danh sách của file đó đang chạy, chỉ báo lỗi.
+ROSTER_FILE = "dssv.xlsx"
+ROSTER_DIR = "rosters"
+ROSTER_EXTS = (".xlsx", ".csv", ".parquet")
+ROSTER_BATCH = 5000  # số dòng / batch khi đọc parquet
+ROSTER_COLUMNS = {  # tên cột chấp nhận (so sau khi strip + lower)
+    "mssv": ("mssv", "ma sv", "student_id", "student id"),
+    "hoten": ("hoten", "họ tên", "ho ten", "fullname", "full name"),
+    "pin": ("pin", "pin4", "pass", "password"),
+    "lop": ("lop", "lớp", "ma lop", "class", "class_id"),
+}
+MSSV_PATTERN = r"[A-Z0-9][A-Z0-9_.\-]*"
+LOP_PATTERN = r"[\w.\- ]{0,40}"
+
+
+@dataclass(frozen=True)
+class RosterIndex:
+    """Ảnh chụp bất biến của danh sách lớp (chỉ đọc)."""
+    stat: tuple = ()  # ((path, mtime_ns, size), ...) lúc nạp
+    digest: str = ""
+    rows: dict = field(default_factory=dict)  # mssv -> (hoten, pin, lop)
+    registry: dict = field(default_factory=dict)  # mssv -> {"hoten", "pin", "lop"} (chỉ dòng có PIN)
+    names: dict = field(default_factory=dict)  # mssv -> hoten (mọi dòng có MSSV)
+    by_class: dict = field(default_factory=dict)  # lop -> frozenset(mssv)
+    diff: dict = field(default_factory=dict)  # {"added", "changed", "removed"}: số dòng lần nạp gần nhất
+    report: dict = field(default_factory=dict)  # file -> {"rows", "bad_mssv", "bad_lop", "no_pin", "dup"}
+    error: str = ""
+
+
+def _cell_str(v) -> str:
+    """Ô Excel/CSV/parquet -> chuỗi đã strip (số nguyên 12.0 -> "12")."""
+    if v is None:
+        return ""
+    if isinstance(v, float):
+        if v != v:
+            return ""
+        if v.is_integer():
+            v = int(v)
+    return str(v).strip()
+
+
+def _iter_roster_rows(data: bytes, ext: str):
+    """Duyệt từng dòng (dòng đầu là tiêu đề) mà không dựng cả bảng trong bộ nhớ."""
+    if ext == ".xlsx":
+        from openpyxl import load_workbook
+        wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+        try:
+            yield from wb.active.iter_rows(values_only=True)
+        finally:
+            wb.close()
+    elif ext == ".csv":
+        yield from csv.reader(io.StringIO(data.decode("utf-8-sig")))
+    elif ext == ".parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ValueError("cần cài pyarrow để đọc file .parquet")
+        pf = pq.ParquetFile(io.BytesIO(data))
+        yield tuple(pf.schema_arrow.names)
+        for batch in pf.iter_batches(batch_size=ROSTER_BATCH):
+            yield from zip(*(col.to_pylist() for col in batch.columns))
+    else:
+        raise ValueError(f"không hỗ trợ định dạng {ext}")
 
-        # Chuẩn hóa tên cột linh hoạt
-        cols = {c.strip().lower(): c for c in df.columns}
 
-        mssv_col = cols.get("mssv") or cols.get("ma sv") or cols.get("student_id") or cols.get("student id")
-        pin_col  = cols.get("pin") or cols.get("pin4") or cols.get("pass") or cols.get("password")
-        hoten_col = cols.get("hoten") or cols.get("họ tên") or cols.get("ho ten") or cols.get("fullname") or cols.get("full name")
+def parse_roster(data: bytes, name: str = ROSTER_FILE, default_lop: str = "") -> tuple[dict | None, str, dict]:
+    """
+    Nội dung 1 file danh sách -> ({mssv: (hoten, pin, lop)}, lỗi, thống kê).
+    Thiếu cột MSSV -> (None, lỗi, {}).
+    """
+    rows_iter = _iter_roster_rows(data, os.path.splitext(name)[1].lower())
+    header = [_cell_str(h).lower() for h in next(rows_iter, ())]
+    idx = {key: next((header.index(a) for a in aliases if a in header), None) for key, aliases in ROSTER_COLUMNS.items()}
+    if idx["mssv"] is None:
+        return None, f"File {name} thiếu cột MSSV hoặc PIN.", {}
+
+    # Chỉ giữ 4 cột cần dùng, từng dòng một
+    picks = [(k, i) for k, i in idx.items() if i is not None]
+    cols = {k: [] for k in ROSTER_COLUMNS}
+    for r in rows_iter:
+        n = len(r)
+        for k, i in picks:
+            cols[k].append(_cell_str(r[i]) if i < n else "")
+    n_rows = len(cols["mssv"])
+    for k, i in idx.items():
+        if i is None:
+            cols[k] = [default_lop if k == "lop" else ""] * n_rows
+
+    # Kiểm tra cả cột một lượt
+    df = pd.DataFrame(cols, dtype=object)
+    mssv = df["mssv"].str.upper()
+    lop = df["lop"].where(df["lop"] != "", default_lop)
+    filled = (mssv != "").to_numpy()
+    ok_mssv = mssv.str.fullmatch(MSSV_PATTERN).to_numpy(dtype=bool)
+    ok_lop = lop.str.fullmatch(LOP_PATTERN).to_numpy(dtype=bool)
+    keep = filled & ok_mssv & ok_lop
+    kept = mssv[keep]
+    stats = {
+        "rows": int(keep.sum()),
+        "bad_mssv": int((filled & ~ok_mssv).sum()),
+        "bad_lop": int((filled & ok_mssv & ~ok_lop).sum()),
+        "no_pin": int((df["pin"][keep] == "").sum()),
+        "dup": int(kept.duplicated().sum()),
+    }
+    rows = dict(zip(kept, zip(df["hoten"][keep], df["pin"][keep], lop[keep])))  # MSSV trùng: dòng sau thắng
+    return rows, "" if idx["pin"] is not None else f"File {name} thiếu cột MSSV hoặc PIN.", stats
+
+
+def apply_roster_diff(old: RosterIndex, rows: dict, **meta) -> RosterIndex:
+    """Index mới = index cũ + các dòng thêm/sửa/xóa (dòng không đổi giữ nguyên)."""
+    removed = old.rows.keys() - rows.keys()
+    touched = [m for m, row in rows.items() if old.rows.get(m) != row]
+    registry, names = dict(old.registry), dict(old.names)
+    by_class = {lop: set(members) for lop, members in old.by_class.items()}
+    for m in removed:
+        registry.pop(m, None)
+        names.pop(m, None)
+        by_class[old.rows[m][2]].discard(m)
+    for m in touched:
+        hoten, pin, lop = rows[m]
+        if m in old.rows:
+            by_class[old.rows[m][2]].discard(m)
+        by_class.setdefault(lop, set()).add(m)
+        names[m] = hoten
+        if pin:
+            registry[m] = {"hoten": hoten, "pin": pin, "lop": lop}
+        else:
+            registry.pop(m, None)
+    n_added = len(rows.keys() - old.rows.keys())
+    diff = {"added": n_added, "changed": len(touched) - n_added, "removed": len(removed)}
+    by_class = {lop: frozenset(members) for lop, members in by_class.items() if members}
+    return RosterIndex(rows=rows, registry=registry, names=names, by_class=by_class, diff=diff, **meta)
+
+
+class RosterWatcher:
+    """Theo dõi danh sách lớp (1 file gốc + thư mục lớp); `current()` trả index mới nhất."""
+
+    def __init__(self, path: str, folder: str = ""):
+        self.path = path
+        self.folder = folder
+        self._lock = threading.Lock()
+        self._index = RosterIndex()
+        self._files = {}  # path -> (stat, digest, rows, error, stats): kết quả parse từng file
+
+    def _sources(self) -> tuple:
+        """((path, mtime_ns, size), ...): file gốc trước, rồi các file trong thư mục theo tên."""
+        paths = [self.path]
+        if self.folder and os.path.isdir(self.folder):
+            paths += [os.path.join(self.folder, f) for f in sorted(os.listdir(self.folder))
+                      if f.lower().endswith(ROSTER_EXTS) and not f.startswith((".", "~$"))]
+        sig = []
+        for p in paths:
+            try:
+                st_ = os.stat(p)
+            except OSError:
+                continue
+            sig.append((p, st_.st_mtime_ns, st_.st_size))
+        return tuple(sig)
+
+    def _load(self, p: str, stat: tuple):
+        """Parse lại 1 file nếu nội dung đổi; lỗi -> giữ kết quả cũ của file đó."""
+        prev = self._files.get(p)
+        if prev and prev[0] == stat:
+            return prev
+        name = os.path.basename(p)
+        try:
+            with open(p, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            return (stat, "", prev[2] if prev else {}, f"Lỗi đọc file {name}: {e}", prev[4] if prev else {})
+        digest = hashlib.sha256(data).hexdigest()
+        if prev and digest == prev[1]:
+            loaded = (stat,) + prev[1:]
+        else:
+            default_lop = "" if p == self.path else os.path.splitext(name)[0]
+            try:
+                rows, error, stats = parse_roster(data, name, default_lop)
+            except Exception as e:
+                rows, error, stats = None, f"Lỗi đọc file {name}: {e}", {}
+            if rows is None:
+                rows, stats = (prev[2], prev[4]) if prev else ({}, {})
+            loaded = (stat, digest, rows, error, stats)
+        self._files[p] = loaded
+        return loaded
+
+    def current(self) -> RosterIndex:
+        sig = self._sources()
+        index = self._index
+        if sig == index.stat:
+            return index
+        with self._lock:  # chỉ 1 phiên đọc lại file, các phiên khác chờ rồi dùng kết quả
+            index = self._index
+            if sig == index.stat:
+                return index
+            if not sig:
+                return replace(index, error=f"Không tìm thấy {ROSTER_FILE} hay file nào trong {ROSTER_DIR}/.")
+            loaded = [self._load(p, (p, mtime, size)) for p, mtime, size in sig]
+            self._files = {s[0][0]: s for s in loaded}  # bỏ file đã xóa khỏi thư mục
+            digest = hashlib.sha256("".join(s[1] for s in loaded).encode()).hexdigest()
+            errors = "; ".join(s[3] for s in loaded if s[3])
+            if digest == index.digest:
+                new = replace(index, stat=sig, error=errors)
+            else:
+                merged, report = {}, {}
+                for (p, _, _), _, rows, _, stats in loaded:
+                    report[os.path.basename(p)] = dict(stats, dup=stats.get("dup", 0) + len(merged.keys() & rows.keys()))
+                    merged.update(rows)  # MSSV trùng giữa các file: file sau thắng
+                new = apply_roster_diff(index, merged, stat=sig, digest=digest, report=report, error=errors)
+            self._index = new
+            return new
 
-        if not mssv_col or not pin_col:
-            st.error("⚠️ File dssv.xlsx thiếu cột MSSV hoặc PIN.")
-            return {}
 
-        df[mssv_col] = df[mssv_col].astype(str).str.strip().str.upper()
-        df[pin_col]  = df[pin_col].astype(str).str.strip()
+@st.cache_resource
+def roster_watcher() -> RosterWatcher:
+    here = os.path.dirname(os.path.abspath(__file__))
+    return RosterWatcher(os.path.join(here, ROSTER_FILE), os.path.join(here, ROSTER_DIR))
 
-        if hoten_col:
-            df[hoten_col] = df[hoten_col].astype(str).str.strip()
-        else:
-            df["__hoten__"] = ""
-            hoten_col = "__hoten__"
-
-        reg = {}
-        for _, r in df.iterrows():
-            m = (r.get(mssv_col) or "").strip().upper()
-            p = (r.get(pin_col) or "").strip()
-            h = (r.get(hoten_col) or "").strip()
-            if m and p:
-                reg[m] = {"hoten": h, "pin": p}
-        return reg
 
-    except Exception as e:
-        st.error(f"⚠️ Lỗi đọc file Excel: {e}")
-        return {}
+def load_student_registry():
+    """
+    Danh sách lớp hiện hành (chỉ đọc):
+    REG[mssv] = {"hoten": "...", "pin": "...", "lop": "..."}
+    """
+    index = roster_watcher().current()
+    if index.error:
+        st.error(f"⚠️ {index.error}")
+    return index.registry
 
 
 def get_student_name(mssv: str) -> str:
@@ -95,6 +298,35 @@ def get_student_name(mssv: str) -> str:
     reg = load_student_registry()
     return (reg.get(m, {}) or {}).get("hoten", "").strip()
 
+
+ROSTER_REPORT_LABELS = {
+    "rows": "SV hợp lệ", "bad_mssv": "MSSV sai định dạng", "bad_lop": "Lớp sai định dạng",
+    "no_pin": "Thiếu PIN", "dup": "MSSV trùng",
+}
+
+
+def roster_report_frame(index: RosterIndex) -> pd.DataFrame:
+    """Bảng kiểm tra danh sách theo file: số dòng hợp lệ / bị loại / thiếu PIN / trùng."""
+    df = pd.DataFrame.from_dict(index.report, orient="index").reindex(columns=list(ROSTER_REPORT_LABELS))
+    df = df.fillna(0).astype(int).rename(columns=ROSTER_REPORT_LABELS)
+    return df.rename_axis("File").reset_index()
+
+
+def get_student_class(mssv: str) -> str:
+    """Lớp của SV theo danh sách hiện hành ("" nếu không rõ)."""
+    row = roster_watcher().current().rows.get(str(mssv).strip().upper())
+    return row[2] if row else ""
+
+
+def class_members(lop: str) -> frozenset:
+    """Tập MSSV của 1 lớp (phân vùng theo lớp của danh sách hiện hành)."""
+    return roster_watcher().current().by_class.get(lop, frozenset())
+
+
+def ai_quota_for(mssv: str) -> int:
+    """Số lượt gọi AI tối đa của SV: theo lớp nếu có trong CLASS_AI_QUOTA, không thì MAX_AI_QUOTA."""
+    return CLASS_AI_QUOTA.get(get_student_class(mssv), MAX_AI_QUOTA)
+
 def verify_mssv_pin(mssv: str, pin: str) -> tuple[bool, str]:
     reg = load_student_registry()
     m = str(mssv).strip().upper()
@@ -147,7 +379,7 @@ def update_usage_to_supabase(student_id, current_usage):
 
 # --- HÀM LOGIC CHÍNH (Đã sửa đổi để gọi Supabase) ---
 
-def verify_and_check_quota(student_id, max_limit=MAX_AI_QUOTA):
+def verify_and_check_quota(student_id, max_limit=None):
     """
     Kiểm tra 2 lớp:
     1. Có trong file Excel không? (Hợp lệ)
@@ -165,6 +397,8 @@ def verify_and_check_quota(student_id, max_limit=MAX_AI_QUOTA):
     
     # LỚP 2: KIỂM TRA QUOTA TỪ SUPABASE (Thay vì RAM)
     current_usage = get_usage_from_supabase(clean_id)
+    if max_limit is None:
+        max_limit = ai_quota_for(clean_id)
     
     if current_usage >= max_limit:
         return "LIMIT_REACHED", current_usage
@@ -196,322 +430,598 @@ def stable_seed(*parts) -> int:
     return int(h[:16], 16) & ((1 << 63) - 1)
 
 
-def gen_case_D01(seed: int) -> tuple[dict, dict]:
-    """
-    D01: Cross-rate EUR/VND từ EUR/USD & USD/VND (Bid/Ask/Spread)
-    Trả về (params, answers)
-    """
-    rng = np.random.default_rng(seed)
-
-    # USD/VND: bid bội số 10, ask = bid + spread(80..160)
-    usd_bid = int(rng.integers(2400, 2701) * 10)  # 24,000 .. 27,000
-    usd_spread = int(rng.choice([80, 90, 100, 110, 120, 130, 140, 150, 160]))
-    usd_ask = usd_bid + usd_spread
-
-    # EUR/USD: bid 4 decimals, ask = bid + (0.0010..0.0030)
-    # EUR/USD bid theo bước 0.0005 (tick = 5 trên thang 1/10000)
-    eur_bid_ticks = int(rng.integers(10200 // 5, 11500 // 5 + 1) * 5)
-    eur_bid = eur_bid_ticks / 10000
-
-    eur_mark = float(rng.integers(10, 31) / 10000)          # 0.0010..0.0030
-    eur_ask = round(eur_bid + eur_mark, 4)
+# =========================
+# QUY ƯỚC ĐẾM NGÀY & GHÉP LÃI (dùng chung cho IRP, carry, chi phí vốn thương mại)
+# =========================
+# Mọi công thức lãi suất trong app đi qua year_fraction + growth_factor / simple_interest.
+# Đầu vào vectorized: số ngày (int/mảng) hoặc 2 mảng ngày (datetime64 / chuỗi 'YYYY-MM-DD').
+DAY_COUNTS = ("ACT/360", "ACT/365F", "30/360")
+DEFAULT_DAY_COUNT = "ACT/360"   # quy ước thị trường tiền tệ VND/USD dùng xuyên suốt các bài
+COMPOUNDING = {"simple": 0, "annual": 1, "semiannual": 2, "quarterly": 4, "monthly": 12, "continuous": None}
 
-    # Theo code room_1_dealing: cross_bid=eur_bid*usd_bid; cross_ask=eur_ask*usd_ask
-    # Hiển thị dạng 0f => chấm theo làm tròn integer VND/EUR
-    cross_bid = int(round(eur_bid * usd_bid, 0))
-    cross_ask = int(round(eur_ask * usd_ask, 0))
-    spread = int(cross_ask - cross_bid)
 
-    params = {
-        "usd_bid": usd_bid, "usd_ask": usd_ask,
-        "eur_bid": eur_bid, "eur_ask": eur_ask,
-    }
-    answers = {
-        "cross_bid": cross_bid,
-        "cross_ask": cross_ask,
-        "spread": spread,
-    }
-    return params, answers
+def _ymd(dates) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    d = np.asarray(dates, dtype="datetime64[D]")
+    y = d.astype("datetime64[Y]")
+    m = d.astype("datetime64[M]")
+    return (y.astype(np.int64) + 1970, (m - y).astype(np.int64) + 1, (d - m).astype(np.int64) + 1)
 
-import numpy as np
 
-def gen_case_D02(seed: int) -> tuple[dict, dict]:
+def year_fraction(start=None, end=None, convention: str = DEFAULT_DAY_COUNT, days=None):
     """
-    D02 — Tam giác VND–USD–EUR.
-    Cho 3 báo giá: USD/VND, EUR/USD, EUR/VND (direct).
-    Hỏi: Có arbitrage không? Nếu có thì theo hướng nào và lợi nhuận (VND) với số vốn ban đầu.
+    Phần năm giữa start và end (hoặc theo số ngày `days`) theo quy ước:
+    - ACT/360, ACT/365F: số ngày thực tế / 360 hoặc / 365
+    - 30/360 (US bond basis): 360(Y2-Y1) + 30(M2-M1) + (D2-D1), D1=31→30; D2=31→30 nếu D1≥30.
+      Khi chỉ có số ngày (không có lịch) thì 30/360 ≈ ngày/360.
     """
-    rng = np.random.default_rng(int(seed) % 2_000_000_000)  # an toàn bigint
+    if convention not in DAY_COUNTS:
+        raise ValueError(f"Quy ước đếm ngày không hỗ trợ: {convention}")
+    if days is None:
+        d0 = np.asarray(start, dtype="datetime64[D]")
+        d1 = np.asarray(end, dtype="datetime64[D]")
+        if convention == "30/360":
+            y1, m1, dd1 = _ymd(d0)
+            y2, m2, dd2 = _ymd(d1)
+            dd1 = np.minimum(dd1, 30)
+            dd2 = np.where((dd1 >= 30) & (dd2 == 31), 30, dd2)
+            return (360 * (y2 - y1) + 30 * (m2 - m1) + (dd2 - dd1)) / 360.0
+        days = (d1 - d0).astype(np.int64)
+    days = np.asarray(days, dtype=float) if not np.isscalar(days) else days
+    return days / (365.0 if convention == "ACT/365F" else 360.0)
+
+
+def growth_factor(rate, yf, compounding: str = "simple"):
+    """Hệ số tích lũy 1 đồng vốn: 1 + r·t (đơn), (1 + r/m)^(m·t) (ghép m lần/năm), e^(r·t) (liên tục)."""
+    m = COMPOUNDING[compounding]
+    if m == 0:
+        return 1.0 + rate * yf
+    if m is None:
+        return np.exp(np.multiply(rate, yf))
+    return (1.0 + np.divide(rate, m)) ** (np.multiply(m, yf))
+
+
+def simple_interest(principal, rate, yf):
+    """Tiền lãi đơn = gốc × lãi suất × phần năm."""
+    return principal * rate * yf
+
+
+def equivalent_rate(rate, yf, from_comp: str, to_comp: str):
+    """Đổi lãi suất giữa 2 kiểu ghép lãi sao cho cùng hệ số tích lũy trên kỳ yf."""
+    g = growth_factor(rate, yf, from_comp)
+    m = COMPOUNDING[to_comp]
+    if m == 0:
+        return (g - 1.0) / yf
+    if m is None:
+        return np.log(g) / yf
+    return m * (g ** (1.0 / (m * np.asarray(yf, dtype=float))) - 1.0)
 
-    # 1) Báo giá USD/VND
-    usd_bid = int(rng.integers(23500, 25501))              # VND/USD
-    usd_ask = usd_bid + int(rng.integers(10, 61))          # spread 10–60
 
-    # 2) Báo giá EUR/USD
-    eur_bid = float(rng.integers(10200, 11501) / 10000)    # 1.0200–1.1500
-    eur_ask = round(eur_bid + float(rng.integers(10, 41) / 10000), 4)  # +0.0010..0.0040
+# =========================
+# CASHFLOW ANALYTICS (NPV, IRR, MIRR, PI, payback) - dùng chung cho I01, I02 và phòng Đầu tư
+# =========================
+# Mọi hàm nhận 1 dòng tiền (T+1,) hoặc lô dòng tiền (B, T+1), cột 0 = CF năm 0.
+# rate là số hoặc mảng (B,) theo decimal; kết quả là số (1 dòng) hoặc mảng (B,).
+def _cf_batch(cashflows, rate=None):
+    cf = np.asarray(cashflows, dtype=float)
+    single = cf.ndim == 1
+    cf = np.atleast_2d(cf)
+    if rate is None:
+        return cf, None, single
+    r = np.broadcast_to(np.asarray(rate, dtype=float), (cf.shape[0],))
+    return cf, r, single
 
-    # 3) Cross implied EUR/VND
-    implied_bid = eur_bid * usd_bid
-    implied_ask = eur_ask * usd_ask
 
-    # 4) Tạo market EUR/VND direct có thể lệch để tạo arbitrage (có xác suất)
-    spread_eurvnd = int(rng.integers(40, 121))  # 40–120 VND
-    mid = (implied_bid + implied_ask) / 2
+def _cf_out(x, single):
+    return float(x[0]) if single else x
 
-    # delta: tạo lệch vừa phải + thỉnh thoảng lệch mạnh để chắc chắn có case arbitrage
-    if rng.random() < 0.55:
-        delta = int(rng.integers(-120, 121))    # thường: nhỏ
-    else:
-        delta = int(rng.integers(-600, 601))    # đôi lúc: lớn
-
-    market_mid = mid + delta
-    eurvnd_bid = int(round(market_mid - spread_eurvnd / 2))
-    eurvnd_ask = int(round(eurvnd_bid + spread_eurvnd))
-
-    # đảm bảo hợp lý
-    eurvnd_bid = max(eurvnd_bid, 1000)
-    eurvnd_ask = max(eurvnd_ask, eurvnd_bid + 1)
-
-    # 5) Vốn ban đầu
-    start_vnd = int(rng.integers(200_000_000, 1_200_000_000))  # 200m–1.2b
-
-    # 6) Xác định arbitrage
-    # Điều kiện A: EUR rẻ direct so với cross -> mua EUR direct (ask), bán EUR->USD (bid), bán USD->VND (bid)
-    cond_A = eurvnd_ask < implied_bid
-
-    # Điều kiện B: EUR đắt direct so với cross -> mua EUR qua cross, bán EUR direct (bid)
-    cond_B = eurvnd_bid > implied_ask
-
-    # Tính profit theo 2 hướng (nếu âm thì coi như 0)
-    profit_A = 0
-    profit_B = 0
-
-    if cond_A:
-        eur = start_vnd / eurvnd_ask
-        usd = eur * eur_bid
-        end_vnd = usd * usd_bid
-        profit_A = int(round(end_vnd - start_vnd))
-
-    if cond_B:
-        usd = start_vnd / usd_ask
-        eur = usd / eur_ask
-        end_vnd = eur * eurvnd_bid
-        profit_B = int(round(end_vnd - start_vnd))
-
-    # Chọn đáp án đúng nhất
-    if profit_A > 0 and profit_A >= profit_B:
-        correct_option = "A"
-        profit_vnd = profit_A
-    elif profit_B > 0:
-        correct_option = "B"
-        profit_vnd = profit_B
-    else:
-        correct_option = "C"
-        profit_vnd = 0
 
-    params = {
-        "usd_bid": usd_bid,
-        "usd_ask": usd_ask,
-        "eur_bid": eur_bid,
-        "eur_ask": eur_ask,
-        "eurvnd_bid": eurvnd_bid,
-        "eurvnd_ask": eurvnd_ask,
-        "start_vnd": start_vnd,
-    }
+def cf_present_values(cashflows, rate) -> np.ndarray:
+    """PV từng kỳ CF_t / (1+r)^t, cùng shape với cashflows."""
+    cf, r, single = _cf_batch(cashflows, rate)
+    pv = np.empty_like(cf)
+    for t in range(cf.shape[1]):
+        pv[:, t] = cf[:, t] / (1.0 + r) ** t
+    return pv[0] if single else pv
 
-    answers = {
-        "correct_option": correct_option,   # A/B/C
-        "profit_vnd": int(profit_vnd),
-        "implied_bid": int(round(implied_bid)),
-        "implied_ask": int(round(implied_ask)),
-    }
 
-    return params, answers
+def cf_npv(cashflows, rate):
+    """NPV = Σ CF_t/(1+r)^t, cộng dồn theo thứ tự kỳ (khớp bit với công thức viết tay)."""
+    cf, r, single = _cf_batch(cashflows, rate)
+    acc = cf[:, 0].copy()
+    for t in range(1, cf.shape[1]):
+        acc = acc + cf[:, t] / (1.0 + r) ** t
+    return _cf_out(acc, single)
 
-def gen_case_R01(seed: int) -> tuple[dict, dict]:
+
+def cf_irr(cashflows, guess=0.1, n_iter: int = 8, tol: float = 1e-9):
     """
-    R01: Tính tỷ giá kỳ hạn theo IRP + chi phí hedge Forward cho khoản nợ USD.
-    Output:
-      - params: dữ liệu đề bài
-      - answers: đáp án chuẩn
+    IRR: Newton với số vòng lặp cố định (vector hoá, không rẽ nhánh) từ guess;
+    dòng nào chưa hội tụ thì bisection trên [-0.99, 10] nếu NPV đổi dấu, không thì NaN.
     """
-    rng = random.Random(int(seed))
-
-    usd_amount = rng.randrange(200_000, 2_000_001, 50_000)     # USD nợ
-    days = rng.choice([30, 60, 90, 180])                       # kỳ hạn (ngày)
-
-    # Spot USD/VND (BID/ASK) - step 10 VND
-    spot_bid = rng.randrange(23200, 25801, 10)
-    spread = rng.randrange(20, 71, 5)
-    spot_ask = spot_bid + spread
-
-    # Lãi suất năm (decimal)
-    i_vnd = rng.choice([0.045, 0.050, 0.055, 0.060, 0.065, 0.070, 0.075, 0.080])
-    i_usd = rng.choice([0.020, 0.025, 0.030, 0.035, 0.040, 0.045, 0.050, 0.055])
-
-    t = days / 360.0
-    factor = (1.0 + i_vnd * t) / (1.0 + i_usd * t)
-
-    fwd_bid = spot_bid * factor
-    fwd_ask = spot_ask * factor
-
-    fwd_bid_i = int(round(fwd_bid))   # làm tròn đến VND
-    fwd_ask_i = int(round(fwd_ask))
-
-    # Hedge khoản nợ USD => DN cần MUA USD tương lai => dùng Forward ASK
-    hedged_cost_vnd = int(round(usd_amount * fwd_ask_i))
-
-    params = {
-        "usd_amount": usd_amount,
-        "days": days,
-        "spot_bid": spot_bid,
-        "spot_ask": spot_ask,
-        "i_vnd": i_vnd,   # decimal
-        "i_usd": i_usd,   # decimal
+    cf, r0, single = _cf_batch(cashflows, guess)
+    t = np.arange(cf.shape[1], dtype=float)
+    r = r0.copy()
+    with np.errstate(all="ignore"):
+        for _ in range(n_iter):
+            disc = (1.0 + r)[:, None] ** (-t)
+            f = (cf * disc).sum(axis=1)
+            df = -(cf * t * disc).sum(axis=1) / (1.0 + r)
+            r = r - f / df
+
+        scale = np.abs(cf).sum(axis=1)
+        f = (cf * (1.0 + r)[:, None] ** (-t)).sum(axis=1)
+        bad = ~np.isfinite(r) | (r <= -1.0) | (np.abs(f) > tol * np.maximum(scale, 1.0))
+        if bad.any():
+            cb = cf[bad]
+            lo = np.full(len(cb), -0.99)
+            hi = np.full(len(cb), 10.0)
+            f_lo = cf_npv(cb, lo)
+            ok = np.sign(f_lo) != np.sign(cf_npv(cb, hi))
+            for _ in range(200):
+                mid = (lo + hi) / 2
+                f_mid = cf_npv(cb, mid)
+                left = np.sign(f_mid) == np.sign(f_lo)
+                lo = np.where(left, mid, lo)
+                f_lo = np.where(left, f_mid, f_lo)
+                hi = np.where(left, hi, mid)
+            r[bad] = np.where(ok, (lo + hi) / 2, np.nan)
+    return _cf_out(r, single)
+
+
+def cf_mirr(cashflows, finance_rate, reinvest_rate):
+    """MIRR = (FV dòng dương theo reinvest_rate / |PV dòng âm theo finance_rate|)^(1/n) - 1."""
+    cf, fr, single = _cf_batch(cashflows, finance_rate)
+    rr = np.broadcast_to(np.asarray(reinvest_rate, dtype=float), fr.shape)
+    n = cf.shape[1] - 1
+    t = np.arange(cf.shape[1], dtype=float)
+    fv_pos = (np.where(cf > 0, cf, 0.0) * (1.0 + rr)[:, None] ** (n - t)).sum(axis=1)
+    pv_neg = (np.where(cf < 0, cf, 0.0) / (1.0 + fr)[:, None] ** t).sum(axis=1)
+    with np.errstate(all="ignore"):
+        out = np.where((pv_neg < 0) & (fv_pos > 0), (fv_pos / -pv_neg) ** (1.0 / max(n, 1)) - 1.0, np.nan)
+    return _cf_out(out, single)
+
+
+def cf_profitability_index(cashflows, rate):
+    """PI = PV(CF_1..n) / |CF_0|."""
+    cf, r, single = _cf_batch(cashflows, rate)
+    pv_future = cf_npv(np.column_stack([np.zeros(len(cf)), cf[:, 1:]]), r)
+    with np.errstate(all="ignore"):
+        out = np.where(cf[:, 0] != 0, pv_future / np.abs(cf[:, 0]), np.nan)
+    return _cf_out(out, single)
+
+
+def cf_payback(cashflows, rate=None):
+    """
+    Thời gian hoàn vốn (năm): rate=None -> giản đơn, có rate -> chiết khấu (DPP).
+    Nội suy trong năm hoàn vốn: (t-1) + |Lũy kế_{t-1}| / CF_t ; NaN nếu chưa hoàn vốn.
+    """
+    cf, r, single = _cf_batch(cashflows, rate)
+    flows = cf if r is None else cf_present_values(cf, r)
+    cum = np.cumsum(flows, axis=1)
+    hit = cum[:, 1:] >= 0
+    found = hit.any(axis=1)
+    k = np.argmax(hit, axis=1) + 1                          # kỳ đầu tiên lũy kế >= 0
+    rows = np.arange(len(cf))
+    prev = cum[rows, k - 1]
+    step = flows[rows, k]
+    with np.errstate(all="ignore"):
+        frac = np.where(step != 0, np.abs(prev) / step, 0.0)
+    out = np.where(found, (k - 1) + frac, np.nan)
+    return _cf_out(out, single)
+
+
+def cashflow_metrics(cashflows, rate, finance_rate=None, reinvest_rate=None, irr_guess=0.1) -> dict:
+    """Gói đủ chỉ tiêu thẩm định cho 1 hoặc nhiều dòng tiền (MIRR mặc định finance = reinvest = rate)."""
+    finance_rate = rate if finance_rate is None else finance_rate
+    reinvest_rate = rate if reinvest_rate is None else reinvest_rate
+    return {
+        "npv": cf_npv(cashflows, rate),
+        "irr": cf_irr(cashflows, irr_guess, n_iter=50),
+        "mirr": cf_mirr(cashflows, finance_rate, reinvest_rate),
+        "pi": cf_profitability_index(cashflows, rate),
+        "payback": cf_payback(cashflows),
+        "dpp": cf_payback(cashflows, rate),
     }
 
-    answers = {
-        "fwd_bid": fwd_bid_i,
-        "fwd_ask": fwd_ask_i,
-        "hedged_cost_vnd": hedged_cost_vnd,
-    }
-    return params, answers
 
-def gen_case_R02(seed: int) -> tuple[dict, dict]:
-    """
-    R02: So sánh Hedge Forward vs Option cho khoản nợ USD
-    - Sinh Spot USD/VND, lãi suất -> tính Forward (ASK)
-    - Sinh Option: strike K, premium (VND/USD)
-    - Sinh kịch bản Spot tại đáo hạn (S_T)
-    Yêu cầu SV: tính chi phí Forward, chi phí Option, và chọn phương án rẻ hơn.
-    """
-    rng = random.Random(int(seed))
+# =========================
+# GENERATOR DSL (không gian tham số khai báo -> sampler vector hoá)
+# =========================
+# Mỗi spec gồm danh sách (tên, nút) theo đúng THỨ TỰ RÚT SỐ của bản viết tay cũ,
+# nhờ đó sample_case(spec, seed) (n=1) tái tạo y nguyên đề cũ theo seed,
+# còn sample_case_batch() dùng cùng định nghĩa để sinh hàng triệu đề một lượt.
+def g_int(lo: int, hi: int, step: int = 1, floor: int = 1, mul: int = 1, div=None, dtype=None) -> dict:
+    """Số nguyên trong [lo, hi) theo bước step; sau đó //floor*floor, *mul, /div."""
+    return {"kind": "int", "lo": lo, "hi": hi, "step": step, "floor": floor,
+            "mul": mul, "div": div, "dtype": dtype}
 
-    usd_amount = rng.randrange(200_000, 2_000_001, 50_000)
-    days = rng.choice([30, 60, 90, 180])
 
-    # Spot USD/VND
-    spot_bid = rng.randrange(23200, 25801, 10)
-    spr = rng.randrange(20, 71, 5)
-    spot_ask = spot_bid + spr
+def g_choice(values) -> dict:
+    """Chọn đều 1 giá trị trong danh sách."""
+    return {"kind": "choice", "values": list(values)}
 
-    # Lãi suất (năm)
-    i_vnd = rng.choice([0.045, 0.050, 0.055, 0.060, 0.065, 0.070, 0.075, 0.080])
-    i_usd = rng.choice([0.020, 0.025, 0.030, 0.035, 0.040, 0.045, 0.050, 0.055])
 
-    t = days / 360.0
-    factor = (1.0 + i_vnd * t) / (1.0 + i_usd * t)
+def g_uniform(lo: float, hi: float) -> dict:
+    return {"kind": "uniform", "lo": lo, "hi": hi}
 
-    fwd_ask = int(round(spot_ask * factor))
-    fwd_bid = int(round(spot_bid * factor))
 
-    # Option: USD Call (DN mua USD để trả nợ)
-    # Strike quanh forward ± (0..200) cho đa dạng
-    strike = int(round(fwd_ask + rng.choice([-200, -100, 0, 100, 200])))
-    premium = rng.choice([30, 40, 50, 60, 70, 80, 100, 120])   # VND/USD
+def g_mix(p: float, a: dict, b: dict) -> dict:
+    """Với xác suất p rút theo nút a, ngược lại theo nút b (chỉ rút nhánh được chọn)."""
+    return {"kind": "mix", "p": p, "a": a, "b": b}
 
-    # Kịch bản Spot tại đáo hạn (S_T ask) quanh forward ± (0..400)
-    sT = int(round(fwd_ask + rng.choice([-400, -250, -150, -50, 50, 150, 250, 400])))
 
-    # Chi phí hedge:
-    forward_cost = int(round(usd_amount * fwd_ask))
+def g_derived(fn, dtype=None) -> dict:
+    """Trường suy ra (vector hoá) từ các cột đã có, không tiêu thụ số ngẫu nhiên."""
+    return {"kind": "derived", "fn": fn, "dtype": dtype}
 
-    # Option cost: trả premium + mua USD theo min(S_T, K) (vì có quyền mua tại K)
-    option_rate = min(sT, strike) + premium  # VND/USD (all-in)
-    option_cost = int(round(usd_amount * option_rate))
 
-    if option_cost < forward_cost:
-        best = "OPTION"
-    elif option_cost > forward_cost:
-        best = "FORWARD"
+def py_round(x, nd: int = 0) -> np.ndarray:
+    """
+    round(x, nd) của Python cho mảng: np.rint cho phần lớn phần tử,
+    các phần tử sát mốc .5 (nơi x*10^nd bị sai số nhị phân) tính lại bằng round() gốc.
+    """
+    x = np.asarray(x, dtype=float)
+    if nd == 0:
+        return np.rint(x)
+    scale = 10.0 ** nd
+    y = x * scale
+    out = np.rint(y) / scale
+    near = np.abs(y - np.floor(y) - 0.5) < 1e-6
+    if near.any():
+        out[near] = [round(float(v), nd) for v in x[near]]
+    return out
+
+
+class _NumpyDraw:
+    """Nguồn rút số từ np.random.Generator (rng.choice(list) == list[rng.integers(0, len)])."""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def integers(self, lo, hi, step, n):
+        if step == 1:
+            return self.rng.integers(lo, hi, size=n)
+        return lo + step * self.rng.integers(0, -(-(hi - lo) // step), size=n)
+
+    def choice(self, values, n):
+        return np.asarray(values)[self.rng.integers(0, len(values), size=n)]
+
+    def uniform(self, lo, hi, n):
+        return self.rng.uniform(lo, hi, size=n)
+
+    def random(self, n):
+        return self.rng.random(n)
+
+
+class _PyRandomDraw:
+    """Nguồn rút số từ random.Random (các bài R01/R02 cũ) - chỉ dùng cho từng đề."""
+
+    def __init__(self, rng):
+        self.rng = rng
+
+    def integers(self, lo, hi, step, n):
+        return np.array([self.rng.randrange(lo, hi, step) for _ in range(n)], dtype=np.int64)
+
+    def choice(self, values, n):
+        return np.asarray([self.rng.choice(values) for _ in range(n)])
+
+    def uniform(self, lo, hi, n):
+        return np.array([self.rng.uniform(lo, hi) for _ in range(n)])
+
+    def random(self, n):
+        return np.array([self.rng.random() for _ in range(n)])
+
+
+def _draw_node(node: dict, draw, n: int, cols: dict) -> np.ndarray:
+    kind = node["kind"]
+    if kind == "int":
+        v = draw.integers(node["lo"], node["hi"], node["step"], n)
+        if node["floor"] != 1:
+            v = v // node["floor"] * node["floor"]
+        if node["mul"] != 1:
+            v = v * node["mul"]
+        if node["div"] is not None:
+            v = v / node["div"]
+    elif kind == "choice":
+        v = draw.choice(node["values"], n)
+    elif kind == "uniform":
+        v = draw.uniform(node["lo"], node["hi"], n)
+    elif kind == "mix":
+        use_a = draw.random(n) < node["p"]
+        v = None
+        for branch, mask in ((node["a"], use_a), (node["b"], ~use_a)):
+            k = int(mask.sum())
+            if k == 0:
+                continue
+            part = _draw_node(branch, draw, k, cols)
+            if v is None:
+                v = np.empty(n, dtype=part.dtype)
+            v[mask] = part
+    elif kind == "derived":
+        v = np.asarray(node["fn"](cols))
+    else:
+        raise ValueError(f"Nút không hợp lệ: {kind}")
+    if node.get("dtype") is not None:
+        v = v.astype(node["dtype"])
+    return v
+
+
+def run_gen_spec(spec: dict, draw, n: int) -> dict:
+    """Chạy spec cho n đề, trả về dict cột (mọi trường kể cả trung gian)."""
+    cols = {}
+    for name, node in spec["fields"]:
+        cols[name] = _draw_node(node, draw, n, cols)
+    return cols
+
+
+def _to_py(v):
+    if isinstance(v, np.bool_):
+        return bool(v)
+    if isinstance(v, np.integer):
+        return int(v)
+    if isinstance(v, np.floating):
+        return float(v)
+    if isinstance(v, np.str_):
+        return str(v)
+    return v
+
+
+def _emit(mapping: dict, cols: dict, i: int) -> dict:
+    return {k: _emit(v, cols, i) if isinstance(v, dict) else _to_py(cols[v][i])
+            for k, v in mapping.items()}
+
+
+def sample_case(spec: dict, seed: int) -> tuple[dict, dict]:
+    """Sinh 1 đề (params, answers) từ spec - tương thích seed với bản gen_case viết tay."""
+    seed = int(seed)
+    if spec.get("seed_mod"):
+        seed %= spec["seed_mod"]
+    if spec.get("rng") == "python":
+        draw = _PyRandomDraw(random.Random(seed))
     else:
-        best = "TIE"
+        draw = _NumpyDraw(np.random.default_rng(seed))
+    cols = run_gen_spec(spec, draw, 1)
+    return _emit(spec["params"], cols, 0), _emit(spec["answers"], cols, 0)
+
+
+D01_SPEC = {
+    "fields": [
+        # USD/VND: bid bội số 10, ask = bid + spread(80..160)
+        ("usd_bid", g_int(2400, 2701, mul=10)),  # 24,000 .. 27,000
+        ("usd_spread", g_choice([80, 90, 100, 110, 120, 130, 140, 150, 160])),
+        ("usd_ask", g_derived(lambda c: c["usd_bid"] + c["usd_spread"])),
+        # EUR/USD bid theo bước 0.0005 (tick = 5 trên thang 1/10000), ask = bid + (0.0010..0.0030)
+        ("eur_bid_ticks", g_int(10200 // 5, 11500 // 5 + 1, mul=5)),
+        ("eur_mark_ticks", g_int(10, 31)),
+        ("eur_bid", g_derived(lambda c: c["eur_bid_ticks"] / 10000)),
+        # cộng theo tick rồi chia == round(eur_bid + eur_mark, 4)
+        ("eur_ask", g_derived(lambda c: (c["eur_bid_ticks"] + c["eur_mark_ticks"]) / 10000)),
+        # Theo code room_1_dealing: cross_bid=eur_bid*usd_bid; cross_ask=eur_ask*usd_ask
+        ("cross_bid", g_derived(lambda c: py_round(c["eur_bid"] * c["usd_bid"]), np.int64)),
+        ("cross_ask", g_derived(lambda c: py_round(c["eur_ask"] * c["usd_ask"]), np.int64)),
+        ("spread", g_derived(lambda c: c["cross_ask"] - c["cross_bid"])),
+    ],
+    "params": {"usd_bid": "usd_bid", "usd_ask": "usd_ask", "eur_bid": "eur_bid", "eur_ask": "eur_ask"},
+    "answers": {"cross_bid": "cross_bid", "cross_ask": "cross_ask", "spread": "spread"},
+}
 
-    params = {
-        "usd_amount": usd_amount,
-        "days": days,
-        "spot_bid": spot_bid,
-        "spot_ask": spot_ask,
-        "i_vnd": i_vnd,
-        "i_usd": i_usd,
-        "fwd_bid": fwd_bid,
-        "fwd_ask": fwd_ask,
-        "strike": strike,
-        "premium": premium,
-        "spot_T": sT,
-    }
 
-    answers = {
-        "forward_cost": forward_cost,
-        "option_cost": option_cost,
-        "best_choice": best,  # "FORWARD" | "OPTION" | "TIE"
-    }
-    return params, answers
+def gen_case_D01(seed: int) -> tuple[dict, dict]:
+    """
+    D01: Cross-rate EUR/VND từ EUR/USD & USD/VND (Bid/Ask/Spread)
+    Trả về (params, answers)
+    """
+    return sample_case(D01_SPEC, seed)
 
-def gen_case_T01(seed: int) -> tuple[dict, dict]:
-    rng = np.random.default_rng(int(seed))
+import numpy as np
 
-    # Invoice & kỳ hạn
-    amount_usd = int(rng.integers(20_000, 200_001) // 1000 * 1000)   # bội 1,000
-    tenor_days = int(rng.choice([30, 60, 90, 120]))
+def _d02_profit_a(c: dict) -> np.ndarray:
+    """A: EUR rẻ direct -> mua EUR direct (ask), bán EUR->USD (bid), bán USD->VND (bid)."""
+    start = c["start_vnd"]
+    end_vnd = start / c["eurvnd_ask"] * c["eur_bid"] * c["usd_bid"]
+    return np.where(c["eurvnd_ask"] < c["implied_bid_f"], py_round(end_vnd - start), 0).astype(np.int64)
+
+
+def _d02_profit_b(c: dict) -> np.ndarray:
+    """B: EUR đắt direct -> mua EUR qua cross, bán EUR direct (bid)."""
+    start = c["start_vnd"]
+    end_vnd = start / c["usd_ask"] / c["eur_ask"] * c["eurvnd_bid"]
+    return np.where(c["eurvnd_bid"] > c["implied_ask_f"], py_round(end_vnd - start), 0).astype(np.int64)
+
+
+def _d02_pick(c: dict) -> np.ndarray:
+    """Chọn đáp án đúng nhất: A nếu lãi A > 0 và >= B, B nếu lãi B > 0, còn lại C."""
+    pick_a = (c["profit_a"] > 0) & (c["profit_a"] >= c["profit_b"])
+    return np.where(pick_a, "A", np.where(c["profit_b"] > 0, "B", "C"))
+
+
+D02_SPEC = {
+    "seed_mod": 2_000_000_000,  # an toàn bigint
+    "fields": [
+        # 1) Báo giá USD/VND, spread 10–60
+        ("usd_bid", g_int(23500, 25501)),
+        ("usd_spread", g_int(10, 61)),
+        ("usd_ask", g_derived(lambda c: c["usd_bid"] + c["usd_spread"])),
+        # 2) Báo giá EUR/USD 1.0200–1.1500, ask = bid + 0.0010..0.0040
+        ("eur_bid_ticks", g_int(10200, 11501)),
+        ("eur_mark_ticks", g_int(10, 41)),
+        ("eur_bid", g_derived(lambda c: c["eur_bid_ticks"] / 10000)),
+        ("eur_ask", g_derived(lambda c: (c["eur_bid_ticks"] + c["eur_mark_ticks"]) / 10000)),
+        # 3) Cross implied EUR/VND
+        ("implied_bid_f", g_derived(lambda c: c["eur_bid"] * c["usd_bid"])),
+        ("implied_ask_f", g_derived(lambda c: c["eur_ask"] * c["usd_ask"])),
+        # 4) Market EUR/VND direct lệch khỏi mid: thường nhỏ, đôi lúc lớn để chắc có arbitrage
+        ("spread_eurvnd", g_int(40, 121)),
+        ("delta", g_mix(0.55, g_int(-120, 121), g_int(-600, 601))),
+        ("raw_bid", g_derived(lambda c: py_round(
+            (c["implied_bid_f"] + c["implied_ask_f"]) / 2 + c["delta"] - c["spread_eurvnd"] / 2), np.int64)),
+        ("eurvnd_bid", g_derived(lambda c: np.maximum(c["raw_bid"], 1000))),
+        ("eurvnd_ask", g_derived(lambda c: np.maximum(c["raw_bid"] + c["spread_eurvnd"], c["eurvnd_bid"] + 1))),
+        # 5) Vốn ban đầu 200m–1.2b
+        ("start_vnd", g_int(200_000_000, 1_200_000_000)),
+        # 6) Xác định arbitrage
+        ("profit_a", g_derived(_d02_profit_a)),
+        ("profit_b", g_derived(_d02_profit_b)),
+        ("correct_option", g_derived(_d02_pick)),
+        ("profit_vnd", g_derived(lambda c: np.select(
+            [c["correct_option"] == "A", c["correct_option"] == "B"], [c["profit_a"], c["profit_b"]], 0))),
+        ("implied_bid", g_derived(lambda c: py_round(c["implied_bid_f"]), np.int64)),
+        ("implied_ask", g_derived(lambda c: py_round(c["implied_ask_f"]), np.int64)),
+    ],
+    "params": {
+        "usd_bid": "usd_bid", "usd_ask": "usd_ask",
+        "eur_bid": "eur_bid", "eur_ask": "eur_ask",
+        "eurvnd_bid": "eurvnd_bid", "eurvnd_ask": "eurvnd_ask",
+        "start_vnd": "start_vnd",
+    },
+    "answers": {
+        "correct_option": "correct_option",   # A/B/C
+        "profit_vnd": "profit_vnd",
+        "implied_bid": "implied_bid",
+        "implied_ask": "implied_ask",
+    },
+}
 
-    # Lãi suất cơ hội (nếu trả sớm sẽ mất lãi cơ hội)
-    opp_rate = float(rng.uniform(0.04, 0.09))  # 4% -> 9%
 
-    # --- Fees ---
-    # T/T
-    tt_fixed = float(rng.integers(10, 31))  # USD
-    tt_pct = float(rng.choice([0.0005, 0.0010, 0.0015, 0.0020]))  # 0.05% -> 0.20%
+def gen_case_D02(seed: int) -> tuple[dict, dict]:
+    """
+    D02 — Tam giác VND–USD–EUR.
+    Cho 3 báo giá: USD/VND, EUR/USD, EUR/VND (direct).
+    Hỏi: Có arbitrage không? Nếu có thì theo hướng nào và lợi nhuận (VND) với số vốn ban đầu.
+    """
+    return sample_case(D02_SPEC, seed)
 
-    # Nhờ thu (D/A)
-    da_fixed = float(rng.integers(20, 61))
-    da_pct = float(rng.choice([0.0008, 0.0012, 0.0018, 0.0025]))  # 0.08% -> 0.25%
+R_SPOT_FIELDS = [
+    ("usd_amount", g_int(200_000, 2_000_001, step=50_000)),    # USD nợ
+    ("days", g_choice([30, 60, 90, 180])),                      # kỳ hạn (ngày)
+    # Spot USD/VND (BID/ASK) - step 10 VND
+    ("spot_bid", g_int(23200, 25801, step=10)),
+    ("spot_spread", g_int(20, 71, step=5)),
+    ("spot_ask", g_derived(lambda c: c["spot_bid"] + c["spot_spread"])),
+    # Lãi suất năm (decimal)
+    ("i_vnd", g_choice([0.045, 0.050, 0.055, 0.060, 0.065, 0.070, 0.075, 0.080])),
+    ("i_usd", g_choice([0.020, 0.025, 0.030, 0.035, 0.040, 0.045, 0.050, 0.055])),
+    ("irp_factor", g_derived(lambda c: growth_factor(c["i_vnd"], year_fraction(days=c["days"]))
+                                       / growth_factor(c["i_usd"], year_fraction(days=c["days"])))),
+    ("fwd_bid", g_derived(lambda c: py_round(c["spot_bid"] * c["irp_factor"]), np.int64)),  # làm tròn đến VND
+    ("fwd_ask", g_derived(lambda c: py_round(c["spot_ask"] * c["irp_factor"]), np.int64)),
+]
+
+R01_SPEC = {
+    "rng": "python",
+    "fields": R_SPOT_FIELDS + [
+        # Hedge khoản nợ USD => DN cần MUA USD tương lai => dùng Forward ASK
+        ("hedged_cost_vnd", g_derived(lambda c: c["usd_amount"] * c["fwd_ask"])),
+    ],
+    "params": {
+        "usd_amount": "usd_amount", "days": "days",
+        "spot_bid": "spot_bid", "spot_ask": "spot_ask",
+        "i_vnd": "i_vnd", "i_usd": "i_usd",
+    },
+    "answers": {"fwd_bid": "fwd_bid", "fwd_ask": "fwd_ask", "hedged_cost_vnd": "hedged_cost_vnd"},
+}
 
-    # L/C trả chậm
-    lc_fixed = float(rng.integers(50, 121))
-    lc_pct_per_quarter = float(rng.choice([0.0015, 0.0020, 0.0025, 0.0035, 0.0040]))  # 0.15% -> 0.40% / quý
-    lc_margin = float(rng.choice([0.05, 0.10, 0.15, 0.20]))  # ký quỹ 5% -> 20%
-    quarters = int(math.ceil(tenor_days / 90))
+R02_SPEC = {
+    "rng": "python",
+    "fields": R_SPOT_FIELDS + [
+        # Option USD Call: strike quanh forward ± (0..200), premium VND/USD
+        ("_strike_off", g_choice([-200, -100, 0, 100, 200])),
+        ("strike", g_derived(lambda c: c["fwd_ask"] + c["_strike_off"])),
+        ("premium", g_choice([30, 40, 50, 60, 70, 80, 100, 120])),
+        # Kịch bản Spot tại đáo hạn (S_T ask) quanh forward ± (0..400)
+        ("_spot_T_off", g_choice([-400, -250, -150, -50, 50, 150, 250, 400])),
+        ("spot_T", g_derived(lambda c: c["fwd_ask"] + c["_spot_T_off"])),
+        ("forward_cost", g_derived(lambda c: c["usd_amount"] * c["fwd_ask"])),
+        # Option: trả premium + mua USD theo min(S_T, K)
+        ("option_cost", g_derived(lambda c: c["usd_amount"] * (np.minimum(c["spot_T"], c["strike"]) + c["premium"]))),
+        ("best_choice", g_derived(lambda c: np.select(
+            [c["option_cost"] < c["forward_cost"], c["option_cost"] > c["forward_cost"]],
+            ["OPTION", "FORWARD"], "TIE"))),
+    ],
+    "params": {
+        "usd_amount": "usd_amount", "days": "days",
+        "spot_bid": "spot_bid", "spot_ask": "spot_ask",
+        "i_vnd": "i_vnd", "i_usd": "i_usd",
+        "fwd_bid": "fwd_bid", "fwd_ask": "fwd_ask",
+        "strike": "strike", "premium": "premium", "spot_T": "spot_T",
+    },
+    "answers": {
+        "forward_cost": "forward_cost",
+        "option_cost": "option_cost",
+        "best_choice": "best_choice",  # "FORWARD" | "OPTION" | "TIE"
+    },
+}
 
-    # --- Cost model (USD) ---
-    # T/T: trả ngay => opportunity cost trên toàn bộ invoice trong tenor_days
-    opp_cost_tt = amount_usd * opp_rate * (tenor_days / 360.0)
-    cost_tt = tt_fixed + tt_pct * amount_usd + opp_cost_tt
 
-    # D/A: trả cuối kỳ => giả định không mất opp cost (chỉ fee)
-    cost_da = da_fixed + da_pct * amount_usd
+def gen_case_R01(seed: int) -> tuple[dict, dict]:
+    """
+    R01: Tính tỷ giá kỳ hạn theo IRP + chi phí hedge Forward cho khoản nợ USD.
+    Output:
+      - params: dữ liệu đề bài
+      - answers: đáp án chuẩn
+    """
+    return sample_case(R01_SPEC, seed)
 
-    # L/C trả chậm: phí mở theo quý + fixed + opp cost trên phần ký quỹ
-    opp_cost_margin = amount_usd * lc_margin * opp_rate * (tenor_days / 360.0)
-    cost_lc = lc_fixed + (lc_pct_per_quarter * quarters * amount_usd) + opp_cost_margin
+def gen_case_R02(seed: int) -> tuple[dict, dict]:
+    """
+    R02: So sánh Hedge Forward vs Option cho khoản nợ USD
+    - Sinh Spot USD/VND, lãi suất -> tính Forward (ASK)
+    - Sinh Option: strike K, premium (VND/USD)
+    - Sinh kịch bản Spot tại đáo hạn (S_T)
+    Yêu cầu SV: tính chi phí Forward, chi phí Option, và chọn phương án rẻ hơn.
+    """
+    return sample_case(R02_SPEC, seed)
+
+T01_SPEC = {
+    "fields": [
+        # Invoice & kỳ hạn
+        ("amount_usd", g_int(20_000, 200_001, floor=1000)),   # bội 1,000
+        ("tenor_days", g_choice([30, 60, 90, 120])),
+        # Lãi suất cơ hội (nếu trả sớm sẽ mất lãi cơ hội) 4% -> 9%
+        ("opp_rate", g_uniform(0.04, 0.09)),
+        # T/T
+        ("tt_fixed", g_int(10, 31, dtype=float)),  # USD
+        ("tt_pct", g_choice([0.0005, 0.0010, 0.0015, 0.0020])),  # 0.05% -> 0.20%
+        # Nhờ thu (D/A)
+        ("da_fixed", g_int(20, 61, dtype=float)),
+        ("da_pct", g_choice([0.0008, 0.0012, 0.0018, 0.0025])),  # 0.08% -> 0.25%
+        # L/C trả chậm
+        ("lc_fixed", g_int(50, 121, dtype=float)),
+        ("lc_pct_per_quarter", g_choice([0.0015, 0.0020, 0.0025, 0.0035, 0.0040])),  # 0.15% -> 0.40% / quý
+        ("lc_margin", g_choice([0.05, 0.10, 0.15, 0.20])),  # ký quỹ 5% -> 20%
+        ("quarters", g_derived(lambda c: -(-c["tenor_days"] // 90))),
+        # --- Cost model (USD) ---
+        # T/T: trả ngay => opportunity cost trên toàn bộ invoice trong tenor_days
+        ("cost_tt", g_derived(lambda c: py_round(
+            c["tt_fixed"] + c["tt_pct"] * c["amount_usd"]
+            + simple_interest(c["amount_usd"], c["opp_rate"], year_fraction(days=c["tenor_days"])), 2))),
+        # D/A: trả cuối kỳ => giả định không mất opp cost (chỉ fee)
+        ("cost_da", g_derived(lambda c: py_round(c["da_fixed"] + c["da_pct"] * c["amount_usd"], 2))),
+        # L/C trả chậm: phí mở theo quý + fixed + opp cost trên phần ký quỹ
+        ("cost_lc", g_derived(lambda c: py_round(
+            c["lc_fixed"] + (c["lc_pct_per_quarter"] * c["quarters"] * c["amount_usd"])
+            + simple_interest(c["amount_usd"] * c["lc_margin"], c["opp_rate"], year_fraction(days=c["tenor_days"])), 2))),
+        ("best_method", g_derived(lambda c: np.array(["TT", "DA", "LC"])[
+            np.argmin(np.column_stack([c["cost_tt"], c["cost_da"], c["cost_lc"]]), axis=1)])),
+        ("min_cost", g_derived(lambda c: np.minimum(np.minimum(c["cost_tt"], c["cost_da"]), c["cost_lc"]))),
+    ],
+    "params": {
+        "amount_usd": "amount_usd", "tenor_days": "tenor_days", "opp_rate": "opp_rate",
+        "tt_fixed": "tt_fixed", "tt_pct": "tt_pct",
+        "da_fixed": "da_fixed", "da_pct": "da_pct",
+        "lc_fixed": "lc_fixed", "lc_pct_per_quarter": "lc_pct_per_quarter",
+        "lc_margin": "lc_margin", "quarters": "quarters",
+    },
+    "answers": {
+        "best_method": "best_method",   # "TT" | "DA" | "LC"
+        "costs": {"TT": "cost_tt", "DA": "cost_da", "LC": "cost_lc"},
+        "min_cost": "min_cost",
+    },
+}
 
-    costs = {
-        "TT": round(cost_tt, 2),
-        "DA": round(cost_da, 2),
-        "LC": round(cost_lc, 2),
-    }
-    best_method = min(costs, key=costs.get)
 
-    params = {
-        "amount_usd": amount_usd,
-        "tenor_days": tenor_days,
-        "opp_rate": opp_rate,
-        "tt_fixed": tt_fixed,
-        "tt_pct": tt_pct,
-        "da_fixed": da_fixed,
-        "da_pct": da_pct,
-        "lc_fixed": lc_fixed,
-        "lc_pct_per_quarter": lc_pct_per_quarter,
-        "lc_margin": lc_margin,
-        "quarters": quarters,
-    }
-    answers = {
-        "best_method": best_method,   # "TT" | "DA" | "LC"
-        "costs": costs,
-        "min_cost": costs[best_method],
-    }
-    return params, answers
+def gen_case_T01(seed: int) -> tuple[dict, dict]:
+    return sample_case(T01_SPEC, seed)
 
 from datetime import date, timedelta
 
@@ -553,7 +1063,7 @@ def gen_case_T02(seed: int) -> tuple[dict, dict]:
         "bl_ship_date": latest_ship,          # sẽ bị đổi nếu sai
         "bl_port_load": port_load,
         "bl_port_discharge": port_discharge,
-        "bl_originals": int(rng.choice([1, 2, 3])),  # sẽ bị đổi nếu sai
+        "bl_originals": 3,                    # đủ bộ theo L/C; sẽ bị đổi nếu sai
 
         "insurance_present": True if incoterm == "CIF" else bool(rng.choice([True, False])),
         "insurance_coverage_pct": 110 if incoterm == "CIF" else int(rng.choice([0, 100, 110])),
@@ -579,10 +1089,16 @@ def gen_case_T02(seed: int) -> tuple[dict, dict]:
         ("T02-10", "Thiếu Packing List"),
     ]
 
-    # Random số sai biệt (1-3)
+    # Random số sai biệt (1-3), chỉ trong các sai biệt áp dụng được cho bộ này
+    # (như gen_t02_batch): bảo hiểm chỉ xét với CIF, 06 và 07 loại trừ nhau
+    if incoterm == "CIF":
+        excluded = {"T02-07"} if rng.random() < 0.5 else {"T02-06"}
+    else:
+        excluded = {"T02-06", "T02-07"}
+    applicable = [code for code, _ in DISCREPANCY_POOL if code not in excluded]
     k = int(rng.integers(1, 4))
-    chosen = rng.choice(len(DISCREPANCY_POOL), size=k, replace=False)
-    chosen_codes = [DISCREPANCY_POOL[i][0] for i in chosen]
+    chosen = rng.choice(len(applicable), size=k, replace=False)
+    chosen_codes = [applicable[i] for i in chosen]
 
     # --- Apply sai biệt vào bộ chứng từ ---
     # 01: invoice amount vượt tolerance
@@ -601,7 +1117,7 @@ def gen_case_T02(seed: int) -> tuple[dict, dict]:
 
     # 04: thiếu originals
     if "T02-04" in chosen_codes:
-        presented["bl_originals"] = int(rng.choice([0, 1]))  # thiếu rõ
+        presented["bl_originals"] = int(rng.choice([0, 1, 2]))  # thiếu so với 3 bản yêu cầu
 
     # 05: sai cảng
     if "T02-05" in chosen_codes:
@@ -652,304 +1168,2439 @@ def gen_case_T02(seed: int) -> tuple[dict, dict]:
         "discrepancy_pool": DISCREPANCY_POOL,  # để render options đồng nhất
     }
 
-    answers = {
-        "correct_codes": sorted(chosen_codes),
+    answers = {
+        "correct_codes": sorted(chosen_codes),
+    }
+
+    return params, answers
+
+I01_SPEC = {
+    "fields": [
+        # Initial investment (USD)
+        ("I0", g_int(80_000, 200_001, floor=1000)),
+        # 3-year cash flows (USD)
+        ("cf1", g_int(30_000, 90_001, floor=1000)),
+        ("cf2", g_int(30_000, 90_001, floor=1000)),
+        ("cf3", g_int(30_000, 90_001, floor=1000)),
+        # Discount rate (USD) 8% - 15%
+        ("r", g_int(8, 16, div=100.0)),
+        ("npv", g_derived(lambda c: py_round(cf_npv(
+            np.column_stack([-c["I0"], c["cf1"], c["cf2"], c["cf3"]]), c["r"])), np.int64)),  # làm tròn USD
+        ("decision", g_derived(lambda c: np.where(c["npv"] > 0, "ACCEPT", "REJECT"))),
+    ],
+    "params": {"I0": "I0", "cf1": "cf1", "cf2": "cf2", "cf3": "cf3", "r": "r"},  # r decimal, ví dụ 0.12
+    "answers": {"npv": "npv", "decision": "decision"},
+}
+
+
+def gen_case_I01(seed: int) -> tuple[dict, dict]:
+    return sample_case(I01_SPEC, seed)
+
+# Phân phối độ khó của I02: nhãn -> (trọng số, |IRR - WACC| min, max) theo decimal.
+# Sinh chênh lệch trước rồi dựng dòng tiền khớp IRR mục tiêu -> không cần regen.
+I02_DIFFICULTY = {
+    "EASY":   (0.3, 0.06, 0.12),
+    "MEDIUM": (0.4, 0.03, 0.06),
+    "HARD":   (0.3, 0.01, 0.03),
+}
+I02_CF_RANGES = ((25_000, 90_001), (25_000, 95_001), (25_000, 100_001), (25_000, 110_001))
+
+
+def sample_i02_cases(rng, n: int, difficulty_weights: dict | None = None) -> dict:
+    """
+    Sinh n case I02 dạng cột bằng cách dựng ngược:
+    WACC -> độ khó -> chênh lệch IRR-WACC (có dấu) -> IRR mục tiêu
+    -> CF1..CF4 ngẫu nhiên -> I0 = PV(CF, IRR mục tiêu) làm tròn nghìn USD.
+    IRR đáp án tính lại từ dòng tiền nguyên sau làm tròn; sai lệch do làm tròn
+    (< 0.3 điểm %) nhỏ hơn chênh lệch tối thiểu nên quyết định không bị đảo.
+    """
+    levels = list(I02_DIFFICULTY)
+    weights = difficulty_weights or {k: v[0] for k, v in I02_DIFFICULTY.items()}
+    w = np.array([float(weights.get(k, 0.0)) for k in levels])
+    w = w / w.sum()
+    lo = np.array([I02_DIFFICULTY[k][1] for k in levels])
+    hi = np.array([I02_DIFFICULTY[k][2] for k in levels])
+
+    wacc = rng.integers(8, 17, size=n) / 100.0
+    level = rng.choice(len(levels), size=n, p=w)
+    sign = np.where(rng.random(n) < 0.5, 1.0, -1.0)
+    gap = sign * (lo[level] + rng.random(n) * (hi[level] - lo[level]))
+    target = wacc + gap
+
+    cfs = np.column_stack([rng.integers(a, b, size=n) // 1000 * 1000 for a, b in I02_CF_RANGES])
+    pv = cf_npv(np.column_stack([np.zeros(n), cfs]), target)
+    I0 = (np.rint(pv / 1000.0) * 1000).astype(np.int64)
+
+    flows = np.column_stack([-I0, cfs])
+    irr = cf_irr(flows, target, n_iter=8)
+    return {
+        "I0": I0, "cfs": cfs, "wacc": wacc, "irr": irr,
+        "target_irr": target, "level": np.array(levels)[level],
+    }
+
+
+def gen_case_I02(seed: int, difficulty_weights: dict | None = None) -> tuple[dict, dict]:
+    rng = np.random.default_rng(int(seed))
+    b = sample_i02_cases(rng, 1, difficulty_weights)
+
+    I0 = int(b["I0"][0])
+    cf1, cf2, cf3, cf4 = (int(x) for x in b["cfs"][0])
+    wacc = float(b["wacc"][0])
+    irr = float(b["irr"][0])
+    cashflows = [-I0, cf1, cf2, cf3, cf4]
+
+    irr_pct = float(irr) * 100.0
+    irr_pct_round = round(irr_pct, 2)  # làm tròn 2 chữ số thập phân
+
+    decision = "ACCEPT" if irr > wacc else "REJECT"
+
+    params = {
+        "I0": I0,
+        "cf1": cf1, "cf2": cf2, "cf3": cf3, "cf4": cf4,
+        "wacc": wacc,              # decimal
+        "cashflows": cashflows,    # lưu để debug/học
+        "difficulty": str(b["level"][0]),
+    }
+    answers = {
+        "irr_pct": irr_pct_round,  # %
+        "decision": decision,
+    }
+    return params, answers
+
+
+def validate_i02_generator(n: int = 1_000_000, seed: int = 0,
+                           difficulty_weights: dict | None = None) -> pd.DataFrame:
+    """
+    Kiểm tra gen I02 trên n case sinh theo lô: IRR hội tụ (NPV(IRR) ~ 0),
+    quyết định khớp dấu chênh lệch mục tiêu, chênh lệch thực tế nằm trong
+    dải của mức độ khó (cho phép sai số làm tròn I0), tần suất từng mức ~ trọng số.
+    """
+    b = sample_i02_cases(np.random.default_rng(int(seed)), int(n), difficulty_weights)
+    npv_at_irr = cf_npv(np.column_stack([-b["I0"], b["cfs"]]), b["irr"])
+    gap = b["irr"] - b["wacc"]
+    sign_ok = np.sign(gap) == np.sign(b["target_irr"] - b["wacc"])
+
+    weights = difficulty_weights or {k: v[0] for k, v in I02_DIFFICULTY.items()}
+    w_total = sum(float(weights.get(k, 0.0)) for k in I02_DIFFICULTY)
+    rows = []
+    for k, (_, g_lo, g_hi) in I02_DIFFICULTY.items():
+        m = b["level"] == k
+        g = np.abs(gap[m])
+        rows.append({
+            "Mức": k,
+            "Trọng số": float(weights.get(k, 0.0)) / w_total,
+            "Tần suất": float(m.mean()),
+            "|IRR-WACC| min (%)": float(g.min() * 100) if m.any() else np.nan,
+            "|IRR-WACC| max (%)": float(g.max() * 100) if m.any() else np.nan,
+            "Trong dải (%)": float(((g >= g_lo - 0.005) & (g <= g_hi + 0.005)).mean() * 100) if m.any() else np.nan,
+            "Quyết định đúng dấu (%)": float(sign_ok[m].mean() * 100) if m.any() else np.nan,
+            "Max |NPV(IRR)|": float(np.abs(npv_at_irr[m]).max()) if m.any() else np.nan,
+        })
+    return pd.DataFrame(rows)
+
+M01_SPEC = {
+    "seed_mod": 2_000_000_000,  # tránh seed quá lớn (an toàn cho DB nếu bạn có lưu seed)
+    "fields": [
+        ("debt_usd_bn", g_int(20, 101)),  # 20..100 (tỷ USD)
+        ("base_rate", g_int(23000, 27001, floor=50)),  # bội 50 cho “đẹp”
+        ("shock_pct", g_choice([5.0, 7.0, 10.0, 12.0, 15.0, 18.0, 20.0, 25.0, 30.0])),
+        ("new_rate", g_derived(lambda c: py_round(c["base_rate"] * (1 + c["shock_pct"] / 100)), np.int64)),
+        # Quy đổi đơn vị: debt_usd_bn (tỷ USD) * base_rate (VND/USD) -> nghìn tỷ VND vì: bn * rate / 1000
+        ("base_debt_tril", g_derived(lambda c: py_round(c["debt_usd_bn"] * c["base_rate"] / 1000, 1))),
+        ("new_debt_tril", g_derived(lambda c: py_round(c["debt_usd_bn"] * c["new_rate"] / 1000, 1))),
+        ("increase_tril", g_derived(lambda c: py_round(c["new_debt_tril"] - c["base_debt_tril"], 1))),
+    ],
+    "params": {"debt_usd_bn": "debt_usd_bn", "base_rate": "base_rate", "shock_pct": "shock_pct"},
+    "answers": {
+        "new_rate": "new_rate",
+        "increase_tril": "increase_tril",
+        "base_debt_tril": "base_debt_tril",
+        "new_debt_tril": "new_debt_tril",
+    },
+}
+
+
+def gen_case_M01(seed: int) -> tuple[dict, dict]:
+    """
+    M01: Cú sốc tỷ giá lên nợ công
+    - Random: nợ nước ngoài (tỷ USD), tỷ giá gốc, shock %
+    - Yêu cầu SV tính: tỷ giá mới, gánh nặng tăng thêm (nghìn tỷ VND)
+    """
+    return sample_case(M01_SPEC, seed)
+
+
+M02_SPEC = {
+    "seed_mod": 2_000_000_000,
+    "fields": [
+        # Notional vay JPY (triệu JPY -> đổi ra JPY)
+        ("notional_mjpy", g_int(50, 301)),          # 50..300 (million JPY)
+        ("notional_jpy", g_derived(lambda c: c["notional_mjpy"] * 1_000_000)),
+        # Spot JPY/VND (VND/JPY)
+        ("s0", g_int(160, 211, div=10)),             # 16.0 .. 21.0 (VND/JPY)
+        # Lãi suất năm
+        ("i_vnd", g_choice([0.05, 0.06, 0.07, 0.08, 0.09, 0.10])),
+        ("i_jpy", g_choice([0.001, 0.003, 0.005, 0.01, 0.015, 0.02])),
+        ("horizon_days", g_choice([30, 60, 90])),
+        # Shock: JPY mạnh lên so với VND => VND/JPY (s) tăng
+        ("shock_pct", g_choice([3.0, 5.0, 8.0, 10.0, 12.0, 15.0])),
+        ("s1", g_derived(lambda c: c["s0"] * (1 + c["shock_pct"] / 100))),
+        # Vốn tự có + ngưỡng margin call
+        ("equity_vnd", g_int(100, 401, mul=1_000_000)),  # 100..400 triệu VND
+        ("margin_trigger", g_choice([0.10, 0.15])),      # 10% hoặc 15%
+        # ---- Tính đáp án ----
+        ("vnd_open_f", g_derived(lambda c: c["notional_jpy"] * c["s0"])),
+        ("vnd_end", g_derived(lambda c: c["vnd_open_f"] * growth_factor(c["i_vnd"], year_fraction(days=c["horizon_days"])))),
+        ("jpy_debt", g_derived(lambda c: c["notional_jpy"] * growth_factor(c["i_jpy"], year_fraction(days=c["horizon_days"])))),
+        # P/L: VND cuối kỳ đổi lại JPY theo s1 trừ nợ JPY, định giá theo tỷ giá unwind
+        ("pl_vnd_f", g_derived(lambda c: (c["vnd_end"] / c["s1"] - c["jpy_debt"]) * c["s1"])),
+        ("loss_pct", g_derived(lambda c: np.maximum(0.0, -c["pl_vnd_f"]) / np.maximum(1.0, c["equity_vnd"]))),
+        ("margin_call", g_derived(lambda c: c["loss_pct"] >= c["margin_trigger"])),
+        # Làm tròn để chấm dễ (VND làm tròn 1,000)
+        ("vnd_open", g_derived(lambda c: py_round(c["vnd_open_f"] / 1000) * 1000, np.int64)),
+        ("pl_vnd", g_derived(lambda c: py_round(c["pl_vnd_f"] / 1000) * 1000, np.int64)),
+    ],
+    "params": {
+        "notional_mjpy": "notional_mjpy", "notional_jpy": "notional_jpy",
+        "s0": "s0", "i_vnd": "i_vnd", "i_jpy": "i_jpy",
+        "horizon_days": "horizon_days", "shock_pct": "shock_pct", "s1": "s1",
+        "equity_vnd": "equity_vnd", "margin_trigger": "margin_trigger",
+    },
+    "answers": {
+        "vnd_open": "vnd_open",
+        "pl_vnd": "pl_vnd",
+        "margin_call": "margin_call",
+        # thêm vài số để debug/giải thích nếu cần
+        "vnd_end": "vnd_end",
+        "jpy_debt": "jpy_debt",
+        "loss_pct": "loss_pct",
+    },
+}
+
+
+def gen_case_M02(seed: int) -> tuple[dict, dict]:
+    """
+    M02: Carry Trade Unwind (Option A)
+    SV nhập:
+    1) VND nhận được khi mở carry (JPY->VND)
+    2) P/L (VND) sau horizon_days khi JPY mạnh lên shock_pct
+    3) Margin call? dựa equity_vnd và margin_trigger
+    """
+    return sample_case(M02_SPEC, seed)
+
+#======= KẾT THÚC CÁC HÀM gen_case ======
+
+GEN_SPECS = {
+    "D01": D01_SPEC, "D02": D02_SPEC,
+    "R01": R01_SPEC, "R02": R02_SPEC,
+    "T01": T01_SPEC,
+    "I01": I01_SPEC,
+    "M01": M01_SPEC, "M02": M02_SPEC,
+}
+
+
+def sample_case_batch(ex_code: str, n: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Sinh n đề của 1 bài dạng bảng (1 dòng/đề, gồm cả trường trung gian) để phân tích phân phối.
+    Dùng chung spec với gen_case_*; batch rút từ 1 Generator duy nhất nên không trùng đề theo seed SV.
+    T02/I02 đã có sampler vector hoá riêng (gen_t02_batch / sample_i02_cases).
+    """
+    ex_code = str(ex_code).strip().upper()
+    rng = np.random.default_rng(int(seed))
+    if ex_code in GEN_SPECS:
+        return pd.DataFrame(run_gen_spec(GEN_SPECS[ex_code], _NumpyDraw(rng), int(n)))
+    if ex_code == "I02":
+        b = sample_i02_cases(rng, int(n))
+        df = pd.DataFrame(b["cfs"], columns=["cf1", "cf2", "cf3", "cf4"])
+        df.insert(0, "I0", b["I0"])
+        df["wacc"] = b["wacc"]
+        df["difficulty"] = b["level"]
+        df["irr_pct"] = np.round(b["irr"] * 100, 2)
+        df["decision"] = np.where(b["irr"] > b["wacc"], "ACCEPT", "REJECT")
+        return df
+    if ex_code == "T02":
+        return t02_batch_to_frame(gen_t02_batch(int(n), int(seed)))
+    raise ValueError(f"Không có sampler cho bài {ex_code}")
+
+
+# =========================
+# CASE RECORDS: params/answers có kiểu (dataclass + __slots__) + schema version
+# =========================
+CASE_SCHEMA_VERSION = 1
+
+
+def _json_safe(x):
+    """Chuyển date/NumPy scalar/tuple về kiểu JSON thuần (để ghi params_json/answer_json)."""
+    if isinstance(x, dict):
+        return {k: _json_safe(v) for k, v in x.items()}
+    if isinstance(x, (list, tuple)):
+        return [_json_safe(v) for v in x]
+    if isinstance(x, date):
+        return x.isoformat()
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+
+@dataclass(slots=True)
+class CaseRecord:
+    """
+    Lớp gốc cho params/answers của từng bài.
+    - to_json(): dict JSON thuần + khóa "_v" (schema version)
+    - from_json(): đọc dict từ DB (kể cả bản ghi cũ chưa có "_v"), bỏ khóa lạ, thiếu khóa -> mặc định
+    """
+
+    def to_json(self) -> dict:
+        d = {k: _json_safe(getattr(self, k)) for k in self.__slots__}
+        d["_v"] = CASE_SCHEMA_VERSION
+        return d
+
+    @classmethod
+    def migrate(cls, data: dict, version: int) -> dict:
+        """Nâng cấp dict từ schema cũ. v0 (dict tự do trước khi có record) trùng tên khóa với v1."""
+        return data
+
+    @classmethod
+    def from_json(cls, data):
+        data = dict(data or {})
+        version = int(data.pop("_v", 0) or 0)
+        if version < CASE_SCHEMA_VERSION:
+            data = cls.migrate(data, version)
+        return cls(**{k: data[k] for k in cls.__slots__ if k in data and data[k] is not None})
+
+
+@dataclass(slots=True)
+class D01Params(CaseRecord):
+    usd_bid: int = 0
+    usd_ask: int = 0
+    eur_bid: float = 0.0
+    eur_ask: float = 0.0
+
+
+@dataclass(slots=True)
+class D01Answers(CaseRecord):
+    cross_bid: int = 0
+    cross_ask: int = 0
+    spread: int = 0
+
+
+@dataclass(slots=True)
+class D02Params(CaseRecord):
+    usd_bid: int = 0
+    usd_ask: int = 0
+    eur_bid: float = 0.0
+    eur_ask: float = 0.0
+    eurvnd_bid: int = 0
+    eurvnd_ask: int = 0
+    start_vnd: int = 0
+
+
+@dataclass(slots=True)
+class D02Answers(CaseRecord):
+    correct_option: str = "-"
+    profit_vnd: int = 0
+    implied_bid: int = 0
+    implied_ask: int = 0
+
+
+@dataclass(slots=True)
+class R01Params(CaseRecord):
+    usd_amount: int = 0
+    days: int = 0
+    spot_bid: int = 0
+    spot_ask: int = 0
+    i_vnd: float = 0.0
+    i_usd: float = 0.0
+
+
+@dataclass(slots=True)
+class R01Answers(CaseRecord):
+    fwd_bid: int = 0
+    fwd_ask: int = 0
+    hedged_cost_vnd: int = 0
+
+
+@dataclass(slots=True)
+class R02Params(CaseRecord):
+    usd_amount: int = 0
+    days: int = 0
+    spot_bid: int = 0
+    spot_ask: int = 0
+    i_vnd: float = 0.0
+    i_usd: float = 0.0
+    fwd_bid: int = 0
+    fwd_ask: int = 0
+    strike: int = 0
+    premium: int = 0
+    spot_T: int = 0
+
+
+@dataclass(slots=True)
+class R02Answers(CaseRecord):
+    forward_cost: int = 0
+    option_cost: int = 0
+    best_choice: str = "-"
+
+
+@dataclass(slots=True)
+class T01Params(CaseRecord):
+    amount_usd: int = 0
+    tenor_days: int = 0
+    opp_rate: float = 0.0
+    tt_fixed: float = 0.0
+    tt_pct: float = 0.0
+    da_fixed: float = 0.0
+    da_pct: float = 0.0
+    lc_fixed: float = 0.0
+    lc_pct_per_quarter: float = 0.0
+    lc_margin: float = 0.0
+    quarters: int = 0
+
+
+@dataclass(slots=True)
+class T01Answers(CaseRecord):
+    best_method: str = "-"
+    costs: dict = field(default_factory=dict)
+    min_cost: float = 0.0
+
+
+@dataclass(slots=True)
+class T02Params(CaseRecord):
+    lc_terms: dict = field(default_factory=dict)
+    presented: dict = field(default_factory=dict)
+    discrepancy_pool: list = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class T02Answers(CaseRecord):
+    correct_codes: list = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class I01Params(CaseRecord):
+    I0: int = 0
+    cf1: int = 0
+    cf2: int = 0
+    cf3: int = 0
+    r: float = 0.0
+
+
+@dataclass(slots=True)
+class I01Answers(CaseRecord):
+    npv: int = 0
+    decision: str = "-"
+
+
+@dataclass(slots=True)
+class I02Params(CaseRecord):
+    I0: int = 0
+    cf1: int = 0
+    cf2: int = 0
+    cf3: int = 0
+    cf4: int = 0
+    wacc: float = 0.0
+    cashflows: list = field(default_factory=list)
+    difficulty: str = ""
+
+
+@dataclass(slots=True)
+class I02Answers(CaseRecord):
+    irr_pct: float = 0.0
+    decision: str = "-"
+
+
+@dataclass(slots=True)
+class M01Params(CaseRecord):
+    debt_usd_bn: int = 0
+    base_rate: int = 0
+    shock_pct: float = 0.0
+
+
+@dataclass(slots=True)
+class M01Answers(CaseRecord):
+    new_rate: int = 0
+    increase_tril: float = 0.0
+    base_debt_tril: float = 0.0
+    new_debt_tril: float = 0.0
+
+
+@dataclass(slots=True)
+class M02Params(CaseRecord):
+    notional_mjpy: int = 0
+    notional_jpy: int = 0
+    s0: float = 0.0
+    i_vnd: float = 0.0
+    i_jpy: float = 0.0
+    horizon_days: int = 0
+    shock_pct: float = 0.0
+    s1: float = 0.0
+    equity_vnd: int = 0
+    margin_trigger: float = 0.0
+
+
+@dataclass(slots=True)
+class M02Answers(CaseRecord):
+    vnd_open: int = 0
+    pl_vnd: int = 0
+    margin_call: bool = False
+    vnd_end: float = 0.0
+    jpy_debt: float = 0.0
+    loss_pct: float = 0.0
+
+
+# ex_code -> (hàm sinh đề, lớp Params, lớp Answers)
+CASE_REGISTRY = {
+    "D01": (gen_case_D01, D01Params, D01Answers),
+    "D02": (gen_case_D02, D02Params, D02Answers),
+    "R01": (gen_case_R01, R01Params, R01Answers),
+    "R02": (gen_case_R02, R02Params, R02Answers),
+    "T01": (gen_case_T01, T01Params, T01Answers),
+    "T02": (gen_case_T02, T02Params, T02Answers),
+    "I01": (gen_case_I01, I01Params, I01Answers),
+    "I02": (gen_case_I02, I02Params, I02Answers),
+    "M01": (gen_case_M01, M01Params, M01Answers),
+    "M02": (gen_case_M02, M02Params, M02Answers),
+}
+
+
+def gen_case_records(ex_code: str, seed: int) -> tuple[CaseRecord, CaseRecord]:
+    """Sinh đề theo seed và trả về (Params, Answers) có kiểu."""
+    gen, p_cls, a_cls = CASE_REGISTRY[ex_code]
+    params, answers = gen(seed)
+    return p_cls(**params), a_cls(**answers)
+
+
+def load_case_records(ex_code: str, params_json, answer_json) -> tuple[CaseRecord, CaseRecord]:
+    """Đọc params_json/answer_json từ DB về record (không cần .get(...) phòng thủ ở renderer)."""
+    _, p_cls, a_cls = CASE_REGISTRY[ex_code]
+    return p_cls.from_json(params_json), a_cls.from_json(answer_json)
+
+
+
+# =========================
+# GOLDEN FILE: chụp đề theo seed để phát hiện thay đổi khi nâng cấp NumPy/pandas
+# =========================
+# Chấm bài dựa vào việc gen_case_*(stable_seed(mssv, ex, attempt)) lúc nộp trùng với lúc render.
+# Bản chụp lưu mọi trường lá của (params, answers) cho 1 mẫu seed dạng cột trong 1 file .npz nén:
+#   - số nguyên -> int64, số thực -> float64 (so sánh bit-exact, đổi kiểu int<->float cũng bị bắt)
+#   - còn lại (chuỗi, bool, ngày, list) -> cột chuỗi JSON
+GOLDEN_FILE = "golden_cases.npz"
+GOLDEN_N_SEEDS = 2000
+
+
+def _golden_path() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), GOLDEN_FILE)
+
+
+def golden_seeds(ex_code: str, n: int) -> np.ndarray:
+    """Mẫu seed cố định, cùng miền 63-bit với stable_seed thật của SV."""
+    return np.array([stable_seed("GOLDEN", ex_code, i) for i in range(int(n))], dtype=np.int64)
+
+
+def _flatten_case(prefix: str, obj, out: dict):
+    if isinstance(obj, dict):
+        for k, v in obj.items():
+            _flatten_case(f"{prefix}.{k}" if prefix else str(k), v, out)
+    else:
+        out[prefix] = obj
+
+
+def snapshot_cases(ex_code: str, seeds) -> dict:
+    """Sinh đề cho từng seed và gom thành dict cột {đường_dẫn_trường: mảng}."""
+    gen_fn = CASE_REGISTRY[ex_code][0]
+    rows = []
+    for s in seeds:
+        params, answers = gen_fn(int(s))
+        flat = {}
+        _flatten_case("params", params, flat)
+        _flatten_case("answers", answers, flat)
+        rows.append(flat)
+
+    keys = list(dict.fromkeys(k for r in rows for k in r))
+    cols = {}
+    for k in keys:
+        vals = [r.get(k) for r in rows]
+        if all(isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_)) for v in vals):
+            cols[k] = np.array(vals, dtype=np.int64)
+        elif all(isinstance(v, (int, float, np.integer, np.floating)) and not isinstance(v, (bool, np.bool_))
+                 for v in vals):
+            cols[k] = np.array(vals, dtype=np.float64)
+        else:
+            cols[k] = np.array([json.dumps(v, default=str, sort_keys=True) for v in vals])
+    return cols
+
+
+def write_golden_cases(path: str | None = None, n_seeds: int = GOLDEN_N_SEEDS, codes=None) -> str:
+    """Ghi file golden (chạy lại khi CHỦ ĐỘNG đổi logic sinh đề)."""
+    path = path or _golden_path()
+    arrays = {}
+    for code in (codes or CASE_REGISTRY):
+        seeds = golden_seeds(code, n_seeds)
+        arrays[f"{code}/__seeds__"] = seeds
+        for k, v in snapshot_cases(code, seeds).items():
+            if v.dtype.kind == "U":
+                # cột chuỗi lặp nhiều (pool sai biệt, nhãn đáp án) -> lưu dạng từ điển + chỉ số
+                uniq, idx = np.unique(v, return_inverse=True)
+                arrays[f"{code}/{k}"] = uniq
+                arrays[f"{code}/{k}@idx"] = idx.astype(np.int32)
+            else:
+                arrays[f"{code}/{k}"] = v
+    arrays["__meta__"] = np.array([json.dumps({
+        "numpy": np.__version__, "pandas": pd.__version__,
+        "n_seeds": int(n_seeds), "schema": CASE_SCHEMA_VERSION,
+    })])
+    np.savez_compressed(path, **arrays)
+    return path
+
+
+def diff_golden_cases(path: str | None = None) -> pd.DataFrame:
+    """
+    So đề sinh lại với file golden. Trả về bảng các trường bị lệch
+    (rỗng = tái lập đúng); phiên bản lúc chụp nằm trong df.attrs["golden_meta"].
+    """
+    path = path or _golden_path()
+    rows = []
+    with np.load(path) as z:
+        meta = json.loads(str(z["__meta__"][0]))
+        by_code = {}
+        for key in z.files:
+            if key == "__meta__" or key.endswith("@idx"):
+                continue
+            code, field_name = key.split("/", 1)
+            v = z[key]
+            if f"{key}@idx" in z.files:
+                v = v[z[f"{key}@idx"]]
+            by_code.setdefault(code, {})[field_name] = v
+
+    for code, golden in by_code.items():
+        seeds = golden.pop("__seeds__")
+        if code not in CASE_REGISTRY:
+            rows.append({"Bài": code, "Trường": "*", "Số đề lệch": len(seeds),
+                         "Seed đầu tiên": None, "Golden": "bài không còn tồn tại", "Hiện tại": ""})
+            continue
+        current = snapshot_cases(code, seeds)
+        for k in sorted(set(golden) | set(current)):
+            g, c = golden.get(k), current.get(k)
+            if g is None or c is None or g.dtype.kind != c.dtype.kind:
+                rows.append({"Bài": code, "Trường": k, "Số đề lệch": len(seeds), "Seed đầu tiên": int(seeds[0]),
+                             "Golden": "thiếu" if g is None else str(g[0]),
+                             "Hiện tại": "thiếu" if c is None else str(c[0])})
+                continue
+            if g.dtype.kind == "f":
+                bad = ~((g == c) | (np.isnan(g) & np.isnan(c)))
+            else:
+                bad = g != c
+            if bad.any():
+                i = int(np.argmax(bad))
+                rows.append({"Bài": code, "Trường": k, "Số đề lệch": int(bad.sum()),
+                             "Seed đầu tiên": int(seeds[i]), "Golden": str(g[i]), "Hiện tại": str(c[i])})
+
+    df = pd.DataFrame(rows, columns=["Bài", "Trường", "Số đề lệch", "Seed đầu tiên", "Golden", "Hiện tại"])
+    df.attrs["golden_meta"] = meta
+    df.attrs["runtime"] = {"numpy": np.__version__, "pandas": pd.__version__}
+    return df
+
+
+
+def fetch_attempt(mssv: str, exercise_code: str, attempt_no: int):
+    """Kiểm tra attempt đã nộp chưa."""
+    if not supabase_client:
+        return None
+    try:
+        res = (
+            supabase_client.table("lab_attempts")
+            .select("id,is_correct,score,created_at,answer_json,params_json")
+            .eq("mssv", mssv)
+            .eq("exercise_code", exercise_code)
+            .eq("attempt_no", attempt_no)
+            .limit(1)
+            .execute()
+        )
+        return res.data[0] if res.data else None
+    except Exception as e:
+        st.error(f"⚠️ Lỗi đọc lab_attempts: {e}")
+        return None
+
+def insert_attempt(payload: dict) -> bool:
+    """Ghi attempt vào DB."""
+    if not supabase_client:
+        st.error("⚠️ Chưa kết nối Supabase.")
+        return False
+    try:
+        supabase_client.table("lab_attempts").insert(payload).execute()
+        return True
+    except Exception as e:
+        st.error(f"⚠️ Lỗi ghi lab_attempts: {e}")
+        return False
+
+def reward_ai_calls_by_decreasing_usage(mssv: str, bonus_calls: int = 2):
+    """
+    Thưởng thêm lượt gọi AI theo mô hình hiện tại:
+    - DB đang lưu 'usage' (đã dùng).
+    - Thưởng = GIẢM usage đi bonus_calls (tối thiểu = 0).
+    => SV sẽ có thêm 'remaining' lượt dùng.
+    """
+    if not supabase_client:
+        return
+    try:
+        cur = int(get_usage_from_supabase(mssv))
+        if cur >= 999:
+            return
+        new_usage = max(cur - bonus_calls, 0)
+        supabase_client.table("user_quota").upsert(
+            {"mssv": mssv, "usage": new_usage},
+            on_conflict="mssv"
+        ).execute()
+    except Exception as e:
+        st.error(f"⚠️ Lỗi thưởng lượt AI: {e}")
+
+
+# =========================
+# RISK ENGINE: BACKTEST CHIẾN LƯỢC PHÒNG VỆ (Thả nổi / Forward / Option)
+# =========================
+HEDGE_STRATEGIES = ["OPEN", "FORWARD", "OPTION"]
+HEDGE_STRATEGY_LABELS = {
+    "OPEN": "1. Thả nổi (No Hedge)",
+    "FORWARD": "2. Kỳ hạn (Forward)",
+    "OPTION": "3. Quyền chọn (Option)",
+}
+
+
+def simulate_spot_outcomes(spot0: float, r_vnd: float, r_usd: float, days: int,
+                           vol_pct: float, n_sims: int = 100_000, seed: int = 42) -> np.ndarray:
+    """
+    Sinh n_sims kịch bản Spot tại đáo hạn (log-normal, kỳ vọng = Forward IRP).
+    - r_vnd, r_usd, vol_pct: %/năm (giống input trên UI)
+    Trả về np.ndarray shape (n_sims,)
+    """
+    t = year_fraction(days=days)
+    fwd = spot0 * growth_factor(r_vnd / 100, t) / growth_factor(r_usd / 100, t)
+    sigma = vol_pct / 100 * math.sqrt(year_fraction(days=days, convention="ACT/365F"))
+
+    rng = np.random.default_rng(int(seed))
+    z = rng.standard_normal(int(n_sims))
+    return fwd * np.exp(sigma * z - 0.5 * sigma ** 2)
+
+
+def backtest_hedge_strategies(debt_usd: float, spot_outcomes, fwd_rate: float, strike: float,
+                              premium: float, percentiles=(95, 99)) -> dict:
+    """
+    Đánh giá 3 chiến lược phòng vệ trên toàn bộ kịch bản Spot cùng lúc (vectorized).
+    - spot_outcomes: mảng Spot tại đáo hạn (mô phỏng hoặc lịch sử)
+    Trả về dict:
+      costs: ma trận chi phí VND shape (3, n) theo thứ tự HEDGE_STRATEGIES
+      summary: {strategy: {expected, worst, p95, p99, car95, car99, win_prob}}
+    """
+    s = np.asarray(spot_outcomes, dtype=float).ravel()
+    n = s.size
+    if n == 0:
+        return {"costs": np.empty((3, 0)), "summary": {}}
+
+    costs = np.empty((3, n))
+    costs[0] = debt_usd * s                                   # Thả nổi
+    costs[1] = debt_usd * fwd_rate                            # Forward: khóa cứng
+    costs[2] = debt_usd * (np.minimum(s, strike) + premium)   # Option: chặn trần tại Strike
+
+    expected = costs.mean(axis=1)
+    worst = costs.max(axis=1)
+    pct = np.percentile(costs, percentiles, axis=1)           # shape (len(percentiles), 3)
+
+    # Chiến lược thắng = chi phí thấp nhất trong từng kịch bản
+    winner = np.argmin(costs, axis=0)
+    win_prob = np.bincount(winner, minlength=3) / n
+
+    summary = {}
+    for i, key in enumerate(HEDGE_STRATEGIES):
+        row = {"expected": float(expected[i]), "worst": float(worst[i]), "win_prob": float(win_prob[i])}
+        for j, p in enumerate(percentiles):
+            row[f"p{p}"] = float(pct[j, i])
+            row[f"car{p}"] = float(pct[j, i] - expected[i])   # Cost-at-Risk so với kỳ vọng
+        summary[key] = row
+
+    return {"costs": costs, "summary": summary}
+
+
+@st.cache_data(show_spinner=False)
+def run_hedge_backtest(debt_usd: float, spot0: float, r_vnd: float, r_usd: float, days: int, vol_pct: float,
+                       fwd_rate: float, strike: float, premium: float,
+                       n_sims: int = 100_000, seed: int = 42) -> pd.DataFrame:
+    """Cache kết quả backtest theo bộ input -> bảng tổng hợp cho UI."""
+    spots = simulate_spot_outcomes(spot0, r_vnd, r_usd, days, vol_pct, n_sims, seed)
+    res = backtest_hedge_strategies(debt_usd, spots, fwd_rate, strike, premium)
+
+    rows = []
+    for key in HEDGE_STRATEGIES:
+        r = res["summary"][key]
+        rows.append({
+            "Chiến lược": HEDGE_STRATEGY_LABELS[key],
+            "Chi phí kỳ vọng (VND)": r["expected"],
+            "Chi phí P95 (VND)": r["p95"],
+            "Chi phí P99 (VND)": r["p99"],
+            "Xấu nhất (VND)": r["worst"],
+            "CaR 95% (VND)": r["car95"],
+            "Xác suất thắng (%)": r["win_prob"] * 100,
+        })
+    return pd.DataFrame(rows)
+
+
+# =========================
+# RISK ENGINE: ĐƯỜNG CONG FORWARD ĐA KỲ HẠN (IRP)
+# =========================
+FX_TENORS = [
+    ("1D", 1), ("1W", 7), ("2W", 14), ("1M", 30), ("2M", 60), ("3M", 90),
+    ("6M", 180), ("9M", 270), ("1Y", 360), ("18M", 540), ("2Y", 720),
+]
+
+# Đường cong lãi suất mặc định: (kỳ hạn ngày, lãi suất %/năm)
+DEFAULT_VND_CURVE = [(1, 4.0), (30, 4.5), (90, 5.0), (180, 5.5), (360, 6.0), (720, 6.5)]
+DEFAULT_USD_CURVE = [(1, 4.3), (30, 4.3), (90, 4.2), (180, 4.1), (360, 3.9), (720, 3.7)]
+
+
+def interp_rate_curve(curve_days, curve_rates, tenor_days) -> np.ndarray:
+    """
+    Nội suy tuyến tính lãi suất theo kỳ hạn (ngày); ngoài khoảng thì giữ phẳng.
+    Trả về np.ndarray lãi suất %/năm cho từng tenor.
+    """
+    d = np.asarray(curve_days, dtype=float)
+    r = np.asarray(curve_rates, dtype=float)
+    order = np.argsort(d)
+    return np.interp(np.asarray(tenor_days, dtype=float), d[order], r[order])
+
+
+def build_forward_curve(spot: float, vnd_curve, usd_curve, tenor_days,
+                        convention: str = DEFAULT_DAY_COUNT, compounding: str = "simple") -> dict:
+    """
+    Tính Forward IRP cho cả vector kỳ hạn trong 1 lần gọi (mặc định ACT/360, lãi đơn).
+    - vnd_curve, usd_curve: list[(ngày, %/năm)]
+    Trả về dict các mảng: days, r_vnd, r_usd, forward, swap_points
+    """
+    days = np.asarray(tenor_days, dtype=float)
+    vnd_d, vnd_r = zip(*vnd_curve)
+    usd_d, usd_r = zip(*usd_curve)
+
+    rv = interp_rate_curve(vnd_d, vnd_r, days)
+    ru = interp_rate_curve(usd_d, usd_r, days)
+
+    t = year_fraction(days=days, convention=convention)
+    fwd = spot * growth_factor(rv / 100, t, compounding) / growth_factor(ru / 100, t, compounding)
+    return {"days": days, "r_vnd": rv, "r_usd": ru, "forward": fwd, "swap_points": fwd - spot}
+
+
+@st.cache_data(show_spinner=False)
+def get_forward_curve(spot: float, vnd_curve: tuple, usd_curve: tuple, tenors: tuple = tuple(FX_TENORS)) -> pd.DataFrame:
+    """Cache đường cong Forward theo snapshot (spot + 2 đường cong lãi suất)."""
+    labels = [lb for lb, _ in tenors]
+    res = build_forward_curve(spot, vnd_curve, usd_curve, [d for _, d in tenors])
+    return pd.DataFrame({
+        "Kỳ hạn": labels,
+        "Ngày": res["days"].astype(int),
+        "LS VND (%)": res["r_vnd"],
+        "LS USD (%)": res["r_usd"],
+        "Forward": res["forward"],
+        "Swap Point": res["swap_points"],
+    })
+
+
+# =========================
+# KHO DỮ LIỆU FX OFFLINE (memory-mapped, có phiên bản)
+# =========================
+# fx_store/: mỗi cột là 1 file .npy (đọc bằng np.load(mmap_mode="r") -> không nạp cả file vào RAM),
+# manifest.json ghi phiên bản + danh sách cột. Cắt theo ngày = searchsorted trên cột date rồi
+# slice -> trả về view của memmap (zero-copy), không qua pandas mỗi lần rerun.
+# Số liệu MINH HỌA cho bài giảng: USD/VND lấy từ usdvnd_history.csv; EUR/USD, USD/JPY nội suy
+# quanh các mốc cuối năm/giữa năm xấp xỉ thực tế; lãi suất điều hành là hàm bậc thang theo các
+# ngày điều chỉnh chính (xấp xỉ), không phải dữ liệu niêm yết chính thức.
+FX_STORE_DIR = "fx_store"
+FX_STORE_VERSION = "2025.12-1"
+FX_STORE_COLUMNS = {
+    "usd_vnd": "USD/VND",
+    "eur_usd": "EUR/USD",
+    "usd_jpy": "USD/JPY",
+    "vnd_policy": "LS tái cấp vốn NHNN (%)",
+    "usd_policy": "Fed funds - cận trên (%)",
+    "eur_policy": "ECB deposit facility (%)",
+    "jpy_policy": "BoJ policy rate (%)",
+}
+
+# Mốc tỷ giá (ngày, mức) để dựng chuỗi minh họa
+FX_STORE_ANCHORS = {
+    "eur_usd": [("2015-01-02", 1.20), ("2015-12-31", 1.09), ("2016-12-30", 1.05), ("2017-12-29", 1.20),
+                ("2018-12-31", 1.145), ("2019-12-31", 1.12), ("2020-03-20", 1.07), ("2020-12-31", 1.22),
+                ("2021-12-31", 1.137), ("2022-09-28", 0.96), ("2022-12-30", 1.07), ("2023-12-29", 1.104),
+                ("2024-12-31", 1.035), ("2025-12-31", 1.17)],
+    "usd_jpy": [("2015-01-02", 120.0), ("2015-12-31", 120.5), ("2016-12-30", 117.0), ("2017-12-29", 112.7),
+                ("2018-12-31", 109.7), ("2019-12-31", 108.7), ("2020-12-31", 103.3), ("2021-12-31", 115.1),
+                ("2022-10-21", 150.0), ("2022-12-30", 131.1), ("2023-12-29", 141.0), ("2024-07-10", 161.5),
+                ("2024-09-16", 140.5), ("2024-12-31", 157.2), ("2025-12-31", 156.0)],
+}
+FX_STORE_VOL = {"eur_usd": 0.07, "usd_jpy": 0.09}   # biến động năm của phần nhiễu quanh đường nội suy
+
+# Lãi suất điều hành: (ngày hiệu lực, mức %)
+FX_STORE_POLICY_STEPS = {
+    "vnd_policy": [("2015-01-01", 6.5), ("2017-07-10", 6.25), ("2019-09-16", 6.0), ("2020-03-17", 5.0),
+                   ("2020-05-13", 4.5), ("2020-10-01", 4.0), ("2022-09-23", 5.0), ("2022-10-25", 6.0),
+                   ("2023-04-03", 5.5), ("2023-05-25", 5.0), ("2023-06-19", 4.5)],
+    "usd_policy": [("2015-01-01", 0.25), ("2015-12-17", 0.50), ("2016-12-15", 0.75), ("2017-03-16", 1.00),
+                   ("2017-06-15", 1.25), ("2017-12-14", 1.50), ("2018-03-22", 1.75), ("2018-06-14", 2.00),
+                   ("2018-09-27", 2.25), ("2018-12-20", 2.50), ("2019-08-01", 2.25), ("2019-09-19", 2.00),
+                   ("2019-10-31", 1.75), ("2020-03-04", 1.25), ("2020-03-16", 0.25), ("2022-03-17", 0.50),
+                   ("2022-05-05", 1.00), ("2022-06-16", 1.75), ("2022-07-28", 2.50), ("2022-09-22", 3.25),
+                   ("2022-11-03", 4.00), ("2022-12-15", 4.50), ("2023-02-02", 4.75), ("2023-03-23", 5.00),
+                   ("2023-05-04", 5.25), ("2023-07-27", 5.50), ("2024-09-19", 5.00), ("2024-11-08", 4.75),
+                   ("2024-12-19", 4.50), ("2025-09-18", 4.25), ("2025-10-30", 4.00), ("2025-12-11", 3.75)],
+    "eur_policy": [("2015-01-01", -0.20), ("2015-12-09", -0.30), ("2016-03-16", -0.40), ("2019-09-18", -0.50),
+                   ("2022-07-27", 0.00), ("2022-09-14", 0.75), ("2022-11-02", 1.50), ("2022-12-21", 2.00),
+                   ("2023-02-08", 2.50), ("2023-03-22", 3.00), ("2023-05-10", 3.25), ("2023-06-21", 3.50),
+                   ("2023-08-02", 3.75), ("2023-09-20", 4.00), ("2024-06-12", 3.75), ("2024-09-18", 3.50),
+                   ("2024-10-23", 3.25), ("2024-12-18", 3.00), ("2025-02-05", 2.75), ("2025-03-12", 2.50),
+                   ("2025-04-23", 2.25), ("2025-06-11", 2.00)],
+    "jpy_policy": [("2015-01-01", 0.10), ("2016-02-16", -0.10), ("2024-03-19", 0.10), ("2024-08-01", 0.25),
+                   ("2025-01-24", 0.50)],
+}
+
+
+def _fx_store_path() -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), FX_STORE_DIR)
+
+
+def _anchored_series(days: np.ndarray, anchors, vol: float, rng) -> np.ndarray:
+    """Nội suy log-tuyến tính qua các mốc + cầu Brown (Brownian bridge) giữa 2 mốc liền kề -> đi qua đúng mốc."""
+    a_days = np.array([np.datetime64(d, "D") for d, _ in anchors]).astype(np.int64)
+    a_log = np.log([v for _, v in anchors])
+    d = days.astype(np.int64)
+    base = np.interp(d, a_days, a_log)
+    walk = np.cumsum(rng.standard_normal(d.size) * vol * np.sqrt(np.diff(d, prepend=d[0]) / 365))
+    seg = np.clip(np.searchsorted(a_days, d, side="right") - 1, 0, len(a_days) - 2)
+    lo, hi = a_days[seg], a_days[seg + 1]
+    w_lo, w_hi = np.interp(lo, d, walk), np.interp(hi, d, walk)
+    frac = np.clip((d - lo) / (hi - lo), 0.0, 1.0)
+    return np.exp(base + walk - (w_lo + frac * (w_hi - w_lo)))
+
+
+def _step_series(days: np.ndarray, steps) -> np.ndarray:
+    s_days = np.array([np.datetime64(d, "D") for d, _ in steps])
+    idx = np.searchsorted(s_days, days, side="right") - 1
+    return np.asarray([v for _, v in steps], dtype=float)[np.clip(idx, 0, None)]
+
+
+def build_fx_store(path: str | None = None, seed: int = 2015) -> dict:
+    """
+    Dựng lại fx_store/ từ usdvnd_history.csv + các mốc ở trên (chạy tay khi đổi dữ liệu,
+    nhớ tăng FX_STORE_VERSION). Trả về manifest đã ghi.
+    """
+    path = path or _fx_store_path()
+    os.makedirs(path, exist_ok=True)
+    src = pd.read_csv(os.path.join(os.path.dirname(os.path.abspath(__file__)), "usdvnd_history.csv"),
+                      parse_dates=["date"])
+    dates = src["date"].values.astype("datetime64[D]")
+    rng = np.random.default_rng(seed)
+    cols = {"usd_vnd": src["usd_vnd"].to_numpy(dtype=float)}
+    for name, anchors in FX_STORE_ANCHORS.items():
+        cols[name] = _anchored_series(dates, anchors, FX_STORE_VOL[name], rng)
+    for name, steps in FX_STORE_POLICY_STEPS.items():
+        cols[name] = _step_series(dates, steps)
+
+    np.save(os.path.join(path, "date.npy"), dates)
+    for name in FX_STORE_COLUMNS:
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(cols[name], dtype=np.float64))
+    manifest = {
+        "version": FX_STORE_VERSION,
+        "illustrative": True,
+        "note": "Số liệu minh họa cho bài giảng, không phải dữ liệu niêm yết chính thức.",
+        "n_rows": int(dates.size),
+        "start": str(dates[0]),
+        "end": str(dates[-1]),
+        "columns": FX_STORE_COLUMNS,
+    }
+    with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest
+
+
+@dataclass(frozen=True)
+class FxStore:
+    """Kho FX đã mở: `dates` và `columns` đều là memmap chỉ-đọc."""
+    manifest: dict
+    dates: np.ndarray
+    columns: dict
+
+    def _bounds(self, start=None, end=None) -> tuple[int, int]:
+        i0 = 0 if start is None else int(np.searchsorted(self.dates, np.datetime64(start, "D"), side="left"))
+        i1 = self.dates.size if end is None else int(np.searchsorted(self.dates, np.datetime64(end, "D"), side="right"))
+        return i0, i1
+
+    def slice(self, start=None, end=None, cols=None) -> tuple[np.ndarray, dict]:
+        """Cắt [start, end] (bao gồm 2 đầu) -> (dates, {cột: mảng}); các mảng là view, không copy."""
+        i0, i1 = self._bounds(start, end)
+        names = list(self.columns) if cols is None else list(cols)
+        return self.dates[i0:i1], {c: self.columns[c][i0:i1] for c in names}
+
+    def frame(self, start=None, end=None, cols=None) -> pd.DataFrame:
+        """Bản DataFrame (có copy) cho bảng/biểu đồ."""
+        dates, data = self.slice(start, end, cols)
+        return pd.DataFrame({c: np.asarray(v) for c, v in data.items()}, index=pd.DatetimeIndex(dates, name="date"))
+
+
+@st.cache_resource
+def open_fx_store(path: str | None = None) -> FxStore:
+    """Mở fx_store/ (1 lần / tiến trình); báo lỗi rõ nếu thiếu file hoặc lệch phiên bản."""
+    path = path or _fx_store_path()
+    with open(os.path.join(path, "manifest.json"), encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != FX_STORE_VERSION:
+        raise ValueError(f"fx_store phiên bản {manifest.get('version')} != {FX_STORE_VERSION}; chạy lại build_fx_store().")
+    dates = np.load(os.path.join(path, "date.npy"), mmap_mode="r")
+    columns = {c: np.load(os.path.join(path, f"{c}.npy"), mmap_mode="r") for c in manifest["columns"]}
+    return FxStore(manifest=manifest, dates=dates, columns=columns)
+
+
+# =========================
+# RISK ENGINE: FX VaR / EXPECTED SHORTFALL CHO KHOẢN NỢ USD
+# =========================
+# Chuỗi USD/VND theo ngày làm việc (2015–2025) lấy từ kho fx_store/ (gốc: usdvnd_history.csv,
+# dựng lại bám theo các mốc tỷ giá lịch sử - số liệu minh họa, không phải dữ liệu niêm yết chính thức).
+VAR_LEVELS = (0.95, 0.99)
+
+
+def load_usdvnd_history() -> pd.Series:
+    """Series tỷ giá USD/VND, index = ngày (đọc từ kho FX memmap)."""
+    return open_fx_store().frame(cols=["usd_vnd"])["usd_vnd"]
+
+
+def horizon_log_returns(rates, horizon: int) -> np.ndarray:
+    """Log-return chồng lấp (overlapping) sau `horizon` phiên, tính vectorized."""
+    log_s = np.log(np.asarray(rates, dtype=float))
+    h = max(1, int(horizon))
+    if log_s.size <= h:
+        return np.empty(0)
+    return log_s[h:] - log_s[:-h]
+
+
+def var_es_from_losses(losses, levels=VAR_LEVELS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    VaR & ES cho mọi mức tin cậy cùng lúc (sort 1 lần + cumsum).
+    Trả về (var, es), mỗi mảng shape (len(levels),)
+    """
+    x = np.sort(np.asarray(losses, dtype=float))
+    n = x.size
+    lv = np.asarray(levels, dtype=float)
+    var = np.quantile(x, lv)
+
+    # ES = trung bình đuôi từ vị trí ceil(q*n)
+    k = np.minimum(np.ceil(lv * n).astype(int), n - 1)
+    tail_sum = np.cumsum(x[::-1])[::-1]
+    es = tail_sum[k] / (n - k)
+    return var, es
+
+
+def _norm_cdf(x: float) -> float:
+    return 0.5 * (1 + math.erf(x / math.sqrt(2)))
+
+
+def _norm_ppf(p: float) -> float:
+    """Nghịch đảo CDF chuẩn (bisection, đủ chính xác cho VaR)."""
+    lo, hi = -10.0, 10.0
+    for _ in range(100):
+        mid = (lo + hi) / 2
+        if _norm_cdf(mid) < p:
+            lo = mid
+        else:
+            hi = mid
+    return (lo + hi) / 2
+
+
+def parametric_var_es(mu: float, sigma: float, horizon: int, exposure_vnd: float,
+                      levels=VAR_LEVELS) -> tuple[np.ndarray, np.ndarray]:
+    """
+    VaR/ES tham số: log-return h phiên ~ N(mu*h, sigma*sqrt(h)).
+    Lỗ = exposure * (e^r - 1) -> dùng công thức đóng của log-normal.
+    """
+    m = mu * horizon
+    s = sigma * math.sqrt(horizon)
+    var, es = [], []
+    for q in levels:
+        z = _norm_ppf(q)
+        var.append(exposure_vnd * (math.exp(m + z * s) - 1))
+        tail_mean = math.exp(m + s ** 2 / 2) * (1 - _norm_cdf(z - s)) / (1 - q)
+        es.append(exposure_vnd * (tail_mean - 1))
+    return np.array(var), np.array(es)
+
+
+def monte_carlo_var_es(daily_returns, horizon: int, exposure_vnd: float, n_sims: int = 200_000,
+                       chunk: int = 2_000_000, seed: int = 42, t_df: float = 4.0,
+                       levels=VAR_LEVELS, n_bins: int = 20_000) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Monte Carlo (cú sốc ngày Student-t, đuôi dày) theo từng chunk để bộ nhớ phẳng.
+    chunk = số cú sốc ngày mỗi lượt (mỗi lượt chunk // horizon kịch bản) -> bộ nhớ không tăng theo kỳ hạn.
+    Mỗi chunk chỉ cộng dồn histogram (đếm + tổng lỗ theo bin) -> VaR/ES đọc từ histogram.
+    """
+    r = np.asarray(daily_returns, dtype=float)
+    mu, sigma = float(r.mean()), float(r.std(ddof=1))
+    h = max(1, int(horizon))
+    scale = sigma / math.sqrt(t_df / (t_df - 2))   # để độ lệch chuẩn ngày = sigma
+
+    # Miền bin cố định theo ±12 sigma của h phiên
+    span = 12 * sigma * math.sqrt(h)
+    edges = np.linspace(mu * h - span, mu * h + span, n_bins + 1)
+    counts = np.zeros(n_bins)
+    sums = np.zeros(n_bins)
+
+    rng = np.random.default_rng(int(seed))
+    per_chunk = max(1, int(chunk) // h)
+    done = 0
+    while done < n_sims:
+        m = min(per_chunk, n_sims - done)
+        paths = mu * h + scale * rng.standard_t(t_df, size=(m, h)).sum(axis=1)
+        loss = exposure_vnd * np.expm1(paths)
+        idx = np.clip(np.searchsorted(edges, paths, side="right") - 1, 0, n_bins - 1)
+        counts += np.bincount(idx, minlength=n_bins)
+        sums += np.bincount(idx, weights=loss, minlength=n_bins)
+        done += m
+
+    cum = np.cumsum(counts)
+    var, es = [], []
+    for q in levels:
+        b = int(np.searchsorted(cum, q * n_sims))
+        # nội suy tuyến tính trong bin chứa quantile
+        prev = cum[b - 1] if b > 0 else 0.0
+        frac = (q * n_sims - prev) / counts[b] if counts[b] > 0 else 0.0
+        r_q = edges[b] + frac * (edges[b + 1] - edges[b])
+        var.append(exposure_vnd * math.expm1(r_q))
+        tail_n = counts[b + 1:].sum() + counts[b] * (1 - frac)
+        tail_s = sums[b + 1:].sum() + sums[b] * (1 - frac)
+        es.append(tail_s / tail_n if tail_n > 0 else var[-1])
+    return np.array(var), np.array(es)
+
+
+def hedge_adjust_var(values, exposure_usd: float, spot0: float, fwd_rate: float, hedge_ratio: float) -> np.ndarray:
+    """
+    Lỗ của vị thế hedge một phần: phần hedge khóa ở Forward (lỗ cố định = F - S0),
+    phần còn lại chịu biến động -> phép biến đổi affine nên áp dụng thẳng lên VaR/ES.
+    """
+    h = min(max(float(hedge_ratio), 0.0), 1.0)
+    return (1 - h) * np.asarray(values, dtype=float) + h * exposure_usd * (fwd_rate - spot0)
+
+
+@st.cache_data(show_spinner=False)
+def compute_debt_var_table(exposure_usd: float, spot0: float, days: int, fwd_rate: float,
+                           hedge_ratio: float, n_sims: int = 200_000, seed: int = 42) -> pd.DataFrame:
+    """Bảng VaR/ES (95%, 99%) theo 3 phương pháp, cho vị thế Không hedge vs Có hedge."""
+    hist = load_usdvnd_history()
+    daily = horizon_log_returns(hist.values, 1)
+    h = max(1, int(round(days * 252 / 365)))   # ngày lịch -> số phiên giao dịch
+    exposure_vnd = exposure_usd * spot0
+
+    results = {}
+    hist_r = horizon_log_returns(hist.values, h)
+    if hist_r.size:   # kỳ hạn dài hơn chuỗi lịch sử -> không có mẫu nào, bỏ phương pháp lịch sử
+        results["Lịch sử (Historical)"] = var_es_from_losses(exposure_vnd * np.expm1(hist_r))
+    results["Tham số (Parametric)"] = parametric_var_es(float(daily.mean()), float(daily.std(ddof=1)), h, exposure_vnd)
+    results["Monte Carlo"] = monte_carlo_var_es(daily, h, exposure_vnd, n_sims=n_sims, seed=seed)
+
+    rows = []
+    for method, (var, es) in results.items():
+        for label, ratio in [("Không hedge", 0.0), (f"Hedge {hedge_ratio:.0%}", hedge_ratio)]:
+            v = hedge_adjust_var(var, exposure_usd, spot0, fwd_rate, ratio)
+            e = hedge_adjust_var(es, exposure_usd, spot0, fwd_rate, ratio)
+            rows.append({
+                "Phương pháp": method,
+                "Vị thế": label,
+                "VaR 95%": v[0], "ES 95%": e[0],
+                "VaR 99%": v[1], "ES 99%": e[1],
+            })
+    return pd.DataFrame(rows)
+
+
+# =========================
+# RISK ENGINE: PAYOFF DIAGRAM (TOÀN BỘ MIỀN SPOT)
+# =========================
+def hedge_payoff_grid(debt_usd: float, fwd_rate: float, strike: float, premium: float,
+                      s_min: float, s_max: float, n_points: int = 401) -> pd.DataFrame:
+    """
+    Chi phí 3 chiến lược trên cả lưới Spot trong 1 lần tính NumPy.
+    Trả về DataFrame dạng long: Spot | Chiến lược | Tỷ giá hiệu dụng | Chi phí (VND)
+    """
+    s = np.linspace(float(s_min), float(s_max), int(n_points))
+    rates = np.vstack([
+        s,                                          # Thả nổi
+        np.full_like(s, float(fwd_rate)),           # Forward
+        np.minimum(s, float(strike)) + premium,     # Option
+    ])
+    labels = [HEDGE_STRATEGY_LABELS[k] for k in HEDGE_STRATEGIES]
+    return pd.DataFrame({
+        "Spot": np.tile(s, 3),
+        "Chiến lược": np.repeat(labels, s.size),
+        "Tỷ giá hiệu dụng": rates.ravel(),
+        "Chi phí (VND)": (debt_usd * rates).ravel(),
+    })
+
+
+def hedge_break_even_points(fwd_rate: float, strike: float, premium: float) -> list[dict]:
+    """
+    Điểm hòa vốn giữa các chiến lược (giải tích, không dò lưới).
+    Option cost rate = min(S, K) + premium.
+    """
+    points = [{"Cặp so sánh": "Thả nổi = Forward", "Spot hòa vốn": float(fwd_rate),
+               "Ý nghĩa": "Spot cao hơn mức này ⇒ Forward rẻ hơn Thả nổi"}]
+
+    # Thả nổi vs Option: chỉ cắt nhau ở nhánh S > K, tại S = K + premium
+    points.append({"Cặp so sánh": "Thả nổi = Option", "Spot hòa vốn": float(strike + premium),
+                   "Ý nghĩa": "Spot cao hơn mức này ⇒ Option rẻ hơn Thả nổi"})
+
+    # Forward vs Option
+    if strike + premium < fwd_rate:
+        points.append({"Cặp so sánh": "Forward = Option", "Spot hòa vốn": None,
+                       "Ý nghĩa": "Strike + Phí < Forward ⇒ Option luôn rẻ hơn Forward"})
+    elif strike + premium == fwd_rate:
+        points.append({"Cặp so sánh": "Forward = Option", "Spot hòa vốn": float(strike),
+                       "Ý nghĩa": "Từ Strike trở lên hai phương án bằng nhau"})
+    else:
+        points.append({"Cặp so sánh": "Forward = Option", "Spot hòa vốn": float(fwd_rate - premium),
+                       "Ý nghĩa": "Spot thấp hơn mức này ⇒ Option (bỏ quyền) rẻ hơn Forward"})
+    return points
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def build_payoff_chart(debt_usd: float, fwd_rate: float, strike: float, premium: float,
+                       s_min: float, s_max: float):
+    """
+    Biểu đồ payoff tương tác: rê chuột đọc giá trị đã tính sẵn trên trình duyệt,
+    không cần rerun Streamlit. Không phụ thuộc slider Spot dự báo -> kéo slider vẫn trúng cache
+    (vạch Spot dự báo thêm ngoài bằng payoff_marker_layer).
+    """
+    df = hedge_payoff_grid(debt_usd, fwd_rate, strike, premium, s_min, s_max)
+    hover = alt.selection_point(fields=["Spot"], nearest=True, on="mouseover", empty=False, clear="mouseout")
+
+    base = alt.Chart(df).encode(
+        x=alt.X("Spot:Q", title="Spot tại đáo hạn (VND/USD)", scale=alt.Scale(zero=False)),
+        y=alt.Y("Chi phí (VND):Q", scale=alt.Scale(zero=False)),
+        color=alt.Color("Chiến lược:N", legend=alt.Legend(orient="bottom")),
+    )
+    lines = base.mark_line()
+    points = base.mark_circle(size=60).encode(
+        opacity=alt.condition(hover, alt.value(1), alt.value(0)),
+        tooltip=[
+            alt.Tooltip("Chiến lược:N"),
+            alt.Tooltip("Spot:Q", format=",.0f"),
+            alt.Tooltip("Tỷ giá hiệu dụng:Q", format=",.0f"),
+            alt.Tooltip("Chi phí (VND):Q", format=",.0f"),
+        ],
+    ).add_params(hover)
+    rule = alt.Chart(df).mark_rule(color="gray").encode(x="Spot:Q").transform_filter(hover)
+
+    be = pd.DataFrame([p for p in hedge_break_even_points(fwd_rate, strike, premium) if p["Spot hòa vốn"] is not None])
+    be = be[(be["Spot hòa vốn"] >= s_min) & (be["Spot hòa vốn"] <= s_max)]
+    be_rules = alt.Chart(be).mark_rule(strokeDash=[4, 4], color="#ff9800").encode(
+        x="Spot hòa vốn:Q", tooltip=["Cặp so sánh", alt.Tooltip("Spot hòa vốn:Q", format=",.0f")]
+    )
+    return (lines + points + rule + be_rules).properties(height=380)
+
+
+def payoff_marker_layer(marker_spot: float):
+    """Vạch Spot dự báo (1 điểm dữ liệu, dựng lại mỗi lần kéo slider)."""
+    return alt.Chart(pd.DataFrame({"Spot": [marker_spot]})).mark_rule(color="#0d47a1", strokeWidth=2).encode(x="Spot:Q")
+
+
+# =========================
+# RISK ENGINE: NETTING ĐA PHƯƠNG (TREASURY CENTER)
+# =========================
+# Tỷ giá quy đổi về USD (1 đơn vị ngoại tệ = ? USD) - số liệu minh họa
+NETTING_FX_TO_USD = {"USD": 1.0, "EUR": 1.08, "JPY": 0.0067, "SGD": 0.74, "VND": 1 / 25_000}
+
+
+def gen_intercompany_invoices(n_entities: int, n_invoices: int, seed: int = 7) -> tuple[list, pd.DataFrame]:
+    """
+    Sinh dữ liệu hóa đơn nội bộ tập đoàn (bài tập minh họa).
+    Trả về (entities, invoices) với entities = [{"name", "ccy"}], invoices: payer | receiver | currency | amount
+    Hóa đơn xuất theo đồng tiền của bên nhận (bên trả phải đổi ngoại tệ).
+    """
+    rng = np.random.default_rng(int(seed))
+    ccys = list(NETTING_FX_TO_USD)
+    entities = [{"name": f"SUB-{i + 1:03d}", "ccy": ccys[int(rng.integers(0, len(ccys)))]} for i in range(n_entities)]
+
+    payer = rng.integers(0, n_entities, size=n_invoices)
+    receiver = (payer + rng.integers(1, n_entities, size=n_invoices)) % n_entities   # không tự trả cho mình
+    amount_usd = rng.integers(10, 501, size=n_invoices) * 1_000
+    inv_ccy = np.array([entities[r]["ccy"] for r in receiver])
+    to_usd = np.array([NETTING_FX_TO_USD[c] for c in inv_ccy])
+
+    invoices = pd.DataFrame({
+        "payer": payer,
+        "receiver": receiver,
+        "currency": inv_ccy,
+        "amount": np.round(amount_usd / to_usd, 0),
+    })
+    return entities, invoices
+
+
+def build_exposure_matrix(invoices: pd.DataFrame, n_entities: int, fx_to_usd: dict = NETTING_FX_TO_USD) -> np.ndarray:
+    """Ma trận M[i, j] = tổng USD mà i phải trả j (cộng dồn vectorized bằng np.add.at)."""
+    m = np.zeros((n_entities, n_entities))
+    usd = invoices["amount"].to_numpy(dtype=float) * invoices["currency"].map(fx_to_usd).to_numpy(dtype=float)
+    np.add.at(m, (invoices["payer"].to_numpy(), invoices["receiver"].to_numpy()), usd)
+    return m
+
+
+def bilateral_net(matrix: np.ndarray) -> np.ndarray:
+    """Bù trừ song phương: mỗi cặp (i, j) chỉ còn 1 chiều thanh toán."""
+    return np.maximum(matrix - matrix.T, 0.0)
+
+
+def settle_net_positions(net: np.ndarray, tol: float = 0.5) -> list[tuple[int, int, float]]:
+    """
+    Kế hoạch thanh toán đa phương từ vị thế ròng (nhận - trả) của từng đơn vị.
+    Ghép tham lam con nợ lớn nhất với chủ nợ lớn nhất (2 con trỏ trên mảng đã sắp xếp):
+    - tổng khối lượng = tổng vị thế dương (tối thiểu có thể)
+    - số giao dịch ≤ (số con nợ + số chủ nợ - 1)
+    Trả về list (payer, receiver, amount_usd)
+    """
+    net = np.asarray(net, dtype=float)
+    debtors = np.where(net < -tol)[0]
+    creditors = np.where(net > tol)[0]
+    debtors = debtors[np.argsort(net[debtors])]             # nợ nhiều nhất trước
+    creditors = creditors[np.argsort(-net[creditors])]      # nhận nhiều nhất trước
+
+    owe = -net[debtors]
+    due = net[creditors].copy()
+    transfers = []
+    i = j = 0
+    while i < debtors.size and j < creditors.size:
+        amt = min(owe[i], due[j])
+        transfers.append((int(debtors[i]), int(creditors[j]), float(amt)))
+        owe[i] -= amt
+        due[j] -= amt
+        if owe[i] <= tol:
+            i += 1
+        if due[j] <= tol:
+            j += 1
+    return transfers
+
+
+def multilateral_netting(invoices: pd.DataFrame, entities: list, fx_to_usd: dict = NETTING_FX_TO_USD) -> dict:
+    """
+    So sánh 3 cách thanh toán: Gộp (gross) / Song phương / Đa phương qua Netting Center (USD).
+    FX conversion: gross = mọi hóa đơn mà bên trả khác đồng tiền hóa đơn;
+    đa phương = mỗi đơn vị chỉ đổi 1 lần vị thế ròng (nếu đồng tiền gốc khác USD).
+    """
+    n = len(entities)
+    m = build_exposure_matrix(invoices, n, fx_to_usd)
+    bil = bilateral_net(m)
+    net = m.sum(axis=0) - m.sum(axis=1)                      # nhận - trả
+    transfers = settle_net_positions(net)
+
+    home = np.array([e["ccy"] for e in entities])
+    payer_ccy = home[invoices["payer"].to_numpy()]
+    inv_usd = invoices["amount"].to_numpy(dtype=float) * invoices["currency"].map(fx_to_usd).to_numpy(dtype=float)
+    fx_gross = float(inv_usd[payer_ccy != invoices["currency"].to_numpy()].sum())
+    fx_multi = float(np.abs(net)[home != "USD"].sum())
+
+    return {
+        "net_positions": net,
+        "transfers": transfers,
+        "gross_count": int(np.count_nonzero(m)), "gross_volume": float(m.sum()),
+        "bilateral_count": int(np.count_nonzero(bil)), "bilateral_volume": float(bil.sum()),
+        "multilateral_count": len(transfers), "multilateral_volume": float(sum(t[2] for t in transfers)),
+        "fx_gross": fx_gross, "fx_multilateral": fx_multi, "fx_saved": fx_gross - fx_multi,
+    }
+
+
+# =========================
+# TRADE ENGINE: TỐI ƯU CHI PHÍ PHƯƠNG THỨC THANH TOÁN (T/T, NHỜ THU, L/C)
+# =========================
+PAYMENT_METHODS = ["T/T", "Nhờ thu", "L/C"]
+
+
+def payment_method_costs(values, rate_pct, fees: dict) -> dict:
+    """
+    Tổng chi phí (USD) của 3 phương thức cho cả lưới giá trị hợp đồng × lãi suất.
+    - values, rate_pct: mảng NumPy broadcast được với nhau (vd values[None, :], rates[:, None])
+    - fees: biểu phí giống các input của room_3_trade (tt_pct, tt_min, tt_max, tt_other, ...)
+    Phí Min/Max áp dụng vectorized như calculate_fee_min_max: max(min, min(raw, max)).
+    """
+    v = np.asarray(values, dtype=float)
+    r = np.asarray(rate_pct, dtype=float) / 100
+
+    tt_fee = np.maximum(fees["tt_min"], np.minimum(v * fees["tt_pct"] / 100, fees["tt_max"]))
+    col_fee = np.maximum(fees["col_min"], np.minimum(v * fees["col_pct"] / 100, fees["col_max"]))
+    lc_fee = np.maximum(fees["lc_min"], v * fees["lc_open_pct"] / 100) + v * fees["lc_pay_pct"] / 100
+
+    return {
+        "T/T": tt_fee + fees["tt_other"] + simple_interest(v, r, year_fraction(days=fees["days_tt"])),
+        "Nhờ thu": col_fee + fees["col_other"] + simple_interest(v, r, year_fraction(days=fees["days_col"])),
+        "L/C": lc_fee + fees["lc_other"] + simple_interest(v, r, year_fraction(days=fees["days_lc"])),
+    }
+
+
+def _fee_kinks(fees: dict) -> list[float]:
+    """Các điểm gãy của hàm phí (nơi phí chạm Min/Max) theo giá trị hợp đồng."""
+    kinks = []
+    for pct_key, lim_keys in [("tt_pct", ("tt_min", "tt_max")), ("col_pct", ("col_min", "col_max")),
+                              ("lc_open_pct", ("lc_min",))]:
+        if fees[pct_key] > 0:
+            kinks += [fees[k] * 100 / fees[pct_key] for k in lim_keys]
+    return kinks
+
+
+def payment_break_even_values(fees: dict, rate_pct: float, v_min: float, v_max: float) -> list[dict]:
+    """
+    Giá trị hợp đồng hòa vốn CHÍNH XÁC giữa từng cặp phương thức.
+    Chênh lệch chi phí là hàm tuyến tính từng khúc (gãy tại Min/Max phí)
+    -> giải phương trình bậc nhất trên từng khúc, không dò lưới.
+    """
+    pts = np.unique(np.clip([v_min, v_max] + _fee_kinks(fees), v_min, v_max))
+    costs = payment_method_costs(pts, rate_pct, fees)
+
+    out = []
+    for a in range(len(PAYMENT_METHODS)):
+        for b in range(a + 1, len(PAYMENT_METHODS)):
+            ma, mb = PAYMENT_METHODS[a], PAYMENT_METHODS[b]
+            d = costs[ma] - costs[mb]
+            for k in range(pts.size - 1):
+                d0, d1 = d[k], d[k + 1]
+                if d0 == 0 and (k == 0 or d[k - 1] != 0):
+                    root = pts[k]
+                elif d0 * d1 < 0:
+                    root = pts[k] - d0 * (pts[k + 1] - pts[k]) / (d1 - d0)
+                else:
+                    continue
+                cost = float(payment_method_costs(root, rate_pct, fees)[ma])
+                out.append({"Cặp": f"{ma} = {mb}", "Giá trị HĐ (USD)": float(root), "Chi phí (USD)": cost})
+    return out
+
+
+@st.cache_data(show_spinner=False)
+def build_payment_cost_grid(fee_items: tuple, v_min: float, v_max: float, r_min: float, r_max: float,
+                            n_values: int = 300, n_rates: int = 60) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Cache theo biểu phí: tính 3 × n_rates × n_values chi phí trong 1 lần broadcast.
+    Trả về (df_cheapest: phương thức rẻ nhất trên lưới, df_wide: toàn bộ chi phí dạng long)
+    """
+    fees = dict(fee_items)
+    values = np.linspace(v_min, v_max, n_values)
+    rates = np.linspace(r_min, r_max, n_rates)
+    costs = payment_method_costs(values[None, :], rates[:, None], fees)
+
+    stack = np.stack([costs[m] for m in PAYMENT_METHODS])          # (3, n_rates, n_values)
+    best = np.argmin(stack, axis=0)
+    vv, rr = np.meshgrid(values, rates)
+    df_cheapest = pd.DataFrame({
+        "Giá trị HĐ (USD)": vv.ravel(),
+        "Lãi suất (%)": rr.ravel(),
+        "Rẻ nhất": np.array(PAYMENT_METHODS)[best.ravel()],
+        "Chi phí thấp nhất (USD)": np.take_along_axis(stack, best[None], axis=0).ravel(),
+    })
+    df_long = pd.DataFrame({
+        "Giá trị HĐ (USD)": np.tile(vv.ravel(), 3),
+        "Lãi suất (%)": np.tile(rr.ravel(), 3),
+        "Phương thức": np.repeat(PAYMENT_METHODS, vv.size),
+        "Chi phí (USD)": stack.reshape(3, -1).ravel(),
+    })
+    return df_cheapest, df_long
+
+
+# =========================
+# TRADE ENGINE: RULE ENGINE UCP 600 (KHAI BÁO -> BIÊN DỊCH -> KIỂM TRA HÀNG LOẠT)
+# =========================
+# Cú pháp biểu thức:
+#   "ten_cot"             -> cột dữ liệu (mảng NumPy)
+#   ("lit", giá trị)      -> hằng số
+#   (op, a, b, ...)       -> op thuộc _RULE_OPS
+# Mỗi rule trả về True khi bộ chứng từ có SAI BIỆT.
+UCP600_RULES = [
+    {"code": "T02-01", "article": "Điều 30b", "name": "Invoice vượt dung sai",
+     "expr": ("gt", "invoice_amount", ("mul", "lc_amount", ("add", ("lit", 1), ("div", "tolerance_pct", ("lit", 100)))))},
+    {"code": "T02-02", "article": "Điều 18c", "name": "Mô tả hàng hóa không khớp",
+     "expr": ("ne", "invoice_goods_desc", "lc_goods")},
+    {"code": "T02-03", "article": "Điều 20a(ii)", "name": "Giao hàng sau Latest shipment",
+     "expr": ("gt", "bl_ship_date", "latest_ship")},
+    {"code": "T02-04", "article": "Điều 20a(iv)", "name": "Thiếu bản gốc B/L",
+     "expr": ("lt", "bl_originals", "required_bl_originals")},
+    {"code": "T02-05", "article": "Điều 20a(iii)", "name": "Cảng xếp/dỡ không đúng",
+     "expr": ("or", ("ne", "bl_port_load", "lc_port_load"), ("ne", "bl_port_discharge", "lc_port_discharge"))},
+    {"code": "T02-06", "article": "Điều 28", "name": "Thiếu Insurance (CIF)",
+     "expr": ("and", ("eq", "incoterm", ("lit", "CIF")), ("not", "insurance_present"))},
+    {"code": "T02-07", "article": "Điều 28f(ii)", "name": "Insurance coverage < 110% (CIF)",
+     "expr": ("and", ("eq", "incoterm", ("lit", "CIF")), "insurance_present", ("lt", "insurance_coverage_pct", ("lit", 110)))},
+    {"code": "T02-08", "article": "Điều 14c", "name": "Xuất trình muộn",
+     "expr": ("gt", "documents_presented_within_days", "max_presentation_days")},
+    {"code": "T02-09", "article": "Điều 14", "name": "Thiếu C/O",
+     "expr": ("not", "co_present")},
+    {"code": "T02-10", "article": "Điều 14", "name": "Thiếu Packing List",
+     "expr": ("not", "packing_list_present")},
+]
+
+_RULE_OPS = {
+    "add": np.add, "sub": np.subtract, "mul": np.multiply, "div": np.divide,
+    "gt": np.greater, "ge": np.greater_equal, "lt": np.less, "le": np.less_equal,
+    "eq": np.equal, "ne": np.not_equal,
+    "and": np.logical_and, "or": np.logical_or, "not": np.logical_not,
+}
+
+
+def compile_rule_expr(expr):
+    """Biên dịch 1 biểu thức khai báo thành hàm f(cols) -> mảng NumPy (chạy trên cả cột)."""
+    if isinstance(expr, str):
+        return lambda cols: np.asarray(cols[expr])
+    op, *args = expr
+    if op == "lit":
+        value = args[0]
+        return lambda cols: value
+    if op not in _RULE_OPS:
+        raise ValueError(f"Toán tử rule không hợp lệ: {op}")
+
+    fn = _RULE_OPS[op]
+    parts = [compile_rule_expr(a) for a in args]
+    if len(parts) == 1:
+        return lambda cols: fn(parts[0](cols))
+    if len(parts) == 2:
+        return lambda cols: fn(parts[0](cols), parts[1](cols))
+
+    def _reduce(cols):
+        out = parts[0](cols)
+        for p in parts[1:]:
+            out = fn(out, p(cols))
+        return out
+    return _reduce
+
+
+def compile_rules(rules) -> list[tuple[str, callable]]:
+    """Biên dịch toàn bộ rule 1 lần -> list (code, predicate)."""
+    return [(r["code"], compile_rule_expr(r["expr"])) for r in rules]
+
+
+UCP600_COMPILED = compile_rules(UCP600_RULES)
+
+
+def check_document_sets(cols: dict, compiled=UCP600_COMPILED) -> tuple[np.ndarray, pd.DataFrame]:
+    """
+    Kiểm tra hàng loạt bộ chứng từ dạng cột (mỗi key = 1 mảng độ dài n).
+    Trả về:
+      hits: ma trận bool (n, số rule) - True = có sai biệt
+      stats: số lần vi phạm + tỷ lệ theo từng rule
+    """
+    n = len(next(iter(cols.values())))
+    hits = np.empty((n, len(compiled)), dtype=bool)
+    for j, (_, pred) in enumerate(compiled):
+        hits[:, j] = np.broadcast_to(pred(cols), (n,))
+
+    meta = {r["code"]: r for r in UCP600_RULES}
+    codes = [c for c, _ in compiled]
+    counts = hits.sum(axis=0)
+    stats = pd.DataFrame({
+        "Mã": codes,
+        "Rule": [meta.get(c, {}).get("name", "") for c in codes],
+        "UCP 600": [meta.get(c, {}).get("article", "") for c in codes],
+        "Số lần vi phạm": counts,
+        "Tỷ lệ (%)": counts / max(n, 1) * 100,
+    })
+    return hits, stats
+
+
+def t02_cases_to_columns(cases: list) -> dict:
+    """Chuyển list params của gen_case_T02 (dict lồng nhau, date) sang dạng cột cho rule engine."""
+    lc = [c["lc_terms"] for c in cases]
+    pr = [c["presented"] for c in cases]
+    epoch = date(2025, 1, 1)
+
+    def days(x):
+        return (x - epoch).days
+
+    return {
+        "lc_amount": np.array([t["amount"] for t in lc], dtype=float),
+        "tolerance_pct": np.array([t["tolerance_pct"] for t in lc], dtype=float),
+        "lc_goods": np.array([t["goods"] for t in lc]),
+        "latest_ship": np.array([days(t["latest_ship"]) for t in lc]),
+        "lc_port_load": np.array([t["port_load"] for t in lc]),
+        "lc_port_discharge": np.array([t["port_discharge"] for t in lc]),
+        "incoterm": np.array([t["incoterm"] for t in lc]),
+        "required_bl_originals": np.array([t["required_bl_originals"] for t in lc]),
+        "max_presentation_days": np.array([t["max_presentation_days"] for t in lc]),
+        "invoice_amount": np.array([p["invoice_amount"] for p in pr], dtype=float),
+        "invoice_goods_desc": np.array([p["invoice_goods_desc"] for p in pr]),
+        "bl_ship_date": np.array([days(p["bl_ship_date"]) for p in pr]),
+        "bl_port_load": np.array([p["bl_port_load"] for p in pr]),
+        "bl_port_discharge": np.array([p["bl_port_discharge"] for p in pr]),
+        "bl_originals": np.array([p["bl_originals"] for p in pr]),
+        "insurance_present": np.array([p["insurance_present"] for p in pr], dtype=bool),
+        "insurance_coverage_pct": np.array([p["insurance_coverage_pct"] for p in pr], dtype=float),
+        "co_present": np.array([p["co_present"] for p in pr], dtype=bool),
+        "packing_list_present": np.array([p["packing_list_present"] for p in pr], dtype=bool),
+        "documents_presented_within_days": np.array([p["documents_presented_within_days"] for p in pr]),
     }
 
-    return params, answers
 
-def gen_case_I01(seed: int) -> tuple[dict, dict]:
+# =========================
+# TRADE ENGINE: SINH & KIỂM TRA HÀNG LOẠT BỘ CHỨNG TỪ T02 (DẠNG CỘT)
+# =========================
+# Danh mục dùng chung với gen_case_T02; lưu dạng mã số (categorical code)
+T02_GOODS = ["Coffee beans (Robusta)", "Pepper (Black Pepper)", "Cashew kernels", "Frozen seafood",
+             "Textile garments", "Spare parts", "Rice", "Electronics components"]
+T02_N_LC_GOODS = 5                      # 5 mặt hàng đầu dùng cho L/C, còn lại là mô tả sai
+T02_INCOTERMS = ["CIF", "FOB", "CFR"]
+T02_PORTS_LOAD = ["Ho Chi Minh City, VN", "Hai Phong, VN", "Da Nang, VN"]
+T02_PORTS_DISCHARGE = ["Los Angeles, US", "Hamburg, DE", "Rotterdam, NL", "Tokyo, JP",
+                       "Singapore, SG", "Shanghai, CN", "Sydney, AU"]
+T02_N_LC_PORTS = 4                      # 4 cảng đầu dùng cho L/C, còn lại là cảng sai
+T02_CODES = [r["code"] for r in UCP600_RULES]
+T02_EPOCH = date(2025, 1, 1)
+
+
+def gen_t02_batch(n: int, seed: int = 0, count_weights=(0.1, 0.3, 0.3, 0.3)) -> dict:
+    """
+    Sinh n bộ L/C + chứng từ dạng cột (ngày = số nguyên từ 2025-01-01, hàng/cảng/incoterm = mã số).
+    - count_weights[k]: tỷ lệ số bộ có đúng k sai biệt (phân bổ chính xác theo tỷ lệ rồi xáo trộn)
+    Trả về dict cột + "chosen": ma trận bool (n, 10) các sai biệt được cài.
+    """
     rng = np.random.default_rng(int(seed))
+    n = int(n)
 
-    # Initial investment (USD)
-    I0 = int(rng.integers(80_000, 200_001) // 1000 * 1000)
+    # --- Số sai biệt mỗi bộ: chia đúng tỷ lệ ---
+    w = np.asarray(count_weights, dtype=float)
+    w = w / w.sum()
+    per_k = np.floor(w * n).astype(int)
+    per_k[np.argmax(w)] += n - per_k.sum()
+    k = rng.permutation(np.repeat(np.arange(w.size), per_k))
 
-    # 3-year cash flows (USD)
-    cf1 = int(rng.integers(30_000, 90_001) // 1000 * 1000)
-    cf2 = int(rng.integers(30_000, 90_001) // 1000 * 1000)
-    cf3 = int(rng.integers(30_000, 90_001) // 1000 * 1000)
+    # --- L/C terms ---
+    issue = rng.integers(0, 330, n)
+    latest_ship = issue + rng.choice([30, 45, 60], n)
+    expiry = latest_ship + rng.choice([15, 21, 30], n)
+    amount = rng.integers(50_000, 300_001, n) // 1000 * 1000
+    tolerance = rng.choice([0, 5, 10], n)
+    goods = rng.integers(0, T02_N_LC_GOODS, n)
+    incoterm = rng.integers(0, len(T02_INCOTERMS), n)
+    port_load = rng.integers(0, len(T02_PORTS_LOAD), n)
+    port_discharge = rng.integers(0, T02_N_LC_PORTS, n)
+    is_cif = incoterm == 0
+
+    # --- Chọn sai biệt: khóa ngẫu nhiên, loại rule không áp dụng, lấy k khóa nhỏ nhất ---
+    keys = rng.random((n, len(T02_CODES)))
+    i06, i07 = T02_CODES.index("T02-06"), T02_CODES.index("T02-07")
+    keys[~is_cif, i06] = np.inf                       # bảo hiểm chỉ xét với CIF
+    keys[~is_cif, i07] = np.inf
+    drop_07 = rng.random(n) < 0.5                      # 06 và 07 loại trừ nhau
+    keys[is_cif & drop_07, i07] = np.inf
+    keys[is_cif & ~drop_07, i06] = np.inf
+    ranks = np.argsort(np.argsort(keys, axis=1), axis=1)
+    chosen = (ranks < k[:, None]) & np.isfinite(keys)
+
+    # --- Bộ chứng từ sạch ---
+    inv_amount = amount.astype(float)
+    inv_goods = goods.copy()
+    ship = latest_ship - rng.integers(0, 10, n)
+    bl_load = port_load.copy()
+    bl_discharge = port_discharge.copy()
+    originals = np.full(n, 3)
+    ins_present = np.where(is_cif, True, rng.random(n) < 0.5)
+    coverage = np.where(is_cif, 110, rng.choice([0, 100, 110], n)).astype(float)
+    co_present = np.ones(n, dtype=bool)
+    pl_present = np.ones(n, dtype=bool)
+    pres_days = rng.choice([5, 10, 15, 21], n)
+
+    # --- Cài sai biệt (vectorized theo mask) ---
+    c = {code: chosen[:, j] for j, code in enumerate(T02_CODES)}
+    inv_amount = np.where(c["T02-01"], np.floor(amount * (1 + tolerance / 100)) + rng.integers(500, 3000, n), inv_amount)
+    inv_goods = np.where(c["T02-02"], rng.integers(T02_N_LC_GOODS, len(T02_GOODS), n), inv_goods)
+    ship = np.where(c["T02-03"], latest_ship + rng.integers(1, 8, n), ship)
+    originals = np.where(c["T02-04"], rng.choice([0, 1, 2], n), originals)
+    bl_discharge = np.where(c["T02-05"], rng.integers(T02_N_LC_PORTS, len(T02_PORTS_DISCHARGE), n), bl_discharge)
+    ins_present = np.where(c["T02-06"], False, ins_present)
+    coverage = np.where(c["T02-07"], rng.choice([100, 105, 108], n), coverage)
+    pres_days = np.where(c["T02-08"], rng.choice([22, 25, 30], n), pres_days)
+    co_present = np.where(c["T02-09"], False, co_present)
+    pl_present = np.where(c["T02-10"], False, pl_present)
+
+    return {
+        "issue_date": issue, "latest_ship": latest_ship, "expiry_date": expiry,
+        "lc_amount": amount.astype(float), "tolerance_pct": tolerance.astype(float),
+        "lc_goods": goods, "incoterm_code": incoterm, "lc_port_load": port_load, "lc_port_discharge": port_discharge,
+        "required_bl_originals": np.full(n, 3), "max_presentation_days": np.full(n, 21),
+        "applicant": rng.integers(0, 3, n), "beneficiary": rng.integers(0, 3, n),
+        "invoice_amount": inv_amount, "invoice_goods_desc": inv_goods,
+        "bl_ship_date": ship, "bl_port_load": bl_load, "bl_port_discharge": bl_discharge, "bl_originals": originals,
+        "insurance_present": ins_present, "insurance_coverage_pct": coverage,
+        "co_present": co_present, "packing_list_present": pl_present,
+        "documents_presented_within_days": pres_days,
+        "chosen": chosen,
+    }
 
-    # Discount rate (USD) 8% - 15%
-    r = float(rng.integers(8, 16)) / 100.0
 
-    npv = -I0 + (cf1 / (1 + r) ** 1) + (cf2 / (1 + r) ** 2) + (cf3 / (1 + r) ** 3)
-    npv_round = int(round(npv))  # làm tròn USD
+def check_t02_batch(batch: dict) -> tuple[np.ndarray, pd.DataFrame]:
+    """Kiểm tra cả batch bằng rule engine UCP 600 (so sánh trực tiếp trên mã số)."""
+    cols = dict(batch)
+    cols["incoterm"] = np.asarray(T02_INCOTERMS)[batch["incoterm_code"]]
+    return check_document_sets(cols)
 
-    decision = "ACCEPT" if npv_round > 0 else "REJECT"
 
-    params = {
-        "I0": I0,
-        "cf1": cf1,
-        "cf2": cf2,
-        "cf3": cf3,
-        "r": r,  # decimal, ví dụ 0.12
+def t02_batch_case(batch: dict, i: int) -> tuple[dict, dict]:
+    """Giải mã 1 dòng của batch về đúng định dạng (params, answers) của gen_case_T02."""
+    d = lambda col: T02_EPOCH + timedelta(days=int(batch[col][i]))
+    applicants = ["ABC Import LLC", "Global Traders GmbH", "Sunrise Foods Co."]
+    beneficiaries = ["VN Export JSC", "Mekong Trading Co., Ltd.", "Saigon Agro Ltd."]
+    incoterm = T02_INCOTERMS[int(batch["incoterm_code"][i])]
+
+    lc_terms = {
+        "issue_date": d("issue_date"), "latest_ship": d("latest_ship"), "expiry_date": d("expiry_date"),
+        "amount": int(batch["lc_amount"][i]), "currency": "USD", "tolerance_pct": int(batch["tolerance_pct"][i]),
+        "goods": T02_GOODS[int(batch["lc_goods"][i])], "incoterm": incoterm,
+        "port_load": T02_PORTS_LOAD[int(batch["lc_port_load"][i])],
+        "port_discharge": T02_PORTS_DISCHARGE[int(batch["lc_port_discharge"][i])],
+        "applicant": applicants[int(batch["applicant"][i])],
+        "beneficiary": beneficiaries[int(batch["beneficiary"][i])],
+        "required_bl_originals": int(batch["required_bl_originals"][i]),
+        "max_presentation_days": int(batch["max_presentation_days"][i]),
     }
-    answers = {
-        "npv": npv_round,
-        "decision": decision,
+    presented = {
+        "invoice_amount": int(batch["invoice_amount"][i]), "invoice_currency": "USD",
+        "invoice_goods_desc": T02_GOODS[int(batch["invoice_goods_desc"][i])], "invoice_incoterm": incoterm,
+        "bl_shipped_on_board": True, "bl_ship_date": d("bl_ship_date"),
+        "bl_port_load": T02_PORTS_LOAD[int(batch["bl_port_load"][i])],
+        "bl_port_discharge": T02_PORTS_DISCHARGE[int(batch["bl_port_discharge"][i])],
+        "bl_originals": int(batch["bl_originals"][i]),
+        "insurance_present": bool(batch["insurance_present"][i]),
+        "insurance_coverage_pct": int(batch["insurance_coverage_pct"][i]), "insurance_currency": "USD",
+        "co_present": bool(batch["co_present"][i]), "packing_list_present": bool(batch["packing_list_present"][i]),
+        "documents_presented_within_days": int(batch["documents_presented_within_days"][i]),
     }
-    return params, answers
+    pool = [(r["code"], r["name"]) for r in UCP600_RULES]
+    codes = sorted(np.asarray(T02_CODES)[batch["chosen"][i]].tolist())
+    return {"lc_terms": lc_terms, "presented": presented, "discrepancy_pool": pool}, {"correct_codes": codes}
+
+
+def t02_batch_to_frame(batch: dict) -> pd.DataFrame:
+    """Bảng tổng hợp ngân hàng đề (giải mã mã số -> chuỗi) để GV tải về."""
+    epoch = np.datetime64(T02_EPOCH.isoformat())
+    codes = np.asarray(T02_CODES)
+    return pd.DataFrame({
+        "latest_ship": epoch + batch["latest_ship"].astype("timedelta64[D]"),
+        "bl_ship_date": epoch + batch["bl_ship_date"].astype("timedelta64[D]"),
+        "lc_amount": batch["lc_amount"].astype(int),
+        "tolerance_pct": batch["tolerance_pct"].astype(int),
+        "invoice_amount": batch["invoice_amount"].astype(int),
+        "incoterm": np.asarray(T02_INCOTERMS)[batch["incoterm_code"]],
+        "lc_goods": np.asarray(T02_GOODS)[batch["lc_goods"]],
+        "invoice_goods_desc": np.asarray(T02_GOODS)[batch["invoice_goods_desc"]],
+        "lc_port_discharge": np.asarray(T02_PORTS_DISCHARGE)[batch["lc_port_discharge"]],
+        "bl_port_discharge": np.asarray(T02_PORTS_DISCHARGE)[batch["bl_port_discharge"]],
+        "bl_originals": batch["bl_originals"],
+        "insurance_present": batch["insurance_present"],
+        "insurance_coverage_pct": batch["insurance_coverage_pct"].astype(int),
+        "documents_presented_within_days": batch["documents_presented_within_days"],
+        "co_present": batch["co_present"],
+        "packing_list_present": batch["packing_list_present"],
+        "correct_codes": [",".join(codes[row]) for row in batch["chosen"]],
+        "n_discrepancies": batch["chosen"].sum(axis=1),
+    })
+
 
-def irr_bisect(cashflows, low=-0.9, high=1.5, tol=1e-7, max_iter=200):
+@st.cache_data(show_spinner=False)
+def run_t02_rule_audit(n_cases: int = 2_000) -> tuple[pd.DataFrame, float, float]:
     """
-    Tính IRR bằng bisection trên NPV(r)=0.
-    cashflows: list[float] với CF0 âm.
-    Trả về irr dạng decimal (vd 0.1543).
+    Sinh n_cases đề T02 (seed 0..n-1), kiểm tra bằng rule engine.
+    Trả về (thống kê theo rule, số bộ chứng từ/giây, tỷ lệ khớp với đáp án của đề)
     """
-    def npv(rate):
-        return sum(cf / ((1 + rate) ** t) for t, cf in enumerate(cashflows))
-
-    f_low = npv(low)
-    f_high = npv(high)
-
-    # Nếu không đổi dấu -> không đảm bảo có nghiệm trong khoảng
-    if f_low == 0:
-        return low
-    if f_high == 0:
-        return high
-    if f_low * f_high > 0:
-        # fallback: trả None để báo không tính được
-        return None
+    cases, keys = [], []
+    for seed in range(int(n_cases)):
+        params, answers = gen_case_T02(seed)
+        cases.append(params)
+        keys.append(answers["correct_codes"])
+    cols = t02_cases_to_columns(cases)
 
-    for _ in range(max_iter):
-        mid = (low + high) / 2
-        f_mid = npv(mid)
-        if abs(f_mid) < tol:
-            return mid
-        if f_low * f_mid < 0:
-            high = mid
-            f_high = f_mid
-        else:
-            low = mid
-            f_low = f_mid
-    return (low + high) / 2
+    t0 = time.perf_counter()
+    hits, stats = check_document_sets(cols)
+    elapsed = max(time.perf_counter() - t0, 1e-9)
 
+    codes = np.array([c for c, _ in UCP600_COMPILED])
+    agree = np.mean([sorted(codes[h].tolist()) == k for h, k in zip(hits, keys)])
+    return stats, n_cases / elapsed, float(agree)
 
-def compute_irr_decimal(cashflows):
-    """
-    Ưu tiên numpy_financial nếu có, nếu không thì bisection.
-    """
-    try:
-        import numpy_financial as npf
-        irr = npf.irr(cashflows)
-        if irr is None or (isinstance(irr, float) and (np.isnan(irr) or np.isinf(irr))):
-            return None
-        return float(irr)
-    except Exception:
-        return irr_bisect(cashflows)
-    
-def gen_case_I02(seed: int) -> tuple[dict, dict]:
-    rng = np.random.default_rng(int(seed))
 
-    I0 = int(rng.integers(80_000, 220_001) // 1000 * 1000)
+# ==============================================================================
+# DCF PHÒNG 4: đồ thị tính toán theo nút, mỗi nút memo theo đúng input của nó
+# ==============================================================================
+# fx_path(fx_spot, depre, years) ─┐
+#                                  ├─> cf_vnd ─┬─> irr / payback           (không phụ thuộc WACC)
+# cf_usd(inv, cf, salvage, years) ─┘            └─> valuation(+wacc): PV, NPV, DPP, MIRR, PI
+# sensitivity(cf_usd, fx_spot, years, wacc_range, depre_range)
+# Đổi WACC chỉ tính lại valuation + sensitivity; đổi mất giá không tính lại cf_usd; v.v.
+@st.cache_data(show_spinner=False)
+def dcf_fx_path(fx_spot: float, depre: float, years: int) -> np.ndarray:
+    """Tỷ giá kỳ vọng S_t = S_0 (1 + mất giá)^t, t = 0..years."""
+    return fx_spot * (1 + depre / 100) ** np.arange(int(years) + 1)
 
-    # 4 năm để IRR "đẹp" hơn
-    cf1 = int(rng.integers(25_000, 90_001) // 1000 * 1000)
-    cf2 = int(rng.integers(25_000, 95_001) // 1000 * 1000)
-    cf3 = int(rng.integers(25_000, 100_001) // 1000 * 1000)
-    cf4 = int(rng.integers(25_000, 110_001) // 1000 * 1000)
 
-    # WACC 8% - 16%
-    wacc = float(rng.integers(8, 17)) / 100.0
+@st.cache_data(show_spinner=False)
+def dcf_cf_usd(inv: float, cf_yearly: float, salvage_val: float, years: int) -> np.ndarray:
+    """Dòng tiền USD: năm 0 = -CapEx, năm cuối cộng giá trị thanh lý."""
+    cf_usd = np.full(int(years) + 1, float(cf_yearly))
+    cf_usd[0] = -inv
+    cf_usd[-1] += salvage_val
+    return cf_usd
 
-    cashflows = [-I0, cf1, cf2, cf3, cf4]
-    irr = compute_irr_decimal(cashflows)
-
-    # Nếu hiếm khi irr None do dữ liệu không đổi dấu trong khoảng -> regen nhẹ bằng seed+1
-    if irr is None:
-        rng = np.random.default_rng(int(seed) + 1)
-        I0 = int(rng.integers(80_000, 220_001) // 1000 * 1000)
-        cf1 = int(rng.integers(30_000, 90_001) // 1000 * 1000)
-        cf2 = int(rng.integers(30_000, 95_001) // 1000 * 1000)
-        cf3 = int(rng.integers(30_000, 100_001) // 1000 * 1000)
-        cf4 = int(rng.integers(30_000, 110_001) // 1000 * 1000)
-        wacc = float(rng.integers(8, 17)) / 100.0
-        cashflows = [-I0, cf1, cf2, cf3, cf4]
-        irr = compute_irr_decimal(cashflows)
 
-    irr_pct = float(irr) * 100.0
-    irr_pct_round = round(irr_pct, 2)  # làm tròn 2 chữ số thập phân
+@st.cache_data(show_spinner=False)
+def dcf_cf_vnd(inv: float, cf_yearly: float, salvage_val: float, years: int,
+               fx_spot: float, depre: float) -> np.ndarray:
+    return dcf_cf_usd(inv, cf_yearly, salvage_val, years) * dcf_fx_path(fx_spot, depre, years)
 
-    decision = "ACCEPT" if irr > wacc else "REJECT"
 
-    params = {
-        "I0": I0,
-        "cf1": cf1, "cf2": cf2, "cf3": cf3, "cf4": cf4,
-        "wacc": wacc,              # decimal
-        "cashflows": cashflows,    # lưu để debug/học
-    }
-    answers = {
-        "irr_pct": irr_pct_round,  # %
-        "decision": decision,
+@st.cache_data(show_spinner=False)
+def dcf_rate_free_metrics(inv: float, cf_yearly: float, salvage_val: float, years: int,
+                          fx_spot: float, depre: float) -> dict:
+    """Chỉ tiêu không phụ thuộc WACC: IRR và hoàn vốn giản đơn."""
+    cf_vnd = dcf_cf_vnd(inv, cf_yearly, salvage_val, years, fx_spot, depre)
+    return {"irr": cf_irr(cf_vnd, 0.1, n_iter=50), "payback": cf_payback(cf_vnd)}
+
+
+@st.cache_data(show_spinner=False)
+def dcf_valuation(inv: float, cf_yearly: float, salvage_val: float, years: int,
+                  fx_spot: float, depre: float, wacc: float) -> tuple[pd.DataFrame, dict]:
+    """Bảng dòng tiền (PV, lũy kế) + NPV, DPP, MIRR, PI tại WACC; ghép thêm IRR/PP từ nút trên."""
+    cf_usd = dcf_cf_usd(inv, cf_yearly, salvage_val, years)
+    fx_path = dcf_fx_path(fx_spot, depre, years)
+    cf_vnd = dcf_cf_vnd(inv, cf_yearly, salvage_val, years, fx_spot, depre)
+    rate = wacc / 100
+    pv_vnd = cf_present_values(cf_vnd, rate)
+    df_cf = pd.DataFrame(
+        {
+            "Năm": np.arange(int(years) + 1),
+            "Tỷ giá (VND/USD)": fx_path,
+            "CF (USD)": cf_usd,
+            "CF Quy đổi (VND)": cf_vnd,
+            "PV (Hiện giá VND)": pv_vnd,
+            "Lũy kế PV": np.cumsum(pv_vnd),
+        }
+    )
+    metrics = {
+        "npv": cf_npv(cf_vnd, rate),
+        "mirr": cf_mirr(cf_vnd, rate, rate),
+        "pi": cf_profitability_index(cf_vnd, rate),
+        "dpp": cf_payback(cf_vnd, rate),
+        **dcf_rate_free_metrics(inv, cf_yearly, salvage_val, years, fx_spot, depre),
     }
-    return params, answers
+    return df_cf, metrics
 
-def gen_case_M01(seed: int) -> tuple[dict, dict]:
+
+@st.cache_data(show_spinner=False)
+def dcf_sensitivity(inv: float, cf_yearly: float, salvage_val: float, years: int,
+                    fx_spot: float, wacc_range: tuple, depre_range: tuple) -> pd.DataFrame:
+    """Ma trận NPV (WACC x mất giá) tính một lượt bằng cf_npv theo lô."""
+    cf_usd = dcf_cf_usd(inv, cf_yearly, salvage_val, years)
+    w_grid, d_grid = np.meshgrid(wacc_range, depre_range, indexing="ij")
+    sim_cf_vnd = cf_usd * (fx_spot * (1 + d_grid.reshape(-1, 1) / 100) ** np.arange(int(years) + 1))
+    npv_grid = cf_npv(sim_cf_vnd, w_grid.reshape(-1) / 100).reshape(w_grid.shape)
+    return pd.DataFrame(
+        npv_grid,
+        index=[f"WACC {w:.1f}%" for w in wacc_range],
+        columns=[f"Mất giá {d:.1f}%" for d in depre_range],
+    )
+
+
+# ==============================================================================
+# QUYỀN CHỌN THỰC (REAL OPTIONS) - cây nhị phân CRR trên giá trị dự án (VND)
+# ==============================================================================
+REAL_OPTION_KINDS = ["DELAY", "EXPAND", "ABANDON"]
+REAL_OPTION_LABELS = {
+    "DELAY": "⏳ Quyền trì hoãn đầu tư",
+    "EXPAND": "📈 Quyền mở rộng quy mô",
+    "ABANDON": "🛑 Quyền từ bỏ (thanh lý)",
+}
+
+
+def project_value_vol(sigma_project: float, sigma_fx: float, rho: float) -> float:
+    """Độ biến động giá trị dự án tính bằng VND = dự án USD x tỷ giá (cộng phương sai có tương quan)."""
+    var = sigma_project ** 2 + sigma_fx ** 2 + 2 * rho * sigma_project * sigma_fx
+    if var <= 1e-12:
+        raise ValueError("Độ biến động giá trị dự án (VND) bằng 0: hai nguồn biến động triệt tiêu nhau, "
+                         "hãy đổi biến động hoặc tương quan.")
+    return math.sqrt(var)
+
+
+def binomial_real_option(v0: float, sigma: float, r: float, T: float, n_steps: int, kind: str,
+                         strike: float, q: float = 0.0, expand_pct: float = 0.0) -> float:
     """
-    M01: Cú sốc tỷ giá lên nợ công
-    - Random: nợ nước ngoài (tỷ USD), tỷ giá gốc, shock %
-    - Yêu cầu SV tính: tỷ giá mới, gánh nặng tăng thêm (nghìn tỷ VND)
+    Định giá quyền kiểu Mỹ trên cây CRR kết hợp lại (recombining) của giá trị dự án V.
+    - DELAY:   giá trị cơ hội đầu tư = max(V - strike, 0), được chờ tới T  (trả về C)
+    - EXPAND:  dự án + quyền trả strike để có thêm expand_pct x V       (trả về W - V0)
+    - ABANDON: dự án + quyền bán/thanh lý ở strike                        (trả về W - V0)
+    q: tỷ suất dòng tiền dự án chi trả (đóng vai "cổ tức" của V, dùng cho cả 3 loại quyền).
+    Quy nạp ngược vector hoá theo từng bước: mỗi bước là vài phép toán trên mảng <= n+1 phần tử.
     """
-    import numpy as np
+    if not sigma > 1e-6:
+        raise ValueError("Độ biến động phải > 0 để dựng cây nhị phân.")
+    n = int(n_steps)
+    dt = T / n
+    u = math.exp(sigma * math.sqrt(dt))
+    d = 1.0 / u
+    p = (math.exp((r - q) * dt) - d) / (u - d)
+    if not 0.0 < p < 1.0:
+        raise ValueError("Xác suất rủi ro trung tính ngoài (0, 1): tăng số bước hoặc độ biến động.")
+    disc = math.exp(-r * dt)
+
+    if kind == "DELAY":
+        exercise = lambda v: np.maximum(v - strike, 0.0)
+    elif kind == "EXPAND":
+        exercise = lambda v: np.maximum(v, (1.0 + expand_pct) * v - strike)
+    elif kind == "ABANDON":
+        exercise = lambda v: np.maximum(v, strike)
+    else:
+        raise ValueError(f"Loại quyền không hợp lệ: {kind}")
 
-    # tránh seed quá lớn (an toàn cho DB nếu bạn có lưu seed)
-    seed = int(seed) % 2_000_000_000
-    rng = np.random.default_rng(seed)
+    v = v0 * u ** (2.0 * np.arange(n + 1) - n)   # giá trị dự án tại đáo hạn (j = số bước lên)
+    val = exercise(v)
+    for _ in range(n):
+        v = v[:-1] * u
+        val = disc * (p * val[1:] + (1.0 - p) * val[:-1])
+        val = np.maximum(val, exercise(v))
+    return float(val[0]) if kind == "DELAY" else max(float(val[0] - v0), 0.0)   # quyền không âm (bỏ sai số làm tròn)
 
-    debt_usd_bn = int(rng.integers(20, 101))  # 20..100 (tỷ USD)
-    base_rate = int(rng.integers(23000, 27001) // 50 * 50)  # bội 50 cho “đẹp”
-    shock_pct = float(rng.choice([5, 7, 10, 12, 15, 18, 20, 25, 30]))
 
-    new_rate = int(round(base_rate * (1 + shock_pct / 100), 0))
+@st.cache_data(show_spinner=False)
+def value_real_options(inv: float, cf_yearly: float, salvage_val: float, years: int,
+                       fx_spot: float, depre: float, wacc: float,
+                       sigma_project: float, sigma_fx: float, rho: float, r_vnd: float,
+                       delay_years: float, expand_pct: float, expand_cost_usd: float,
+                       n_steps: int) -> tuple[pd.DataFrame, dict]:
+    """
+    Gắn 3 quyền chọn thực vào mô hình DCF phòng 4 (wacc, depre theo %, các tham số còn lại theo decimal).
+    V0 = PV dòng tiền VND tương lai (tại WACC); đầu tư I = CapEx x Spot.
+    Trả về (bảng so sánh NPV tĩnh / giá trị quyền / NPV mở rộng, thông số cây).
+    """
+    df_cf, metrics = dcf_valuation(inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc)
+    invest_vnd = inv * fx_spot
+    v0 = metrics["npv"] + invest_vnd
+    static_npv = metrics["npv"]
+    sigma = project_value_vol(sigma_project, sigma_fx, rho)
+    q = float(df_cf["CF Quy đổi (VND)"].iloc[1]) / v0 if v0 > 0 else 0.0
+
+    delay = binomial_real_option(v0, sigma, r_vnd, delay_years, n_steps, "DELAY", invest_vnd, q=q)
+    expand = binomial_real_option(v0, sigma, r_vnd, float(years), n_steps, "EXPAND",
+                                  expand_cost_usd * fx_spot, q=q, expand_pct=expand_pct)
+    abandon = binomial_real_option(v0, sigma, r_vnd, float(years), n_steps, "ABANDON",
+                                   salvage_val * fx_spot, q=q)
+
+    # Trì hoãn: NPV mở rộng = giá trị cơ hội C (thay cho đầu tư ngay); quyền = C - max(NPV, 0)
+    rows = [
+        {"Quyền": REAL_OPTION_LABELS["DELAY"], "NPV tĩnh (VND)": static_npv,
+         "Giá trị quyền (VND)": max(delay - max(static_npv, 0.0), 0.0), "NPV mở rộng (VND)": delay},
+        {"Quyền": REAL_OPTION_LABELS["EXPAND"], "NPV tĩnh (VND)": static_npv,
+         "Giá trị quyền (VND)": expand, "NPV mở rộng (VND)": static_npv + expand},
+        {"Quyền": REAL_OPTION_LABELS["ABANDON"], "NPV tĩnh (VND)": static_npv,
+         "Giá trị quyền (VND)": abandon, "NPV mở rộng (VND)": static_npv + abandon},
+    ]
+    info = {"v0": v0, "invest_vnd": invest_vnd, "sigma": sigma, "q": q}
+    return pd.DataFrame(rows), info
+
 
-    # Quy đổi đơn vị:
-    # debt_usd_bn (tỷ USD) * base_rate (VND/USD) -> nghìn tỷ VND vì: bn * rate / 1000
-    base_debt_tril = round(debt_usd_bn * base_rate / 1000, 1)
-    new_debt_tril = round(debt_usd_bn * new_rate / 1000, 1)
-    increase_tril = round(new_debt_tril - base_debt_tril, 1)
+# ==============================================================================
+# ĐỘ NHẠY TOÀN DIỆN MÔ HÌNH FDI: Tornado (một-lần-một-biến) + Sobol (phương sai)
+# ==============================================================================
+DCF_DRIVERS = ["inv", "cf_yearly", "salvage_val", "years", "fx_spot", "depre", "wacc"]
+DCF_DRIVER_LABELS = {
+    "inv": "Vốn đầu tư (USD)",
+    "cf_yearly": "Dòng tiền/năm (USD)",
+    "salvage_val": "Giá trị thanh lý (USD)",
+    "years": "Vòng đời (năm)",
+    "fx_spot": "Tỷ giá Spot",
+    "depre": "Mất giá VND (%)",
+    "wacc": "WACC (%)",
+}
 
-    params = {
-        "debt_usd_bn": debt_usd_bn,
-        "base_rate": base_rate,
-        "shock_pct": shock_pct,
-    }
-    answers = {
-        "new_rate": new_rate,
-        "increase_tril": increase_tril,
-        "base_debt_tril": base_debt_tril,
-        "new_debt_tril": new_debt_tril,
-    }
-    return params, answers
 
-def gen_case_M02(seed: int) -> tuple[dict, dict]:
+def dcf_npv_batch(inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc) -> np.ndarray:
     """
-    M02: Carry Trade Unwind (Option A)
-    SV nhập:
-    1) VND nhận được khi mở carry (JPY->VND)
-    2) P/L (VND) sau horizon_days khi JPY mạnh lên shock_pct
-    3) Margin call? dựa equity_vnd và margin_trigger
+    NPV (VND) cho lô kịch bản - mỗi tham số là số hoặc mảng (B,).
+    Vòng đời khác nhau được đệm 0 tới vòng đời dài nhất rồi chiết khấu một lượt bằng cf_npv.
     """
-    import numpy as np
+    inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc = np.broadcast_arrays(
+        *(np.atleast_1d(np.asarray(x, dtype=float)) for x in (inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc))
+    )
+    years = years.astype(np.int64)
+    t = np.arange(int(years.max()) + 1)
+    alive = t <= years[:, None]
+    cf_usd = np.where(alive, cf_yearly[:, None], 0.0)
+    cf_usd[:, 0] = -inv
+    cf_usd += np.where(t == years[:, None], salvage_val[:, None], 0.0)
+    fx = fx_spot[:, None] * (1 + depre[:, None] / 100) ** t
+    return cf_npv(cf_usd * fx, wacc / 100)
+
+
+def dcf_driver_ranges(base: dict, swing_pct: float, rate_pts: float, year_step: int) -> dict:
+    """Khoảng thấp/cao của từng biến: tiền & tỷ giá ±swing_pct%, WACC/mất giá ±rate_pts điểm, vòng đời ±year_step năm."""
+    ranges = {}
+    for k in DCF_DRIVERS:
+        v = float(base[k])
+        if k == "years":
+            ranges[k] = (max(1, int(v) - int(year_step)), int(v) + int(year_step))
+        elif k in ("depre", "wacc"):
+            ranges[k] = (v - rate_pts, v + rate_pts)
+        else:
+            ranges[k] = (v * (1 - swing_pct / 100), v * (1 + swing_pct / 100))
+    return ranges
 
-    seed = int(seed) % 2_000_000_000
-    rng = np.random.default_rng(seed)
 
-    # Notional vay JPY (triệu JPY -> đổi ra JPY)
-    notional_mjpy = int(rng.integers(50, 301))          # 50..300 (million JPY)
-    notional_jpy = int(notional_mjpy * 1_000_000)
+@st.cache_data(show_spinner=False)
+def dcf_tornado(inv: float, cf_yearly: float, salvage_val: float, years: int, fx_spot: float,
+                depre: float, wacc: float, swing_pct: float, rate_pts: float, year_step: int) -> tuple[pd.DataFrame, float]:
+    """Đẩy từng biến lên thấp/cao (giữ nguyên các biến khác) -> 2k+1 kịch bản trong 1 lần gọi dcf_npv_batch."""
+    base = dict(inv=inv, cf_yearly=cf_yearly, salvage_val=salvage_val, years=years,
+                fx_spot=fx_spot, depre=depre, wacc=wacc)
+    ranges = dcf_driver_ranges(base, swing_pct, rate_pts, year_step)
+    k = len(DCF_DRIVERS)
+    grid = {name: np.full(2 * k + 1, float(base[name])) for name in DCF_DRIVERS}
+    for i, name in enumerate(DCF_DRIVERS):
+        grid[name][2 * i], grid[name][2 * i + 1] = ranges[name]
+    npv = dcf_npv_batch(**grid)
+    base_npv = float(npv[-1])
+    df = pd.DataFrame({
+        "Biến": [DCF_DRIVER_LABELS[n] for n in DCF_DRIVERS],
+        "Giá trị thấp": [ranges[n][0] for n in DCF_DRIVERS],
+        "Giá trị cao": [ranges[n][1] for n in DCF_DRIVERS],
+        "NPV khi thấp": npv[0:2 * k:2],
+        "NPV khi cao": npv[1:2 * k:2],
+    })
+    df["Biên độ"] = (df["NPV khi cao"] - df["NPV khi thấp"]).abs()
+    return df.sort_values("Biên độ", ascending=False).reset_index(drop=True), base_npv
+
+
+def sobol_saltelli(fn, lows, highs, integer_mask, n: int, seed: int = 42) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Chỉ số Sobol bậc 1 (Saltelli 2010) và tổng (Jansen) cho biến độc lập phân phối đều [low, high].
+    fn nhận ma trận (n, k) và trả về (n,). Tốn n(k+2) lần gọi mô hình, mỗi lần một lô n.
+    """
+    lows, highs = np.asarray(lows, dtype=float), np.asarray(highs, dtype=float)
+    k = len(lows)
+    rng = np.random.default_rng(seed)
 
-    # Spot JPY/VND (VND/JPY) - làm tròn theo bước 0.5 cho "đẹp"
-    s0 = float(rng.integers(160, 211) / 10)             # 16.0 .. 21.0 (VND/JPY)
+    def draw():
+        x = lows + rng.random((n, k)) * (highs - lows)
+        # biến rời rạc (số năm): đều trên các số nguyên low..high
+        x[:, integer_mask] = np.floor(lows[integer_mask] + rng.random((n, int(np.sum(integer_mask))))
+                                      * (highs[integer_mask] - lows[integer_mask] + 1))
+        return x
+
+    a, b = draw(), draw()
+    f_a, f_b = fn(a), fn(b)
+    var = np.var(np.concatenate([f_a, f_b]))
+    s1, st_ = np.zeros(k), np.zeros(k)
+    for i in range(k):
+        ab = a.copy()
+        ab[:, i] = b[:, i]
+        f_ab = fn(ab)
+        s1[i] = np.mean(f_b * (f_ab - f_a)) / var
+        st_[i] = 0.5 * np.mean((f_a - f_ab) ** 2) / var
+    return s1, st_
 
-    # Lãi suất năm
-    i_vnd = float(rng.choice([0.05, 0.06, 0.07, 0.08, 0.09, 0.10]))
-    i_jpy = float(rng.choice([0.001, 0.003, 0.005, 0.01, 0.015, 0.02]))
 
-    horizon_days = int(rng.choice([30, 60, 90]))
-    t = horizon_days / 360.0
+@st.cache_data(show_spinner=False)
+def dcf_sobol(inv: float, cf_yearly: float, salvage_val: float, years: int, fx_spot: float,
+              depre: float, wacc: float, swing_pct: float, rate_pts: float, year_step: int,
+              n: int = 100_000, seed: int = 42) -> pd.DataFrame:
+    """Sobol toàn cục trên cùng khoảng thấp/cao của tornado (mỗi biến phân phối đều)."""
+    base = dict(inv=inv, cf_yearly=cf_yearly, salvage_val=salvage_val, years=years,
+                fx_spot=fx_spot, depre=depre, wacc=wacc)
+    ranges = dcf_driver_ranges(base, swing_pct, rate_pts, year_step)
+    lows = [ranges[k][0] for k in DCF_DRIVERS]
+    highs = [ranges[k][1] for k in DCF_DRIVERS]
+    integer_mask = np.array([k == "years" for k in DCF_DRIVERS])
+    s1, st_ = sobol_saltelli(lambda x: dcf_npv_batch(*x.T), lows, highs, integer_mask, int(n), seed)
+    df = pd.DataFrame({
+        "Biến": [DCF_DRIVER_LABELS[k] for k in DCF_DRIVERS],
+        "Sobol bậc 1 (S1)": s1,
+        "Sobol tổng (ST)": st_,
+    })
+    return df.sort_values("Sobol tổng (ST)", ascending=False).reset_index(drop=True)
+
+
+def build_tornado_chart(df_tornado: pd.DataFrame, base_npv: float) -> alt.LayerChart:
+    """Biểu đồ tornado: mỗi biến 2 thanh từ NPV gốc tới NPV khi thấp/cao, xếp theo biên độ."""
+    order = df_tornado["Biến"].tolist()
+    long = pd.concat([
+        pd.DataFrame({"Biến": df_tornado["Biến"], "Kịch bản": "Biến ở mức thấp",
+                      "NPV": df_tornado["NPV khi thấp"], "Gốc": base_npv}),
+        pd.DataFrame({"Biến": df_tornado["Biến"], "Kịch bản": "Biến ở mức cao",
+                      "NPV": df_tornado["NPV khi cao"], "Gốc": base_npv}),
+    ])
+    bars = alt.Chart(long).mark_bar().encode(
+        y=alt.Y("Biến:N", sort=order, title=None),
+        x=alt.X("NPV:Q", title="NPV (VND)", axis=alt.Axis(format="~s")),
+        x2="Gốc:Q",
+        color=alt.Color("Kịch bản:N", scale=alt.Scale(range=["#ff6b6b", "#4B4BFF"]),
+                        legend=alt.Legend(orient="bottom", title=None)),
+        tooltip=["Biến", "Kịch bản", alt.Tooltip("NPV:Q", format=",.0f")],
+    )
+    rule = alt.Chart(pd.DataFrame({"Gốc": [base_npv]})).mark_rule(color="black", strokeDash=[4, 4]).encode(x="Gốc:Q")
+    return (bars + rule).properties(height=40 * len(order) + 40)
 
-    # Shock: JPY mạnh lên so với VND => JPY/VND tăng => VND/JPY (s) cũng tăng
-    shock_pct = float(rng.choice([3, 5, 8, 10, 12, 15]))
-    s1 = s0 * (1 + shock_pct / 100)
 
-    # Vốn tự có + ngưỡng margin call
-    equity_vnd = int(rng.integers(100, 401) * 1_000_000)  # 100..400 triệu VND
-    margin_trigger = float(rng.choice([0.10, 0.15]))      # 10% hoặc 15%
+# ==============================================================================
+# STRESS TEST NỢ CÔNG ĐA TIỀN TỆ (phòng 5) - cú sốc tương quan + kịch bản khủng hoảng
+# ==============================================================================
+DEBT_CURRENCIES = ["USD", "JPY", "EUR", "CNY"]
+# Danh mục mặc định (minh hoạ): dư nợ quy đổi USD theo tỷ giá hôm nay, kỳ hạn còn lại, lãi suất
+DEFAULT_DEBT_PORTFOLIO = [
+    ("USD", 25.0, 8.0, 4.5),
+    ("JPY", 15.0, 20.0, 1.0),
+    ("EUR", 6.0, 12.0, 2.0),
+    ("CNY", 4.0, 10.0, 3.0),
+]
+# Phân phối 1 năm của % thay đổi VND trên 1 đơn vị ngoại tệ (log-return): kỳ vọng, độ lệch chuẩn
+DEBT_SHOCK_DRIFT = {"USD": 2.0, "JPY": 0.0, "EUR": 1.0, "CNY": 1.5}
+DEBT_SHOCK_VOL = {"USD": 3.0, "JPY": 10.0, "EUR": 8.0, "CNY": 4.0}
+DEBT_SHOCK_CORR = [
+    [1.00, 0.30, 0.35, 0.80],
+    [0.30, 1.00, 0.50, 0.30],
+    [0.35, 0.50, 1.00, 0.35],
+    [0.80, 0.30, 0.35, 1.00],
+]
+# Kịch bản khủng hoảng đóng gói sẵn: % VND mất giá so với từng ngoại tệ ở đỉnh căng thẳng.
+# Mức minh hoạ làm tròn từ diễn biến lịch sử (EUR năm 1997 lấy theo DEM), không phải số liệu chính thức.
+DEBT_CRISIS_PRESETS = {
+    "Khủng hoảng châu Á 1997–98": {"USD": 26.0, "JPY": -3.0, "EUR": 8.0, "CNY": 26.0},
+    "Khủng hoảng tài chính toàn cầu 2008–09": {"USD": 10.0, "JPY": 33.0, "EUR": 5.0, "CNY": 17.0},
+    "Phá giá VND 2011": {"USD": 9.3, "JPY": 16.0, "EUR": 18.0, "CNY": 14.0},
+    "USD mạnh 2022": {"USD": 8.0, "JPY": -17.0, "EUR": -8.0, "CNY": -6.0},
+}
 
-    # ---- Tính đáp án ----
-    vnd_open = notional_jpy * s0
-    vnd_end = vnd_open * (1 + i_vnd * t)
 
-    jpy_debt = notional_jpy * (1 + i_jpy * t)
-    jpy_repay_capacity = vnd_end / s1
+def nearest_psd_corr(corr) -> np.ndarray:
+    """Đưa ma trận tương quan nhập tay về nửa xác định dương gần nhất (cắt trị riêng âm, chuẩn hoá đường chéo)."""
+    c = np.asarray(corr, dtype=float)
+    c = (c + c.T) / 2
+    w, v = np.linalg.eigh(c)
+    c = (v * np.clip(w, 1e-10, None)) @ v.T
+    d = np.sqrt(np.diag(c))
+    return c / np.outer(d, d)
 
-    pl_jpy = jpy_repay_capacity - jpy_debt
-    pl_vnd = pl_jpy * s1  # định giá theo tỷ giá unwind
 
-    loss_vnd = max(0.0, -pl_vnd)
-    loss_pct = loss_vnd / max(1.0, equity_vnd)
-    margin_call = bool(loss_pct >= margin_trigger)
+def simulate_fx_shocks(drift_pct, vol_pct, corr, n: int, seed: int = 42, t_df=None) -> np.ndarray:
+    """
+    Hệ số nhân tỷ giá VND/ngoại tệ sau 1 năm cho n kịch bản, shape (n, k).
+    log-return ~ chuẩn đa biến (hoặc Student-t đa biến nếu t_df) với tương quan corr.
+    """
+    mu = np.asarray(drift_pct, dtype=float) / 100
+    sig = np.asarray(vol_pct, dtype=float) / 100
+    chol = np.linalg.cholesky(nearest_psd_corr(corr))
+    rng = np.random.default_rng(int(seed))
+    z = rng.standard_normal((int(n), len(mu))) @ chol.T
+    if t_df:
+        # t đa biến: chia chung 1 biến chi-square mỗi kịch bản (khủng hoảng lan sang mọi đồng tiền), giữ phương sai
+        w = np.sqrt(rng.chisquare(t_df, size=(int(n), 1)) / t_df)
+        z = z / w * math.sqrt((t_df - 2) / t_df)
+    return np.exp(mu + sig * z)
 
-    # Làm tròn để chấm dễ (VND làm tròn 1,000)
-    vnd_open_r = int(round(vnd_open / 1000) * 1000)
-    pl_vnd_r = int(round(pl_vnd / 1000) * 1000)
 
-    params = {
-        "notional_mjpy": notional_mjpy,
-        "notional_jpy": notional_jpy,
-        "s0": s0,
-        "i_vnd": i_vnd,
-        "i_jpy": i_jpy,
-        "horizon_days": horizon_days,
-        "shock_pct": shock_pct,
-        "s1": s1,
-        "equity_vnd": equity_vnd,
-        "margin_trigger": margin_trigger,
+def debt_stress_metrics(amount_usd_bn, maturity_years, rate_pct, fx_mult, usdvnd: float, revenue_tril: float) -> dict:
+    """
+    Với mỗi kịch bản (dòng của fx_mult):
+    - tăng gánh nặng nợ (nghìn tỷ VND) = Σ dư nợ_c × USD/VND × (hệ số_c - 1) / 1000
+    - nghĩa vụ trả nợ năm tới = Σ dư nợ_c × (lãi suất_c + 1/kỳ hạn_c) × USD/VND × hệ số_c / 1000
+    - tỷ lệ trả nợ/thu ngân sách (%) = nghĩa vụ / thu ngân sách
+    """
+    amount = np.asarray(amount_usd_bn, dtype=float)
+    service = amount * (np.asarray(rate_pct, dtype=float) / 100 + 1.0 / np.maximum(np.asarray(maturity_years, dtype=float), 1.0))
+    fx_mult = np.atleast_2d(fx_mult)
+    increase = (fx_mult - 1.0) @ amount * usdvnd / 1000
+    service_vnd = fx_mult @ service * usdvnd / 1000
+    return {
+        "increase": increase,
+        "service": service_vnd,
+        "dsr": service_vnd / revenue_tril * 100,
+        "base_debt": amount.sum() * usdvnd / 1000,
+        "base_dsr": service.sum() * usdvnd / 1000 / revenue_tril * 100,
     }
-    answers = {
-        "vnd_open": vnd_open_r,
-        "pl_vnd": pl_vnd_r,
-        "margin_call": margin_call,
-        # thêm vài số để bạn debug/giải thích nếu cần
-        "vnd_end": float(vnd_end),
-        "jpy_debt": float(jpy_debt),
-        "loss_pct": float(loss_pct),
+
+
+@st.cache_data(show_spinner=False)
+def run_debt_stress(portfolio: tuple, drift: tuple, vol: tuple, corr: tuple, usdvnd: float,
+                    revenue_tril: float, dsr_limit: float, n_sims: int = 50_000,
+                    fat_tails: bool = True, seed: int = 42) -> tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    portfolio: ((tiền tệ, dư nợ tỷ USD, kỳ hạn, lãi suất %), ...) - tiền tệ phải thuộc DEBT_CURRENCIES.
+    Trả về (bảng phân phối Monte Carlo, histogram tăng gánh nặng, bảng kịch bản khủng hoảng).
+    """
+    ccy_idx = [DEBT_CURRENCIES.index(c) for c, *_ in portfolio]
+    amount = np.array([p[1] for p in portfolio], dtype=float)
+    maturity = np.array([p[2] for p in portfolio], dtype=float)
+    rate = np.array([p[3] for p in portfolio], dtype=float)
+
+    mult_all = simulate_fx_shocks(drift, vol, corr, n_sims, seed, t_df=4.0 if fat_tails else None)
+    res = debt_stress_metrics(amount, maturity, rate, mult_all[:, ccy_idx], usdvnd, revenue_tril)
+
+    pcts = [50, 95, 99]
+    inc_q = np.percentile(res["increase"], pcts)
+    dsr_q = np.percentile(res["dsr"], pcts)
+    df_dist = pd.DataFrame({
+        "Chỉ tiêu": ["Tăng gánh nặng nợ (nghìn tỷ VND)", "Trả nợ / Thu NS (%)"],
+        "Hiện tại": [0.0, res["base_dsr"]],
+        "Trung bình": [res["increase"].mean(), res["dsr"].mean()],
+        "P50": [inc_q[0], dsr_q[0]],
+        "P95": [inc_q[1], dsr_q[1]],
+        "P99": [inc_q[2], dsr_q[2]],
+        "Xấu nhất": [res["increase"].max(), res["dsr"].max()],
+    })
+    df_dist.attrs["p_breach"] = float((res["dsr"] > dsr_limit).mean() * 100)
+    df_dist.attrs["base_debt"] = float(res["base_debt"])
+
+    preset_mult = np.array([[1 + p[c] / 100 for c in DEBT_CURRENCIES] for p in DEBT_CRISIS_PRESETS.values()])
+    res_p = debt_stress_metrics(amount, maturity, rate, preset_mult[:, ccy_idx], usdvnd, revenue_tril)
+
+    # Histogram trên [P0.1, P99.9] (mở rộng để chứa các kịch bản lịch sử), đuôi dồn vào bin ngoài cùng
+    lo = min(np.percentile(res["increase"], 0.1), res_p["increase"].min())
+    hi = max(np.percentile(res["increase"], 99.9), res_p["increase"].max())
+    counts, edges = np.histogram(np.clip(res["increase"], lo, hi), bins=60, range=(lo, hi))
+    df_hist = pd.DataFrame({"Từ": edges[:-1], "Đến": edges[1:], "Tần suất (%)": counts / n_sims * 100})
+    df_preset = pd.DataFrame({
+        "Kịch bản": list(DEBT_CRISIS_PRESETS),
+        **{f"VND/{c} (%)": [p[c] for p in DEBT_CRISIS_PRESETS.values()] for c in DEBT_CURRENCIES},
+        "Tăng gánh nặng (nghìn tỷ VND)": res_p["increase"],
+        "Trả nợ / Thu NS (%)": res_p["dsr"],
+        "Phân vị MC (%)": [float((res["increase"] <= x).mean() * 100) for x in res_p["increase"]],
+    })
+    return df_dist, df_hist, df_preset
+
+
+# ==============================================================================
+# CARRY TRADE UNWIND THEO ĐƯỜNG ĐI (phòng 5 / bài M02) - margin call kiểm tra hằng ngày
+# ==============================================================================
+def simulate_carry_unwind(notional_jpy: float, s0: float, i_vnd: float, i_jpy: float, horizon_days: int,
+                          equity_vnd: float, margin_trigger: float, vol_pct: float, jump_lambda: float,
+                          jump_mean_pct: float, jump_sd_pct: float, drift_pct: float = 0.0,
+                          n_paths: int = 100_000, chunk: int = 10_000, seed: int = 42) -> dict:
+    """
+    Mô phỏng tỷ giá VND/JPY hằng ngày (khuếch tán + bước nhảy Poisson, JPY tăng giá = s tăng)
+    và đánh giá vị thế carry như M02 tại MỖI ngày:
+        P/L_d = VND_open (1 + i_vnd d/360) - JPY_nợ (1 + i_jpy d/360) x s_d
+    Margin call ở ngày đầu tiên lỗ/vốn tự có >= margin_trigger (first passage).
+    Chạy theo chunk (m đường x horizon ngày) để bộ nhớ không tăng theo n_paths.
+    """
+    h = int(horizon_days)
+    dt = 1.0 / 365
+    sig = vol_pct / 100
+    mu_j, sd_j = jump_mean_pct / 100, jump_sd_pct / 100
+    days = np.arange(1, h + 1)
+    vnd_asset = notional_jpy * s0 * growth_factor(i_vnd, year_fraction(days=days))   # (h,)
+    jpy_debt = notional_jpy * growth_factor(i_jpy, year_fraction(days=days))          # (h,)
+
+    rng = np.random.default_rng(int(seed))
+    n_calls = 0
+    loss_at_call = 0.0
+    call_day_counts = np.zeros(h, dtype=np.int64)
+    terminal_pl = np.empty(int(n_paths))
+    done = 0
+    while done < n_paths:
+        m = min(int(chunk), int(n_paths) - done)
+        n_jumps = rng.poisson(jump_lambda * dt, size=(m, h))
+        log_ret = ((drift_pct / 100 - 0.5 * sig ** 2) * dt + sig * math.sqrt(dt) * rng.standard_normal((m, h))
+                   + n_jumps * mu_j + np.sqrt(n_jumps) * sd_j * rng.standard_normal((m, h)))
+        s_path = s0 * np.exp(np.cumsum(log_ret, axis=1))
+        pl = vnd_asset - jpy_debt * s_path                           # (m, h)
+        breach = -pl >= margin_trigger * equity_vnd
+        hit = breach.any(axis=1)
+        first = np.argmax(breach, axis=1)
+        n_calls += int(hit.sum())
+        loss_at_call += float(-pl[hit, first[hit]].sum())
+        call_day_counts += np.bincount(first[hit], minlength=h)
+        terminal_pl[done:done + m] = pl[:, -1]
+        done += m
+
+    return {
+        "p_call": n_calls / n_paths,
+        "el_given_call": loss_at_call / n_calls if n_calls else 0.0,
+        "call_day_counts": call_day_counts,
+        "terminal_pl": terminal_pl,
+        "p_call_horizon_only": float((-terminal_pl >= margin_trigger * equity_vnd).mean()),
     }
-    return params, answers
 
-#======= KẾT THÚC CÁC HÀM gen_case ======
 
-def fetch_attempt(mssv: str, exercise_code: str, attempt_no: int):
-    """Kiểm tra attempt đã nộp chưa."""
-    if not supabase_client:
-        return None
-    try:
-        res = (
-            supabase_client.table("lab_attempts")
-            .select("id,is_correct,score,created_at,answer_json,params_json")
-            .eq("mssv", mssv)
-            .eq("exercise_code", exercise_code)
-            .eq("attempt_no", attempt_no)
-            .limit(1)
-            .execute()
-        )
-        return res.data[0] if res.data else None
-    except Exception as e:
-        st.error(f"⚠️ Lỗi đọc lab_attempts: {e}")
-        return None
+@st.cache_data(show_spinner=False)
+def run_carry_unwind_mc(notional_mjpy: float, s0: float, i_vnd: float, i_jpy: float, horizon_days: int,
+                        equity_mvnd: float, margin_trigger: float, vol_pct: float, jump_lambda: float,
+                        jump_mean_pct: float, jump_sd_pct: float, n_paths: int = 100_000,
+                        seed: int = 42) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """Bảng tóm tắt (VND) + phân phối ngày bị margin call; đầu vào theo đơn vị của bài M02 (triệu JPY, triệu VND)."""
+    res = simulate_carry_unwind(notional_mjpy * 1e6, s0, i_vnd, i_jpy, horizon_days, equity_mvnd * 1e6,
+                                margin_trigger, vol_pct, jump_lambda, jump_mean_pct, jump_sd_pct,
+                                n_paths=n_paths, seed=seed)
+    pl = res["terminal_pl"]
+    df_sum = pd.DataFrame({
+        "Chỉ tiêu": [
+            "Xác suất margin call TRƯỚC đáo hạn (kiểm tra hằng ngày)",
+            "Xác suất margin call nếu chỉ kiểm tra ngày cuối",
+            "Lỗ kỳ vọng tại thời điểm bị call (VND)",
+            "P/L kỳ vọng cuối kỳ (VND)",
+            "P/L cuối kỳ – phân vị 5% (VND)",
+            "P/L cuối kỳ – phân vị 1% (VND)",
+        ],
+        "Giá trị": [
+            res["p_call"] * 100, res["p_call_horizon_only"] * 100, res["el_given_call"],
+            float(pl.mean()), float(np.percentile(pl, 5)), float(np.percentile(pl, 1)),
+        ],
+    })
+    df_days = pd.DataFrame({
+        "Ngày": np.arange(1, int(horizon_days) + 1),
+        "Tỷ lệ bị call (%)": res["call_day_counts"] / n_paths * 100,
+    })
+    return df_sum, df_days
 
-def insert_attempt(payload: dict) -> bool:
-    """Ghi attempt vào DB."""
-    if not supabase_client:
-        st.error("⚠️ Chưa kết nối Supabase.")
-        return False
-    try:
-        supabase_client.table("lab_attempts").insert(payload).execute()
-        return True
-    except Exception as e:
-        st.error(f"⚠️ Lỗi ghi lab_attempts: {e}")
-        return False
 
-def reward_ai_calls_by_decreasing_usage(mssv: str, bonus_calls: int = 2):
+# ==============================================================================
+# BACKTEST CARRY TRADE (phòng 5) - chạy trên kho fx_store (số liệu minh họa), vectorized toàn chuỗi
+# ==============================================================================
+CARRY_CCY = {  # mã -> (cột tỷ giá, USD/đơn vị = f(x)?, cột lãi suất điều hành)
+    "USD": (None, None, "usd_policy"),
+    "VND": ("usd_vnd", "inverse", "vnd_policy"),
+    "EUR": ("eur_usd", "direct", "eur_policy"),
+    "JPY": ("usd_jpy", "inverse", "jpy_policy"),
+}
+CARRY_REBALANCE = {"D": "Hằng ngày", "W": "Hằng tuần", "M": "Hằng tháng", "Q": "Hằng quý"}
+CARRY_CRASH_DD = 0.10   # sụt giảm từ đỉnh >= 10% được tính là 1 "cú sập"
+
+
+def _ccy_usd_value(store_cols: dict, ccy: str, n: int) -> np.ndarray:
+    """Giá trị 1 đơn vị tiền tệ tính bằng USD theo ngày."""
+    col, kind, _ = CARRY_CCY[ccy]
+    if col is None:
+        return np.ones(n)
+    x = np.asarray(store_cols[col], dtype=float)
+    return 1.0 / x if kind == "inverse" else x
+
+
+def _rebalance_groups(dates: np.ndarray, freq: str) -> np.ndarray:
+    """Mã kỳ tái cân bằng (0, 1, 2, ...) cho từng ngày."""
+    d = dates.astype("datetime64[D]").astype(np.int64)
+    if freq == "D":
+        key = d
+    elif freq == "W":
+        key = (d + 3) // 7                       # tuần bắt đầu thứ Hai (1970-01-01 là thứ Năm)
+    else:
+        m = dates.astype("datetime64[M]").astype(np.int64)
+        key = m if freq == "M" else m // 3
+    return np.concatenate([[0], np.cumsum(key[1:] != key[:-1])])
+
+
+def _group_first_index(groups: np.ndarray) -> np.ndarray:
+    """Vị trí phần tử đầu tiên của nhóm chứa mỗi phần tử (groups tăng dần)."""
+    starts = np.flatnonzero(np.concatenate([[True], groups[1:] != groups[:-1]]))
+    return starts[groups - groups[0]]
+
+
+def _hold_from_first_hit(period_ret: np.ndarray, hit: np.ndarray, first: np.ndarray, groups: np.ndarray):
     """
-    Thưởng thêm lượt gọi AI theo mô hình hiện tại:
-    - DB đang lưu 'usage' (đã dùng).
-    - Thưởng = GIẢM usage đi bonus_calls (tối thiểu = 0).
-    => SV sẽ có thêm 'remaining' lượt dùng.
+    Đóng vị thế tại ngày chạm ngưỡng đầu tiên trong kỳ: từ ngày đó tới hết kỳ giữ nguyên
+    kết quả của ngày chạm. Trả về (period_ret mới, mặt nạ các ngày đã đóng).
     """
-    if not supabase_client:
-        return
-    try:
-        cur = int(get_usage_from_supabase(mssv))
-        if cur >= 999:
-            return
-        new_usage = max(cur - bonus_calls, 0)
-        supabase_client.table("user_quota").upsert(
-            {"mssv": mssv, "usage": new_usage},
-            on_conflict="mssv"
-        ).execute()
-    except Exception as e:
-        st.error(f"⚠️ Lỗi thưởng lượt AI: {e}")
+    m = period_ret.size
+    idx = np.arange(m)
+    first_hit = np.where(hit, idx, m)
+    first_hit = np.minimum.reduceat(first_hit, np.unique(first))[groups - groups[0]]
+    closed = first_hit <= idx
+    return np.where(closed, period_ret[np.minimum(first_hit, m - 1)], period_ret), closed
+
+
+def carry_backtest(dates: np.ndarray, fund_usd: np.ndarray, target_usd: np.ndarray,
+                   fund_rate_pct: np.ndarray, target_rate_pct: np.ndarray, freq: str = "M",
+                   leverage: float = 1.0, stop_loss_pct: float = 0.0, positive_carry_only: bool = False) -> dict:
+    """
+    Vay đồng funding, nắm giữ đồng target (tiền lãi tính theo lãi suất điều hành, ngày thực tế/365).
+    Đầu mỗi kỳ tái cân bằng: quy mô vị thế = leverage x vốn hiện có; trong kỳ giữ nguyên.
+    Stop-loss: lỗ trong kỳ chạm -stop_loss_pct% vốn đầu kỳ -> đóng vị thế, đứng ngoài tới kỳ sau.
+    Lỗ chạm -100% (cháy tài khoản) luôn bị đóng như vậy, và vốn = 0 ở mọi kỳ sau.
+    Toàn bộ tính bằng cumsum/cumprod theo nhóm, không có vòng lặp theo ngày.
+    """
+    n = dates.size
+    yf = year_fraction(dates[:-1], dates[1:], convention="ACT/365F")
+    # Tăng trưởng 1 đơn vị funding-currency đem đổi sang target (gồm lãi 2 bên) trên mỗi bước t-1 -> t
+    growth = (target_usd[1:] / target_usd[:-1]) * growth_factor(target_rate_pct[:-1] / 100, yf) \
+        / ((fund_usd[1:] / fund_usd[:-1]) * growth_factor(fund_rate_pct[:-1] / 100, yf))
+
+    groups = _rebalance_groups(dates, freq)[:-1]         # bước t-1 -> t thuộc kỳ của ngày t-1
+    first = _group_first_index(groups)
+    log_g = np.log(growth)
+    cum = np.cumsum(log_g)
+    cum_in_period = cum - (cum[first] - log_g[first])   # tổng log từ đầu kỳ tới bước hiện tại
+    period_ret = leverage * np.expm1(cum_in_period)      # lãi/lỗ trong kỳ / vốn đầu kỳ
+
+    active = np.ones(n - 1, dtype=bool)
+    if positive_carry_only:
+        active = (target_rate_pct[:-1] > fund_rate_pct[:-1])[first]
+    period_ret = np.where(active, period_ret, 0.0)
+
+    stopped = np.zeros(n - 1, dtype=bool)
+    if stop_loss_pct > 0:
+        period_ret, stopped = _hold_from_first_hit(period_ret, period_ret <= -stop_loss_pct / 100, first, groups)
+    # Cháy tài khoản (lỗ >= 100% vốn đầu kỳ) = bị đóng vị thế cưỡng bức: khóa -100% tới hết kỳ,
+    # giá có hồi lại trong kỳ cũng không cứu được
+    period_ret, wiped = _hold_from_first_hit(period_ret, period_ret <= -1.0, first, groups)
+    period_ret = np.maximum(period_ret, -1.0)            # không lỗ quá vốn
+    stopped |= wiped
+
+    # Vốn đầu kỳ = tích (1 + kết quả cuối) của các kỳ trước
+    starts = np.unique(first)
+    ends = np.concatenate([starts[1:] - 1, [n - 2]])
+    start_equity = np.concatenate([[1.0], np.cumprod(1 + period_ret[ends])[:-1]])
+    equity = np.concatenate([[1.0], start_equity[np.searchsorted(starts, first)] * (1 + period_ret)])
+
+    daily_ret = equity[1:] / np.where(equity[:-1] > 0, equity[:-1], np.nan) - 1
+    peak = np.maximum.accumulate(equity)
+    drawdown = equity / peak - 1
+    years = (dates[-1] - dates[0]).astype("timedelta64[D]").astype(float) / 365.25
+    sd = np.nanstd(daily_ret, ddof=1)
+    return {
+        "equity": equity,
+        "drawdown": drawdown,
+        "total_return": equity[-1] - 1,
+        "cagr": equity[-1] ** (1 / years) - 1 if years > 0 and equity[-1] > 0 else -1.0,
+        "ann_vol": sd * np.sqrt(252),
+        "sharpe": np.nanmean(daily_ret) / sd * np.sqrt(252) if sd > 0 else 0.0,
+        "max_dd": drawdown.min(),
+        "n_stops": int(np.unique(groups[stopped]).size),
+        "n_periods": int(starts.size),
+    }
+
+
+def crash_episodes(dates: np.ndarray, equity: np.ndarray, threshold: float = CARRY_CRASH_DD) -> pd.DataFrame:
+    """
+    Các đợt sụt giảm (đỉnh -> đáy -> hồi phục) sâu hơn threshold.
+    Mốc thời gian chỉ ghi theo quý: EUR/USD, USD/JPY trong kho là cầu Brown giữa vài mốc
+    nên ngày cụ thể của đỉnh/đáy là nhiễu mô phỏng, không phải sự kiện thật.
+    """
+    peak = np.maximum.accumulate(equity)
+    dd = equity / peak - 1
+    under = dd < 0
+    edges = np.diff(np.concatenate([[0], under.astype(np.int8), [0]]))
+    seg_start, seg_end = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)   # [start, end)
+    rows = []
+    for s, e in zip(seg_start, seg_end):
+        trough = s + int(np.argmin(dd[s:e]))
+        if dd[trough] > -threshold:
+            continue
+        quarter = lambda i: str(pd.Timestamp(dates[i]).to_period("Q"))
+        rows.append({
+            "Đỉnh (quý)": quarter(max(s - 1, 0)),
+            "Đáy (quý)": quarter(trough),
+            "Hồi phục (quý)": quarter(e) if e < dates.size else "chưa hồi phục",
+            "Sụt giảm (%)": dd[trough] * 100,
+        })
+    return pd.DataFrame(rows, columns=["Đỉnh (quý)", "Đáy (quý)", "Hồi phục (quý)", "Sụt giảm (%)"])
+
+
+@st.cache_data(show_spinner=False)
+def run_carry_backtest(funding: str, target: str, start: str, end: str, freq: str = "M",
+                       leverage: float = 1.0, stop_loss_pct: float = 0.0,
+                       positive_carry_only: bool = False) -> tuple[dict, pd.DataFrame, pd.DataFrame]:
+    """Cắt kho FX theo ngày rồi chạy carry_backtest -> (chỉ số, chuỗi vốn/drawdown, các cú sập)."""
+    store = open_fx_store()
+    cols = {c for ccy in (funding, target) for c in (CARRY_CCY[ccy][0], CARRY_CCY[ccy][2]) if c}
+    dates, data = store.slice(start, end, sorted(cols))
+    n = dates.size
+    res = carry_backtest(
+        dates, _ccy_usd_value(data, funding, n), _ccy_usd_value(data, target, n),
+        np.asarray(data[CARRY_CCY[funding][2]]), np.asarray(data[CARRY_CCY[target][2]]),
+        freq=freq, leverage=leverage, stop_loss_pct=stop_loss_pct, positive_carry_only=positive_carry_only,
+    )
+    df_curve = pd.DataFrame({"Ngày": pd.DatetimeIndex(dates), "Vốn (x)": res.pop("equity"),
+                             "Drawdown (%)": res.pop("drawdown") * 100})
+    return res, df_curve, crash_episodes(dates, df_curve["Vốn (x)"].to_numpy())
 
 
 # ==============================================================================
@@ -1025,30 +3676,29 @@ def render_exercise_D01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.write("**Đề bài bạn đã nhận (từ DB):**")
         c1, c2 = st.columns(2)
         with c1:
             st.markdown("##### 🇺🇸 USD/VND")
-            st.write(f"BID: **{params.get('usd_bid','-'):,.0f}**")
-            st.write(f"ASK: **{params.get('usd_ask','-'):,.0f}**")
+            st.write(f"BID: **{params.usd_bid:,.0f}**")
+            st.write(f"ASK: **{params.usd_ask:,.0f}**")
         with c2:
             st.markdown("##### 🇪🇺 EUR/USD")
-            st.write(f"BID: **{float(params.get('eur_bid',0.0)):.4f}**" if params.get("eur_bid") else "BID: **-**")
-            st.write(f"ASK: **{float(params.get('eur_ask',0.0)):.4f}**" if params.get("eur_ask") else "ASK: **-**")
+            st.write(f"BID: **{float(params.eur_bid):.4f}**" if params.eur_bid else "BID: **-**")
+            st.write(f"ASK: **{float(params.eur_ask):.4f}**" if params.eur_ask else "ASK: **-**")
 
         st.markdown("**Đáp án chuẩn (để bạn đối chiếu học tập):**")
         st.success(
-            f"EUR/VND = **{ans.get('cross_bid','-'):,.0f} - {ans.get('cross_ask','-'):,.0f}** | Spread = **{ans.get('spread','-'):,.0f}**"
+            f"EUR/VND = **{ans.cross_bid:,.0f} - {ans.cross_ask:,.0f}** | Spread = **{ans.spread:,.0f}**"
         )
         return  # ✅ thay st.stop()
 
     # 2) Seed ổn định + clamp để ghi BIGINT an toàn
     seed_raw = stable_seed(mssv, ex_code, attempt_no)
     seed = int(seed_raw) & ((1 << 63) - 1)   # ✅ chống lỗi bigint
-    params, answers = gen_case_D01(seed)
+    params, answers = gen_case_records("D01", seed)
 
     # 3) Ghi nhận thời điểm bắt đầu
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -1072,12 +3722,12 @@ def render_exercise_D01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     c1, c2 = st.columns(2)
     with c1:
         st.markdown("##### 🇺🇸 Thị trường 1: USD/VND")
-        st.write(f"BID (NH mua USD): **{params['usd_bid']:,.0f}**")
-        st.write(f"ASK (NH bán USD): **{params['usd_ask']:,.0f}**")
+        st.write(f"BID (NH mua USD): **{params.usd_bid:,.0f}**")
+        st.write(f"ASK (NH bán USD): **{params.usd_ask:,.0f}**")
     with c2:
         st.markdown("##### 🇪🇺 Thị trường 2: EUR/USD")
-        st.write(f"BID (NH mua EUR): **{params['eur_bid']:.4f}**")
-        st.write(f"ASK (NH bán EUR): **{params['eur_ask']:.4f}**")
+        st.write(f"BID (NH mua EUR): **{params.eur_bid:.4f}**")
+        st.write(f"ASK (NH bán EUR): **{params.eur_ask:.4f}**")
 
     st.markdown("---")
     st.caption("✍️ Nhập kết quả (làm tròn 0 chữ số thập phân – VND/EUR)")
@@ -1095,9 +3745,9 @@ def render_exercise_D01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_d01_{attempt_no}"):
         is_ok = (
-            abs(int(in_bid) - answers["cross_bid"]) <= TOL
-            and abs(int(in_ask) - answers["cross_ask"]) <= TOL
-            and abs(int(in_spread) - answers["spread"]) <= TOL
+            abs(int(in_bid) - answers.cross_bid) <= TOL
+            and abs(int(in_ask) - answers.cross_ask) <= TOL
+            and abs(int(in_spread) - answers.spread) <= TOL
         )
         score = 10 if is_ok else 0
         duration_sec = int(time.time() - st.session_state[start_key])
@@ -1105,13 +3755,13 @@ def render_exercise_D01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": "DEALING",
             "exercise_code": ex_code,
             "attempt_no": attempt_no,
             "seed": int(seed),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": bool(is_ok),
             "score": int(score),
             "duration_sec": int(duration_sec),
@@ -1129,7 +3779,7 @@ def render_exercise_D01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.error("❌ CHƯA ĐÚNG. Bạn được **0 điểm**.")
 
         st.info(
-            f"📌 Đáp án chuẩn: EUR/VND = **{answers['cross_bid']:,.0f} - {answers['cross_ask']:,.0f}** | Spread = **{answers['spread']:,.0f}**"
+            f"📌 Đáp án chuẩn: EUR/VND = **{answers.cross_bid:,.0f} - {answers.cross_ask:,.0f}** | Spread = **{answers.spread:,.0f}**"
         )
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -1159,37 +3809,36 @@ def render_exercise_D02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.write("**Đề bài bạn đã nhận (từ DB):**")
         c1, c2, c3 = st.columns(3)
         with c1:
             st.markdown("##### 🇺🇸 USD/VND")
-            st.write(f"BID: **{params.get('usd_bid','-'):,.0f}**")
-            st.write(f"ASK: **{params.get('usd_ask','-'):,.0f}**")
+            st.write(f"BID: **{params.usd_bid:,.0f}**")
+            st.write(f"ASK: **{params.usd_ask:,.0f}**")
         with c2:
             st.markdown("##### 🇪🇺 EUR/USD")
-            st.write(f"BID: **{params.get('eur_bid','-')}**")
-            st.write(f"ASK: **{params.get('eur_ask','-')}**")
+            st.write(f"BID: **{params.eur_bid}**")
+            st.write(f"ASK: **{params.eur_ask}**")
         with c3:
             st.markdown("##### 🇪🇺 EUR/VND (Direct)")
-            st.write(f"BID: **{params.get('eurvnd_bid','-'):,.0f}**")
-            st.write(f"ASK: **{params.get('eurvnd_ask','-'):,.0f}**")
+            st.write(f"BID: **{params.eurvnd_bid:,.0f}**")
+            st.write(f"ASK: **{params.eurvnd_ask:,.0f}**")
 
-        st.info(f"💰 Vốn ban đầu: **{params.get('start_vnd','-'):,.0f} VND**")
+        st.info(f"💰 Vốn ban đầu: **{params.start_vnd:,.0f} VND**")
         st.markdown("**Đáp án chuẩn (để bạn đối chiếu học tập):**")
         st.success(
-            f"Đáp án đúng: **{ans.get('correct_option','-')}** | Lợi nhuận: **{ans.get('profit_vnd',0):,} VND**"
+            f"Đáp án đúng: **{ans.correct_option}** | Lợi nhuận: **{ans.profit_vnd:,} VND**"
         )
         st.caption(
-            f"Cross implied (tham khảo): {ans.get('implied_bid','-'):,.0f} – {ans.get('implied_ask','-'):,.0f}"
+            f"Cross implied (tham khảo): {ans.implied_bid:,.0f} – {ans.implied_ask:,.0f}"
         )
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_D02(seed)
+    params, answers = gen_case_records("D02", seed)
 
     # 3) Start time (nếu sau này cần)
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -1213,18 +3862,18 @@ def render_exercise_D02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     c1, c2, c3 = st.columns(3)
     with c1:
         st.markdown("##### 🇺🇸 USD/VND")
-        st.write(f"BID: **{params['usd_bid']:,.0f}**")
-        st.write(f"ASK: **{params['usd_ask']:,.0f}**")
+        st.write(f"BID: **{params.usd_bid:,.0f}**")
+        st.write(f"ASK: **{params.usd_ask:,.0f}**")
     with c2:
         st.markdown("##### 🇪🇺 EUR/USD")
-        st.write(f"BID: **{params['eur_bid']:.4f}**")
-        st.write(f"ASK: **{params['eur_ask']:.4f}**")
+        st.write(f"BID: **{params.eur_bid:.4f}**")
+        st.write(f"ASK: **{params.eur_ask:.4f}**")
     with c3:
         st.markdown("##### 🇪🇺 EUR/VND (Direct)")
-        st.write(f"BID: **{params['eurvnd_bid']:,.0f}**")
-        st.write(f"ASK: **{params['eurvnd_ask']:,.0f}**")
+        st.write(f"BID: **{params.eurvnd_bid:,.0f}**")
+        st.write(f"ASK: **{params.eurvnd_ask:,.0f}**")
 
-    st.info(f"💰 Vốn ban đầu: **{params['start_vnd']:,.0f} VND**")
+    st.info(f"💰 Vốn ban đầu: **{params.start_vnd:,.0f} VND**")
     st.markdown("---")
 
     # 5) Chọn đáp án (MCQ) + nhập lợi nhuận
@@ -1258,8 +3907,8 @@ def render_exercise_D02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     PROFIT_TOL = 10_000
 
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_d02_{attempt_no}"):
-        correct_opt = answers["correct_option"]
-        correct_profit = int(answers["profit_vnd"])
+        correct_opt = answers.correct_option
+        correct_profit = int(answers.profit_vnd)
 
         ok_choice = (pick == correct_opt)
         ok_profit = (abs(int(in_profit) - correct_profit) <= PROFIT_TOL) if correct_opt in ("A","B") else (int(in_profit) == 0)
@@ -1271,13 +3920,13 @@ def render_exercise_D02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": None,      # bạn có thể fill từ Excel map sau
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": room_key,
             "exercise_code": ex_code,
             "attempt_no": int(attempt_no),
             "seed": int(int(seed) % 2_000_000_000),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": bool(is_ok),
             "score": int(score),
             "duration_sec": int(duration_sec),
@@ -1295,7 +3944,7 @@ def render_exercise_D02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.error("❌ CHƯA ĐÚNG.")
             st.info(
                 f"📌 Đáp án: **{correct_opt}** | Lợi nhuận chuẩn: **{correct_profit:,} VND** "
-                f"(Cross implied tham khảo: {answers['implied_bid']:,.0f} – {answers['implied_ask']:,.0f})"
+                f"(Cross implied tham khảo: {answers.implied_bid:,.0f} – {answers.implied_ask:,.0f})"
             )
 
         # ✅ Lưu kết quả để sau rerun vẫn hiện
@@ -1329,24 +3978,23 @@ def render_exercise_R01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.write("**Đề bài bạn đã nhận (từ DB):**")
-        st.write(f"- Khoản nợ: **{params.get('usd_amount','-'):,.0f} USD**, đáo hạn **{params.get('days','-')} ngày**")
-        st.write(f"- Spot USD/VND: **{params.get('spot_bid','-'):,.0f} / {params.get('spot_ask','-'):,.0f}**")
-        st.write(f"- i(VND): **{float(params.get('i_vnd',0))*100:.2f}%** | i(USD): **{float(params.get('i_usd',0))*100:.2f}%**")
+        st.write(f"- Khoản nợ: **{params.usd_amount:,.0f} USD**, đáo hạn **{params.days} ngày**")
+        st.write(f"- Spot USD/VND: **{params.spot_bid:,.0f} / {params.spot_ask:,.0f}**")
+        st.write(f"- i(VND): **{float(params.i_vnd)*100:.2f}%** | i(USD): **{float(params.i_usd)*100:.2f}%**")
 
         st.markdown("**Đáp án chuẩn (để đối chiếu):**")
         st.success(
-            f"Forward USD/VND = **{ans.get('fwd_bid','-'):,.0f} / {ans.get('fwd_ask','-'):,.0f}**  |  "
-            f"Chi phí hedge (Forward ASK) = **{ans.get('hedged_cost_vnd','-'):,.0f} VND**"
+            f"Forward USD/VND = **{ans.fwd_bid:,.0f} / {ans.fwd_ask:,.0f}**  |  "
+            f"Chi phí hedge (Forward ASK) = **{ans.hedged_cost_vnd:,.0f} VND**"
         )
         return
 
     # 2) sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_R01(seed)
+    params, answers = gen_case_records("R01", seed)
 
     # 3) ghi nhận thời điểm bắt đầu (optional)
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -1359,7 +4007,7 @@ def render_exercise_R01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 <div class="role-card">
   <div class="role-title">🧾 Bài R01 — Tỷ giá kỳ hạn (IRP) & Hedge Forward cho khoản nợ USD</div>
   <div class="mission-text">
-    Doanh nghiệp có khoản nợ <b>{params['usd_amount']:,.0f} USD</b> đáo hạn sau <b>{params['days']} ngày</b>.
+    Doanh nghiệp có khoản nợ <b>{params.usd_amount:,.0f} USD</b> đáo hạn sau <b>{params.days} ngày</b>.
     Dựa trên Spot và lãi suất, hãy tính <b>Forward USD/VND (ASK)</b> và <b>chi phí hedge (VND)</b> nếu dùng Forward.
     <br>(Làm tròn đến <b>VND</b>)
   </div>
@@ -1371,12 +4019,12 @@ def render_exercise_R01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     c1, c2 = st.columns(2)
     with c1:
         st.markdown("##### 🌐 Spot USD/VND")
-        st.write(f"BID: **{params['spot_bid']:,.0f}**")
-        st.write(f"ASK: **{params['spot_ask']:,.0f}**")
+        st.write(f"BID: **{params.spot_bid:,.0f}**")
+        st.write(f"ASK: **{params.spot_ask:,.0f}**")
     with c2:
         st.markdown("##### 📈 Lãi suất năm (Act/360)")
-        st.write(f"i(VND): **{params['i_vnd']*100:.2f}%**")
-        st.write(f"i(USD): **{params['i_usd']*100:.2f}%**")
+        st.write(f"i(VND): **{params.i_vnd*100:.2f}%**")
+        st.write(f"i(USD): **{params.i_usd*100:.2f}%**")
 
     st.markdown("---")
     st.caption("✍️ Nhập kết quả (làm tròn 0 chữ số thập phân)")
@@ -1397,11 +4045,11 @@ def render_exercise_R01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 
     # 5) submit + chấm
     TOL_FWD = 5  # sai số ±5 VND do làm tròn
-    tol_cost = int(params["usd_amount"] * TOL_FWD)  # sai số cost tương ứng
+    tol_cost = int(params.usd_amount * TOL_FWD)  # sai số cost tương ứng
 
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_r01_{attempt_no}"):
-        ok_fwd = abs(int(in_fwd_ask) - int(answers["fwd_ask"])) <= TOL_FWD
-        ok_cost = abs(int(in_cost) - int(answers["hedged_cost_vnd"])) <= tol_cost
+        ok_fwd = abs(int(in_fwd_ask) - int(answers.fwd_ask)) <= TOL_FWD
+        ok_cost = abs(int(in_cost) - int(answers.hedged_cost_vnd)) <= tol_cost
 
         is_ok = bool(ok_fwd and ok_cost)
         score = 10 if is_ok else 0
@@ -1410,13 +4058,13 @@ def render_exercise_R01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": room_key,
             "exercise_code": ex_code,
             "attempt_no": int(attempt_no),
             "seed": int(seed),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": is_ok,
             "score": int(score),
             "duration_sec": int(duration_sec),
@@ -1434,8 +4082,8 @@ def render_exercise_R01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.error("❌ CHƯA ĐÚNG. (0 điểm)")
 
         st.info(
-            f"📌 Đáp án chuẩn: Forward USD/VND = **{answers['fwd_bid']:,.0f} / {answers['fwd_ask']:,.0f}**  |  "
-            f"Chi phí hedge = **{answers['hedged_cost_vnd']:,.0f} VND**"
+            f"📌 Đáp án chuẩn: Forward USD/VND = **{answers.fwd_bid:,.0f} / {answers.fwd_ask:,.0f}**  |  "
+            f"Chi phí hedge = **{answers.hedged_cost_vnd:,.0f} VND**"
         )
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -1467,27 +4115,26 @@ def render_exercise_R02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.write("**Đề bài bạn đã nhận (từ DB):**")
-        st.write(f"- Khoản nợ: **{params.get('usd_amount','-'):,.0f} USD**, đáo hạn **{params.get('days','-')} ngày**")
-        st.write(f"- Spot USD/VND: **{params.get('spot_bid','-'):,.0f} / {params.get('spot_ask','-'):,.0f}**")
-        st.write(f"- Forward USD/VND: **{params.get('fwd_bid','-'):,.0f} / {params.get('fwd_ask','-'):,.0f}**")
-        st.write(f"- Option Call: Strike **{params.get('strike','-'):,.0f}**, Premium **{params.get('premium','-'):,.0f} VND/USD**")
-        st.write(f"- Kịch bản Spot tại đáo hạn (S_T): **{params.get('spot_T','-'):,.0f}**")
+        st.write(f"- Khoản nợ: **{params.usd_amount:,.0f} USD**, đáo hạn **{params.days} ngày**")
+        st.write(f"- Spot USD/VND: **{params.spot_bid:,.0f} / {params.spot_ask:,.0f}**")
+        st.write(f"- Forward USD/VND: **{params.fwd_bid:,.0f} / {params.fwd_ask:,.0f}**")
+        st.write(f"- Option Call: Strike **{params.strike:,.0f}**, Premium **{params.premium:,.0f} VND/USD**")
+        st.write(f"- Kịch bản Spot tại đáo hạn (S_T): **{params.spot_T:,.0f}**")
 
         st.markdown("**Đáp án chuẩn (để đối chiếu):**")
         st.success(
-            f"Chi phí Forward = **{ans.get('forward_cost','-'):,.0f} VND** | "
-            f"Chi phí Option = **{ans.get('option_cost','-'):,.0f} VND** | "
-            f"Chọn: **{ans.get('best_choice','-')}**"
+            f"Chi phí Forward = **{ans.forward_cost:,.0f} VND** | "
+            f"Chi phí Option = **{ans.option_cost:,.0f} VND** | "
+            f"Chọn: **{ans.best_choice}**"
         )
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_R02(seed)
+    params, answers = gen_case_records("R02", seed)
 
     # 3) Start time (optional)
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -1500,7 +4147,7 @@ def render_exercise_R02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 <div class="role-card">
   <div class="role-title">🧾 Bài R02 — So sánh Hedge Forward vs Option (Call USD)</div>
   <div class="mission-text">
-    DN có khoản nợ <b>{params['usd_amount']:,.0f} USD</b> đáo hạn sau <b>{params['days']} ngày</b>.
+    DN có khoản nợ <b>{params.usd_amount:,.0f} USD</b> đáo hạn sau <b>{params.days} ngày</b>.
     So sánh 2 phương án hedge:
     <br>① <b>Forward</b> theo báo giá kỳ hạn.
     <br>② <b>Option Call USD</b> (Strike + Premium), kịch bản tại đáo hạn có Spot S<sub>T</sub>.
@@ -1515,19 +4162,19 @@ def render_exercise_R02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     c1, c2, c3 = st.columns(3)
     with c1:
         st.markdown("##### 🌐 Spot USD/VND")
-        st.write(f"BID: **{params['spot_bid']:,.0f}**")
-        st.write(f"ASK: **{params['spot_ask']:,.0f}**")
+        st.write(f"BID: **{params.spot_bid:,.0f}**")
+        st.write(f"ASK: **{params.spot_ask:,.0f}**")
     with c2:
         st.markdown("##### 📌 Forward USD/VND")
-        st.write(f"BID: **{params['fwd_bid']:,.0f}**")
-        st.write(f"ASK: **{params['fwd_ask']:,.0f}**")
+        st.write(f"BID: **{params.fwd_bid:,.0f}**")
+        st.write(f"ASK: **{params.fwd_ask:,.0f}**")
     with c3:
         st.markdown("##### 🎯 Option Call USD")
-        st.write(f"Strike (K): **{params['strike']:,.0f}**")
-        st.write(f"Premium: **{params['premium']:,.0f} VND/USD**")
+        st.write(f"Strike (K): **{params.strike:,.0f}**")
+        st.write(f"Premium: **{params.premium:,.0f} VND/USD**")
 
     st.markdown("##### 🔮 Kịch bản tại đáo hạn")
-    st.write(f"Spot tại đáo hạn S_T (ASK): **{params['spot_T']:,.0f}**")
+    st.write(f"Spot tại đáo hạn S_T (ASK): **{params.spot_T:,.0f}**")
 
     st.markdown("---")
     st.caption("✍️ Nhập kết quả (VND).")
@@ -1556,12 +4203,12 @@ def render_exercise_R02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     # 5) Nộp bài
     # Tolerance theo quy mô khoản nợ: sai lệch do nhập/làm tròn
     TOL_RATE = 5  # ±5 VND/USD
-    tol_cost = int(params["usd_amount"] * TOL_RATE)
+    tol_cost = int(params.usd_amount * TOL_RATE)
 
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_r02_{attempt_no}"):
-        ok_forward = abs(int(in_forward_cost) - int(answers["forward_cost"])) <= tol_cost
-        ok_option = abs(int(in_option_cost) - int(answers["option_cost"])) <= tol_cost
-        ok_choice = (choice == answers["best_choice"])
+        ok_forward = abs(int(in_forward_cost) - int(answers.forward_cost)) <= tol_cost
+        ok_option = abs(int(in_option_cost) - int(answers.option_cost)) <= tol_cost
+        ok_choice = (choice == answers.best_choice)
 
         is_ok = bool(ok_forward and ok_option and ok_choice)
         score = 10 if is_ok else 0
@@ -1570,13 +4217,13 @@ def render_exercise_R02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": room_key,
             "exercise_code": ex_code,
             "attempt_no": int(attempt_no),
             "seed": int(seed),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": is_ok,
             "score": int(score),
             "duration_sec": int(duration_sec),
@@ -1594,9 +4241,9 @@ def render_exercise_R02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.error("❌ CHƯA ĐÚNG. (0 điểm)")
 
         st.info(
-            f"📌 Đáp án chuẩn: Forward = **{answers['forward_cost']:,.0f} VND** | "
-            f"Option = **{answers['option_cost']:,.0f} VND** | "
-            f"Chọn: **{answers['best_choice']}**"
+            f"📌 Đáp án chuẩn: Forward = **{answers.forward_cost:,.0f} VND** | "
+            f"Option = **{answers.option_cost:,.0f} VND** | "
+            f"Chọn: **{answers.best_choice}**"
         )
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -1626,24 +4273,23 @@ def render_exercise_T01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
-        costs = (ans.get("costs") or {})
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
+        costs = (ans.costs or {})
 
         st.markdown("**Đề bài (từ DB):**")
-        st.write(f"- Invoice: **{params.get('amount_usd','-'):,} USD** | Kỳ hạn: **{params.get('tenor_days','-')} ngày**")
-        st.write(f"- Lãi suất cơ hội: **{float(params.get('opp_rate',0))*100:.2f}%/năm**")
+        st.write(f"- Invoice: **{params.amount_usd:,} USD** | Kỳ hạn: **{params.tenor_days} ngày**")
+        st.write(f"- Lãi suất cơ hội: **{float(params.opp_rate)*100:.2f}%/năm**")
 
         st.markdown("**Đáp án chuẩn (để đối chiếu học tập):**")
         st.success(
-            f"Phương án rẻ nhất: **{ans.get('best_method','-')}** | "
+            f"Phương án rẻ nhất: **{ans.best_method}** | "
             f"T/T={costs.get('TT','-')} | D/A={costs.get('DA','-')} | L/C={costs.get('LC','-')} (USD)"
         )
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_T01(seed)
+    params, answers = gen_case_records("T01", seed)
 
     st.markdown(
         """
@@ -1659,27 +4305,27 @@ def render_exercise_T01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     )
 
     # 3) Hiển thị dữ kiện
-    st.write(f"**Invoice:** {params['amount_usd']:,} USD")
-    st.write(f"**Kỳ hạn thanh toán:** {params['tenor_days']} ngày")
-    st.write(f"**Lãi suất cơ hội (cost of funds):** {params['opp_rate']*100:.2f}%/năm (360 ngày)")
+    st.write(f"**Invoice:** {params.amount_usd:,} USD")
+    st.write(f"**Kỳ hạn thanh toán:** {params.tenor_days} ngày")
+    st.write(f"**Lãi suất cơ hội (cost of funds):** {params.opp_rate*100:.2f}%/năm (360 ngày)")
 
     st.markdown("#### 📌 Phí ngân hàng")
     col1, col2, col3 = st.columns(3)
     with col1:
         st.markdown("**T/T**")
-        st.write(f"Fixed: {params['tt_fixed']:.0f} USD")
-        st.write(f"% fee: {params['tt_pct']*100:.2f}%")
+        st.write(f"Fixed: {params.tt_fixed:.0f} USD")
+        st.write(f"% fee: {params.tt_pct*100:.2f}%")
         st.caption("T/T trả ngay ⇒ có opportunity cost")
     with col2:
         st.markdown("**Nhờ thu (D/A)**")
-        st.write(f"Fixed: {params['da_fixed']:.0f} USD")
-        st.write(f"% fee: {params['da_pct']*100:.2f}%")
+        st.write(f"Fixed: {params.da_fixed:.0f} USD")
+        st.write(f"% fee: {params.da_pct*100:.2f}%")
         st.caption("Giả định trả cuối kỳ ⇒ không tính opp cost")
     with col3:
         st.markdown("**L/C trả chậm**")
-        st.write(f"Fixed: {params['lc_fixed']:.0f} USD")
-        st.write(f"Opening fee: {params['lc_pct_per_quarter']*100:.2f}% / quý × {params['quarters']} quý")
-        st.write(f"Ký quỹ: {params['lc_margin']*100:.0f}% (tính opp cost trên phần ký quỹ)")
+        st.write(f"Fixed: {params.lc_fixed:.0f} USD")
+        st.write(f"Opening fee: {params.lc_pct_per_quarter*100:.2f}% / quý × {params.quarters} quý")
+        st.write(f"Ký quỹ: {params.lc_margin*100:.0f}% (tính opp cost trên phần ký quỹ)")
 
     st.markdown("---")
 
@@ -1698,19 +4344,19 @@ def render_exercise_T01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 
     # 5) Nộp bài
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_t01_{attempt_no}"):
-        is_ok = (pick == answers["best_method"])
+        is_ok = (pick == answers.best_method)
         score = 10 if is_ok else 0
 
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": "TRADE",
             "exercise_code": ex_code,
             "attempt_no": attempt_no,
             "seed": int(seed),  # seed của bạn đã fix tránh overflow bigint rồi
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": bool(is_ok),
             "score": int(score),
             "duration_sec": None,
@@ -1727,9 +4373,9 @@ def render_exercise_T01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         else:
             st.error("❌ CHƯA ĐÚNG. Bạn được **0 điểm**.")
 
-        c = answers["costs"]
+        c = answers.costs
         st.info(
-            f"📌 Chi phí chuẩn (USD): T/T={c['TT']} | D/A={c['DA']} | L/C={c['LC']}  →  Rẻ nhất: **{answers['best_method']}**"
+            f"📌 Chi phí chuẩn (USD): T/T={c['TT']} | D/A={c['DA']} | L/C={c['LC']}  →  Rẻ nhất: **{answers.best_method}**"
         )
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -1759,12 +4405,11 @@ def render_exercise_T02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
-        lc = (params.get("lc_terms") or {})
-        pr = (params.get("presented") or {})
-        pool = (params.get("discrepancy_pool") or [])
+        lc = (params.lc_terms or {})
+        pr = (params.presented or {})
+        pool = (params.discrepancy_pool or [])
 
         st.markdown("**Đề bài (từ DB):**")
         st.write(f"- Beneficiary: **{lc.get('beneficiary','-')}** | Applicant: **{lc.get('applicant','-')}**")
@@ -1772,23 +4417,23 @@ def render_exercise_T02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         st.write(f"- Latest shipment: **{lc.get('latest_ship','-')}** | Max presentation: **{lc.get('max_presentation_days','-')} ngày**")
 
         st.markdown("**Đáp án chuẩn (codes):**")
-        st.success(", ".join(ans.get("correct_codes", [])) or "(Không có)")
+        st.success(", ".join(ans.correct_codes) or "(Không có)")
 
         # (Tuỳ chọn) hiển thị mô tả
         mp = {c: d for c, d in pool}
-        if ans.get("correct_codes"):
+        if ans.correct_codes:
             st.markdown("**Mô tả sai biệt:**")
-            for c in ans["correct_codes"]:
+            for c in ans.correct_codes:
                 st.write(f"- **{c}**: {mp.get(c,'')}")
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_T02(seed)
+    params, answers = gen_case_records("T02", seed)
 
-    lc = params["lc_terms"]
-    pr = params["presented"]
-    pool = params["discrepancy_pool"]
+    lc = params.lc_terms
+    pr = params.presented
+    pool = params.discrepancy_pool
 
     st.markdown(
         """
@@ -1866,20 +4511,20 @@ def render_exercise_T02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 
     # 6) Nộp bài
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_t02_{attempt_no}"):
-        correct = sorted(answers["correct_codes"])
+        correct = sorted(answers.correct_codes)
         is_ok = (picked_codes == correct)
         score = 10 if is_ok else 0
 
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": "TRADE",
             "exercise_code": ex_code,
             "attempt_no": attempt_no,
             "seed": int(seed),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": bool(is_ok),
             "score": int(score),
             "duration_sec": None,
@@ -1925,24 +4570,23 @@ def render_exercise_I01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.markdown("**Đề bài bạn đã nhận (từ DB):**")
-        st.write(f"- I0: **{params.get('I0',0):,} USD**")
-        st.write(f"- CF1: **{params.get('cf1',0):,} USD**, CF2: **{params.get('cf2',0):,} USD**, CF3: **{params.get('cf3',0):,} USD**")
-        r = float(params.get("r", 0))
+        st.write(f"- I0: **{params.I0:,} USD**")
+        st.write(f"- CF1: **{params.cf1:,} USD**, CF2: **{params.cf2:,} USD**, CF3: **{params.cf3:,} USD**")
+        r = float(params.r)
         st.write(f"- Discount rate r: **{r*100:.0f}%/năm**")
 
         st.markdown("**Đáp án chuẩn (để đối chiếu học tập):**")
-        dec = ans.get("decision","-")
+        dec = ans.decision
         dec_vn = "Chấp nhận" if dec == "ACCEPT" else "Từ chối"
-        st.success(f"NPV = **{ans.get('npv','-'):,.0f} USD** | Quyết định: **{dec_vn}**")
+        st.success(f"NPV = **{ans.npv:,.0f} USD** | Quyết định: **{dec_vn}**")
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_I01(seed)
+    params, answers = gen_case_records("I01", seed)
 
     # 3) ghi thời điểm bắt đầu (để sau này bạn muốn tính time thì có sẵn)
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -1966,13 +4610,13 @@ def render_exercise_I01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     c1, c2 = st.columns(2)
     with c1:
         st.markdown("##### 📌 Thông tin dự án")
-        st.write(f"I0 (t=0): **{params['I0']:,} USD**")
-        st.write(f"CF1 (t=1): **{params['cf1']:,} USD**")
-        st.write(f"CF2 (t=2): **{params['cf2']:,} USD**")
-        st.write(f"CF3 (t=3): **{params['cf3']:,} USD**")
+        st.write(f"I0 (t=0): **{params.I0:,} USD**")
+        st.write(f"CF1 (t=1): **{params.cf1:,} USD**")
+        st.write(f"CF2 (t=2): **{params.cf2:,} USD**")
+        st.write(f"CF3 (t=3): **{params.cf3:,} USD**")
     with c2:
         st.markdown("##### 📉 Chiết khấu")
-        st.write(f"r (USD discount rate): **{params['r']*100:.0f}%/năm**")
+        st.write(f"r (USD discount rate): **{params.r*100:.0f}%/năm**")
         st.caption("Công thức: NPV = -I0 + Σ CFt/(1+r)^t")
 
     st.markdown("---")
@@ -1999,10 +4643,10 @@ def render_exercise_I01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     # 6) Chấm điểm + ghi DB
     TOL = 5  # sai số ±5 USD
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_i01_{attempt_no}"):
-        npv_ok = abs(int(in_npv) - int(answers["npv"])) <= TOL
+        npv_ok = abs(int(in_npv) - int(answers.npv)) <= TOL
 
         dec_code = "ACCEPT" if in_decision == "Chấp nhận" else "REJECT"
-        dec_ok = (dec_code == answers["decision"])
+        dec_ok = (dec_code == answers.decision)
 
         is_ok = bool(npv_ok and dec_ok)
         score = 10 if is_ok else 0
@@ -2010,13 +4654,13 @@ def render_exercise_I01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": "INVEST",
             "exercise_code": ex_code,
             "attempt_no": attempt_no,
             "seed": int(seed),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": is_ok,
             "score": int(score),
             "duration_sec": int(time.time() - st.session_state[start_key]),
@@ -2033,8 +4677,8 @@ def render_exercise_I01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.success("✅ CHÍNH XÁC! Bạn được **+10 điểm**.")
         else:
             st.error("❌ CHƯA ĐÚNG. Bạn được **0 điểm**.")
-            dec_vn = "Chấp nhận" if answers["decision"] == "ACCEPT" else "Từ chối"
-            st.info(f"📌 Đáp án chuẩn: NPV = **{answers['npv']:,.0f} USD** | Quyết định: **{dec_vn}**")
+            dec_vn = "Chấp nhận" if answers.decision == "ACCEPT" else "Từ chối"
+            st.info(f"📌 Đáp án chuẩn: NPV = **{answers.npv:,.0f} USD** | Quyết định: **{dec_vn}**")
 
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -2064,23 +4708,22 @@ def render_exercise_I02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.markdown("**Đề bài bạn đã nhận (từ DB):**")
-        st.write(f"- I0: **{params.get('I0',0):,} USD**")
-        st.write(f"- CF1: **{params.get('cf1',0):,}**, CF2: **{params.get('cf2',0):,}**, CF3: **{params.get('cf3',0):,}**, CF4: **{params.get('cf4',0):,}** (USD)")
-        wacc = float(params.get("wacc", 0))
+        st.write(f"- I0: **{params.I0:,} USD**")
+        st.write(f"- CF1: **{params.cf1:,}**, CF2: **{params.cf2:,}**, CF3: **{params.cf3:,}**, CF4: **{params.cf4:,}** (USD)")
+        wacc = float(params.wacc)
         st.write(f"- WACC: **{wacc*100:.0f}%/năm**")
 
-        dec = ans.get("decision","-")
+        dec = ans.decision
         dec_vn = "Chấp nhận" if dec == "ACCEPT" else "Từ chối"
-        st.success(f"IRR = **{ans.get('irr_pct','-')}%** | Quyết định: **{dec_vn}**")
+        st.success(f"IRR = **{ans.irr_pct}%** | Quyết định: **{dec_vn}**")
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_I02(seed)
+    params, answers = gen_case_records("I02", seed)
 
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
     if start_key not in st.session_state:
@@ -2103,14 +4746,14 @@ def render_exercise_I02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     c1, c2 = st.columns(2)
     with c1:
         st.markdown("##### 📌 Dòng tiền dự án (USD)")
-        st.write(f"I0 (t=0): **-{params['I0']:,}**")
-        st.write(f"CF1 (t=1): **{params['cf1']:,}**")
-        st.write(f"CF2 (t=2): **{params['cf2']:,}**")
-        st.write(f"CF3 (t=3): **{params['cf3']:,}**")
-        st.write(f"CF4 (t=4): **{params['cf4']:,}**")
+        st.write(f"I0 (t=0): **-{params.I0:,}**")
+        st.write(f"CF1 (t=1): **{params.cf1:,}**")
+        st.write(f"CF2 (t=2): **{params.cf2:,}**")
+        st.write(f"CF3 (t=3): **{params.cf3:,}**")
+        st.write(f"CF4 (t=4): **{params.cf4:,}**")
     with c2:
         st.markdown("##### 🧮 WACC")
-        st.write(f"WACC: **{params['wacc']*100:.0f}%/năm**")
+        st.write(f"WACC: **{params.wacc*100:.0f}%/năm**")
         st.caption("Quy tắc: Accept nếu IRR > WACC")
 
     st.markdown("---")
@@ -2138,10 +4781,10 @@ def render_exercise_I02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     TOL_PCT = 0.10  # cho phép sai số ±0.10% do làm tròn/nhập
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_i02_{attempt_no}"):
 
-        irr_ok = abs(float(in_irr) - float(answers["irr_pct"])) <= TOL_PCT
+        irr_ok = abs(float(in_irr) - float(answers.irr_pct)) <= TOL_PCT
 
         dec_code = "ACCEPT" if in_decision == "Chấp nhận" else "REJECT"
-        dec_ok = (dec_code == answers["decision"])
+        dec_ok = (dec_code == answers.decision)
 
         is_ok = bool(irr_ok and dec_ok)
         score = 10 if is_ok else 0
@@ -2149,13 +4792,13 @@ def render_exercise_I02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": get_student_name(mssv) or None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": "INVEST",
             "exercise_code": ex_code,
             "attempt_no": attempt_no,
             "seed": int(seed),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": is_ok,
             "score": int(score),
             "duration_sec": int(time.time() - st.session_state[start_key]),
@@ -2171,8 +4814,8 @@ def render_exercise_I02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.success("✅ CHÍNH XÁC! Bạn được **+10 điểm**.")
         else:
             st.error("❌ CHƯA ĐÚNG. Bạn được **0 điểm**.")
-            dec_vn = "Chấp nhận" if answers["decision"] == "ACCEPT" else "Từ chối"
-            st.info(f"📌 Đáp án chuẩn: IRR = **{answers['irr_pct']}%** | Quyết định: **{dec_vn}**")
+            dec_vn = "Chấp nhận" if answers.decision == "ACCEPT" else "Từ chối"
+            st.info(f"📌 Đáp án chuẩn: IRR = **{answers.irr_pct}%** | Quyết định: **{dec_vn}**")
 
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -2204,24 +4847,23 @@ def render_exercise_M01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.markdown("**Đề bài bạn đã nhận (từ DB):**")
-        st.write(f"- Nợ nước ngoài: **{params.get('debt_usd_bn','-')} tỷ USD**")
-        st.write(f"- Tỷ giá gốc: **{params.get('base_rate','-'):,.0f} VND/USD**")
-        st.write(f"- Mất giá: **{params.get('shock_pct','-')}%**")
+        st.write(f"- Nợ nước ngoài: **{params.debt_usd_bn} tỷ USD**")
+        st.write(f"- Tỷ giá gốc: **{params.base_rate:,.0f} VND/USD**")
+        st.write(f"- Mất giá: **{params.shock_pct}%**")
 
         st.markdown("**Đáp án chuẩn (đối chiếu học tập):**")
         st.success(
-            f"Tỷ giá mới: **{int(ans.get('new_rate',0)):,.0f} VND/USD**  |  "
-            f"Gánh nặng tăng thêm: **{ans.get('increase_tril','-')} nghìn tỷ VND**"
+            f"Tỷ giá mới: **{int(ans.new_rate):,.0f} VND/USD**  |  "
+            f"Gánh nặng tăng thêm: **{ans.increase_tril} nghìn tỷ VND**"
         )
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_M01(seed)
+    params, answers = gen_case_records("M01", seed)
 
     # 3) Ghi thời điểm bắt đầu (nếu sau này bạn muốn tính thời gian)
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -2243,11 +4885,11 @@ def render_exercise_M01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 
     c1, c2, c3 = st.columns(3)
     with c1:
-        st.metric("Nợ nước ngoài", f"{params['debt_usd_bn']} tỷ USD")
+        st.metric("Nợ nước ngoài", f"{params.debt_usd_bn} tỷ USD")
     with c2:
-        st.metric("Tỷ giá gốc", f"{params['base_rate']:,.0f} VND/USD")
+        st.metric("Tỷ giá gốc", f"{params.base_rate:,.0f} VND/USD")
     with c3:
-        st.metric("Mức mất giá", f"{params['shock_pct']}%")
+        st.metric("Mức mất giá", f"{params.shock_pct}%")
 
     st.markdown("---")
     st.caption("✍️ Nhập đáp án:")
@@ -2272,8 +4914,8 @@ def render_exercise_M01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     TOL_TRIL = 0.2
 
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_m01_{attempt_no}"):
-        ok_rate = abs(int(in_new_rate) - int(answers["new_rate"])) <= TOL_RATE
-        ok_inc = abs(float(in_increase) - float(answers["increase_tril"])) <= TOL_TRIL
+        ok_rate = abs(int(in_new_rate) - int(answers.new_rate)) <= TOL_RATE
+        ok_inc = abs(float(in_increase) - float(answers.increase_tril)) <= TOL_TRIL
 
         is_ok = bool(ok_rate and ok_inc)
 
@@ -2290,13 +4932,13 @@ def render_exercise_M01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": None,      # nếu bạn đã map họ tên từ Excel thì fill ở đây
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": room_key,   # "MACRO"
             "exercise_code": ex_code,  # "M01"
             "attempt_no": attempt_no,
             "seed": int(int(seed) % 2_000_000_000),
-            "params_json": params,
-            "answer_json": answers,
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": bool(is_ok),
             "score": int(score),
             "duration_sec": int(duration_sec),
@@ -2316,8 +4958,8 @@ def render_exercise_M01(mssv: str, room_key: str, ex_code: str, attempt_no: int)
             st.error("❌ CHƯA ĐÚNG. Bạn được **0 điểm**.")
 
         st.info(
-            f"📌 Đáp án: Tỷ giá mới **{answers['new_rate']:,.0f}** | "
-            f"Tăng thêm **{answers['increase_tril']} nghìn tỷ VND**"
+            f"📌 Đáp án: Tỷ giá mới **{answers.new_rate:,.0f}** | "
+            f"Tăng thêm **{answers.increase_tril} nghìn tỷ VND**"
         )
         # ✅ Lưu kết quả để sau rerun vẫn hiện
         st.session_state[f"LAST_GRADE_{ex_code}_{attempt_no}"] = {
@@ -2349,29 +4991,28 @@ def render_exercise_M02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         )
 
         st.warning(f"🔒 Bạn đã nộp **{ex_code} – Lần {attempt_no}** rồi.")
-        params = existing.get("params_json", {}) or {}
-        ans = existing.get("answer_json", {}) or {}
+        params, ans = load_case_records(ex_code, existing.get("params_json"), existing.get("answer_json"))
 
         st.markdown("**Đề bài bạn đã nhận (từ DB):**")
-        st.write(f"- Vay: **{params.get('notional_mjpy','-')} triệu JPY**")
-        st.write(f"- Spot JPY/VND (t0): **{float(params.get('s0',0)):,.1f} VND/JPY**")
-        st.write(f"- iVND: **{float(params.get('i_vnd',0))*100:.1f}%/năm**, iJPY: **{float(params.get('i_jpy',0))*100:.2f}%/năm**")
-        st.write(f"- Kỳ hạn: **{params.get('horizon_days','-')} ngày**")
-        st.write(f"- Shock: **JPY mạnh lên {params.get('shock_pct','-')}%**")
-        st.write(f"- Equity: **{int(params.get('equity_vnd',0)):,.0f} VND**, Margin trigger: **{float(params.get('margin_trigger',0))*100:.0f}%**")
+        st.write(f"- Vay: **{params.notional_mjpy} triệu JPY**")
+        st.write(f"- Spot JPY/VND (t0): **{float(params.s0):,.1f} VND/JPY**")
+        st.write(f"- iVND: **{float(params.i_vnd)*100:.1f}%/năm**, iJPY: **{float(params.i_jpy)*100:.2f}%/năm**")
+        st.write(f"- Kỳ hạn: **{params.horizon_days} ngày**")
+        st.write(f"- Shock: **JPY mạnh lên {params.shock_pct}%**")
+        st.write(f"- Equity: **{int(params.equity_vnd):,.0f} VND**, Margin trigger: **{float(params.margin_trigger)*100:.0f}%**")
 
         st.markdown("**Đáp án chuẩn (đối chiếu học tập):**")
-        mc = "YES" if bool(ans.get("margin_call", False)) else "NO"
+        mc = "YES" if bool(ans.margin_call) else "NO"
         st.success(
-            f"VND mở carry: **{int(ans.get('vnd_open',0)):,.0f}** | "
-            f"P/L: **{int(ans.get('pl_vnd',0)):,.0f} VND** | "
+            f"VND mở carry: **{int(ans.vnd_open):,.0f}** | "
+            f"P/L: **{int(ans.pl_vnd):,.0f} VND** | "
             f"Margin call: **{mc}**"
         )
         return
 
     # 2) Sinh đề theo seed ổn định
     seed = stable_seed(mssv, ex_code, attempt_no)
-    params, answers = gen_case_M02(seed)
+    params, answers = gen_case_records("M02", seed)
 
     # 3) Start time (nếu sau này cần)
     start_key = f"START_{mssv}_{ex_code}_{attempt_no}"
@@ -2394,22 +5035,22 @@ def render_exercise_M02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
 
     c1, c2, c3 = st.columns(3)
     with c1:
-        st.metric("Vay (Funding)", f"{params['notional_mjpy']} triệu JPY")
-        st.metric("Spot t0 (JPY/VND)", f"{params['s0']:.1f} VND/JPY")
+        st.metric("Vay (Funding)", f"{params.notional_mjpy} triệu JPY")
+        st.metric("Spot t0 (JPY/VND)", f"{params.s0:.1f} VND/JPY")
     with c2:
-        st.metric("iVND", f"{params['i_vnd']*100:.1f}%/năm")
-        st.metric("iJPY", f"{params['i_jpy']*100:.2f}%/năm")
+        st.metric("iVND", f"{params.i_vnd*100:.1f}%/năm")
+        st.metric("iJPY", f"{params.i_jpy*100:.2f}%/năm")
     with c3:
-        st.metric("Kỳ hạn", f"{params['horizon_days']} ngày")
-        st.metric("Shock (JPY mạnh lên)", f"{params['shock_pct']:.0f}%")
+        st.metric("Kỳ hạn", f"{params.horizon_days} ngày")
+        st.metric("Shock (JPY mạnh lên)", f"{params.shock_pct:.0f}%")
 
     st.markdown("---")
     st.caption("Thông tin margin:")
     m1, m2 = st.columns(2)
     with m1:
-        st.write(f"Equity ban đầu: **{params['equity_vnd']:,.0f} VND**")
+        st.write(f"Equity ban đầu: **{params.equity_vnd:,.0f} VND**")
     with m2:
-        st.write(f"Margin trigger: **{params['margin_trigger']*100:.0f}% (lỗ/equity)**")
+        st.write(f"Margin trigger: **{params.margin_trigger*100:.0f}% (lỗ/equity)**")
 
     st.markdown("---")
     st.caption("✍️ Nhập đáp án (làm tròn **1,000 VND** để nhập nhanh):")
@@ -2442,13 +5083,13 @@ def render_exercise_M02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
     # tolerance
     TOL_OPEN = 2000  # ±2,000 VND
     # P/L: cho lệch 0.5% hoặc tối thiểu 200,000 VND
-    pl_true = int(answers["pl_vnd"])
+    pl_true = int(answers.pl_vnd)
     TOL_PL = max(200_000, int(round(abs(pl_true) * 0.005)))
 
     if st.button("📩 NỘP BÀI (Submit)", type="primary", use_container_width=True, key=f"btn_submit_m02_{attempt_no}"):
-        ok_open = abs(int(in_vnd_open) - int(answers["vnd_open"])) <= TOL_OPEN
-        ok_pl = abs(int(in_pl_vnd) - int(answers["pl_vnd"])) <= TOL_PL
-        ok_mc = (str(in_mc).strip().upper() == ("YES" if answers["margin_call"] else "NO"))
+        ok_open = abs(int(in_vnd_open) - int(answers.vnd_open)) <= TOL_OPEN
+        ok_pl = abs(int(in_pl_vnd) - int(answers.pl_vnd)) <= TOL_PL
+        ok_mc = (str(in_mc).strip().upper() == ("YES" if answers.margin_call else "NO"))
         is_correct = bool(ok_open and ok_pl and ok_mc)
 
         score = 0
@@ -2461,17 +5102,13 @@ def render_exercise_M02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         payload = {
             "mssv": mssv,
             "hoten": None,
-            "lop": None,
+            "lop": get_student_class(mssv) or None,
             "room": room_key,           # "MACRO"
             "exercise_code": ex_code,   # "M02"
             "attempt_no": attempt_no,
             "seed": int(int(seed) % 2_000_000_000),
-            "params_json": params,
-            "answer_json": {
-                "vnd_open": int(answers["vnd_open"]),
-                "pl_vnd": int(answers["pl_vnd"]),
-                "margin_call": bool(answers["margin_call"]),
-            },
+            "params_json": params.to_json(),
+            "answer_json": answers.to_json(),
             "is_correct": is_correct,
             "score": int(score),
             "duration_sec": int(duration_sec),
@@ -2497,10 +5134,10 @@ def render_exercise_M02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         st.write(f"- (3) Margin call: {'✅' if ok_mc else '❌'}  (+{W_MC if ok_mc else 0})")
         st.success(f"🎯 Tổng điểm lần này: **{score}/10**")
 
-        mc_ans = "YES" if answers["margin_call"] else "NO"
+        mc_ans = "YES" if answers.margin_call else "NO"
         st.info(
-            f"📌 Đáp án: VND mở carry **{answers['vnd_open']:,.0f}** | "
-            f"P/L **{answers['pl_vnd']:,.0f} VND** | "
+            f"📌 Đáp án: VND mở carry **{answers.vnd_open:,.0f}** | "
+            f"P/L **{answers.pl_vnd:,.0f} VND** | "
             f"Margin call **{mc_ans}**"
         )
 
@@ -2513,321 +5150,143 @@ def render_exercise_M02(mssv: str, room_key: str, ex_code: str, attempt_no: int)
         st.rerun()
 
 
-#====== KẾT THÚC ĐỊNH NGHĨA HÀM RENDER CHO CÁC BÀI TẬP ======#
-
-# =========================================================
-# EXERCISE ROUTER MAP: (ROOM, EX_CODE) -> render_function
-# Mỗi render_function phải có chữ ký: fn(mssv: str, ex_code: str, attempt_no: int)
-# =========================================================
-
-EX_RENDERERS = {
-    ("DEALING", "D01"): render_exercise_D01,
-    ("DEALING", "D02"): render_exercise_D02,    
-    ("RISK", "R01"): render_exercise_R01,
-    ("RISK", "R02"): render_exercise_R02,
-    ("TRADE", "T01"): render_exercise_T01,
-    ("TRADE", "T02"): render_exercise_T02,
-    ("INVEST", "I01"): render_exercise_I01,
-    ("INVEST", "I02"): render_exercise_I02,
-    ("MACRO", "M01"): render_exercise_M01,
-    ("MACRO", "M02"): render_exercise_M02,
-}
-
-
-# ==============================================================================
-# 1) STYLE (UI + MOBILE RESPONSIVE)
-# ==============================================================================
-def init_style():
-    st.markdown(
-        """
-<style>
-/* -----------------------------
-   Global
-------------------------------*/
-:root{
-  --blue:#0d47a1;
-  --blue2:#1565c0;
-  --green:#28a745;
-  --green2:#218838;
-  --orange:#ff9800;
-  --red:#ff2b2b;
-  --text:#333;
-}
-.block-container { padding-top: 1.2rem; padding-bottom: 2.0rem; }
-h1, h2, h3, h4 { letter-spacing: 0.2px; }
-small, .stCaption { color: #666 !important; }
-
-/* ===== Buttons (CHUẨN) ===== */
-
-/* PRIMARY: đỏ/cam (AI + nút đang chọn) */
-div[data-testid="stButton"] > button[kind="primary"]{
-  background-color: #ff2b2b !important;
-  color: #fff !important;
-  border: none !important;
-  border-radius: 10px !important;
-  font-weight: 800 !important;
-  box-shadow: 0 2px 6px rgba(255,43,43,.35) !important;
-  font-family: "Segoe UI Emoji","Noto Color Emoji","Apple Color Emoji","Android Emoji",sans-serif !important;
-}
-div[data-testid="stButton"] > button[kind="primary"]:hover{
-  background-color: #d32f2f !important;
-  box-shadow: 0 6px 14px rgba(255,43,43,.45) !important;
-}
-
-/* ========================================================= */
-/* 1. STYLE MẶC ĐỊNH TOÀN APP (Nút Tính toán, Phân tích...)  */
-/* ========================================================= */
-
-/* Secondary mặc định => MÀU XANH (Giống cũ) */
-div[data-testid="stButton"] > button[kind="secondary"] {
-    background-color: #28a745 !important;
-    color: #fff !important;
-    border: none !important;
-    border-radius: 10px !important;
-    font-weight: 700 !important;
-    box-shadow: 0 2px 4px rgba(0,0,0,.18) !important;
-}
-
-/* Hover của nút xanh */
-div[data-testid="stButton"] > button[kind="secondary"]:hover {
-    background-color: #218838 !important; /* Xanh đậm hơn */
-    transform: translateY(-1px) !important;
-    box-shadow: 0 6px 12px rgba(0,0,0,.18) !important;
-    color: #fff !important;
-}
-
-/* ========================================================= */
-/* 2. NGOẠI LỆ: RIÊNG CÁC NÚT TRONG EXPANDER (Gợi ý kịch bản) */
-/* ========================================================= */
-
-/* Tìm thẻ stExpander chứa nút secondary => Ép thành TRONG SUỐT */
-div[data-testid="stExpander"] div[data-testid="stButton"] > button[kind="secondary"] {
-    background-color: #f8f9fa !important; /* <--- ĐỔI Ở ĐÂY (Xám siêu nhạt chuẩn UI) */
-    color: #333 !important;
-    border: 1px solid #d1d5db !important; /* Đổi viền sang xám lợt hơn chút cho tiệp màu */
-    box-shadow: 0 1px 2px rgba(0,0,0,0.05) !important; /* Thêm tí bóng nhẹ cho đẹp */
-}
-
-/* Hover của nút trong suốt => Hiện màu cam nhạt gợi ý */
-div[data-testid="stExpander"] div[data-testid="stButton"] > button[kind="secondary"]:hover {
-    background-color: #fff3e0 !important;
-    border-color: #ff9800 !important;
-    color: #e65100 !important;
-    transform: none !important; /* Không nảy lên để đỡ rối mắt */
-}
-
-/* -----------------------------
-   Cards / Boxes
-------------------------------*/
-.role-card {
-    background-color: #e3f2fd;
-    border-left: 6px solid var(--blue2);
-    padding: 18px 18px;
-    border-radius: 12px;
-    margin-bottom: 18px;
-    box-shadow: 0 2px 6px rgba(0,0,0,0.08);
-}
-.role-title {
-    color: var(--blue2);
-    font-weight: 800;
-    font-size: 18px;
-    margin-bottom: 6px;
-    display: flex;
-    align-items: center;
-    gap: 8px;
-}
-.mission-text { color: #424242; font-style: italic; font-size: 15px; line-height: 1.55; }
-
-.header-style {
-    font-size: 26px;
-    font-weight: 900;
-    color: var(--blue);
-    border-bottom: 2px solid #eee;
-    padding-bottom: 10px;
-    margin-bottom: 18px;
-}
-
-.result-box {
-    background-color: #f1f8e9;
-    padding: 14px 14px;
-    border-radius: 10px;
-    border: 1px solid #c5e1a5;
-    color: #33691e;
-    font-weight: 800;
-}
-.step-box {
-    background-color: #fafafa;
-    color: var(--text);
-    padding: 14px 14px;
-    border-radius: 10px;
-    border: 1px dashed #bdbdbd;
-    margin-bottom: 10px;
-}
-.explanation-box {
-    background-color: #fff8e1;
-    padding: 14px 14px;
-    border-radius: 10px;
-    border-left: 5px solid #ffb300;
-    margin-top: 10px;
-}
-.ai-box {
-    background-color: #fff3e0;
-    padding: 18px;
-    border-radius: 14px;
-    border-left: 6px solid var(--orange);
-    margin-top: 16px;
-    box-shadow: 0 4px 8px rgba(0,0,0,0.05);
-    color: var(--text) !important;
-}
-.ai-box h4 { color: #e65100 !important; font-weight: 900; margin: 0 0 8px 0; }
-.ai-box p, .ai-box li { color: var(--text) !important; }
-
-/* -----------------------------
-   Sidebar cosmetics
-------------------------------*/
-section[data-testid="stSidebar"] { border-right: 1px solid #eee; }
-section[data-testid="stSidebar"] .block-container { padding-top: 1rem; }
-
-/* -----------------------------
-   Mobile responsiveness
-   (Stack columns, reduce paddings, fix overflow)
-------------------------------*/
-@media (max-width: 768px){
-  .block-container { padding-left: 0.9rem; padding-right: 0.9rem; }
-  .header-style { font-size: 22px; }
-  .role-title { font-size: 16px; }
-  .mission-text { font-size: 14px; }
-
-  /* Stack Streamlit columns */
-  div[data-testid="stHorizontalBlock"]{
-      flex-direction: column !important;
-      align-items: stretch !important;
-      gap: 0.75rem !important;
-  }
-  div[data-testid="column"]{
-      width: 100% !important;
-      flex: 1 1 100% !important;
-  }
-
-  /* Make tables and charts scroll nicely */
-  .stDataFrame, .stTable { overflow-x: auto; }
-}
-
-/* =============================
-   Sidebar NAV buttons (mobile wrap fix)
-   ============================= */
-section[data-testid="stSidebar"] div[data-testid="stButton"] > button{
-  white-space: normal !important;      /* cho phép xuống dòng */
-  text-align: center !important;       /* canh giữa */
-  line-height: 1.15 !important;        /* đẹp khi 2 dòng */
-  padding: 12px 12px !important;
-  min-height: 56px !important;         /* tránh bị rớt lẻ */
-}
-
-/* Mobile nhỏ: tăng min-height + giảm font chút */
-@media (max-width: 430px){
-  section[data-testid="stSidebar"] div[data-testid="stButton"] > button{
-    font-size: 16px !important;
-    min-height: 68px !important;       /* đủ chỗ cho 2 dòng */
-    padding: 12px 10px !important;
-  }
-}
+#====== KẾT THÚC ĐỊNH NGHĨA HÀM RENDER CHO CÁC BÀI TẬP ======#
 
-/* Footer */
-.copyright {
-    font-size: 12px;
-    color: #888;
-    text-align: center;
-    margin-top: 36px;
-}
+# =========================================================
+# EXERCISE ROUTER MAP: (ROOM, EX_CODE) -> render_function
+# Mỗi render_function phải có chữ ký: fn(mssv: str, ex_code: str, attempt_no: int)
+# =========================================================
 
-/* ========================================================= */
-/* 3. SIDEBAR NAV BUTTONS (CHỈ ÁP DỤNG CHO MENU ĐIỀU HƯỚNG)   */
-/* ========================================================= */
-
-.nav-menu div[data-testid="stButton"] > button {
-  border-radius: 14px !important;
-  padding: 0.85rem 0.9rem !important;
-  font-weight: 800 !important;
-  border: 1px solid rgba(0,0,0,0.06) !important;
-  box-shadow: 0 2px 8px rgba(0,0,0,0.08) !important;
-  transition: all .18s ease-in-out !important;
-  margin-bottom: 10px !important;
+EX_RENDERERS = {
+    ("DEALING", "D01"): render_exercise_D01,
+    ("DEALING", "D02"): render_exercise_D02,    
+    ("RISK", "R01"): render_exercise_R01,
+    ("RISK", "R02"): render_exercise_R02,
+    ("TRADE", "T01"): render_exercise_T01,
+    ("TRADE", "T02"): render_exercise_T02,
+    ("INVEST", "I01"): render_exercise_I01,
+    ("INVEST", "I02"): render_exercise_I02,
+    ("MACRO", "M01"): render_exercise_M01,
+    ("MACRO", "M02"): render_exercise_M02,
 }
 
-/* Nút menu bình thường (secondary) -> MÀU XANH DƯƠNG/THANH LỊCH */
-.nav-menu div[data-testid="stButton"] > button[kind="secondary"]{
-  background: linear-gradient(180deg, #1e88e5 0%, #1565c0 100%) !important;
-  color: #fff !important;
-}
 
-/* Hover menu bình thường */
-.nav-menu div[data-testid="stButton"] > button[kind="secondary"]:hover{
-  background: linear-gradient(180deg, #42a5f5 0%, #1976d2 100%) !important;
-  transform: translateY(-1px) !important;
-  box-shadow: 0 10px 18px rgba(21,101,192,0.25) !important;
-}
+# ==============================================================================
+# 1) STYLE (UI + MOBILE RESPONSIVE)
+# ==============================================================================
+# Tài sản tĩnh (CSS, ảnh, icon): nguồn ở assets/, build_static_assets() minify/thu nhỏ rồi ghi vào
+# static/ với tên có content hash (app.3f2a9c1e.css) + manifest.json. Streamlit phục vụ static/ tại
+# app/static/... (.streamlit/config.toml: server.enableStaticServing = true) -> mỗi lần rerun chỉ gửi
+# 1 thẻ @import / <img> ngắn thay vì cả khối CSS; đổi nội dung = đổi tên file nên trình duyệt cache
+# thoải mái. Không bật static serving -> chèn CSS đã minify + ảnh từ đĩa (vẫn offline, không gọi CDN).
+ASSET_SRC_DIR = "assets"
+STATIC_DIR = "static"
+STATIC_URL = "app/static"
+STATIC_IMAGE_MAX_WIDTH = 800  # about.png gốc 1536px chỉ hiện trong popover
+
+
+def _app_path(*parts: str) -> str:
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), *parts)
+
+
+def minify_css(css: str) -> str:
+    """Bỏ comment + khoảng trắng thừa quanh { } ; , > và sau ':' (giữ nguyên chuỗi trong nháy)."""
+    parts = re.split(r'("[^"]*"|\'[^\']*\')', re.sub(r"/\*.*?\*/", "", css, flags=re.S))
+    for k in range(0, len(parts), 2):
+        code = re.sub(r"\s+", " ", parts[k])
+        code = re.sub(r"\s*([{};,>])\s*", r"\1", code)
+        parts[k] = re.sub(r":\s+", ":", code).replace(";}", "}")
+    return "".join(parts).strip()
+
+
+def _minify_asset(name: str, data: bytes) -> tuple[bytes, str]:
+    """(nội dung đã tối ưu, đuôi file) của 1 tài sản nguồn."""
+    ext = os.path.splitext(name)[1].lower()
+    if ext == ".css":
+        return minify_css(data.decode("utf-8")).encode("utf-8"), ext
+    if ext == ".svg":
+        return re.sub(rb">\s+<", b"><", re.sub(rb"<!--.*?-->", b"", data, flags=re.S)).strip(), ext
+    if ext == ".png":
+        from io import BytesIO
+        from PIL import Image
+
+        img = Image.open(BytesIO(data))
+        if img.width > STATIC_IMAGE_MAX_WIDTH:
+            img = img.resize((STATIC_IMAGE_MAX_WIDTH, round(img.height * STATIC_IMAGE_MAX_WIDTH / img.width)), Image.LANCZOS)
+        out = BytesIO()
+        if img.mode == "RGB":  # ảnh minh họa không trong suốt -> JPEG nhẹ hơn PNG hàng chục lần
+            img.save(out, format="JPEG", quality=85, optimize=True, progressive=True)
+            return out.getvalue(), ".jpg"
+        img.save(out, format="PNG", optimize=True)
+        return out.getvalue(), ext
+    return data, ext
+
+
+def build_static_assets(src: str | None = None, dest: str | None = None) -> dict:
+    """Build assets/ -> static/<tên>.<hash8><đuôi> + manifest.json (chạy lại khi sửa file trong assets/)."""
+    src = src or _app_path(ASSET_SRC_DIR)
+    dest = dest or _app_path(STATIC_DIR)
+    os.makedirs(dest, exist_ok=True)
+    for old in os.listdir(dest):
+        os.remove(os.path.join(dest, old))
+    files = {}
+    for name in sorted(os.listdir(src)):
+        with open(os.path.join(src, name), "rb") as f:
+            data, ext = _minify_asset(name, f.read())
+        stem = os.path.splitext(name)[0]
+        hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:8]}{ext}"
+        with open(os.path.join(dest, hashed), "wb") as f:
+            f.write(data)
+        files[name] = hashed
+    with open(os.path.join(dest, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(files, f, ensure_ascii=False, indent=2)
+    return files
 
-/* Nút menu đang chọn (primary) -> MÀU TÍM/ĐỎ RƯỢU (khác AI button đỏ) */
-.nav-menu div[data-testid="stButton"] > button[kind="primary"]{
-  background: linear-gradient(180deg, #8e24aa 0%, #6a1b9a 100%) !important;
-  color: #fff !important;
-  border: none !important;
-}
 
-/* Hover nút menu đang chọn */
-.nav-menu div[data-testid="stButton"] > button[kind="primary"]:hover{
-  background: linear-gradient(180deg, #ab47bc 0%, #7b1fa2 100%) !important;
-  transform: translateY(-1px) !important;
-  box-shadow: 0 10px 20px rgba(106,27,154,0.25) !important;
-}
+@st.cache_resource
+def load_static_manifest(path: str | None = None) -> dict:
+    """{tên nguồn: tên có hash} trong static/manifest.json ({} nếu chưa build)."""
+    try:
+        with open(path or _app_path(STATIC_DIR, "manifest.json"), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
 
-/* ========================================================= */
-/* FORCE OVERRIDE MENU BUTTONS IN SIDEBAR                    */
-/* ========================================================= */
-
-/* Chỉ áp dụng cho nút trong SIDEBAR */
-section[data-testid="stSidebar"] div[data-testid="stButton"] > button[kind="secondary"]{
-  background: linear-gradient(180deg, #1e88e5 0%, #1565c0 100%) !important;
-  color: #fff !important;
-  border: 1px solid rgba(0,0,0,0.06) !important;
-  border-radius: 14px !important;
-  font-weight: 800 !important;
-  box-shadow: 0 2px 8px rgba(0,0,0,0.08) !important;
-  transition: all .18s ease-in-out !important;
-}
 
-section[data-testid="stSidebar"] div[data-testid="stButton"] > button[kind="secondary"]:hover{
-  background: linear-gradient(180deg, #42a5f5 0%, #1976d2 100%) !important;
-  transform: translateY(-1px) !important;
-  box-shadow: 0 10px 18px rgba(21,101,192,0.25) !important;
-}
+def asset_url(name: str) -> str | None:
+    """URL app/static/... của tài sản; None nếu không bật static serving hoặc chưa build."""
+    hashed = load_static_manifest().get(name)
+    if hashed is None or not st.get_option("server.enableStaticServing"):
+        return None
+    return f"{STATIC_URL}/{hashed}"
 
-/* Nút đang chọn (primary) trong sidebar */
-section[data-testid="stSidebar"] div[data-testid="stButton"] > button[kind="primary"]{
-  background: linear-gradient(180deg, #8e24aa 0%, #6a1b9a 100%) !important;
-  color: #fff !important;
-  border: none !important;
-  border-radius: 14px !important;
-  font-weight: 900 !important;
-  box-shadow: 0 6px 14px rgba(106,27,154,0.25) !important;
-}
 
-section[data-testid="stSidebar"] div[data-testid="stButton"] > button[kind="primary"]:hover{
-  background: linear-gradient(180deg, #ab47bc 0%, #7b1fa2 100%) !important;
-  transform: translateY(-1px) !important;
-}
+def asset_path(name: str) -> str:
+    """File trên đĩa: bản đã build trong static/ nếu có, ngược lại file nguồn trong assets/."""
+    hashed = load_static_manifest().get(name)
+    built = _app_path(STATIC_DIR, hashed) if hashed else None
+    return built if built and os.path.exists(built) else _app_path(ASSET_SRC_DIR, name)
 
-/* spacing đẹp hơn */
-section[data-testid="stSidebar"] div[data-testid="stButton"]{
-  margin-bottom: 10px !important;
-}
+
+def use_stylesheet(name: str):
+    url = asset_url(name)
+    if url:
+        st.html(f'<style>@import url("{url}");</style>')
+    else:
+        with open(asset_path(name), encoding="utf-8") as f:
+            st.html(f"<style>{minify_css(f.read())}</style>")
 
 
-</style>
-        """,
-        unsafe_allow_html=True,
-    )
+def show_asset_image(name: str, width: int | None = None):
+    url = asset_url(name)
+    if url:
+        st.markdown(f'<img src="{url}" width="{width}">' if width else f"![]({url})", unsafe_allow_html=True)
+    else:
+        st.image(asset_path(name), width=width or "content")
+
+
+def init_style():
+    use_stylesheet("app.css")
 
 
 init_style()
@@ -2954,7 +5413,7 @@ st.caption("Hệ thống Mô phỏng Nghiệp vụ Tài chính Quốc tế với
 # ==============================================================================
 with st.sidebar:
 
-    st.image("https://cdn-icons-png.flaticon.com/512/3135/3135715.png", width=50)
+    show_asset_image("lab-icon.svg", width=50)
     st.markdown("### 🎓 Cổng Lab")      
 
     # 1. Nhập liệu
@@ -2982,13 +5441,14 @@ with st.sidebar:
             quota_placeholder = st.empty()
             # B. Hiển thị số lượt đã dùng ngay tại đây cho SV thấy
             current_used = get_usage_from_supabase(input_mssv)
+            max_quota = ai_quota_for(input_mssv)
 
             if current_used is None:
                 quota_placeholder.error("⛔ Không kết nối được Database quota nên tạm khóa AI. Bạn vẫn thực hành bình thường.")
-            elif current_used < MAX_AI_QUOTA:
-                quota_placeholder.caption(f"✅ Đã dùng: **{current_used}/{MAX_AI_QUOTA}** lượt gọi AI.")
+            elif current_used < max_quota:
+                quota_placeholder.caption(f"✅ Đã dùng: **{current_used}/{max_quota}** lượt gọi AI.")
             else:
-                quota_placeholder.error(f"⛔ Đã dùng hết: **{current_used}/{MAX_AI_QUOTA}** lượt gọi AI.")                
+                quota_placeholder.error(f"⛔ Đã dùng hết: **{current_used}/{max_quota}** lượt gọi AI.")                
         else:
             # C. Nhập sai
             st.error("⛔ Danh sách lớp không có MSSV này! Bạn vẫn thực hành bình thường nhưng không được dùng AI.")
@@ -3050,7 +5510,7 @@ with st.sidebar:
     # Người dùng bấm vào dòng chữ bản quyền -> Hiện About
     with st.popover("© 2026 - Nguyễn Minh Hải", use_container_width=True):        
         st.write("Mô phỏng Tài chính Quốc tế")
-        st.image("about.png") # Nhớ thay tên file ảnh của bạn
+        show_asset_image("about.png")
     
     # st.markdown("---")
     # # --- PHẦN UI HƯỚNG DẪN CÀI ĐẶT ---
@@ -3104,6 +5564,43 @@ def footer():
     )
 
 
+# =========================
+# PANEL FRAGMENTS: chạy lại cục bộ từng khối tính toán
+# =========================
+# Mỗi khối tính toán độc lập là 1 st.fragment có key: đổi widget bên trong chỉ chạy lại khối đó
+# (không chạy lại sidebar/tra cứu quota Supabase/CSS/các tab khác). Widget đầu vào mà khối khác
+# phụ thuộc dùng on_change=rerun_panels(...) để chạy lại đúng các khối phụ thuộc.
+# Khối phụ thuộc đọc giá trị từ st.session_state[<khối nguồn>] (khối nguồn ghi trước khi trả về).
+PANEL_TIMINGS_KEY = "_panel_timings"
+
+
+def panel_fragment(key: str):
+    """@st.fragment(key=key) + ghi thời gian chạy thân khối (ms) vào st.session_state[PANEL_TIMINGS_KEY][key]."""
+    def deco(fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                st.session_state.setdefault(PANEL_TIMINGS_KEY, {})[key] = (time.perf_counter() - t0) * 1000
+        fragment = st.fragment(timed, key=key)
+
+        @functools.wraps(fn)
+        def call(*args, **kwargs):
+            # `import app` ngoài Streamlit (bare mode, vd. kiểm tra golden): st.fragment bỏ qua thân hàm -> chạy thẳng
+            if not st.runtime.exists():
+                return timed(*args, **kwargs)
+            return fragment(*args, **kwargs)
+        return call
+    return deco
+
+
+def rerun_panels(*keys: str):
+    """Callback on_change/on_click: chạy lại đúng các khối có key liệt kê (khối nguồn đứng trước)."""
+    return lambda: st.rerun(list(keys))
+
+
 # ==============================================================================
 # PHÒNG 1: DEALING ROOM
 # ==============================================================================
@@ -3125,41 +5622,43 @@ def room_1_dealing():
     # TAB 1: Cross-rate
     # -------------------------
     with tab1:
-        st.subheader("🏦 Bảng điện tử Tỷ giá liên ngân hàng")
-        st.caption("Nhập tỷ giá thị trường quốc tế và nội địa để tính tỷ giá chéo (EUR/VND).")
+        @panel_fragment("r1_cross_rate")
+        def cross_rate_panel():
+            st.subheader("🏦 Bảng điện tử Tỷ giá liên ngân hàng")
+            st.caption("Nhập tỷ giá thị trường quốc tế và nội địa để tính tỷ giá chéo (EUR/VND).")
 
-        c1, c2 = st.columns(2)
-        with c1:
-            st.markdown("##### 🇺🇸 Thị trường 1: USD/VND")
-            usd_bid = st.number_input("BID (NH Mua USD):", value=25350.0, step=10.0, format="%.0f", key="r1_usd_bid")
-            usd_ask = st.number_input("ASK (NH Bán USD):", value=25450.0, step=10.0, format="%.0f", key="r1_usd_ask")
-        with c2:
-            st.markdown("##### 🇪🇺 Thị trường 2: EUR/USD")
-            eur_bid = st.number_input("BID (NH Mua EUR):", value=1.0820, step=0.0001, format="%.4f", key="r1_eur_bid")
-            eur_ask = st.number_input("ASK (NH Bán EUR):", value=1.0850, step=0.0001, format="%.4f", key="r1_eur_ask")
+            c1, c2 = st.columns(2)
+            with c1:
+                st.markdown("##### 🇺🇸 Thị trường 1: USD/VND")
+                usd_bid = st.number_input("BID (NH Mua USD):", value=25350.0, step=10.0, format="%.0f", key="r1_usd_bid")
+                usd_ask = st.number_input("ASK (NH Bán USD):", value=25450.0, step=10.0, format="%.0f", key="r1_usd_ask")
+            with c2:
+                st.markdown("##### 🇪🇺 Thị trường 2: EUR/USD")
+                eur_bid = st.number_input("BID (NH Mua EUR):", value=1.0820, step=0.0001, format="%.4f", key="r1_eur_bid")
+                eur_ask = st.number_input("ASK (NH Bán EUR):", value=1.0850, step=0.0001, format="%.4f", key="r1_eur_ask")
 
-        st.markdown("---")
+            st.markdown("---")
 
-        if st.button("🚀 TÍNH TOÁN & NIÊM YẾT", key="btn_cross_rate", use_container_width=True):
-            cross_bid = eur_bid * usd_bid
-            cross_ask = eur_ask * usd_ask
-            spread = cross_ask - cross_bid
+            if st.button("🚀 TÍNH TOÁN & NIÊM YẾT", key="btn_cross_rate", use_container_width=True):
+                cross_bid = eur_bid * usd_bid
+                cross_ask = eur_ask * usd_ask
+                spread = cross_ask - cross_bid
 
-            st.success(f"✅ TỶ GIÁ NIÊM YẾT (EUR/VND): {cross_bid:,.0f} - {cross_ask:,.0f}")
-            st.info(f"📊 Spread (Chênh lệch Mua-Bán): {spread:,.0f} VND/EUR")
+                st.success(f"✅ TỶ GIÁ NIÊM YẾT (EUR/VND): {cross_bid:,.0f} - {cross_ask:,.0f}")
+                st.info(f"📊 Spread (Chênh lệch Mua-Bán): {spread:,.0f} VND/EUR")
 
-            with st.expander("🎓 GÓC HỌC TẬP: GIẢI MÃ CÔNG THỨC & SỐ LIỆU", expanded=False):
-                st.markdown("#### 1. Công thức Toán học")
-                st.latex(r"\text{EUR/VND}_{Bid} = \text{EUR/USD}_{Bid} \times \text{USD/VND}_{Bid}")
-                st.latex(r"\text{EUR/VND}_{Ask} = \text{EUR/USD}_{Ask} \times \text{USD/VND}_{Ask}")
+                with st.expander("🎓 GÓC HỌC TẬP: GIẢI MÃ CÔNG THỨC & SỐ LIỆU", expanded=False):
+                    st.markdown("#### 1. Công thức Toán học")
+                    st.latex(r"\text{EUR/VND}_{Bid} = \text{EUR/USD}_{Bid} \times \text{USD/VND}_{Bid}")
+                    st.latex(r"\text{EUR/VND}_{Ask} = \text{EUR/USD}_{Ask} \times \text{USD/VND}_{Ask}")
 
-                st.divider()
+                    st.divider()
 
-                st.markdown("#### 2. Áp dụng số liệu bạn vừa nhập")
-                st.write("Hệ thống đã thực hiện phép tính cụ thể như sau:")
+                    st.markdown("#### 2. Áp dụng số liệu bạn vừa nhập")
+                    st.write("Hệ thống đã thực hiện phép tính cụ thể như sau:")
 
-                st.markdown(
-                    f"""
+                    st.markdown(
+                        f"""
 **a) Tính Tỷ giá Mua (BID):**
 $$
 {eur_bid:.4f} \\times {usd_bid:,.0f} = \\mathbf{{{cross_bid:,.0f}}}
@@ -3175,75 +5674,79 @@ $$
 {cross_ask:,.0f} - {cross_bid:,.0f} = \\mathbf{{{spread:,.0f}}}
 $$
 """
-                )
+                    )
 
-                st.divider()
+                    st.divider()
 
-                st.markdown("#### 3. Tại sao lại nhân `Bid × Bid`?")
-                st.info(
-                    """
+                    st.markdown("#### 3. Tại sao lại nhân `Bid × Bid`?")
+                    st.info(
+                        """
 Để Ngân hàng Việt Nam **mua EUR** từ khách hàng (trả VND), họ đi “đường vòng” qua USD:
 1) **Bước 1:** Bán EUR lấy USD trên thị trường quốc tế → dùng **EUR/USD Bid** (giá đối tác mua EUR).
 2) **Bước 2:** Bán USD lấy VND tại Việt Nam → dùng **USD/VND Bid** (giá thị trường mua USD).
 
 👉 Kết luận: **Cross Bid = Bid × Bid**. Tương tự **Cross Ask = Ask × Ask**.
 """
-                )
+                    )
+
+        cross_rate_panel()
 
     # -------------------------
     # TAB 2: Triangular arbitrage
     # -------------------------
     with tab2:
-        st.subheader("⚡ Săn Arbitrage (Kinh doanh chênh lệch giá)")
-        st.caption("Mô phỏng arbitrage tam giác giữa 3 báo giá. Hệ thống tự chọn chiều giao dịch tối ưu.")
+        @panel_fragment("r1_arbitrage")
+        def arbitrage_panel():
+            st.subheader("⚡ Săn Arbitrage (Kinh doanh chênh lệch giá)")
+            st.caption("Mô phỏng arbitrage tam giác giữa 3 báo giá. Hệ thống tự chọn chiều giao dịch tối ưu.")
 
-        # 1) Inputs
-        capital = st.number_input("Vốn kinh doanh (USD):", value=1_000_000.0, step=10_000.0, format="%.0f", key="r1_capital")
+            # 1) Inputs
+            capital = st.number_input("Vốn kinh doanh (USD):", value=1_000_000.0, step=10_000.0, format="%.0f", key="r1_capital")
 
-        st.markdown("---")
-        k1, k2, k3 = st.columns(3)
-        with k1:
-            bank_a = st.number_input("Bank A (USD/VND):", value=25_000.0, help="Giá bán USD lấy VND", key="r1_bank_a")
-        with k2:
-            bank_b = st.number_input("Bank B (EUR/USD):", value=1.1000, help="Giá bán EUR lấy USD", key="r1_bank_b")
-        with k3:
-            bank_c = st.number_input("Bank C (EUR/VND):", value=28_000.0, help="Giá bán EUR lấy VND", key="r1_bank_c")
-
-        # Core compute (always compute to feed AI)
-        fair_rate_c = bank_a * bank_b
-
-        # Path 1: USD -> EUR -> VND -> USD
-        path1_eur = capital / bank_b
-        path1_vnd = path1_eur * bank_c
-        path1_usd_final = path1_vnd / bank_a
-        profit1 = path1_usd_final - capital
-
-        # Path 2: USD -> VND -> EUR -> USD
-        path2_vnd = capital * bank_a
-        path2_eur = path2_vnd / bank_c
-        path2_usd_final = path2_eur * bank_b
-        profit2 = path2_usd_final - capital
-
-        if profit1 > profit2 and profit1 > 0:
-            best_direction = "Mua EUR (Bank B) ➔ Bán tại Bank C ➔ Đổi về Bank A"
-            best_profit = profit1
-        elif profit2 >= profit1 and profit2 > 0:
-            best_direction = "Đổi VND (Bank A) ➔ Mua EUR (Bank C) ➔ Bán tại Bank B"
-            best_profit = profit2
-        else:
-            best_direction = "Không có cơ hội (Thị trường cân bằng hoặc lỗ)"
-            best_profit = 0.0
+            st.markdown("---")
+            k1, k2, k3 = st.columns(3)
+            with k1:
+                bank_a = st.number_input("Bank A (USD/VND):", value=25_000.0, help="Giá bán USD lấy VND", key="r1_bank_a")
+            with k2:
+                bank_b = st.number_input("Bank B (EUR/USD):", value=1.1000, help="Giá bán EUR lấy USD", key="r1_bank_b")
+            with k3:
+                bank_c = st.number_input("Bank C (EUR/VND):", value=28_000.0, help="Giá bán EUR lấy VND", key="r1_bank_c")
+
+            # Core compute (always compute to feed AI)
+            fair_rate_c = bank_a * bank_b
+
+            # Path 1: USD -> EUR -> VND -> USD
+            path1_eur = capital / bank_b
+            path1_vnd = path1_eur * bank_c
+            path1_usd_final = path1_vnd / bank_a
+            profit1 = path1_usd_final - capital
+
+            # Path 2: USD -> VND -> EUR -> USD
+            path2_vnd = capital * bank_a
+            path2_eur = path2_vnd / bank_c
+            path2_usd_final = path2_eur * bank_b
+            profit2 = path2_usd_final - capital
+
+            if profit1 > profit2 and profit1 > 0:
+                best_direction = "Mua EUR (Bank B) ➔ Bán tại Bank C ➔ Đổi về Bank A"
+                best_profit = profit1
+            elif profit2 >= profit1 and profit2 > 0:
+                best_direction = "Đổi VND (Bank A) ➔ Mua EUR (Bank C) ➔ Bán tại Bank B"
+                best_profit = profit2
+            else:
+                best_direction = "Không có cơ hội (Thị trường cân bằng hoặc lỗ)"
+                best_profit = 0.0
 
-        st.markdown("---")
+            st.markdown("---")
 
-        if st.button("🚀 KÍCH HOẠT THUẬT TOÁN ARBITRAGE", key="btn_arbitrage", use_container_width=True):
-            st.markdown("### 📝 Nhật ký giao dịch tối ưu:")
+            if st.button("🚀 KÍCH HOẠT THUẬT TOÁN ARBITRAGE", key="btn_arbitrage", use_container_width=True):
+                st.markdown("### 📝 Nhật ký giao dịch tối ưu:")
 
-            # tránh nhiễu do làm tròn
-            if profit1 > 1.0:
-                st.success("✅ PHÁT HIỆN CƠ HỘI: Mua EUR (Bank B) ➔ Bán tại Bank C ➔ Đổi về Bank A")
-                st.markdown(
-                    f"""
+                # tránh nhiễu do làm tròn
+                if profit1 > 1.0:
+                    st.success("✅ PHÁT HIỆN CƠ HỘI: Mua EUR (Bank B) ➔ Bán tại Bank C ➔ Đổi về Bank A")
+                    st.markdown(
+                        f"""
 <div class="step-box">
 1. <b>Dùng USD mua EUR (tại Bank B):</b><br>
 {capital:,.0f} / {bank_b} = <b>{path1_eur:,.2f} EUR</b><br><br>
@@ -3253,15 +5756,15 @@ $$
 {path1_vnd:,.0f} / {bank_a:,.0f} = <b>{path1_usd_final:,.2f} USD</b>
 </div>
 """,
-                    unsafe_allow_html=True,
-                )
-                st.markdown(f'<div class="result-box">🎉 LỢI NHUẬN: +{profit1:,.2f} USD</div>', unsafe_allow_html=True)
-                st.info(f"💡 Gợi ý cân bằng: chỉnh **Bank C** về **{fair_rate_c:,.0f}** (= {bank_a:,.0f} × {bank_b}).")
+                        unsafe_allow_html=True,
+                    )
+                    st.markdown(f'<div class="result-box">🎉 LỢI NHUẬN: +{profit1:,.2f} USD</div>', unsafe_allow_html=True)
+                    st.info(f"💡 Gợi ý cân bằng: chỉnh **Bank C** về **{fair_rate_c:,.0f}** (= {bank_a:,.0f} × {bank_b}).")
 
-            elif profit2 > 1.0:
-                st.success("✅ PHÁT HIỆN CƠ HỘI: Đổi VND (Bank A) ➔ Mua EUR (Bank C) ➔ Bán tại Bank B")
-                st.markdown(
-                    f"""
+                elif profit2 > 1.0:
+                    st.success("✅ PHÁT HIỆN CƠ HỘI: Đổi VND (Bank A) ➔ Mua EUR (Bank C) ➔ Bán tại Bank B")
+                    st.markdown(
+                        f"""
 <div class="step-box">
 1. <b>Đổi USD sang VND (tại Bank A):</b><br>
 {capital:,.0f} × {bank_a:,.0f} = <b>{path2_vnd:,.0f} VND</b><br><br>
@@ -3271,19 +5774,19 @@ $$
 {path2_eur:,.2f} × {bank_b} = <b>{path2_usd_final:,.2f} USD</b>
 </div>
 """,
-                    unsafe_allow_html=True,
-                )
-                st.markdown(f'<div class="result-box">🎉 LỢI NHUẬN: +{profit2:,.2f} USD</div>', unsafe_allow_html=True)
-                st.info(f"💡 Gợi ý cân bằng: chỉnh **Bank C** về **{fair_rate_c:,.0f}** (= {bank_a:,.0f} × {bank_b}).")
+                        unsafe_allow_html=True,
+                    )
+                    st.markdown(f'<div class="result-box">🎉 LỢI NHUẬN: +{profit2:,.2f} USD</div>', unsafe_allow_html=True)
+                    st.info(f"💡 Gợi ý cân bằng: chỉnh **Bank C** về **{fair_rate_c:,.0f}** (= {bank_a:,.0f} × {bank_b}).")
 
-            else:
-                st.balloons()
-                st.warning("⚖️ Thị trường cân bằng (No Arbitrage). Cả 2 chiều giao dịch đều không sinh lời.")
-                st.success(f"👏 Bạn đang ở vùng cân bằng: {bank_c:,.0f} ≈ {fair_rate_c:,.0f} (= {bank_a:,.0f} × {bank_b})")
+                else:
+                    st.balloons()
+                    st.warning("⚖️ Thị trường cân bằng (No Arbitrage). Cả 2 chiều giao dịch đều không sinh lời.")
+                    st.success(f"👏 Bạn đang ở vùng cân bằng: {bank_c:,.0f} ≈ {fair_rate_c:,.0f} (= {bank_a:,.0f} × {bank_b})")
 
-            with st.expander("🎓 BẢN CHẤT: Tại sao có tiền lời?"):
-                st.markdown(
-                    """
+                with st.expander("🎓 BẢN CHẤT: Tại sao có tiền lời?"):
+                    st.markdown(
+                        """
 **Nguyên lý:** Arbitrage tam giác (Triangular Arbitrage).
 
 Máy tính so sánh 2 con đường:
@@ -3292,13 +5795,13 @@ Máy tính so sánh 2 con đường:
 
 Nếu chênh lệch đủ lớn, đi một vòng sẽ “đẻ” ra lợi nhuận.
 """
-                )
+                    )
 
-        # Minh họa (cố định, tránh lệch)
-        with st.container(border=True):
-            st.markdown("##### 🔄 Minh họa dòng tiền kiếm lời:")
-            st.graphviz_chart(
-                """
+            # Minh họa (cố định, tránh lệch)
+            with st.container(border=True):
+                st.markdown("##### 🔄 Minh họa dòng tiền kiếm lời:")
+                st.graphviz_chart(
+                    """
 digraph {
     rankdir=LR;
     node [fontname="Arial", shape=box, style="filled,rounded", fillcolor="#f0f2f6", color="#d1d5db"];
@@ -3312,9 +5815,14 @@ digraph {
     MarketB -> Wallet [label="2. Bán cao & Chốt lời", color="#f44336", penwidth=2];
 }
 """,
-                use_container_width=True,
-            )
-            st.info("💡 Dễ hiểu: mua ở nơi rẻ hơn và bán ngay ở nơi đắt hơn, trước khi giá kịp điều chỉnh.")
+                    use_container_width=True,
+                )
+                st.info("💡 Dễ hiểu: mua ở nơi rẻ hơn và bán ngay ở nơi đắt hơn, trước khi giá kịp điều chỉnh.")
+
+            return capital, bank_a, bank_b, bank_c, best_direction, best_profit
+
+        # Giá trị mới nhất cho AI (nút AI nằm ngoài fragment -> bấm là chạy lại toàn trang)
+        capital, bank_a, bank_b, bank_c, best_direction, best_profit = arbitrage_panel()
 
         # AI
         st.markdown("---")
@@ -3330,9 +5838,10 @@ digraph {
 
             # BƯỚC 2: KIỂM TRA HẠN MỨC (QUOTA)
             current_used = get_usage_from_supabase(user_id)
+            max_quota = ai_quota_for(user_id)
             
-            if current_used >= MAX_AI_QUOTA:
-                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({MAX_AI_QUOTA}/{MAX_AI_QUOTA}).")
+            if current_used >= max_quota:
+                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({max_quota}/{max_quota}).")
                 st.stop()
 
             # 3. Chuẩn bị dữ liệu
@@ -3347,7 +5856,7 @@ digraph {
             task = "Phân tích rủi ro khớp lệnh, chi phí vốn và đưa ra quyết định GO/NO-GO."
 
             # 4. Gọi AI và Xử lý lỗi
-            with st.spinner(f"AI đang phân tích... (Lượt gọi AI thứ {current_used + 1}/{MAX_AI_QUOTA})"):
+            with st.spinner(f"AI đang phân tích... (Lượt gọi AI thứ {current_used + 1}/{max_quota})"):
                 try:
                     advise_result = ask_gemini_advisor("Senior FX Trader", context, task)
 
@@ -3365,7 +5874,7 @@ digraph {
                         
                         # Bắn nội dung mới vào cái hộp "quota_placeholder" đang nằm bên Sidebar
                         # Lưu ý: Bạn cần đảm bảo biến 'quota_placeholder' truy cập được từ đây
-                        quota_placeholder.info(f"Đã dùng: {new_usage}/{MAX_AI_QUOTA} lượt")
+                        quota_placeholder.info(f"Đã dùng: {new_usage}/{max_quota} lượt")
                         
                         # 3. Hiện kết quả AI ra màn hình chính
                         st.markdown(f'<div class="ai-box"><h4>🤖 LỜI KHUYÊN CỦA NHÀ GIAO DỊCH AI</h4>{advise_result}</div>', unsafe_allow_html=True)                        
@@ -3386,7 +5895,7 @@ def room_2_risk():
     with c1:
         debt_amount = st.number_input("Giá trị khoản phải trả (USD):", value=1_000_000.0, step=10_000.0, format="%.0f", key="r2_debt")
     with c2:
-        days_loan_profile = st.number_input("Thời hạn thanh toán (Ngày):", value=90, step=30, key="r2_days_profile")
+        days_loan_profile = st.number_input("Thời hạn thanh toán (Ngày):", value=90, min_value=1, max_value=1825, step=30, key="r2_days_profile")
 
     st.markdown(
         f"""
@@ -3401,235 +5910,380 @@ def room_2_risk():
     st.markdown("---")
 
     # IRP
-    st.subheader("2. Tính Tỷ giá Kỳ hạn (Fair Forward Rate)")
-    st.caption("Định giá Forward dựa trên chênh lệch lãi suất VND và USD (IRP).")
-
-    c_input1, c_input2, c_input3, c_input4 = st.columns(4)
-    with c_input1:
-        spot_irp = st.number_input("Spot Rate (Hiện tại):", value=25_000.0, step=10.0, format="%.0f", key="r2_spot")
-    with c_input2:
-        r_vnd = st.number_input("Lãi suất VND (%/năm):", value=6.0, step=0.1, key="r2_rvnd")
-    with c_input3:
-        r_usd = st.number_input("Lãi suất USD (%/năm):", value=3.0, step=0.1, key="r2_rusd")
-    with c_input4:
-        days_loan = st.number_input("Kỳ hạn (Ngày):", value=90, step=30, key="r2_days_irp")
-
-    numerator = 1 + (r_vnd / 100) * (days_loan / 360)
-    denominator = 1 + (r_usd / 100) * (days_loan / 360)
-    fwd_cal = spot_irp * (numerator / denominator)
-    swap_point = fwd_cal - spot_irp
+    @panel_fragment("r2_irp")
+    def irp_panel():
+        st.subheader("2. Tính Tỷ giá Kỳ hạn (Fair Forward Rate)")
+        st.caption("Định giá Forward dựa trên chênh lệch lãi suất VND và USD (IRP).")
+
+        c_input1, c_input2, c_input3, c_input4 = st.columns(4)
+        with c_input1:
+            spot_irp = st.number_input("Spot Rate (Hiện tại):", value=25_000.0, step=10.0, format="%.0f", key="r2_spot",
+                on_change=rerun_panels("r2_irp", "r2_hedge", "r2_swap"))
+        with c_input2:
+            r_vnd = st.number_input("Lãi suất VND (%/năm):", value=6.0, step=0.1, key="r2_rvnd",
+                on_change=rerun_panels("r2_irp", "r2_hedge", "r2_swap"))
+        with c_input3:
+            r_usd = st.number_input("Lãi suất USD (%/năm):", value=3.0, step=0.1, key="r2_rusd",
+                on_change=rerun_panels("r2_irp", "r2_hedge", "r2_swap"))
+        with c_input4:
+            days_loan = st.number_input("Kỳ hạn (Ngày):", value=90, step=30, key="r2_days_irp",
+                on_change=rerun_panels("r2_irp", "r2_hedge", "r2_swap"))
+
+        numerator = growth_factor(r_vnd / 100, year_fraction(days=days_loan))
+        denominator = growth_factor(r_usd / 100, year_fraction(days=days_loan))
+        fwd_cal = spot_irp * (numerator / denominator)
+        swap_point = fwd_cal - spot_irp
 
-    st.markdown("---")
-    col_res_irp1, col_res_irp2 = st.columns([1, 1.5])
-
-    with col_res_irp1:
-        st.markdown("##### 🏁 KẾT QUẢ TÍNH TOÁN")
-        st.metric("Tỷ giá Forward (F)", f"{fwd_cal:,.0f} VND", help="Tỷ giá kỳ hạn hợp lý theo IRP")
-        st.metric(
-            "Điểm kỳ hạn (Swap Point)",
-            f"{swap_point:,.0f} VND",
-            delta="VND giảm giá (Forward > Spot)" if swap_point > 0 else "VND tăng giá (Forward < Spot)",
-            delta_color="inverse",
-        )
+        st.markdown("---")
+        col_res_irp1, col_res_irp2 = st.columns([1, 1.5])
+
+        with col_res_irp1:
+            st.markdown("##### 🏁 KẾT QUẢ TÍNH TOÁN")
+            st.metric("Tỷ giá Forward (F)", f"{fwd_cal:,.0f} VND", help="Tỷ giá kỳ hạn hợp lý theo IRP")
+            st.metric(
+                "Điểm kỳ hạn (Swap Point)",
+                f"{swap_point:,.0f} VND",
+                delta="VND giảm giá (Forward > Spot)" if swap_point > 0 else "VND tăng giá (Forward < Spot)",
+                delta_color="inverse",
+            )
 
-        if r_vnd > r_usd:
-            st.warning(f"📉 Lãi suất VND cao hơn USD ({r_vnd}% > {r_usd}%) ⇒ VND thường bị “trừ điểm” (Forward cao hơn Spot).")
-        else:
-            st.success("📈 Lãi suất VND thấp hơn USD ⇒ VND thường được “cộng điểm” (Forward thấp hơn Spot).")
+            if r_vnd > r_usd:
+                st.warning(f"📉 Lãi suất VND cao hơn USD ({r_vnd}% > {r_usd}%) ⇒ VND thường bị “trừ điểm” (Forward cao hơn Spot).")
+            else:
+                st.success("📈 Lãi suất VND thấp hơn USD ⇒ VND thường được “cộng điểm” (Forward thấp hơn Spot).")
 
-    with col_res_irp2:
-        with st.expander("🎓 GÓC HỌC TẬP: GIẢI MÃ IRP & CÔNG THỨC", expanded=False):
-            st.markdown("#### 1. IRP là gì?")
-            st.info(
-                """
+        with col_res_irp2:
+            with st.expander("🎓 GÓC HỌC TẬP: GIẢI MÃ IRP & CÔNG THỨC", expanded=False):
+                st.markdown("#### 1. IRP là gì?")
+                st.info(
+                    """
 **IRP (Interest Rate Parity – Ngang giá lãi suất)**:
 Chênh lệch lãi suất giữa hai đồng tiền sẽ phản ánh vào chênh lệch giữa **Forward** và **Spot**.
 
 Nói ngắn gọn: **Chênh lệch lãi suất = Chênh lệch tỷ giá kỳ hạn** (trong điều kiện không arbitrage).
 """
-            )
+                )
 
-            st.markdown("#### 2. Công thức tính Forward")
-            st.latex(r"F = S \times \frac{1 + r_{VND} \times \frac{n}{360}}{1 + r_{USD} \times \frac{n}{360}}")
-            st.caption("Thay số theo dữ liệu bạn nhập:")
-            st.latex(
-                f"F = {spot_irp:,.0f} \\times \\frac{{1 + {r_vnd}\\% \\times \\frac{{{days_loan}}}{{360}}}}{{1 + {r_usd}\\% \\times \\frac{{{days_loan}}}{{360}}}} = \\mathbf{{{fwd_cal:,.0f}}}"
-            )
+                st.markdown("#### 2. Công thức tính Forward")
+                st.latex(r"F = S \times \frac{1 + r_{VND} \times \frac{n}{360}}{1 + r_{USD} \times \frac{n}{360}}")
+                st.caption("Thay số theo dữ liệu bạn nhập:")
+                st.latex(
+                    f"F = {spot_irp:,.0f} \\times \\frac{{1 + {r_vnd}\\% \\times \\frac{{{days_loan}}}{{360}}}}{{1 + {r_usd}\\% \\times \\frac{{{days_loan}}}{{360}}}} = \\mathbf{{{fwd_cal:,.0f}}}"
+                )
 
-            st.divider()
+                st.divider()
 
-            st.markdown("#### 3. Điểm kỳ hạn (Swap Point)")
-            st.latex(f"\\text{{Swap}} = {fwd_cal:,.0f} - {spot_irp:,.0f} = \\mathbf{{{swap_point:,.0f}}}")
+                st.markdown("#### 3. Điểm kỳ hạn (Swap Point)")
+                st.latex(f"\\text{{Swap}} = {fwd_cal:,.0f} - {spot_irp:,.0f} = \\mathbf{{{swap_point:,.0f}}}")
 
-            st.divider()
+                st.divider()
 
-            st.markdown("#### 4. Tại sao có quy luật này?")
-            st.write(
-                f"""
+                st.markdown("#### 4. Tại sao có quy luật này?")
+                st.write(
+                    f"""
 Theo nguyên lý **No Arbitrage**:
 - Nếu lãi VND cao ({r_vnd}%) mà tỷ giá tương lai không giảm, nhà đầu tư sẽ bán USD để nắm VND gửi hưởng chênh lệch.
 - Để triệt tiêu “bữa trưa miễn phí”, thị trường thường buộc VND **mất giá trong tương lai** tương ứng phần lãi suất cao hơn.
+"""
+                )
+
+        # --- ĐƯỜNG CONG FORWARD ĐA KỲ HẠN ---
+        with st.expander("📈 MỞ RỘNG: Đường cong Forward & Swap Point đa kỳ hạn (1D → 2Y)", expanded=False):
+            st.caption("Nhập đường cong lãi suất theo kỳ hạn cho VND và USD. Hệ thống nội suy tuyến tính và tính Forward cho mọi kỳ hạn trong 1 lần.")
+            c_cv1, c_cv2 = st.columns(2)
+            with c_cv1:
+                st.markdown("**Đường cong VND**")
+                df_vnd_curve = st.data_editor(
+                    pd.DataFrame(DEFAULT_VND_CURVE, columns=["Ngày", "Lãi suất (%)"]),
+                    num_rows="dynamic", hide_index=True, key="r2_curve_vnd",
+                )
+            with c_cv2:
+                st.markdown("**Đường cong USD**")
+                df_usd_curve = st.data_editor(
+                    pd.DataFrame(DEFAULT_USD_CURVE, columns=["Ngày", "Lãi suất (%)"]),
+                    num_rows="dynamic", hide_index=True, key="r2_curve_usd",
+                )
+
+            vnd_curve = tuple((float(d), float(r)) for d, r in df_vnd_curve.dropna().itertuples(index=False))
+            usd_curve = tuple((float(d), float(r)) for d, r in df_usd_curve.dropna().itertuples(index=False))
+
+            if not vnd_curve or not usd_curve:
+                st.warning("⚠️ Mỗi đường cong cần ít nhất 1 điểm (Ngày, Lãi suất).")
+            else:
+                df_curve = get_forward_curve(float(spot_irp), vnd_curve, usd_curve)
+
+                chart_curve = (
+                    alt.Chart(df_curve)
+                    .mark_line(point=True)
+                    .encode(
+                        x=alt.X("Ngày:Q", title="Kỳ hạn (ngày)"),
+                        y=alt.Y("Swap Point:Q", title="Swap Point (VND)"),
+                        tooltip=["Kỳ hạn", "Ngày", alt.Tooltip("Forward:Q", format=",.0f"), alt.Tooltip("Swap Point:Q", format=",.0f")],
+                    )
+                )
+                st.altair_chart(chart_curve, use_container_width=True)
+                st.dataframe(
+                    df_curve.style.format("{:,.0f}", subset=["Forward", "Swap Point"]).format("{:.2f}", subset=["LS VND (%)", "LS USD (%)"]),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+
+        # --- VaR / ES CHO HỒ SƠ KHOẢN NỢ ---
+        with st.expander("📉 MỞ RỘNG: Đo lường rủi ro tỷ giá VaR & Expected Shortfall cho khoản nợ", expanded=False):
+            st.caption(
+                f"Khoản nợ **{debt_amount:,.0f} USD**, đáo hạn sau **{days_loan_profile} ngày**. "
+                "Lỗ = chi phí VND tăng thêm so với mua USD ở Spot hôm nay. Dữ liệu lịch sử USD/VND offline 2015–2025."
+            )
+            c_var1, c_var2 = st.columns(2)
+            with c_var1:
+                hedge_ratio_pct = st.slider("Tỷ lệ hedge bằng Forward (%):", 0, 100, 70, 5, key="r2_var_hedge")
+            with c_var2:
+                var_sims = st.selectbox("Số kịch bản Monte Carlo:", [100_000, 200_000, 1_000_000], index=1, key="r2_var_sims")
+
+            df_var = compute_debt_var_table(
+                float(debt_amount), float(spot_irp), int(days_loan_profile), float(fwd_cal),
+                hedge_ratio_pct / 100, int(var_sims),
+            )
+            if not (df_var["Phương pháp"] == "Lịch sử (Historical)").any():
+                st.info("ℹ️ Kỳ hạn dài hơn chuỗi lịch sử USD/VND nên không có mẫu cho phương pháp Lịch sử; chỉ hiện Tham số và Monte Carlo.")
+            st.dataframe(
+                df_var.style.format("{:,.0f}", subset=["VaR 95%", "ES 95%", "VaR 99%", "ES 99%"]),
+                hide_index=True,
+                use_container_width=True,
+            )
+            st.latex(r"\text{VaR}_{q} = Q_q(\text{Lỗ}) \qquad \text{ES}_{q} = E[\text{Lỗ} \mid \text{Lỗ} \geq \text{VaR}_{q}]")
+            st.info(
+                """
+💡 **Đọc bảng:** VaR 99% = mức lỗ (VND) chỉ bị vượt qua với xác suất 1%. ES 99% = lỗ **trung bình** trong 1% kịch bản tệ nhất.
+Phần đã hedge bị khóa ở Forward nên lỗ của nó cố định (= điểm kỳ hạn), rủi ro đuôi giảm theo tỷ lệ hedge.
 """
             )
 
+        st.session_state["_r2_irp"] = (spot_irp, r_vnd, r_usd, days_loan, fwd_cal)
+        return spot_irp, days_loan
+
+    spot_irp, days_loan = irp_panel()
+
     st.markdown("---")
-    st.subheader("3. So sánh Chiến lược Phòng vệ")
+    @panel_fragment("r2_hedge")
+    def hedge_panel():
+        spot_irp, r_vnd, r_usd, days_loan, fwd_cal = st.session_state["_r2_irp"]
 
-    st.info(
-        """
+        st.subheader("3. So sánh Chiến lược Phòng vệ")
+
+        st.info(
+            """
 💡 **HƯỚNG DẪN SINH VIÊN (TRY IT):**
 - Để **Option thắng Forward**: đặt `Strike + Phí` < `Forward`, đồng thời kéo `Dự báo tỷ giá` lên cao.
 - Để **Forward thắng Option**: chỉnh `Forward` thấp hơn tổng chi phí Option.
 - Để **Thả nổi thắng**: kéo `Dự báo tỷ giá` xuống thấp hơn cả Forward và Option.
 """
-    )
-
-    col_strat1, col_strat2 = st.columns(2)
-    with col_strat1:
-        st.markdown("#### 🏦 Chốt Deal với Ngân hàng")
-        f_rate_input = st.number_input(
-            "Giá Forward Bank chào:",
-            value=float(f"{fwd_cal:.2f}"),
-            help="Thường Bank sẽ chào giá này hoặc cao hơn chút ít.",
-            key="r2_fwd_offer",
-        )
-        st.markdown("**Thông số Quyền chọn (Option):**")
-        strike = st.number_input("Strike Price (Giá thực hiện):", value=25_100.0, key="r2_strike")
-        premium = st.number_input("Phí Option (VND/USD):", value=100.0, key="r2_premium")
-
-    with col_strat2:
-        st.markdown("#### 🔮 Dự báo Thị trường")
-        future_spot = st.slider(
-            f"Dự báo Spot sau {days_loan} ngày:",
-            24_000.0,
-            26_000.0,
-            25_400.0,
-            step=10.0,
-            key="r2_future_spot",
         )
 
-        if future_spot > f_rate_input:
-            st.warning(
-                f"""
+        col_strat1, col_strat2 = st.columns(2)
+        with col_strat1:
+            st.markdown("#### 🏦 Chốt Deal với Ngân hàng")
+            f_rate_input = st.number_input(
+                "Giá Forward Bank chào:",
+                value=float(f"{fwd_cal:.2f}"),
+                help="Thường Bank sẽ chào giá này hoặc cao hơn chút ít.",
+                key="r2_fwd_offer",
+                on_change=rerun_panels("r2_hedge", "r2_swap"),
+            )
+            st.markdown("**Thông số Quyền chọn (Option):**")
+            strike = st.number_input("Strike Price (Giá thực hiện):", value=25_100.0, key="r2_strike")
+            premium = st.number_input("Phí Option (VND/USD):", value=100.0, key="r2_premium")
+
+        with col_strat2:
+            st.markdown("#### 🔮 Dự báo Thị trường")
+            future_spot = st.slider(
+                f"Dự báo Spot sau {days_loan} ngày:",
+                24_000.0,
+                26_000.0,
+                25_400.0,
+                step=10.0,
+                key="r2_future_spot",
+            )
+
+            if future_spot > f_rate_input:
+                st.warning(
+                    f"""
 🔥 **Cảnh báo:** Spot dự báo ({future_spot:,.0f}) cao hơn Forward ({f_rate_input:,.0f}).
 
 👉 **Nên phòng vệ:** Forward/Option đều giúp né mức giá cao.
 """
-            )
-        else:
-            st.success(
-                f"""
+                )
+            else:
+                st.success(
+                    f"""
 ❄️ **Thị trường hạ nhiệt:** Spot dự báo ({future_spot:,.0f}) thấp hơn Forward ({f_rate_input:,.0f}).
 
 👉 **Cân nhắc:** Thả nổi hoặc Option (bỏ quyền) có thể lợi hơn Forward.
 """
-            )
+                )
+
+        # --- PAYOFF DIAGRAM: toàn bộ miền Spot (rê chuột để đọc, không cần kéo slider) ---
+        st.markdown("##### 📈 Payoff: Chi phí 3 chiến lược trên toàn bộ miền Spot")
+        s_lo = min(24_000.0, 0.97 * min(f_rate_input, strike))
+        s_hi = max(26_000.0, 1.03 * max(f_rate_input, strike + premium))
+        st.altair_chart(
+            build_payoff_chart(float(debt_amount), float(f_rate_input), float(strike), float(premium), s_lo, s_hi)
+            + payoff_marker_layer(float(future_spot)),
+            use_container_width=True,
+        )
+        st.caption("Đường nét đứt cam = điểm hòa vốn (tính giải tích); vạch xanh đậm = Spot dự báo trên slider.")
+        st.dataframe(
+            pd.DataFrame(hedge_break_even_points(f_rate_input, strike, premium)).style.format("{:,.0f}", subset=["Spot hòa vốn"], na_rep="—"),
+            hide_index=True,
+            use_container_width=True,
+        )
 
-    # Costs
-    cost_open = debt_amount * future_spot
-    formula_open = f"{debt_amount:,.0f} × {future_spot:,.0f}"
+        # Costs
+        cost_open = debt_amount * future_spot
+        formula_open = f"{debt_amount:,.0f} × {future_spot:,.0f}"
 
-    cost_fwd = debt_amount * f_rate_input
-    formula_fwd = f"{debt_amount:,.0f} × {f_rate_input:,.0f}"
+        cost_fwd = debt_amount * f_rate_input
+        formula_fwd = f"{debt_amount:,.0f} × {f_rate_input:,.0f}"
 
-    if future_spot > strike:
-        action_text = "Thực hiện quyền"
-        price_base = strike
-        explanation_opt = "✅Đã được bảo hiểm (Dùng Strike)"
-        formula_opt = f"{debt_amount:,.0f} × ({strike:,.0f} + {premium:,.0f})"
-    else:
-        action_text = "Bỏ quyền (Lapse)"
-        price_base = future_spot
-        explanation_opt = "📉Mua giá chợ (Rẻ hơn Strike)"
-        formula_opt = f"{debt_amount:,.0f} × ({future_spot:,.0f} + {premium:,.0f})"
+        if future_spot > strike:
+            action_text = "Thực hiện quyền"
+            price_base = strike
+            explanation_opt = "✅Đã được bảo hiểm (Dùng Strike)"
+            formula_opt = f"{debt_amount:,.0f} × ({strike:,.0f} + {premium:,.0f})"
+        else:
+            action_text = "Bỏ quyền (Lapse)"
+            price_base = future_spot
+            explanation_opt = "📉Mua giá chợ (Rẻ hơn Strike)"
+            formula_opt = f"{debt_amount:,.0f} × ({future_spot:,.0f} + {premium:,.0f})"
 
-    effective_opt_rate = price_base + premium
-    cost_opt = debt_amount * effective_opt_rate
+        effective_opt_rate = price_base + premium
+        cost_opt = debt_amount * effective_opt_rate
 
-    
-    # --- BƯỚC 1: TẠO DATAFRAME ---
-    df_compare = pd.DataFrame(
-        {
-            "Chiến lược": ["1. Thả nổi (No Hedge)", "2. Kỳ hạn (Forward)", "3. Quyền chọn (Option)"],
-            "Trạng thái": ["Chấp nhận rủi ro", "Khóa cứng tỷ giá", explanation_opt],
-            "Tỷ giá thực tế": [future_spot, f_rate_input, effective_opt_rate],
-            "Tổng chi phí (VND)": [cost_open, cost_fwd, cost_opt],
+
+        # --- BƯỚC 1: TẠO DATAFRAME ---
+        df_compare = pd.DataFrame(
+            {
+                "Chiến lược": ["1. Thả nổi (No Hedge)", "2. Kỳ hạn (Forward)", "3. Quyền chọn (Option)"],
+                "Trạng thái": ["Chấp nhận rủi ro", "Khóa cứng tỷ giá", explanation_opt],
+                "Tỷ giá thực tế": [future_spot, f_rate_input, effective_opt_rate],
+                "Tổng chi phí (VND)": [cost_open, cost_fwd, cost_opt],
+            }
+        )
+
+        # --- BƯỚC 1: ÉP KIỂU SỐ (Để đảm bảo tính toán đúng) ---
+        df_compare["Tỷ giá thực tế"] = df_compare["Tỷ giá thực tế"].astype(float)
+        df_compare["Tổng chi phí (VND)"] = df_compare["Tổng chi phí (VND)"].astype(float)
+
+        # --- BƯỚC 2: CẤU HÌNH COLUMN CONFIG (Chỉ dùng để chỉnh độ rộng và tiêu đề) ---
+        # LƯU Ý: Đã XÓA dòng format="%,.0f" ở đây để tránh xung đột
+        column_config_setup = {
+            "Chiến lược": st.column_config.TextColumn("Chiến lược", width="medium", pinned=True),
+            "Trạng thái": st.column_config.TextColumn("Trạng thái", width="medium"),
+            "Tỷ giá thực tế": st.column_config.Column("Tỷ giá", width="small"), # Dùng Column thường
+            "Tổng chi phí (VND)": st.column_config.Column("Chi phí (VND)", width="medium"),
         }
-    )
 
-    # --- BƯỚC 1: ÉP KIỂU SỐ (Để đảm bảo tính toán đúng) ---
-    df_compare["Tỷ giá thực tế"] = df_compare["Tỷ giá thực tế"].astype(float)
-    df_compare["Tổng chi phí (VND)"] = df_compare["Tổng chi phí (VND)"].astype(float)
-
-    # --- BƯỚC 2: CẤU HÌNH COLUMN CONFIG (Chỉ dùng để chỉnh độ rộng và tiêu đề) ---
-    # LƯU Ý: Đã XÓA dòng format="%,.0f" ở đây để tránh xung đột
-    column_config_setup = {
-        "Chiến lược": st.column_config.TextColumn("Chiến lược", width="medium", pinned=True),
-        "Trạng thái": st.column_config.TextColumn("Trạng thái", width="medium"),
-        "Tỷ giá thực tế": st.column_config.Column("Tỷ giá", width="small"), # Dùng Column thường
-        "Tổng chi phí (VND)": st.column_config.Column("Chi phí (VND)", width="medium"),
-    }
+        # --- BƯỚC 3: XỬ LÝ STYLE (Tô màu + Format dấu phẩy + Canh phải) ---
+        min_cost = df_compare["Tổng chi phí (VND)"].min()
 
-    # --- BƯỚC 3: XỬ LÝ STYLE (Tô màu + Format dấu phẩy + Canh phải) ---
-    min_cost = df_compare["Tổng chi phí (VND)"].min()
+        # Hàm tô màu nền
+        def highlight_best(s):
+            return ['background-color: #d1e7dd; color: #0f5132; font-weight: bold' if v == min_cost else '' for v in s]
 
-    # Hàm tô màu nền
-    def highlight_best(s):
-        return ['background-color: #d1e7dd; color: #0f5132; font-weight: bold' if v == min_cost else '' for v in s]
+        # TẠO STYLER OBJECT (Chuỗi xử lý liên hoàn)
+        styled_df = (
+            df_compare.style
+            .apply(highlight_best, subset=["Tổng chi phí (VND)"])             # 1. Tô màu dòng tốt nhất
+            .format("{:,.0f}", subset=["Tỷ giá thực tế", "Tổng chi phí (VND)"]) # 2. Format dấu phẩy (25000 -> 25,000)
+            # 3. QUAN TRỌNG: Ép canh lề phải bằng CSS (Vì sau khi format nó biến thành text)
+            .set_properties(subset=["Tỷ giá thực tế", "Tổng chi phí (VND)"], **{'text-align': 'right'})
+        )
 
-    # TẠO STYLER OBJECT (Chuỗi xử lý liên hoàn)
-    styled_df = (
-        df_compare.style
-        .apply(highlight_best, subset=["Tổng chi phí (VND)"])             # 1. Tô màu dòng tốt nhất
-        .format("{:,.0f}", subset=["Tỷ giá thực tế", "Tổng chi phí (VND)"]) # 2. Format dấu phẩy (25000 -> 25,000)
-        # 3. QUAN TRỌNG: Ép canh lề phải bằng CSS (Vì sau khi format nó biến thành text)
-        .set_properties(subset=["Tỷ giá thực tế", "Tổng chi phí (VND)"], **{'text-align': 'right'})
-    )
+        st.markdown("##### 📊 So sánh hiệu quả các chiến lược:")
 
-    st.markdown("##### 📊 So sánh hiệu quả các chiến lược:")
+        st.dataframe(
+            styled_df, 
+            column_config=column_config_setup,
+            use_container_width=False, 
+            hide_index=True 
+        )
 
-    st.dataframe(
-        styled_df, 
-        column_config=column_config_setup,
-        use_container_width=False, 
-        hide_index=True 
-    )
-    
-    # --- BƯỚC 3: KẾT LUẬN & GIẢI THÍCH ---
+        # --- BƯỚC 3: KẾT LUẬN & GIẢI THÍCH ---
 
-    best_idx = df_compare["Tổng chi phí (VND)"].idxmin()
-    best_strat = df_compare.loc[best_idx, "Chiến lược"]
-    st.markdown(f"### 🏆 KẾT LUẬN: Chọn **{best_strat}**")
+        best_idx = df_compare["Tổng chi phí (VND)"].idxmin()
+        best_strat = df_compare.loc[best_idx, "Chiến lược"]
+        st.markdown(f"### 🏆 KẾT LUẬN: Chọn **{best_strat}**")
 
-    if best_idx == 1:
-        st.success(
-            f"""
+        if best_idx == 1:
+            st.success(
+                f"""
 **Vì sao chọn Forward?**
 - Forward ({f_rate_input:,.0f}) rẻ hơn Spot dự báo ({future_spot:,.0f}).
 - Rẻ hơn Option (vì Option phải cộng premium thành {effective_opt_rate:,.0f}).
 
 👉 Hợp doanh nghiệp thích “chốt chi phí” chắc chắn.
 """
-        )
-    elif best_idx == 2:
-        st.success(
-            f"""
+            )
+        elif best_idx == 2:
+            st.success(
+                f"""
 **Vì sao chọn Option?**
 - Tổng chi phí Option đang thấp nhất (đã gồm premium).
 - Khi thị trường bùng nổ, Option “chặn trần” bằng Strike ({strike:,.0f}) thay vì mua theo Spot cao.
 
 👉 Option mạnh khi biến động lớn và bạn muốn giữ “quyền chọn cơ hội”.
 """
-        )
-    else:
-        st.warning(
-            f"""
+            )
+        else:
+            st.warning(
+                f"""
 **Vì sao chọn Thả nổi?**
 - Bạn kỳ vọng tỷ giá giảm ({future_spot:,.0f}) ⇒ chốt Forward/Option lúc này có thể lãng phí.
 
 👉 *Rủi ro cao*: dự báo sai sẽ đội chi phí rất mạnh.
 """
-        )
+            )
+
+        # --- BACKTEST TRÊN NHIỀU KỊCH BẢN SPOT ---
+        with st.expander("🎲 MỞ RỘNG: Backtest chiến lược trên 100.000 kịch bản Spot", expanded=False):
+            st.caption("Thay vì 1 giá trị dự báo, hệ thống mô phỏng phân phối Spot đáo hạn (log-normal quanh Forward IRP) và so sánh cả 3 chiến lược cùng lúc.")
+            c_bt1, c_bt2, c_bt3 = st.columns(3)
+            with c_bt1:
+                vol_pct = st.number_input("Biến động tỷ giá (%/năm):", value=5.0, step=0.5, min_value=0.1, key="r2_bt_vol")
+            with c_bt2:
+                n_sims = st.selectbox("Số kịch bản:", [10_000, 50_000, 100_000], index=2, key="r2_bt_n")
+            with c_bt3:
+                bt_seed = st.number_input("Seed:", value=42, step=1, key="r2_bt_seed")
+
+            df_bt = run_hedge_backtest(
+                float(debt_amount), float(spot_irp), float(r_vnd), float(r_usd), int(days_loan), float(vol_pct),
+                float(f_rate_input), float(strike), float(premium), int(n_sims), int(bt_seed),
+            )
+            # Định dạng phía trình duyệt qua column_config (không dựng lại pandas Styler mỗi lần rerun)
+            bt_columns = {c: st.column_config.NumberColumn(format="%,.0f") for c in df_bt.columns if c.endswith("(VND)")}
+            bt_columns["Xác suất thắng (%)"] = st.column_config.NumberColumn(format="%.1f%%")
+            st.dataframe(
+                df_bt,
+                column_config=bt_columns,
+                hide_index=True,
+                use_container_width=True,
+            )
+            best_bt = df_bt.loc[df_bt["Chi phí kỳ vọng (VND)"].idxmin(), "Chiến lược"]
+            safest_bt = df_bt.loc[df_bt["Chi phí P99 (VND)"].idxmin(), "Chiến lược"]
+            st.info(
+                f"""
+📌 Rẻ nhất **bình quân**: **{best_bt}** | An toàn nhất ở **đuôi rủi ro (P99)**: **{safest_bt}**.
+
+- **CaR 95%** = Chi phí P95 − Chi phí kỳ vọng (mức "đội chi phí" có thể xảy ra với xác suất 5%).
+- Forward có CaR = 0 vì tỷ giá đã khóa cứng.
+"""
+            )
+
+        st.session_state["_r2_hedge"] = f_rate_input
+        return f_rate_input, strike, premium, future_spot, cost_open, cost_fwd, cost_opt, effective_opt_rate, best_strat
+
+    # Giá trị mới nhất cho AI (nút AI nằm ngoài fragment -> bấm là chạy lại toàn trang)
+    f_rate_input, strike, premium, future_spot, cost_open, cost_fwd, cost_opt, effective_opt_rate, best_strat = hedge_panel()
 
     st.markdown("---")
     # --- PHẦN NÚT BẤM AI ---
@@ -3649,10 +6303,11 @@ Theo nguyên lý **No Arbitrage**:
         else:
             # BƯỚC 2: KIỂM TRA HẠN MỨC (QUOTA)
             current_used = get_usage_from_supabase(user_id)
+            max_quota = ai_quota_for(user_id)
             
-            if current_used >= MAX_AI_QUOTA:
+            if current_used >= max_quota:
                 # Hết lượt -> Báo cảnh báo
-                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({MAX_AI_QUOTA}/{MAX_AI_QUOTA}).")
+                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({max_quota}/{max_quota}).")
             
             else:
                 # Còn lượt -> Chạy AI (Toàn bộ logic AI nằm trong này)
@@ -3671,7 +6326,7 @@ Theo nguyên lý **No Arbitrage**:
     """
                 task = "Nhận xét kết quả. Phân tích 'chi phí cơ hội' của Forward và 'giá trị quyền' của Option (trong 3-4 câu)."
                 
-                with st.spinner(f"AI đang phân tích chiến lược...(Lượt gọi AI thứ {current_used + 1}/{MAX_AI_QUOTA})"):
+                with st.spinner(f"AI đang phân tích chiến lược...(Lượt gọi AI thứ {current_used + 1}/{max_quota})"):
                     try:
                         advise = ask_gemini_advisor("CFO Expert", context, task)
                         
@@ -3685,7 +6340,7 @@ Theo nguyên lý **No Arbitrage**:
                             # 2. Cập nhật Sidebar (nếu có placeholder)
                             if 'quota_placeholder' in locals() or 'quota_placeholder' in globals():
                                 new_usage = current_used + 1
-                                quota_placeholder.info(f"Đã dùng: {new_usage}/{MAX_AI_QUOTA} lượt")
+                                quota_placeholder.info(f"Đã dùng: {new_usage}/{max_quota} lượt")
                             
                             # 3. Hiện kết quả
                             st.markdown(f'<div class="ai-box"><h4>🤖 GÓC NHÌN TỪ GIÁM ĐỐC TÀI CHÍNH AI</h4>{advise}</div>', unsafe_allow_html=True)
@@ -3694,84 +6349,149 @@ Theo nguyên lý **No Arbitrage**:
                         st.error(f"⚠️ Lỗi khi gọi AI: {str(e)}")
 
     # =========================================================
-    # MỤC 4 (NẰM NGOÀI MỌI KHỐI IF CỦA BUTTON)
+    # MỤC 4 (NẰM NGOÀI MỌI KHỐI IF CỦA BUTTON)
+    # =========================================================
+    # Vì không dùng st.stop() ở trên, nên dù chưa đăng nhập hay lỗi gì
+    # Code vẫn trôi xuống đây và hiển thị mục 4 bình thường.
+    @panel_fragment("r2_swap")
+    def swap_panel():
+        spot_irp, r_vnd, r_usd, _, _ = st.session_state["_r2_irp"]
+        f_rate_input = st.session_state["_r2_hedge"]
+
+        st.markdown("---")
+        st.subheader("4. Tình huống nâng cao: Xử lý khi Lệch dòng tiền (Swap)")
+
+        with st.expander("🔄 MỞ RỘNG: Dòng tiền bị trễ hạn, phải làm sao?", expanded=False):
+            st.markdown(
+                """
+            <div class="mission-text">
+            🚨 <b>Tình huống:</b> Hợp đồng Forward cũ đã đến ngày đáo hạn, nhưng đối tác báo 
+            <b>delay thanh toán thêm 30 ngày</b> nữa. Bạn chưa cần USD ngay lúc này, nhưng ngân hàng bắt buộc tất toán Deal cũ.
+            <br>👉 <b>Giải pháp:</b> Dùng <b>FX Swap</b> (Bán Spot tất toán cũ - Mua Forward kỳ hạn mới).
+            </div>
+            """, unsafe_allow_html=True
+            )
+
+            c_swap1, c_swap2 = st.columns(2)
+            with c_swap1:
+                delay_days = st.number_input("Số ngày delay:", value=30, step=15, key="swap_days")
+                # Giả định Spot tại thời điểm đáo hạn Deal cũ
+                spot_at_maturity = st.number_input(
+                    "Spot rate tại ngày đáo hạn Deal cũ:", 
+                    value=spot_irp, # Lấy tạm giá hiện tại làm ví dụ
+                    help="Giá thị trường tại thời điểm Deal cũ hết hạn",
+                    key="swap_spot_mat"
+                )
+
+            with c_swap2:
+                # Tính lại Forward mới cho kỳ hạn delay
+                # Công thức đơn giản hóa giả định lãi suất không đổi
+                num_swap = growth_factor(r_vnd / 100, year_fraction(days=delay_days))
+                den_swap = growth_factor(r_usd / 100, year_fraction(days=delay_days))
+                new_fwd_rate = spot_at_maturity * (num_swap / den_swap)
+
+                st.metric("Tỷ giá Forward mới (cho kỳ hạn delay)", f"{new_fwd_rate:,.0f} VND")
+                swap_points_new = new_fwd_rate - spot_at_maturity
+                st.metric("Điểm Swap (Swap Point)", f"{swap_points_new:,.0f} VND")
+
+            st.markdown("#### 🧮 Hạch toán chi phí Swap (Rollover)")
+
+            # 1. Tất toán Deal cũ: Mua Forward giá f_rate_input, giờ bán lại giá Spot thị trường (spot_at_maturity)
+            # Nếu Spot < Forward cũ => Lỗ (vì cam kết mua cao, giờ bán ra thấp)
+            settlement_pl = (spot_at_maturity - f_rate_input) * debt_amount
+
+            # 2. Chi phí giữ trạng thái thêm X ngày (Swap cost)
+            # Chênh lệch lãi suất thể hiện qua Swap Point
+            swap_cost_total = swap_points_new * debt_amount
+
+            col_cal1, col_cal2 = st.columns(2)
+
+            with col_cal1:
+                st.markdown("**1. Tất toán Deal cũ (Realized P/L):**")
+                st.latex(r"\text{P/L} = (S_{maturity} - F_{old}) \times \text{Volume}")
+                st.write(f"= ({spot_at_maturity:,.0f} - {f_rate_input:,.0f}) × {debt_amount:,.0f}")
+                if settlement_pl >= 0:
+                    st.success(f"💰 Lãi từ chênh lệch giá: {settlement_pl:,.0f} VND")
+                else:
+                    st.error(f"💸 Lỗ tất toán vị thế cũ: {settlement_pl:,.0f} VND")
+
+            with col_cal2:
+                st.markdown("**2. Chi phí Swap (Time Value):**")
+                st.latex(r"\text{Cost} = \text{Swap Point} \times \text{Volume}")
+                st.write(f"= ({new_fwd_rate:,.0f} - {spot_at_maturity:,.0f}) × {debt_amount:,.0f}")
+
+                if swap_points_new > 0:
+                     st.warning(f"📉 Bạn phải trả thêm (VND lãi cao hơn USD): {swap_cost_total:,.0f} VND")
+                else:
+                     st.success(f"📈 Bạn được nhận thêm (Swap Point âm): {abs(swap_cost_total):,.0f} VND")
+
+            total_swap_impact = settlement_pl - swap_cost_total # P/L cũ - Chi phí Swap mới (tùy convention, ở đây để đơn giản ta cộng gộp)
+
+            st.info(
+                f"""
+            💡 **Bài học:** Khi gia hạn nợ bằng Swap, bạn không chỉ quan tâm tỷ giá mới, mà phải xử lý phần chênh lệch (Lãi/Lỗ) của hợp đồng cũ ngay lập tức.
+            """
+            )
+
+    swap_panel()
+
+    # =========================================================
+    # MỤC 5: NETTING ĐA PHƯƠNG CHO TẬP ĐOÀN
     # =========================================================
-    # Vì không dùng st.stop() ở trên, nên dù chưa đăng nhập hay lỗi gì
-    # Code vẫn trôi xuống đây và hiển thị mục 4 bình thường.
-    st.markdown("---")
-    st.subheader("4. Tình huống nâng cao: Xử lý khi Lệch dòng tiền (Swap)")
-    
-    with st.expander("🔄 MỞ RỘNG: Dòng tiền bị trễ hạn, phải làm sao?", expanded=False):
-        st.markdown(
-            """
+    @panel_fragment("r2_netting")
+    def netting_panel():
+        st.markdown("---")
+        st.subheader("5. Netting đa phương: Bù trừ công nợ nội bộ Tập đoàn")
+
+        with st.expander("🔁 MỞ RỘNG: Treasury Center bù trừ phải thu/phải trả giữa các công ty con", expanded=False):
+            st.markdown(
+                """
             <div class="mission-text">
-            🚨 <b>Tình huống:</b> Hợp đồng Forward cũ đã đến ngày đáo hạn, nhưng đối tác báo 
-            <b>delay thanh toán thêm 30 ngày</b> nữa. Bạn chưa cần USD ngay lúc này, nhưng ngân hàng bắt buộc tất toán Deal cũ.
-            <br>👉 <b>Giải pháp:</b> Dùng <b>FX Swap</b> (Bán Spot tất toán cũ - Mua Forward kỳ hạn mới).
+            🏢 <b>Tình huống:</b> Tập đoàn có nhiều công ty con ở các nước, mua bán nội bộ bằng nhiều đồng tiền.
+            Thay vì mỗi hóa đơn chuyển tiền + đổi ngoại tệ riêng, <b>Netting Center</b> bù trừ và mỗi công ty chỉ trả/nhận <b>1 khoản ròng</b>.
             </div>
             """, unsafe_allow_html=True
-        )
-
-        c_swap1, c_swap2 = st.columns(2)
-        with c_swap1:
-            delay_days = st.number_input("Số ngày delay:", value=30, step=15, key="swap_days")
-            # Giả định Spot tại thời điểm đáo hạn Deal cũ
-            spot_at_maturity = st.number_input(
-                "Spot rate tại ngày đáo hạn Deal cũ:", 
-                value=spot_irp, # Lấy tạm giá hiện tại làm ví dụ
-                help="Giá thị trường tại thời điểm Deal cũ hết hạn",
-                key="swap_spot_mat"
             )
-        
-        with c_swap2:
-            # Tính lại Forward mới cho kỳ hạn delay
-            # Công thức đơn giản hóa giả định lãi suất không đổi
-            num_swap = 1 + (r_vnd / 100) * (delay_days / 360)
-            den_swap = 1 + (r_usd / 100) * (delay_days / 360)
-            new_fwd_rate = spot_at_maturity * (num_swap / den_swap)
-            
-            st.metric("Tỷ giá Forward mới (cho kỳ hạn delay)", f"{new_fwd_rate:,.0f} VND")
-            swap_points_new = new_fwd_rate - spot_at_maturity
-            st.metric("Điểm Swap (Swap Point)", f"{swap_points_new:,.0f} VND")
+            c_net1, c_net2, c_net3 = st.columns(3)
+            with c_net1:
+                n_entities = st.number_input("Số công ty con:", value=8, min_value=2, max_value=1_000, step=1, key="r2_net_n")
+            with c_net2:
+                n_invoices = st.number_input("Số hóa đơn nội bộ:", value=40, min_value=1, max_value=200_000, step=10, key="r2_net_inv")
+            with c_net3:
+                net_seed = st.number_input("Seed dữ liệu:", value=7, step=1, key="r2_net_seed")
+
+            entities, invoices = gen_intercompany_invoices(int(n_entities), int(n_invoices), int(net_seed))
+            res_net = multilateral_netting(invoices, entities)
+
+            k1, k2, k3 = st.columns(3)
+            k1.metric("Thanh toán gộp (Gross)", f"{res_net['gross_count']:,} lệnh", f"{res_net['gross_volume']:,.0f} USD", delta_color="off")
+            k2.metric("Bù trừ song phương", f"{res_net['bilateral_count']:,} lệnh", f"{res_net['bilateral_volume']:,.0f} USD", delta_color="off")
+            k3.metric("Netting đa phương", f"{res_net['multilateral_count']:,} lệnh", f"{res_net['multilateral_volume']:,.0f} USD", delta_color="off")
 
-        st.markdown("#### 🧮 Hạch toán chi phí Swap (Rollover)")
-        
-        # 1. Tất toán Deal cũ: Mua Forward giá f_rate_input, giờ bán lại giá Spot thị trường (spot_at_maturity)
-        # Nếu Spot < Forward cũ => Lỗ (vì cam kết mua cao, giờ bán ra thấp)
-        settlement_pl = (spot_at_maturity - f_rate_input) * debt_amount
-        
-        # 2. Chi phí giữ trạng thái thêm X ngày (Swap cost)
-        # Chênh lệch lãi suất thể hiện qua Swap Point
-        swap_cost_total = swap_points_new * debt_amount
+            st.success(
+                f"💱 Khối lượng đổi ngoại tệ giảm từ **{res_net['fx_gross']:,.0f} USD** xuống **{res_net['fx_multilateral']:,.0f} USD** "
+                f"⇒ tiết kiệm **{res_net['fx_saved']:,.0f} USD** giao dịch FX (và phí/spread tương ứng)."
+            )
 
-        col_cal1, col_cal2 = st.columns(2)
-        
-        with col_cal1:
-            st.markdown("**1. Tất toán Deal cũ (Realized P/L):**")
-            st.latex(r"\text{P/L} = (S_{maturity} - F_{old}) \times \text{Volume}")
-            st.write(f"= ({spot_at_maturity:,.0f} - {f_rate_input:,.0f}) × {debt_amount:,.0f}")
-            if settlement_pl >= 0:
-                st.success(f"💰 Lãi từ chênh lệch giá: {settlement_pl:,.0f} VND")
-            else:
-                st.error(f"💸 Lỗ tất toán vị thế cũ: {settlement_pl:,.0f} VND")
-        
-        with col_cal2:
-            st.markdown("**2. Chi phí Swap (Time Value):**")
-            st.latex(r"\text{Cost} = \text{Swap Point} \times \text{Volume}")
-            st.write(f"= ({new_fwd_rate:,.0f} - {spot_at_maturity:,.0f}) × {debt_amount:,.0f}")
-            
-            if swap_points_new > 0:
-                 st.warning(f"📉 Bạn phải trả thêm (VND lãi cao hơn USD): {swap_cost_total:,.0f} VND")
-            else:
-                 st.success(f"📈 Bạn được nhận thêm (Swap Point âm): {abs(swap_cost_total):,.0f} VND")
+            names = [e["name"] for e in entities]
+            df_pos = pd.DataFrame({
+                "Công ty": names,
+                "Đồng tiền": [e["ccy"] for e in entities],
+                "Vị thế ròng (USD)": res_net["net_positions"],
+            })
+            df_transfers = pd.DataFrame(
+                [(names[p], names[r], amt) for p, r, amt in res_net["transfers"]],
+                columns=["Bên trả", "Bên nhận", "Số tiền (USD)"],
+            )
+            c_tb1, c_tb2 = st.columns(2)
+            with c_tb1:
+                st.markdown("**Vị thế ròng từng công ty** (+ nhận / − trả)")
+                st.dataframe(df_pos.style.format("{:,.0f}", subset=["Vị thế ròng (USD)"]), hide_index=True, use_container_width=True)
+            with c_tb2:
+                st.markdown("**Lệnh thanh toán sau Netting**")
+                st.dataframe(df_transfers.style.format("{:,.0f}", subset=["Số tiền (USD)"]), hide_index=True, use_container_width=True)
 
-        total_swap_impact = settlement_pl - swap_cost_total # P/L cũ - Chi phí Swap mới (tùy convention, ở đây để đơn giản ta cộng gộp)
-        
-        st.info(
-            f"""
-            💡 **Bài học:** Khi gia hạn nợ bằng Swap, bạn không chỉ quan tâm tỷ giá mới, mà phải xử lý phần chênh lệch (Lãi/Lỗ) của hợp đồng cũ ngay lập tức.
-            """
-        )
+    netting_panel()
 
     footer()
 
@@ -3797,102 +6517,104 @@ def room_3_trade():
     # TAB COST
     # -------------------------
     with tab_cost:
-        st.subheader("💸 Bài toán Tối ưu Chi phí Thanh toán Quốc tế")
-        st.caption("So sánh: Phí ngân hàng & Chi phí vốn (lãi) giữa T/T, Nhờ thu, L/C.")
-
-        with st.expander("📝 BƯỚC 1: NHẬP GIÁ TRỊ HỢP ĐỒNG & LÃI SUẤT", expanded=True):
-            c1, c2 = st.columns(2)
-            with c1:
-                val = st.number_input("Giá trị hợp đồng (USD):", value=100_000.0, step=1_000.0, key="r3_val")
-                interest_rate = st.number_input(
-                    "Lãi suất vay vốn (%/năm):",
-                    value=7.0,
-                    step=0.1,
-                    help="Dùng để tính chi phí cơ hội/lãi vay trong thời gian chờ thanh toán",
-                    key="r3_ir",
-                )
-            with c2:
-                days_tt = st.number_input("Số ngày đọng vốn T/T:", value=5, help="Thời gian tiền đi trên đường", key="r3_days_tt")
-                days_col = st.number_input("Số ngày đọng vốn Nhờ thu:", value=15, help="Thời gian gửi chứng từ", key="r3_days_col")
-                days_lc = st.number_input("Số ngày đọng vốn L/C:", value=30, help="Thời gian xử lý bộ chứng từ", key="r3_days_lc")
-
-        st.markdown("---")
-        st.subheader("🏦 BƯỚC 2: CẤU HÌNH BIỂU PHÍ NGÂN HÀNG")
-
-        col_tt, col_col, col_lc = st.columns(3)
-
-        with col_tt:
-            st.markdown("#### 1) T/T (Chuyển tiền)")
-            tt_pct = st.number_input("Phí chuyển tiền (%):", value=0.2, step=0.01, format="%.2f", key="r3_tt_pct")
-            tt_min = st.number_input("Min (USD) - T/T:", value=10.0, key="r3_tt_min")
-            tt_max = st.number_input("Max (USD) - T/T:", value=200.0, key="r3_tt_max")
-            tt_other = st.number_input("Điện phí (USD):", value=20.0, key="r3_tt_other")
-
-        with col_col:
-            st.markdown("#### 2) Nhờ thu (D/P, D/A)")
-            col_pct = st.number_input("Phí nhờ thu (%):", value=0.15, step=0.01, format="%.2f", key="r3_col_pct")
-            col_min = st.number_input("Min (USD) - Col:", value=20.0, key="r3_col_min")
-            col_max = st.number_input("Max (USD) - Col:", value=250.0, key="r3_col_max")
-            col_other = st.number_input("Bưu điện phí (USD):", value=50.0, key="r3_col_other")
-
-        with col_lc:
-            st.markdown("#### 3) L/C (Tín dụng thư)")
-            lc_open_pct = st.number_input("Phí mở L/C (%):", value=0.3, step=0.01, format="%.2f", key="r3_lc_open")
-            lc_pay_pct = st.number_input("Phí thanh toán (%):", value=0.2, step=0.01, format="%.2f", key="r3_lc_pay")
-            lc_min = st.number_input("Min (USD) - L/C:", value=50.0, key="r3_lc_min")
-            lc_other = st.number_input("Phí khác (USD):", value=100.0, help="Tu chỉnh, bất hợp lệ...", key="r3_lc_other")
-
-        st.markdown("---")
+        @panel_fragment("r3_cost")
+        def cost_panel():
+            st.subheader("💸 Bài toán Tối ưu Chi phí Thanh toán Quốc tế")
+            st.caption("So sánh: Phí ngân hàng & Chi phí vốn (lãi) giữa T/T, Nhờ thu, L/C.")
+
+            with st.expander("📝 BƯỚC 1: NHẬP GIÁ TRỊ HỢP ĐỒNG & LÃI SUẤT", expanded=True):
+                c1, c2 = st.columns(2)
+                with c1:
+                    val = st.number_input("Giá trị hợp đồng (USD):", value=100_000.0, step=1_000.0, key="r3_val")
+                    interest_rate = st.number_input(
+                        "Lãi suất vay vốn (%/năm):",
+                        value=7.0,
+                        step=0.1,
+                        help="Dùng để tính chi phí cơ hội/lãi vay trong thời gian chờ thanh toán",
+                        key="r3_ir",
+                    )
+                with c2:
+                    days_tt = st.number_input("Số ngày đọng vốn T/T:", value=5, help="Thời gian tiền đi trên đường", key="r3_days_tt")
+                    days_col = st.number_input("Số ngày đọng vốn Nhờ thu:", value=15, help="Thời gian gửi chứng từ", key="r3_days_col")
+                    days_lc = st.number_input("Số ngày đọng vốn L/C:", value=30, help="Thời gian xử lý bộ chứng từ", key="r3_days_lc")
 
-        if st.button("🚀 TÍNH TOÁN & SO SÁNH NGAY", key="btn_tf_cost", use_container_width=True):
-            def calculate_fee_min_max(amount, pct, fee_min, fee_max):
-                raw_fee = amount * (pct / 100)
-                final_fee = max(fee_min, min(raw_fee, fee_max))
-                return final_fee, raw_fee
-
-            # T/T
-            tt_bank_fee, tt_raw = calculate_fee_min_max(val, tt_pct, tt_min, tt_max)
-            tt_total_bank = tt_bank_fee + tt_other
-            tt_interest = val * (interest_rate / 100) * (days_tt / 360)
-            tt_final = tt_total_bank + tt_interest
-
-            # Collection
-            col_bank_fee, col_raw = calculate_fee_min_max(val, col_pct, col_min, col_max)
-            col_total_bank = col_bank_fee + col_other
-            col_interest = val * (interest_rate / 100) * (days_col / 360)
-            col_final = col_total_bank + col_interest
-
-            # L/C
-            lc_open_fee = max(lc_min, val * (lc_open_pct / 100))
-            lc_pay_fee = val * (lc_pay_pct / 100)
-            lc_total_bank = lc_open_fee + lc_pay_fee + lc_other
-            lc_interest = val * (interest_rate / 100) * (days_lc / 360)
-            lc_final = lc_total_bank + lc_interest
-
-            st.subheader("📊 Kết quả Tổng hợp")
-            m1, m2, m3 = st.columns(3)
-            best_price = min(tt_final, col_final, lc_final)
+            st.markdown("---")
+            st.subheader("🏦 BƯỚC 2: CẤU HÌNH BIỂU PHÍ NGÂN HÀNG")
+
+            col_tt, col_col, col_lc = st.columns(3)
+
+            with col_tt:
+                st.markdown("#### 1) T/T (Chuyển tiền)")
+                tt_pct = st.number_input("Phí chuyển tiền (%):", value=0.2, step=0.01, format="%.2f", key="r3_tt_pct")
+                tt_min = st.number_input("Min (USD) - T/T:", value=10.0, key="r3_tt_min")
+                tt_max = st.number_input("Max (USD) - T/T:", value=200.0, key="r3_tt_max")
+                tt_other = st.number_input("Điện phí (USD):", value=20.0, key="r3_tt_other")
+
+            with col_col:
+                st.markdown("#### 2) Nhờ thu (D/P, D/A)")
+                col_pct = st.number_input("Phí nhờ thu (%):", value=0.15, step=0.01, format="%.2f", key="r3_col_pct")
+                col_min = st.number_input("Min (USD) - Col:", value=20.0, key="r3_col_min")
+                col_max = st.number_input("Max (USD) - Col:", value=250.0, key="r3_col_max")
+                col_other = st.number_input("Bưu điện phí (USD):", value=50.0, key="r3_col_other")
+
+            with col_lc:
+                st.markdown("#### 3) L/C (Tín dụng thư)")
+                lc_open_pct = st.number_input("Phí mở L/C (%):", value=0.3, step=0.01, format="%.2f", key="r3_lc_open")
+                lc_pay_pct = st.number_input("Phí thanh toán (%):", value=0.2, step=0.01, format="%.2f", key="r3_lc_pay")
+                lc_min = st.number_input("Min (USD) - L/C:", value=50.0, key="r3_lc_min")
+                lc_other = st.number_input("Phí khác (USD):", value=100.0, help="Tu chỉnh, bất hợp lệ...", key="r3_lc_other")
 
-            m1.metric("1) Tổng phí T/T", f"${tt_final:,.2f}", delta="Rẻ nhất (rủi ro cao)" if tt_final == best_price else None, delta_color="inverse")
-            m2.metric("2) Tổng phí Nhờ thu", f"${col_final:,.2f}", delta=f"+${col_final - tt_final:,.2f} vs T/T", delta_color="off")
-            m3.metric("3) Tổng phí L/C", f"${lc_final:,.2f}", delta=f"+${lc_final - tt_final:,.2f} vs T/T", delta_color="off")
+            st.markdown("---")
 
-            chart_data = pd.DataFrame(
-                {
-                    "Phương thức": ["T/T", "Nhờ thu", "L/C"],
-                    "Phí Ngân hàng": [tt_total_bank, col_total_bank, lc_total_bank],
-                    "Chi phí Vốn (Lãi)": [tt_interest, col_interest, lc_interest],
-                }
-            )
-            st.bar_chart(chart_data.set_index("Phương thức"), stack=True, color=["#FF6C6C", "#4B4BFF"])
+            if st.button("🚀 TÍNH TOÁN & SO SÁNH NGAY", key="btn_tf_cost", use_container_width=True):
+                def calculate_fee_min_max(amount, pct, fee_min, fee_max):
+                    raw_fee = amount * (pct / 100)
+                    final_fee = max(fee_min, min(raw_fee, fee_max))
+                    return final_fee, raw_fee
+
+                # T/T
+                tt_bank_fee, tt_raw = calculate_fee_min_max(val, tt_pct, tt_min, tt_max)
+                tt_total_bank = tt_bank_fee + tt_other
+                tt_interest = simple_interest(val, interest_rate / 100, year_fraction(days=days_tt))
+                tt_final = tt_total_bank + tt_interest
+
+                # Collection
+                col_bank_fee, col_raw = calculate_fee_min_max(val, col_pct, col_min, col_max)
+                col_total_bank = col_bank_fee + col_other
+                col_interest = simple_interest(val, interest_rate / 100, year_fraction(days=days_col))
+                col_final = col_total_bank + col_interest
+
+                # L/C
+                lc_open_fee = max(lc_min, val * (lc_open_pct / 100))
+                lc_pay_fee = val * (lc_pay_pct / 100)
+                lc_total_bank = lc_open_fee + lc_pay_fee + lc_other
+                lc_interest = simple_interest(val, interest_rate / 100, year_fraction(days=days_lc))
+                lc_final = lc_total_bank + lc_interest
+
+                st.subheader("📊 Kết quả Tổng hợp")
+                m1, m2, m3 = st.columns(3)
+                best_price = min(tt_final, col_final, lc_final)
+
+                m1.metric("1) Tổng phí T/T", f"${tt_final:,.2f}", delta="Rẻ nhất (rủi ro cao)" if tt_final == best_price else None, delta_color="inverse")
+                m2.metric("2) Tổng phí Nhờ thu", f"${col_final:,.2f}", delta=f"+${col_final - tt_final:,.2f} vs T/T", delta_color="off")
+                m3.metric("3) Tổng phí L/C", f"${lc_final:,.2f}", delta=f"+${lc_final - tt_final:,.2f} vs T/T", delta_color="off")
+
+                chart_data = pd.DataFrame(
+                    {
+                        "Phương thức": ["T/T", "Nhờ thu", "L/C"],
+                        "Phí Ngân hàng": [tt_total_bank, col_total_bank, lc_total_bank],
+                        "Chi phí Vốn (Lãi)": [tt_interest, col_interest, lc_interest],
+                    }
+                )
+                st.bar_chart(chart_data.set_index("Phương thức"), stack=True, color=["#FF6C6C", "#4B4BFF"])
 
-            st.markdown("### 🧮 Bảng chi tiết lời giải (Step-by-step)")
-            st.info("Dưới đây là cách tính chi tiết giúp bạn hiểu rõ nguồn gốc các con số:")
+                st.markdown("### 🧮 Bảng chi tiết lời giải (Step-by-step)")
+                st.info("Dưới đây là cách tính chi tiết giúp bạn hiểu rõ nguồn gốc các con số:")
 
-            with st.expander("1️⃣ Chi tiết tính toán: T/T (Chuyển tiền)", expanded=False):
-                st.latex(r"Cost_{T/T} = \text{Phí Bank} + \text{Lãi Vốn}")
-                st.markdown(
-                    f"""
+                with st.expander("1️⃣ Chi tiết tính toán: T/T (Chuyển tiền)", expanded=False):
+                    st.latex(r"Cost_{T/T} = \text{Phí Bank} + \text{Lãi Vốn}")
+                    st.markdown(
+                        f"""
 **A) Phí dịch vụ Ngân hàng**
 - Sơ bộ: {val:,.0f} × {tt_pct}% = {tt_raw:,.2f}
 - Áp dụng Min/Max ({tt_min} – {tt_max}) ⇒ **{tt_bank_fee:,.2f}**
@@ -3902,12 +6624,12 @@ def room_3_trade():
 - Công thức: Giá trị × Lãi suất × Ngày/360
 - Thế số: {val:,.0f} × {interest_rate}% × ({days_tt}/360) = **{tt_interest:,.2f}**
 """
-                )
+                    )
 
-            with st.expander("2️⃣ Chi tiết tính toán: Nhờ thu (Collection)", expanded=False):
-                st.latex(r"Cost_{Col} = \text{Phí Nhờ Thu} + \text{Phí Khác} + \text{Lãi Vốn}")
-                st.markdown(
-                    f"""
+                with st.expander("2️⃣ Chi tiết tính toán: Nhờ thu (Collection)", expanded=False):
+                    st.latex(r"Cost_{Col} = \text{Phí Nhờ Thu} + \text{Phí Khác} + \text{Lãi Vốn}")
+                    st.markdown(
+                        f"""
 **A) Phí dịch vụ Ngân hàng**
 - Sơ bộ: {val:,.0f} × {col_pct}% = {col_raw:,.2f}
 - Áp dụng Min/Max ({col_min} – {col_max}) ⇒ **{col_bank_fee:,.2f}**
@@ -3916,12 +6638,12 @@ def room_3_trade():
 **B) Chi phí vốn**
 - {val:,.0f} × {interest_rate}% × ({days_col}/360) = **{col_interest:,.2f}**
 """
-                )
+                    )
 
-            with st.expander("3️⃣ Chi tiết tính toán: L/C (Tín dụng thư)", expanded=False):
-                st.latex(r"Cost_{LC} = \text{Phí Mở} + \text{Phí T.Toán} + \text{Phí Khác} + \text{Lãi Vốn}")
-                st.markdown(
-                    f"""
+                with st.expander("3️⃣ Chi tiết tính toán: L/C (Tín dụng thư)", expanded=False):
+                    st.latex(r"Cost_{LC} = \text{Phí Mở} + \text{Phí T.Toán} + \text{Phí Khác} + \text{Lãi Vốn}")
+                    st.markdown(
+                        f"""
 **A) Các loại phí**
 - Phí mở: {val:,.0f} × {lc_open_pct}% = {val*(lc_open_pct/100):,.2f} ⇒ áp Min {lc_min} ⇒ **{lc_open_fee:,.2f}**
 - Phí thanh toán: {val:,.0f} × {lc_pay_pct}% = **{lc_pay_fee:,.2f}**
@@ -3932,14 +6654,14 @@ def room_3_trade():
 - Do giữ vốn {days_lc} ngày:
 - {val:,.0f} × {interest_rate}% × ({days_lc}/360) = **{lc_interest:,.2f}**
 """
-                )
+                    )
 
-            diff_lc = lc_final - tt_final
-            diff_col = col_final - tt_final
+                diff_lc = lc_final - tt_final
+                diff_col = col_final - tt_final
 
-            st.markdown("---")
-            st.success(
-                f"""
+                st.markdown("---")
+                st.success(
+                    f"""
 #### 💡 GÓC NHÌN QUẢN TRỊ (MANAGEMENT INSIGHT)
 
 Chênh lệch chi phí chính là **“phí mua sự an toàn”** cho lô hàng **{val:,.0f} USD**:
@@ -3954,7 +6676,64 @@ Chênh lệch chi phí chính là **“phí mua sự an toàn”** cho lô hàng
 
 👉 Nếu rủi ro mất trắng là đáng kể, thì **{diff_lc:,.2f} USD** có thể là “phí bảo hiểm” hợp lý.
 """
-            )
+                )
+
+            # --- ĐƯỜNG CONG CHI PHÍ & ĐIỂM HÒA VỐN THEO GIÁ TRỊ HỢP ĐỒNG ---
+            with st.expander("📈 MỞ RỘNG: Đường cong chi phí & Giá trị hợp đồng hòa vốn", expanded=False):
+                st.caption("Cùng biểu phí ở Bước 2, tính chi phí 3 phương thức cho toàn dải giá trị hợp đồng và lãi suất.")
+                c_rg1, c_rg2 = st.columns(2)
+                with c_rg1:
+                    v_range = st.slider("Dải giá trị hợp đồng (USD):", 1_000, 2_000_000, (1_000, 500_000), step=1_000, key="r3_grid_val")
+                with c_rg2:
+                    r_range = st.slider("Dải lãi suất (%/năm):", 0.0, 20.0, (2.0, 12.0), step=0.5, key="r3_grid_rate")
+
+                fees = {
+                    "tt_pct": tt_pct, "tt_min": tt_min, "tt_max": tt_max, "tt_other": tt_other,
+                    "col_pct": col_pct, "col_min": col_min, "col_max": col_max, "col_other": col_other,
+                    "lc_open_pct": lc_open_pct, "lc_pay_pct": lc_pay_pct, "lc_min": lc_min, "lc_other": lc_other,
+                    "days_tt": days_tt, "days_col": days_col, "days_lc": days_lc,
+                }
+                fee_items = tuple(sorted((k, float(v)) for k, v in fees.items()))
+                v_lo, v_hi = float(v_range[0]), float(v_range[1])
+
+                # 1) Đường cong chi phí tại lãi suất hiện tại
+                _, df_curves = build_payment_cost_grid(fee_items, v_lo, v_hi, float(interest_rate), float(interest_rate), n_rates=1)
+                be_list = payment_break_even_values(fees, interest_rate, v_lo, v_hi)
+                curves = alt.Chart(df_curves).mark_line().encode(
+                    x=alt.X("Giá trị HĐ (USD):Q"),
+                    y=alt.Y("Chi phí (USD):Q"),
+                    color="Phương thức:N",
+                    tooltip=["Phương thức", alt.Tooltip("Giá trị HĐ (USD):Q", format=",.0f"), alt.Tooltip("Chi phí (USD):Q", format=",.2f")],
+                )
+                if be_list:
+                    df_be = pd.DataFrame(be_list)
+                    curves = curves + alt.Chart(df_be).mark_rule(strokeDash=[4, 4], color="#ff9800").encode(
+                        x="Giá trị HĐ (USD):Q", tooltip=["Cặp", alt.Tooltip("Giá trị HĐ (USD):Q", format=",.2f")]
+                    )
+                st.markdown(f"**Chi phí theo giá trị hợp đồng (lãi suất {interest_rate}%)**")
+                st.altair_chart(curves, use_container_width=True)
+
+                if be_list:
+                    st.dataframe(
+                        pd.DataFrame(be_list).style.format("{:,.2f}", subset=["Giá trị HĐ (USD)", "Chi phí (USD)"]),
+                        hide_index=True,
+                        use_container_width=True,
+                    )
+                else:
+                    st.info("Trong dải đã chọn không có điểm hòa vốn: thứ tự chi phí giữa các phương thức không đổi.")
+
+                # 2) Bản đồ phương thức rẻ nhất theo (giá trị, lãi suất)
+                df_best, _ = build_payment_cost_grid(fee_items, v_lo, v_hi, float(r_range[0]), float(r_range[1]), n_values=120, n_rates=40)
+                heat = alt.Chart(df_best).mark_rect().encode(
+                    x=alt.X("Giá trị HĐ (USD):Q", bin=alt.Bin(maxbins=120)),
+                    y=alt.Y("Lãi suất (%):Q", bin=alt.Bin(maxbins=40)),
+                    color=alt.Color("Rẻ nhất:N", scale=alt.Scale(domain=PAYMENT_METHODS)),
+                    tooltip=["Rẻ nhất", alt.Tooltip("Chi phí thấp nhất (USD):Q", format=",.2f")],
+                )
+                st.markdown("**Bản đồ phương thức rẻ nhất (Giá trị HĐ × Lãi suất)**")
+                st.altair_chart(heat, use_container_width=True)
+
+        cost_panel()
 
         footer()
 
@@ -4123,6 +6902,70 @@ Chênh lệch chi phí chính là **“phí mua sự an toàn”** cho lô hàng
                     )
                 st.warning("👉 Hậu quả: Ngân hàng có quyền **từ chối thanh toán** và thu phí discrepancy (thường 50–100 USD/lỗi).")
 
+        # --- RULE ENGINE: KIỂM TRA HÀNG LOẠT ---
+        @panel_fragment("r3_rule_engine")
+        def rule_engine_panel():
+            with st.expander("⚙️ MỞ RỘNG: Rule engine UCP 600 – kiểm tra hàng loạt bộ chứng từ", expanded=False):
+                st.caption("Các điều kiện UCP 600 được khai báo dạng dữ liệu, biên dịch 1 lần thành phép so sánh trên cả cột NumPy.")
+                st.dataframe(
+                    pd.DataFrame([{"Mã": r["code"], "Rule": r["name"], "UCP 600": r["article"]} for r in UCP600_RULES]),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                n_audit = st.selectbox("Số bộ chứng từ (đề T02) cần kiểm tra:", [500, 2_000, 10_000], index=1, key="r3_rule_n")
+                if st.button("▶️ Chạy rule engine", key="btn_rule_audit"):
+                    with st.spinner("Đang sinh đề và kiểm tra..."):
+                        df_rule_stats, rate, agree = run_t02_rule_audit(int(n_audit))
+                    r1, r2 = st.columns(2)
+                    r1.metric("Tốc độ kiểm tra", f"{rate:,.0f} bộ/giây")
+                    r2.metric("Khớp đáp án đề T02", f"{agree:.1%}")
+                    st.dataframe(df_rule_stats.style.format("{:.2f}", subset=["Tỷ lệ (%)"]), hide_index=True, use_container_width=True)
+
+        rule_engine_panel()
+
+        # --- NGÂN HÀNG ĐỀ T02 (BATCH) ---
+        @panel_fragment("r3_t02_bank")
+        def t02_bank_panel():
+            with st.expander("🏦 MỞ RỘNG (GV): Sinh ngân hàng đề T02 hàng loạt với phân bố số sai biệt", expanded=False):
+                st.caption("Sinh N bộ chứng từ dạng cột (ngày = số nguyên, hàng/cảng = mã số) rồi kiểm tra ngay bằng rule engine.")
+                c_bk1, c_bk2 = st.columns(2)
+                with c_bk1:
+                    bank_n = st.number_input("Số đề:", value=10_000, min_value=100, max_value=1_000_000, step=1_000, key="r3_bank_n")
+                    bank_seed = st.number_input("Seed ngân hàng đề:", value=2025, step=1, key="r3_bank_seed")
+                with c_bk2:
+                    w_cols = st.columns(4)
+                    bank_w = [
+                        w_cols[k].number_input(f"{k} lỗi (%)", value=v, min_value=0, max_value=100, step=5, key=f"r3_bank_w{k}")
+                        for k, v in enumerate([10, 30, 30, 30])
+                    ]
+
+                if st.button("🏗️ Sinh ngân hàng đề", key="btn_t02_bank"):
+                    if sum(bank_w) <= 0:
+                        st.warning("⚠️ Tổng tỷ lệ phải lớn hơn 0.")
+                    else:
+                        t0 = time.perf_counter()
+                        batch = gen_t02_batch(int(bank_n), int(bank_seed), tuple(bank_w))
+                        bank_hits, bank_stats = check_t02_batch(batch)
+                        elapsed = time.perf_counter() - t0
+
+                        ok_rate = float((bank_hits == batch["chosen"]).all(axis=1).mean())
+                        b1, b2 = st.columns(2)
+                        b1.metric("Thời gian sinh + kiểm tra", f"{elapsed:.2f} giây")
+                        b2.metric("Đáp án khớp rule engine", f"{ok_rate:.1%}")
+
+                        df_bank = t02_batch_to_frame(batch)
+                        st.bar_chart(df_bank["n_discrepancies"].value_counts().sort_index())
+                        st.dataframe(bank_stats.style.format("{:.2f}", subset=["Tỷ lệ (%)"]), hide_index=True, use_container_width=True)
+                        st.download_button(
+                            "⬇️ Tải ngân hàng đề (CSV)",
+                            data=df_bank.to_csv(index=False).encode("utf-8"),
+                            file_name=f"t02_bank_{int(bank_seed)}.csv",
+                            mime="text/csv",
+                            key="btn_t02_bank_dl",
+                        )
+
+        t02_bank_panel()
+
         st.markdown("---")
         if st.button("AI Advisor – Trade Checking", type="primary", icon="🤖", key="btn_ai_ucp"):
             curr_errs = []
@@ -4146,9 +6989,10 @@ Chênh lệch chi phí chính là **“phí mua sự an toàn”** cho lô hàng
 
                 # BƯỚC 2: KIỂM TRA HẠN MỨC (QUOTA)
             current_used = get_usage_from_supabase(user_id)
+            max_quota = ai_quota_for(user_id)
                 
-            if current_used >= MAX_AI_QUOTA:
-                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({MAX_AI_QUOTA}/{MAX_AI_QUOTA}).")
+            if current_used >= max_quota:
+                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({max_quota}/{max_quota}).")
                 st.stop()
 
             context = f"""
@@ -4164,7 +7008,7 @@ Dữ liệu:
 Lỗi phát hiện: {", ".join(curr_errs) if curr_errs else "Không có"}
 """
             task = "Giải thích ngắn gọn các lỗi (nếu có) và 1–2 cách khắc phục thực tế cho doanh nghiệp."
-            with st.spinner(f"AI đang tư vấn ... (Lượt gọi AI thứ {current_used + 1}/{MAX_AI_QUOTA})"):
+            with st.spinner(f"AI đang tư vấn ... (Lượt gọi AI thứ {current_used + 1}/{max_quota})"):
                 try:
                     advise = ask_gemini_advisor("Chuyên gia UCP 600", context, task)
                     if advise.startswith("⚠️"):
@@ -4180,7 +7024,7 @@ Lỗi phát hiện: {", ".join(curr_errs) if curr_errs else "Không có"}
                         
                         # Bắn nội dung mới vào cái hộp "quota_placeholder" đang nằm bên Sidebar
                         # Lưu ý: Bạn cần đảm bảo biến 'quota_placeholder' truy cập được từ đây
-                        quota_placeholder.info(f"Đã dùng: {new_usage}/{MAX_AI_QUOTA} lượt")
+                        quota_placeholder.info(f"Đã dùng: {new_usage}/{max_quota} lượt")
                         
                         # 3. Hiện kết quả AI ra màn hình chính
                         st.markdown(f'<div class="ai-box"><h4>🤖 LUẬT SƯ AI TƯ VẤN UCP 600</h4>{advise}</div>', unsafe_allow_html=True)
@@ -4195,13 +7039,6 @@ Lỗi phát hiện: {", ".join(curr_errs) if curr_errs else "Không có"}
 # PHÒNG 4: INVESTMENT
 # ==============================================================================
 def room_4_invest():
-    # Import numpy_financial (optional)
-    try:
-        import numpy_financial as npf
-    except ImportError:
-        st.error("⚠️ Thiếu 'numpy_financial'. Cài bằng: `pip install numpy-financial` để tính IRR chuẩn.")
-        npf = None
-
     st.markdown('<p class="header-style">🏭 Phòng Đầu tư Quốc tế (Investment Dept)</p>', unsafe_allow_html=True)
     st.markdown(
         """
@@ -4213,88 +7050,51 @@ def room_4_invest():
         unsafe_allow_html=True,
     )
 
-    with st.expander("📝 THÔNG SỐ DỰ ÁN ĐẦU TƯ", expanded=True):
-        c1, c2 = st.columns(2)
-        with c1:
-            st.markdown("##### 1) Dòng tiền Dự án (USD)")
-            inv = st.number_input("Vốn đầu tư ban đầu (CapEx):", value=1_000_000.0, step=10_000.0, format="%.0f", key="r4_inv")
-            cf_yearly = st.number_input("Dòng tiền ròng hằng năm (Operating CF):", value=300_000.0, step=5_000.0, format="%.0f", key="r4_cf")
-            salvage_val = st.number_input("Giá trị thanh lý cuối kỳ (Terminal Value):", value=200_000.0, key="r4_salvage")
-            years = st.slider("Vòng đời dự án (năm):", 3, 10, 5, key="r4_years")
-        with c2:
-            st.markdown("##### 2) Thị trường & Vĩ mô")
-            fx_spot = st.number_input("Tỷ giá Spot hiện tại (VND/USD):", value=25_000.0, step=10.0, key="r4_fx")
-            depre = st.number_input("Mức độ mất giá VND (%/năm):", value=3.0, step=0.1, key="r4_depre")
-            wacc = st.number_input("Chi phí vốn (WACC %):", value=12.0, step=0.5, key="r4_wacc")
-
-    st.markdown("---")
-
     if "run_dcf" not in st.session_state:
         st.session_state.run_dcf = False
 
-    if st.button("📊 CHẠY MÔ HÌNH DCF & PHÂN TÍCH ĐỘ NHẠY", key="btn_run_dcf", use_container_width=True):
+    def start_dcf():
+        # Nút nằm trong fragment: chạy lại toàn trang để hiện cả Real Options/Tornado và nút AI
         st.session_state.run_dcf = True
+        st.rerun()
 
-    if st.session_state.run_dcf:
-        data_cf = []
-        cf_stream_vnd_nominal = []
-        cumulative_pv = 0.0
-        payback_period = None
+    @panel_fragment("r4_dcf")
+    def dcf_panel():
+        with st.expander("📝 THÔNG SỐ DỰ ÁN ĐẦU TƯ", expanded=True):
+            c1, c2 = st.columns(2)
+            with c1:
+                st.markdown("##### 1) Dòng tiền Dự án (USD)")
+                inv = st.number_input("Vốn đầu tư ban đầu (CapEx):", value=1_000_000.0, step=10_000.0, format="%.0f", key="r4_inv",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
+                cf_yearly = st.number_input("Dòng tiền ròng hằng năm (Operating CF):", value=300_000.0, step=5_000.0, format="%.0f", key="r4_cf",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
+                salvage_val = st.number_input("Giá trị thanh lý cuối kỳ (Terminal Value):", value=200_000.0, key="r4_salvage",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
+                years = st.slider("Vòng đời dự án (năm):", 3, 10, 5, key="r4_years",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
+            with c2:
+                st.markdown("##### 2) Thị trường & Vĩ mô")
+                fx_spot = st.number_input("Tỷ giá Spot hiện tại (VND/USD):", value=25_000.0, step=10.0, key="r4_fx",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
+                depre = st.number_input("Mức độ mất giá VND (%/năm):", value=3.0, step=0.1, key="r4_depre",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
+                wacc = st.number_input("Chi phí vốn (WACC %):", value=12.0, step=0.5, key="r4_wacc",
+                    on_change=rerun_panels("r4_dcf", "r4_real_options", "r4_tornado"))
 
-        # Year 0
-        cf0_vnd = -inv * fx_spot
-        cumulative_pv += cf0_vnd
-        cf_stream_vnd_nominal.append(cf0_vnd)
+        st.session_state["_r4_project"] = (inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc)
 
-        data_cf.append(
-            {
-                "Năm": 0,
-                "Tỷ giá (VND/USD)": fx_spot,
-                "CF (USD)": -inv,
-                "CF Quy đổi (VND)": cf0_vnd,
-                "PV (Hiện giá VND)": cf0_vnd,
-                "Lũy kế PV": cumulative_pv,
-            }
-        )
+        st.markdown("---")
 
-        for i in range(1, years + 1):
-            fx_future = fx_spot * ((1 + depre / 100) ** i)
-            cf_usd = cf_yearly + (salvage_val if i == years else 0)
-            cf_vnd = cf_usd * fx_future
-            cf_stream_vnd_nominal.append(cf_vnd)
-
-            pv_vnd = cf_vnd / ((1 + wacc / 100) ** i)
-
-            prev_cumulative = cumulative_pv
-            cumulative_pv += pv_vnd
-
-            if payback_period is None and cumulative_pv >= 0:
-                # fraction of year to recover
-                fraction = abs(prev_cumulative) / pv_vnd if pv_vnd != 0 else 0
-                payback_period = (i - 1) + fraction
-
-            data_cf.append(
-                {
-                    "Năm": i,
-                    "Tỷ giá (VND/USD)": fx_future,
-                    "CF (USD)": cf_usd,
-                    "CF Quy đổi (VND)": cf_vnd,
-                    "PV (Hiện giá VND)": pv_vnd,
-                    "Lũy kế PV": cumulative_pv,
-                }
-            )
+        st.button("📊 CHẠY MÔ HÌNH DCF & PHÂN TÍCH ĐỘ NHẠY", key="btn_run_dcf", use_container_width=True, on_click=start_dcf)
 
-        npv = cumulative_pv
+        if not st.session_state.run_dcf:
+            return None
 
-        # IRR
-        irr_value = 0.0
-        if npf is not None:
-            try:
-                irr_value = float(npf.irr(cf_stream_vnd_nominal)) * 100
-                if np.isnan(irr_value) or np.isinf(irr_value):
-                    irr_value = 0.0
-            except Exception:
-                irr_value = 0.0
+        # Các nút DCF memo theo input riêng: chỉ phần phụ thuộc input vừa đổi được tính lại
+        df_cf, metrics = dcf_valuation(inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc)
+        npv = metrics["npv"]
+        payback_period = None if np.isnan(metrics["dpp"]) else metrics["dpp"]
+        irr_value = 0.0 if np.isnan(metrics["irr"]) else metrics["irr"] * 100
 
         st.subheader("1. Kết quả Thẩm định")
         m1, m2, m3 = st.columns(3)
@@ -4304,6 +7104,10 @@ def room_4_invest():
         else:
             m2.metric("Thời gian hoàn vốn (DPP)", "Chưa hoàn vốn", delta_color="inverse")
         m3.metric("IRR (Hoàn vốn nội bộ)", f"{irr_value:.2f}%", delta=f"WACC: {wacc}%", delta_color="normal")
+        m4, m5, m6 = st.columns(3)
+        m4.metric("MIRR (tái đầu tư theo WACC)", "-" if np.isnan(metrics["mirr"]) else f"{metrics['mirr'] * 100:.2f}%")
+        m5.metric("PI (Chỉ số sinh lời)", "-" if np.isnan(metrics["pi"]) else f"{metrics['pi']:.2f}")
+        m6.metric("Hoàn vốn giản đơn (PP)", "Chưa hoàn vốn" if np.isnan(metrics["payback"]) else f"{metrics['payback']:.2f} năm")
 
         is_feasible = (npv > 0) and (irr_value > wacc)
         if is_feasible:
@@ -4316,12 +7120,11 @@ def room_4_invest():
                 reason.append(f"IRR ({irr_value:.2f}%) ≤ WACC")
             st.error(f"⛔ KẾT LUẬN: KHÔNG NÊN ĐẦU TƯ. Lý do: {', '.join(reason)}.")
 
-        df_chart = pd.DataFrame(data_cf)
-        st.bar_chart(df_chart.set_index("Năm")[["PV (Hiện giá VND)"]], color="#4B4BFF")
+        st.bar_chart(df_cf.set_index("Năm")[["PV (Hiện giá VND)"]], color="#4B4BFF")
 
         with st.expander("🔎 Xem bảng dòng tiền chi tiết (Cashflow Table)"):
-            # 1. Tạo DataFrame từ list data_cf
-            df_display = pd.DataFrame(data_cf)
+            # 1. Bảng dòng tiền dựng từ các mảng ở trên
+            df_display = df_cf.copy()
             
             # 2. QUAN TRỌNG: Thiết lập cột "Năm" làm Index (Trục cố định)
             # Việc này giúp loại bỏ cột số thứ tự 0,1,2 thừa thãi
@@ -4358,8 +7161,8 @@ def room_4_invest():
             if payback_period:
                 y_neg_idx = int(payback_period)
                 try:
-                    val_missing = abs(data_cf[y_neg_idx]["Lũy kế PV"])
-                    val_next = data_cf[y_neg_idx + 1]["PV (Hiện giá VND)"]
+                    val_missing = abs(df_cf.loc[y_neg_idx, "Lũy kế PV"])
+                    val_next = df_cf.loc[y_neg_idx + 1, "PV (Hiện giá VND)"]
                     
                     st.markdown("👇 **Áp dụng số liệu dự án:**")
                     st.latex(f"DPP = {y_neg_idx} + \\frac{{|{val_missing:,.0f}|}}{{{val_next:,.0f}}} = \\mathbf{{{payback_period:.2f} \\text{{ Năm}}}}")
@@ -4387,29 +7190,129 @@ def room_4_invest():
         wacc_range = [wacc - 2, wacc - 1, wacc, wacc + 1, wacc + 2]
         depre_range = [depre - 2, depre - 1, depre, depre + 1, depre + 2]
 
-        sensitivity_data = []
-        for w in wacc_range:
-            row = []
-            for d in depre_range:
-                sim_npv = -inv * fx_spot
-                for t in range(1, years + 1):
-                    sim_fx = fx_spot * ((1 + d / 100) ** t)
-                    sim_cf_usd = cf_yearly + (salvage_val if t == years else 0)
-                    sim_npv += (sim_cf_usd * sim_fx) / ((1 + w / 100) ** t)
-                row.append(sim_npv)
-            sensitivity_data.append(row)
-
-        df_sens = pd.DataFrame(
-            sensitivity_data,
-            index=[f"WACC {w:.1f}%" for w in wacc_range],
-            columns=[f"Mất giá {d:.1f}%" for d in depre_range],
-        )
+        df_sens = dcf_sensitivity(inv, cf_yearly, salvage_val, years, fx_spot,
+                                  tuple(wacc_range), tuple(depre_range))
 
         def color_negative_red(val):
             color = "#ffcccc" if val < 0 else "#ccffcc"
             return f"background-color: {color}; color: black"
 
-        st.dataframe(df_sens.style.applymap(color_negative_red).format("{:,.0f}"))
+        st.dataframe(df_sens.style.map(color_negative_red).format("{:,.0f}"))
+
+        return npv, irr_value, payback_period
+
+    dcf_result = dcf_panel()
+
+    @panel_fragment("r4_real_options")
+    def real_options_panel():
+        if not st.session_state.run_dcf:
+            return
+        inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc = st.session_state["_r4_project"]
+
+        with st.expander("🌳 MỞ RỘNG: Quyền chọn thực (Real Options) – trì hoãn, mở rộng, từ bỏ", expanded=False):
+            st.caption(
+                "NPV tĩnh giả định 'làm ngay và làm đến cùng'. Quyền chọn thực định giá **sự linh hoạt** của nhà quản trị "
+                "trên cây nhị phân giá trị dự án (VND), gộp rủi ro dòng tiền USD và rủi ro tỷ giá."
+            )
+            c_ro1, c_ro2, c_ro3 = st.columns(3)
+            with c_ro1:
+                ro_sigma_p = st.number_input("Biến động dự án USD (%/năm):", value=25.0, min_value=1.0, step=1.0, key="r4_ro_sigma_p")
+                ro_sigma_fx = st.number_input("Biến động tỷ giá (%/năm):", value=5.0, min_value=0.0, step=0.5, key="r4_ro_sigma_fx")
+                ro_rho = st.slider("Tương quan dự án – tỷ giá:", -1.0, 1.0, 0.0, 0.1, key="r4_ro_rho")
+            with c_ro2:
+                ro_rf = st.number_input("Lãi suất phi rủi ro VND (%/năm):", value=5.0, step=0.25, key="r4_ro_rf")
+                ro_delay = st.slider("Có thể trì hoãn tối đa (năm):", 1, 5, 2, key="r4_ro_delay")
+                ro_steps = st.select_slider("Số bước cây nhị phân:", [50, 100, 250, 500, 1000], value=500, key="r4_ro_steps")
+            with c_ro3:
+                ro_expand_pct = st.number_input("Mở rộng thêm (% quy mô):", value=30.0, step=5.0, key="r4_ro_exp_pct")
+                ro_expand_cost = st.number_input("Chi phí mở rộng (USD):", value=250_000.0, step=10_000.0, format="%.0f", key="r4_ro_exp_cost")
+                st.caption(f"Giá trị từ bỏ = giá trị thanh lý **{salvage_val:,.0f} USD** × Spot.")
+
+            try:
+                df_ro, ro_info = value_real_options(
+                    inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc,
+                    ro_sigma_p / 100, ro_sigma_fx / 100, ro_rho, ro_rf / 100,
+                    float(ro_delay), ro_expand_pct / 100, ro_expand_cost, int(ro_steps),
+                )
+            except ValueError as e:
+                st.warning(f"⚠️ {e}")
+            else:
+                st.dataframe(
+                    df_ro.style.format("{:,.0f}", subset=["NPV tĩnh (VND)", "Giá trị quyền (VND)", "NPV mở rộng (VND)"]),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                st.latex(
+                    r"V_0=\sum_{t\ge1}\frac{CF_{t,VND}}{(1+WACC)^t},\quad u=e^{\sigma\sqrt{\Delta t}},\ "
+                    r"p=\frac{e^{(r_f-q)\Delta t}-d}{u-d},\quad \sigma^2=\sigma_{P}^2+\sigma_{FX}^2+2\rho\sigma_P\sigma_{FX}"
+                )
+                st.markdown(
+                    f"- Giá trị dự án $V_0$ = **{ro_info['v0']:,.0f} VND**; vốn đầu tư $I$ = **{ro_info['invest_vnd']:,.0f} VND**\n"
+                    f"- Biến động gộp $\\sigma$ = **{ro_info['sigma'] * 100:.2f}%**; tỷ suất chi trả dòng tiền $q$ (dùng cho cả 3 quyền) = **{ro_info['q'] * 100:.2f}%**"
+                )
+                st.info(
+                    """
+💡 **Đọc bảng:** NPV mở rộng = NPV tĩnh + giá trị linh hoạt. Một dự án có NPV tĩnh âm vẫn có thể đáng giữ lại
+nếu quyền trì hoãn/mở rộng đủ lớn; ngược lại, khi NPV tĩnh dương nhưng quyền trì hoãn vẫn có giá trị > 0,
+chờ thêm thông tin có thể tốt hơn đầu tư ngay.
+"""
+                )
+
+    real_options_panel()
+
+    @panel_fragment("r4_tornado")
+    def tornado_panel():
+        if not st.session_state.run_dcf:
+            return
+        inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc = st.session_state["_r4_project"]
+
+        with st.expander("🌪️ MỞ RỘNG: Biểu đồ Tornado & chỉ số Sobol cho mọi biến của mô hình", expanded=False):
+            st.caption(
+                "Tornado: đẩy **từng biến** lên mức thấp/cao, giữ nguyên các biến khác. "
+                "Sobol: cho **tất cả biến cùng dao động** ngẫu nhiên trong khoảng đó và đo phần phương sai NPV do mỗi biến gây ra."
+            )
+            c_tn1, c_tn2, c_tn3 = st.columns(3)
+            with c_tn1:
+                tn_swing = st.slider("Biên độ biến tiền & tỷ giá (±%):", 5, 50, 20, 5, key="r4_tn_swing")
+            with c_tn2:
+                tn_pts = st.slider("Biên độ WACC & mất giá (± điểm %):", 0.5, 5.0, 2.0, 0.5, key="r4_tn_pts")
+            with c_tn3:
+                tn_years = st.slider("Biên độ vòng đời (± năm):", 1, 3, 2, key="r4_tn_years")
+
+            df_tn, tn_base = dcf_tornado(inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc,
+                                         float(tn_swing), float(tn_pts), int(tn_years))
+            st.altair_chart(build_tornado_chart(df_tn, tn_base), use_container_width=True)
+            st.dataframe(
+                df_tn.style.format("{:,.0f}", subset=["NPV khi thấp", "NPV khi cao", "Biên độ"])
+                .format("{:,.2f}", subset=["Giá trị thấp", "Giá trị cao"]),
+                hide_index=True,
+                use_container_width=True,
+            )
+
+            if st.button("🎲 Tính chỉ số Sobol (100.000 mẫu)", key="btn_r4_sobol"):
+                st.session_state["r4_sobol_on"] = True
+            if st.session_state.get("r4_sobol_on"):
+                with st.spinner("Đang lấy mẫu 100.000 kịch bản x (số biến + 2)..."):
+                    df_sobol = dcf_sobol(inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc,
+                                         float(tn_swing), float(tn_pts), int(tn_years))
+                st.dataframe(
+                    df_sobol.style.format("{:.3f}", subset=["Sobol bậc 1 (S1)", "Sobol tổng (ST)"]),
+                    hide_index=True,
+                    use_container_width=True,
+                )
+                st.latex(r"S_i=\frac{V[E(NPV\mid X_i)]}{V(NPV)} \qquad S_{T,i}=\frac{E[V(NPV\mid X_{\sim i})]}{V(NPV)}")
+                st.info(
+                    """
+💡 **Đọc bảng:** S1 = phần phương sai NPV do riêng biến đó; ST - S1 = phần do biến đó **tương tác** với biến khác
+(ví dụ tỷ giá × dòng tiền). Tornado chỉ thấy tác động riêng lẻ, Sobol thấy cả tương tác.
+"""
+                )
+
+    tornado_panel()
+
+    if st.session_state.run_dcf:
+        npv, irr_value, payback_period = dcf_result
+        inv, cf_yearly, salvage_val, years, fx_spot, depre, wacc = st.session_state["_r4_project"]
 
         st.markdown("---")
         if st.button("AI Advisor – FDI Analysis", type="primary", icon="🤖", key="btn_ai_invest"):
@@ -4422,9 +7325,10 @@ def room_4_invest():
 
                 # BƯỚC 2: KIỂM TRA HẠN MỨC (QUOTA)
             current_used = get_usage_from_supabase(user_id)
+            max_quota = ai_quota_for(user_id)
                 
-            if current_used >= MAX_AI_QUOTA:
-                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({MAX_AI_QUOTA}/{MAX_AI_QUOTA}).")
+            if current_used >= max_quota:
+                st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({max_quota}/{max_quota}).")
                 st.stop()
             context = f"""
 Dự án FDI:
@@ -4439,7 +7343,7 @@ Dự án FDI:
 2) Nêu 2 rủi ro tỷ giá/khả năng chuyển lợi nhuận về nước.
 3) Khuyến nghị: Duyệt hay Từ chối (1 câu chốt).
 """
-            with st.spinner(f"Chuyên viên đang phân tích...(Lượt gọi AI thứ {current_used + 1}/{MAX_AI_QUOTA})"):
+            with st.spinner(f"Chuyên viên đang phân tích...(Lượt gọi AI thứ {current_used + 1}/{max_quota})"):
                 try:
                     advise = ask_gemini_advisor("Investment Specialist", context, task)
                     # advise = ask_gemini_advisor("CFO Advisor", context, task)
@@ -4456,7 +7360,7 @@ Dự án FDI:
                         
                         # Bắn nội dung mới vào cái hộp "quota_placeholder" đang nằm bên Sidebar
                         # Lưu ý: Bạn cần đảm bảo biến 'quota_placeholder' truy cập được từ đây
-                        quota_placeholder.info(f"Đã dùng: {new_usage}/{MAX_AI_QUOTA} lượt")
+                        quota_placeholder.info(f"Đã dùng: {new_usage}/{max_quota} lượt")
                         
                         # 3. Hiện kết quả AI ra màn hình chính
                         st.markdown(f'<div class="ai-box"><h4>🤖 CHUYÊN VIÊN AI NHẬN ĐỊNH</h4>{advise}</div>', unsafe_allow_html=True)
@@ -4486,68 +7390,150 @@ def room_5_macro():
 
     # TAB 1
     with tab_debt:
-        st.subheader("1. Mô phỏng Cú sốc Tỷ giá lên Nợ công")
-        col_macro1, col_macro2 = st.columns(2)
-        with col_macro1:
-            debt_val = st.number_input("Tổng nợ nước ngoài (Tỷ USD):", value=50.0, step=1.0, key="r5_debt_val")
-            base_rate = st.number_input("Tỷ giá hiện tại (VND/USD):", value=25_000.0, step=100.0, key="r5_base_rate")
-        with col_macro2:
-            st.markdown("#### Kịch bản Tỷ giá")
-            shock_pct = st.slider(
-                "Đồng nội tệ mất giá bao nhiêu %?",
-                min_value=0.0,
-                max_value=100.0,
-                value=20.0,
-                step=1.0,
-                key="r5_shock",
-            )
+        @panel_fragment("r5_debt")
+        def debt_panel():
+            st.subheader("1. Mô phỏng Cú sốc Tỷ giá lên Nợ công")
+            col_macro1, col_macro2 = st.columns(2)
+            with col_macro1:
+                debt_val = st.number_input("Tổng nợ nước ngoài (Tỷ USD):", value=50.0, step=1.0, key="r5_debt_val")
+                base_rate = st.number_input("Tỷ giá hiện tại (VND/USD):", value=25_000.0, step=100.0, key="r5_base_rate")
+            with col_macro2:
+                st.markdown("#### Kịch bản Tỷ giá")
+                shock_pct = st.slider(
+                    "Đồng nội tệ mất giá bao nhiêu %?",
+                    min_value=0.0,
+                    max_value=100.0,
+                    value=20.0,
+                    step=1.0,
+                    key="r5_shock",
+                )
 
-        new_rate = base_rate * (1 + shock_pct / 100)
-        base_debt_vnd = debt_val * base_rate
-        new_debt_vnd = debt_val * new_rate
-        loss_vnd = new_debt_vnd - base_debt_vnd
+            new_rate = base_rate * (1 + shock_pct / 100)
+            base_debt_vnd = debt_val * base_rate
+            new_debt_vnd = debt_val * new_rate
+            loss_vnd = new_debt_vnd - base_debt_vnd
 
-        st.markdown("---")
-        m1, m2, m3 = st.columns(3)
-        m1.metric("Tỷ giá sau cú sốc", f"{new_rate:,.0f} VND", f"-{shock_pct}% (Mất giá)", delta_color="inverse")
-        m2.metric("Nợ quy đổi ban đầu", f"{base_debt_vnd:,.0f} Tỷ VND")
-        m3.metric("Gánh nặng TĂNG THÊM", f"{loss_vnd:,.0f} Tỷ VND", delta="RỦI RO VỠ NỢ", delta_color="inverse")
+            st.markdown("---")
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Tỷ giá sau cú sốc", f"{new_rate:,.0f} VND", f"-{shock_pct}% (Mất giá)", delta_color="inverse")
+            m2.metric("Nợ quy đổi ban đầu", f"{base_debt_vnd:,.0f} Tỷ VND")
+            m3.metric("Gánh nặng TĂNG THÊM", f"{loss_vnd:,.0f} Tỷ VND", delta="RỦI RO VỠ NỢ", delta_color="inverse")
 
-        # Cảnh báo động
-        if shock_pct > 30:
-            st.error(f"🚨 **BÁO ĐỘNG ĐỎ:** Mức mất giá {shock_pct}% tương đương kịch bản Khủng hoảng Châu Á 1997. Nguy cơ vỡ nợ quốc gia (Sovereign Default) là rất cao.")
-        elif shock_pct > 10:
-            st.warning(f"⚠️ **Cảnh báo:** Gánh nặng nợ tăng thêm {loss_vnd/1000:,.1f} nghìn tỷ VND sẽ gây áp lực cực lớn lên ngân sách.")
+            # Cảnh báo động
+            if shock_pct > 30:
+                st.error(f"🚨 **BÁO ĐỘNG ĐỎ:** Mức mất giá {shock_pct}% tương đương kịch bản Khủng hoảng Châu Á 1997. Nguy cơ vỡ nợ quốc gia (Sovereign Default) là rất cao.")
+            elif shock_pct > 10:
+                st.warning(f"⚠️ **Cảnh báo:** Gánh nặng nợ tăng thêm {loss_vnd/1000:,.1f} nghìn tỷ VND sẽ gây áp lực cực lớn lên ngân sách.")
 
 
-        with st.expander("🧮 GÓC HỌC TẬP: GIẢI MÃ SỐ LIỆU NỢ CÔNG", expanded=False):
-            st.markdown("#### 1) Vì sao nợ tăng dù không vay thêm?")
-            st.write("Nợ USD không đổi, nhưng **VND cần để mua USD trả nợ tăng** khi tỷ giá tăng.")
+            with st.expander("🧮 GÓC HỌC TẬP: GIẢI MÃ SỐ LIỆU NỢ CÔNG", expanded=False):
+                st.markdown("#### 1) Vì sao nợ tăng dù không vay thêm?")
+                st.write("Nợ USD không đổi, nhưng **VND cần để mua USD trả nợ tăng** khi tỷ giá tăng.")
 
-            st.markdown("#### 2) Công thức & thay số")
-            st.markdown(
-                f"""
+                st.markdown("#### 2) Công thức & thay số")
+                st.markdown(
+                    f"""
 - Nợ ban đầu: $$ {debt_val} \\times {base_rate:,.0f} = \\mathbf{{{base_debt_vnd:,.0f}}} $$
 - Nợ sau cú sốc: $$ {debt_val} \\times {new_rate:,.0f} = \\mathbf{{{new_debt_vnd:,.0f}}} $$
 - Tăng thêm: $$ {new_debt_vnd:,.0f} - {base_debt_vnd:,.0f} = \\mathbf{{{loss_vnd:,.0f}}} $$
 """
-            )
+                )
 
-        # --- PHẦN MINH HỌA LỊCH SỬ ---
-        with st.expander("📚 BÀI HỌC LỊCH SỬ: KHỦNG HOẢNG TÀI CHÍNH 1997"):
-            c_hist1, c_hist2 = st.columns([1, 2])
-            with c_hist1:
-                st.write("### 📉")
-                st.caption("**Đồng Baht Thái sụp đổ**")
-                # Kích hoạt tìm kiếm hình ảnh biểu đồ khủng hoảng
-                st.markdown("")
-            
-            with c_hist2:
-                st.write("""
+            # --- PHẦN MINH HỌA LỊCH SỬ ---
+            with st.expander("📚 BÀI HỌC LỊCH SỬ: KHỦNG HOẢNG TÀI CHÍNH 1997"):
+                c_hist1, c_hist2 = st.columns([1, 2])
+                with c_hist1:
+                    st.write("### 📉")
+                    st.caption("**Đồng Baht Thái sụp đổ**")
+                    # Kích hoạt tìm kiếm hình ảnh biểu đồ khủng hoảng
+                    st.markdown("")
+
+                with c_hist2:
+                    st.write("""
                 **Nguyên nhân sụp đổ:**
                 Vào năm 1997, Thái Lan vay nợ nước ngoài rất lớn (giống ví dụ trên). Khi đồng Baht mất giá 50%, gánh nặng nợ quy đổi tăng gấp đôi, khiến các công ty không thể trả nợ và phá sản hàng loạt.
                 """)
 
+            # --- STRESS TEST DANH MỤC NỢ ĐA TIỀN TỆ ---
+            with st.expander("🌐 MỞ RỘNG: Stress test danh mục nợ đa tiền tệ (cú sốc tương quan + kịch bản khủng hoảng)", expanded=False):
+                st.caption(
+                    "Nợ công thực tế gồm nhiều đồng tiền và kỳ hạn. Mô phỏng hàng chục nghìn kịch bản tỷ giá **có tương quan** "
+                    "(đuôi dày Student-t) và so với các cú sốc lịch sử. Số liệu mặc định mang tính minh hoạ."
+                )
+                c_ds1, c_ds2 = st.columns([3, 2])
+                with c_ds1:
+                    st.markdown("**Danh mục nợ** (dư nợ quy đổi theo tỷ giá hôm nay)")
+                    df_port = st.data_editor(
+                        pd.DataFrame(DEFAULT_DEBT_PORTFOLIO,
+                                     columns=["Tiền tệ", "Dư nợ (tỷ USD)", "Kỳ hạn còn lại (năm)", "Lãi suất (%/năm)"]),
+                        column_config={"Tiền tệ": st.column_config.SelectboxColumn(options=DEBT_CURRENCIES, required=True)},
+                        num_rows="dynamic", hide_index=True, key="r5_debt_port",
+                    )
+                    st.markdown("**Phân phối cú sốc 1 năm** (% VND mất giá so với từng ngoại tệ)")
+                    df_shock = st.data_editor(
+                        pd.DataFrame({"Kỳ vọng (%)": DEBT_SHOCK_DRIFT, "Độ lệch chuẩn (%)": DEBT_SHOCK_VOL}),
+                        key="r5_debt_shock",
+                    )
+                    df_corr = st.data_editor(
+                        pd.DataFrame(DEBT_SHOCK_CORR, index=DEBT_CURRENCIES, columns=DEBT_CURRENCIES),
+                        key="r5_debt_corr",
+                    )
+                with c_ds2:
+                    ds_revenue = st.number_input("Thu ngân sách/năm (nghìn tỷ VND):", value=1_900.0, step=50.0, key="r5_ds_revenue")
+                    ds_limit = st.number_input("Ngưỡng cảnh báo Trả nợ/Thu NS (%):", value=9.0, step=0.5, key="r5_ds_limit")
+                    ds_sims = st.selectbox("Số kịch bản:", [10_000, 50_000, 200_000], index=1, key="r5_ds_sims")
+                    ds_fat = st.checkbox("Đuôi dày (Student-t, df=4)", value=True, key="r5_ds_fat")
+
+                port = tuple(
+                    (str(c), float(a), float(m), float(r))
+                    for c, a, m, r in df_port.dropna().itertuples(index=False)
+                    if c in DEBT_CURRENCIES
+                )
+                if not port:
+                    st.warning("⚠️ Danh mục cần ít nhất 1 khoản nợ.")
+                else:
+                    df_dist, df_hist, df_preset = run_debt_stress(
+                        port,
+                        tuple(float(df_shock.loc[c, "Kỳ vọng (%)"]) for c in DEBT_CURRENCIES),
+                        tuple(float(df_shock.loc[c, "Độ lệch chuẩn (%)"]) for c in DEBT_CURRENCIES),
+                        tuple(tuple(float(x) for x in row) for row in df_corr.loc[DEBT_CURRENCIES, DEBT_CURRENCIES].values),
+                        float(base_rate), float(ds_revenue), float(ds_limit), int(ds_sims), bool(ds_fat),
+                    )
+                    k1, k2 = st.columns(2)
+                    k1.metric("Tổng nợ quy đổi hiện tại", f"{df_dist.attrs['base_debt']:,.0f} nghìn tỷ VND")
+                    k2.metric(f"Xác suất Trả nợ/Thu NS > {ds_limit:.0f}%", f"{df_dist.attrs['p_breach']:.2f}%")
+
+                    hist = alt.Chart(df_hist).mark_bar(color="#4B4BFF", opacity=0.7).encode(
+                        x=alt.X("Từ:Q", title="Tăng gánh nặng nợ (nghìn tỷ VND)"),
+                        x2="Đến:Q",
+                        y=alt.Y("Tần suất (%):Q"),
+                    )
+                    rules = alt.Chart(df_preset).mark_rule(color="#ff4b4b", strokeDash=[4, 3], size=2).encode(
+                        x="Tăng gánh nặng (nghìn tỷ VND):Q",
+                        tooltip=["Kịch bản", alt.Tooltip("Tăng gánh nặng (nghìn tỷ VND):Q", format=",.0f")],
+                    )
+                    st.altair_chart(hist + rules, use_container_width=True)
+
+                    st.dataframe(
+                        df_dist.style.format("{:,.1f}", subset=["Hiện tại", "Trung bình", "P50", "P95", "P99", "Xấu nhất"]),
+                        hide_index=True, use_container_width=True,
+                    )
+                    st.markdown("**Kịch bản khủng hoảng lịch sử** (vạch đỏ trên biểu đồ)")
+                    st.dataframe(
+                        df_preset.style.format("{:,.1f}", subset=[c for c in df_preset.columns if c != "Kịch bản"]),
+                        hide_index=True, use_container_width=True,
+                    )
+                    st.info(
+                        """
+💡 **Đọc kết quả:** "Phân vị MC" cho biết kịch bản lịch sử nằm ở đâu trong phân phối mô phỏng – nếu 1997 ở phân vị 99.9%,
+mô hình đang đánh giá thấp rủi ro đuôi. Danh mục nhiều JPY/EUR có thể bị tổn thất ngay cả khi VND ổn định so với USD.
+"""
+                    )
+
+            return debt_val, shock_pct, loss_vnd
+
+        debt_val, shock_pct, loss_vnd = debt_panel()
+
         macro_context = f"""
         Quốc gia nợ {debt_val} tỷ USD. Tỷ giá mất giá {shock_pct}%.
         Gánh nặng nợ tăng thêm {loss_vnd:,.0f} tỷ VND.
@@ -4556,48 +7542,170 @@ def room_5_macro():
 
     # TAB 2
     with tab_carry:
-        st.subheader("2. Đầu cơ Chênh lệch lãi suất (Carry Trade)")
-        st.caption("Vay đồng tiền lãi thấp ➜ mua đồng tiền lãi cao. Lợi nhuận = lãi suất chênh + biến động tỷ giá.")
+        @panel_fragment("r5_carry")
+        def carry_panel():
+            st.subheader("2. Đầu cơ Chênh lệch lãi suất (Carry Trade)")
+            st.caption("Vay đồng tiền lãi thấp ➜ mua đồng tiền lãi cao. Lợi nhuận = lãi suất chênh + biến động tỷ giá.")
 
-        c1, c2 = st.columns(2)
-        with c1:
-            capital = st.number_input("Vốn đầu tư (Triệu USD):", value=10.0, step=1.0, key="r5_capital")
-            rate_borrow = st.number_input("Lãi vay (Funding Rate %):", value=0.5, step=0.1, key="r5_borrow")
-        with c2:
-            rate_invest = st.number_input("Lãi đầu tư (Target Rate %):", value=5.5, step=0.1, key="r5_invest")
-            fx_move = st.slider("Biến động tỷ giá (%):", -10.0, 10.0, -2.0, 0.5, key="r5_fx_move")
+            c1, c2 = st.columns(2)
+            with c1:
+                capital = st.number_input("Vốn đầu tư (Triệu USD):", value=10.0, step=1.0, key="r5_capital")
+                rate_borrow = st.number_input("Lãi vay (Funding Rate %):", value=0.5, step=0.1, key="r5_borrow")
+            with c2:
+                rate_invest = st.number_input("Lãi đầu tư (Target Rate %):", value=5.5, step=0.1, key="r5_invest")
+                fx_move = st.slider("Biến động tỷ giá (%):", -10.0, 10.0, -2.0, 0.5, key="r5_fx_move")
 
-        st.markdown("---")
-        interest_diff = rate_invest - rate_borrow
-        profit_interest = capital * (interest_diff / 100)
-        profit_fx = capital * (fx_move / 100)
-        total_pnl = profit_interest + profit_fx
-        roi = (total_pnl / capital) * 100 if capital != 0 else 0
+            st.markdown("---")
+            interest_diff = rate_invest - rate_borrow
+            profit_interest = capital * (interest_diff / 100)
+            profit_fx = capital * (fx_move / 100)
+            total_pnl = profit_interest + profit_fx
+            roi = (total_pnl / capital) * 100 if capital != 0 else 0
 
-        c_res1, c_res2, c_res3 = st.columns(3)
-        c_res1.metric("1) Lãi từ lãi suất (Spread)", f"${profit_interest:,.2f} M", f"Chênh lệch: {interest_diff:.1f}%")
-        c_res2.metric("2) Lãi/Lỗ từ tỷ giá (FX)", f"${profit_fx:,.2f} M", f"Biến động: {fx_move}%")
-        c_res3.metric("3) TỔNG LỢI NHUẬN", f"${total_pnl:,.2f} M", f"ROI: {roi:.1f}%")
+            c_res1, c_res2, c_res3 = st.columns(3)
+            c_res1.metric("1) Lãi từ lãi suất (Spread)", f"${profit_interest:,.2f} M", f"Chênh lệch: {interest_diff:.1f}%")
+            c_res2.metric("2) Lãi/Lỗ từ tỷ giá (FX)", f"${profit_fx:,.2f} M", f"Biến động: {fx_move}%")
+            c_res3.metric("3) TỔNG LỢI NHUẬN", f"${total_pnl:,.2f} M", f"ROI: {roi:.1f}%")
 
-        with st.expander("🧮 GÓC HỌC TẬP: GIẢI MÃ CÁCH TÍNH CARRY TRADE", expanded=False):
-            st.markdown("Tổng lợi nhuận đến từ 2 nguồn:")
+            with st.expander("🧮 GÓC HỌC TẬP: GIẢI MÃ CÁCH TÍNH CARRY TRADE", expanded=False):
+                st.markdown("Tổng lợi nhuận đến từ 2 nguồn:")
 
-            st.markdown("#### A) Lợi nhuận từ lãi suất")
-            st.latex(r"\text{Profit}_{Rate} = \text{Vốn} \times (r_{Invest} - r_{Borrow})")
-            st.markdown(f"Áp dụng: {capital} × ({rate_invest}% - {rate_borrow}%) = **{profit_interest:,.2f} triệu USD**")
+                st.markdown("#### A) Lợi nhuận từ lãi suất")
+                st.latex(r"\text{Profit}_{Rate} = \text{Vốn} \times (r_{Invest} - r_{Borrow})")
+                st.markdown(f"Áp dụng: {capital} × ({rate_invest}% - {rate_borrow}%) = **{profit_interest:,.2f} triệu USD**")
 
-            st.divider()
+                st.divider()
 
-            st.markdown("#### B) Lợi nhuận từ tỷ giá")
-            st.latex(r"\text{Profit}_{FX} = \text{Vốn} \times \% \Delta FX")
-            st.markdown(f"Áp dụng: {capital} × {fx_move}% = **{profit_fx:,.2f} triệu USD**")
+                st.markdown("#### B) Lợi nhuận từ tỷ giá")
+                st.latex(r"\text{Profit}_{FX} = \text{Vốn} \times \% \Delta FX")
+                st.markdown(f"Áp dụng: {capital} × {fx_move}% = **{profit_fx:,.2f} triệu USD**")
 
-            st.info(
-                """
+                st.info(
+                    """
 Carry Trade giống như “nhặt tiền lẻ (lãi suất) trước đầu xe lu (tỷ giá)”.
 Bạn có thể lời đều từ chênh lãi suất, nhưng một cú đảo chiều tỷ giá có thể xóa sạch thành quả.
 """
-            )
+                )
+
+            return capital, interest_diff, fx_move, roi
+
+        # Giá trị mới nhất cho AI (nút AI nằm ngoài fragment -> bấm là chạy lại toàn trang)
+        capital, interest_diff, fx_move, roi = carry_panel()
+
+        @panel_fragment("r5_unwind")
+        def unwind_panel():
+            with st.expander("🌊 MỞ RỘNG: Mô phỏng unwind JPY→VND theo từng ngày với margin call", expanded=False):
+                st.caption(
+                    "Bài M02 chỉ xét P/L ở ngày đáo hạn với 1 mức sốc. Thực tế broker kiểm tra ký quỹ **mỗi ngày**: "
+                    "chỉ cần 1 ngày lỗ chạm ngưỡng là bị call, dù cuối kỳ tỷ giá có quay lại. Mô phỏng 100.000 đường tỷ giá có bước nhảy."
+                )
+                c_cu1, c_cu2, c_cu3 = st.columns(3)
+                with c_cu1:
+                    cu_notional = st.number_input("Vay JPY (triệu JPY):", value=200.0, step=10.0, key="r5_cu_notional")
+                    cu_s0 = st.number_input("Spot VND/JPY:", value=17.0, step=0.1, key="r5_cu_s0")
+                    cu_equity = st.number_input("Vốn tự có (triệu VND):", value=300.0, step=10.0, key="r5_cu_equity")
+                    cu_trigger = st.selectbox("Ngưỡng margin call (lỗ/vốn):", [0.10, 0.15, 0.25, 0.50], index=1,
+                                              format_func=lambda x: f"{x:.0%}", key="r5_cu_trigger")
+                with c_cu2:
+                    cu_i_vnd = st.number_input("Lãi suất VND (%/năm):", value=7.0, step=0.5, key="r5_cu_ivnd")
+                    cu_i_jpy = st.number_input("Lãi suất JPY (%/năm):", value=0.5, step=0.1, key="r5_cu_ijpy")
+                    cu_horizon = st.selectbox("Kỳ hạn (ngày):", [30, 60, 90], index=2, key="r5_cu_horizon")
+                with c_cu3:
+                    cu_vol = st.number_input("Biến động VND/JPY (%/năm):", value=10.0, step=1.0, key="r5_cu_vol")
+                    cu_lambda = st.number_input("Số cú nhảy kỳ vọng/năm:", value=3.0, step=0.5, key="r5_cu_lambda")
+                    cu_jmean = st.number_input("Cú nhảy TB (% JPY tăng):", value=2.0, step=0.5, key="r5_cu_jmean")
+                    cu_jsd = st.number_input("Độ lệch chuẩn cú nhảy (%):", value=2.0, step=0.5, key="r5_cu_jsd")
+
+                with st.spinner("Đang mô phỏng 100.000 đường tỷ giá theo ngày..."):
+                    df_cu, df_cu_days = run_carry_unwind_mc(
+                        float(cu_notional), float(cu_s0), cu_i_vnd / 100, cu_i_jpy / 100, int(cu_horizon),
+                        float(cu_equity), float(cu_trigger), float(cu_vol), float(cu_lambda), float(cu_jmean), float(cu_jsd),
+                    )
+                u1, u2, u3 = st.columns(3)
+                u1.metric("P(margin call trước đáo hạn)", f"{df_cu['Giá trị'].iloc[0]:.2f}%")
+                u2.metric("P(call) nếu chỉ xét ngày cuối", f"{df_cu['Giá trị'].iloc[1]:.2f}%")
+                u3.metric("Lỗ kỳ vọng khi bị call", f"{df_cu['Giá trị'].iloc[2]:,.0f} VND")
+
+                st.altair_chart(
+                    alt.Chart(df_cu_days).mark_bar(color="#ff4b4b").encode(
+                        x=alt.X("Ngày:O", title="Ngày bị margin call lần đầu", axis=alt.Axis(labelOverlap=True)),
+                        y=alt.Y("Tỷ lệ bị call (%):Q"),
+                        tooltip=["Ngày", alt.Tooltip("Tỷ lệ bị call (%):Q", format=".3f")],
+                    ),
+                    use_container_width=True,
+                )
+                st.dataframe(
+                    df_cu.style.format("{:,.2f}", subset=["Giá trị"]),
+                    hide_index=True, use_container_width=True,
+                )
+                st.info(
+                    """
+💡 **Vì sao 2 xác suất khác nhau?** Kiểm tra hằng ngày là bài toán **chạm ngưỡng lần đầu** (first passage):
+đường tỷ giá có thể vượt ngưỡng giữa kỳ rồi quay lại. Chênh lệch giữa 2 con số chính là rủi ro mà bài tính "chỉ ngày cuối" bỏ sót.
+"""
+                )
+
+        unwind_panel()
+
+        @panel_fragment("r5_carry_bt")
+        def carry_backtest_panel():
+            with st.expander("📜 MỞ RỘNG: Backtest carry trade trên dữ liệu minh họa (mô phỏng 2015–2025)", expanded=False):
+                fx_manifest = open_fx_store().manifest
+                st.caption(
+                    f"Dữ liệu: kho fx_store v{fx_manifest['version']} ({fx_manifest['start']} → {fx_manifest['end']}). "
+                    "⚠️ Số liệu minh họa cho bài giảng, không phải dữ liệu thị trường: EUR/USD và USD/JPY được dựng "
+                    "qua vài mốc tỷ giá + nhiễu ngẫu nhiên giữa các mốc, lãi suất điều hành là bậc thang xấp xỉ. "
+                    "Dùng để hiểu cơ chế carry trade, không dùng để tra cứu sự kiện."
+                )
+                ccy_list = list(CARRY_CCY)
+                c_bt1, c_bt2, c_bt3 = st.columns(3)
+                with c_bt1:
+                    bt_fund = st.selectbox("Đồng tiền đi vay (funding):", ccy_list, index=ccy_list.index("JPY"), key="r5_bt_fund")
+                    bt_target = st.selectbox("Đồng tiền đầu tư (target):", ccy_list, index=ccy_list.index("VND"), key="r5_bt_target")
+                with c_bt2:
+                    bt_freq = st.selectbox("Tái cân bằng:", list(CARRY_REBALANCE), index=2,
+                                           format_func=CARRY_REBALANCE.get, key="r5_bt_freq")
+                    bt_lev = st.number_input("Đòn bẩy (x vốn):", value=1.0, min_value=0.5, max_value=10.0, step=0.5, key="r5_bt_lev")
+                with c_bt3:
+                    bt_stop = st.number_input("Stop-loss mỗi kỳ (% vốn, 0 = không):", value=0.0, min_value=0.0,
+                                              max_value=50.0, step=1.0, key="r5_bt_stop")
+                    bt_pos = st.checkbox("Chỉ vào lệnh khi chênh lãi > 0", value=False, key="r5_bt_pos")
+                y0, y1 = int(fx_manifest["start"][:4]), int(fx_manifest["end"][:4])
+                bt_years = st.slider("Giai đoạn:", y0, y1, (y0, y1), key="r5_bt_years")
+
+                if bt_fund == bt_target:
+                    st.warning("Chọn 2 đồng tiền khác nhau.")
+                else:
+                    bt_res, df_bt, df_crash = run_carry_backtest(
+                        bt_fund, bt_target, f"{bt_years[0]}-01-01", f"{bt_years[1]}-12-31",
+                        bt_freq, float(bt_lev), float(bt_stop), bool(bt_pos),
+                    )
+                    b1, b2, b3, b4, b5 = st.columns(5)
+                    b1.metric("Tổng lợi nhuận", f"{bt_res['total_return']:.1%}")
+                    b2.metric("CAGR", f"{bt_res['cagr']:.2%}")
+                    b3.metric("Sharpe", f"{bt_res['sharpe']:.2f}")
+                    b4.metric("Max drawdown", f"{bt_res['max_dd']:.1%}")
+                    b5.metric("Số kỳ bị đóng vị thế", f"{bt_res['n_stops']}/{bt_res['n_periods']}",
+                              help="Gồm stop-loss và cháy tài khoản (lỗ hết vốn đầu kỳ).")
+
+                    base_bt = alt.Chart(df_bt).encode(x=alt.X("Ngày:T", title=None))
+                    st.altair_chart(
+                        alt.vconcat(
+                            base_bt.mark_line(color="#2e7d32").encode(y=alt.Y("Vốn (x):Q", scale=alt.Scale(zero=False))).properties(height=220),
+                            base_bt.mark_area(color="#ff4b4b", opacity=0.5).encode(y=alt.Y("Drawdown (%):Q")).properties(height=120),
+                        ),
+                        use_container_width=True,
+                    )
+                    st.markdown(f"**Các cú sập trên dữ liệu mô phỏng (sụt giảm ≥ {CARRY_CRASH_DD:.0%} từ đỉnh, ghi theo quý):**")
+                    if df_crash.empty:
+                        st.success("Không có đợt sụt giảm nào vượt ngưỡng trong giai đoạn này.")
+                    else:
+                        st.dataframe(
+                            df_crash.style.format({"Sụt giảm (%)": "{:,.1f}"}),
+                            hide_index=True, use_container_width=True,
+                        )
+
+        carry_backtest_panel()
 
     st.markdown("---")
     if st.button("AI Advisor – Macro Strategist", type="primary", icon="🤖", key="btn_ai_macro"):
@@ -4610,9 +7718,10 @@ Bạn có thể lời đều từ chênh lãi suất, nhưng một cú đảo ch
 
                 # BƯỚC 2: KIỂM TRA HẠN MỨC (QUOTA)
         current_used = get_usage_from_supabase(user_id)
+        max_quota = ai_quota_for(user_id)
                 
-        if current_used >= MAX_AI_QUOTA:
-            st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({MAX_AI_QUOTA}/{MAX_AI_QUOTA}).")
+        if current_used >= max_quota:
+            st.warning(f"⚠️ Sinh viên {user_id} đã hết lượt dùng AI ({max_quota}/{max_quota}).")
             st.stop() 
 
         full_context = f"""
@@ -4626,7 +7735,7 @@ Làm báo cáo nhanh:
 2) Đánh giá rủi ro nợ công trong kịch bản mất giá {shock_pct}% (nêu 1-2 dấu hiệu cảnh báo).
 3) Lời khuyên hành động: thiên về Risk-On hay Risk-Off? (1 câu chốt).
 """
-        with st.spinner(f"Đang tổng hợp tín hiệu vĩ mô... (Lượt gọi AI thứ {current_used + 1}/{MAX_AI_QUOTA})"):
+        with st.spinner(f"Đang tổng hợp tín hiệu vĩ mô... (Lượt gọi AI thứ {current_used + 1}/{max_quota})"):
             try:
                 advise = ask_gemini_advisor("Macro Strategist", full_context, task)
                 if advise.startswith("⚠️"):
@@ -4642,7 +7751,7 @@ Làm báo cáo nhanh:
                         
                         # Bắn nội dung mới vào cái hộp "quota_placeholder" đang nằm bên Sidebar
                         # Lưu ý: Bạn cần đảm bảo biến 'quota_placeholder' truy cập được từ đây
-                        quota_placeholder.info(f"Đã dùng: {new_usage}/{MAX_AI_QUOTA} lượt")
+                        quota_placeholder.info(f"Đã dùng: {new_usage}/{max_quota} lượt")
                         
                         # 3. Hiện kết quả AI ra màn hình chính
                         st.markdown(f'<div class="ai-box"><h4>🤖 CHUYÊN GIA AI BÁO CÁO CHIẾN LƯỢC</h4>{advise}</div>', unsafe_allow_html=True)
@@ -4655,35 +7764,13 @@ Làm báo cáo nhanh:
 # =========================
 # LEADERBOARD HELPERS
 # =========================
-@st.cache_resource
 def load_student_lookup():
     """
-    Đọc dssv.xlsx và tạo dict: MSSV -> Họ tên
+    Dict MSSV -> Họ tên từ danh sách lớp hiện hành (RosterWatcher)
     - Nếu file hiện chỉ có 1 cột MSSV thì name sẽ rỗng
-    - Khi bạn upload file mới có cột họ tên, hàm tự nhận
+    - Khi bạn upload file mới có cột họ tên, hàm tự nhận (không cần restart)
     """
-    try:
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        file_path = os.path.join(current_dir, "dssv.xlsx")
-        df = pd.read_excel(file_path, dtype=str)
-
-        # Chuẩn hóa tên cột linh hoạt
-        cols = {c.strip().lower(): c for c in df.columns}
-        mssv_col = cols.get("mssv") or cols.get("ma sv") or cols.get("student_id") or cols.get("student id")
-        hoten_col = cols.get("hoten") or cols.get("họ tên") or cols.get("ho ten") or cols.get("fullname") or cols.get("full name")
-
-        if not mssv_col:
-            return {}
-
-        df[mssv_col] = df[mssv_col].astype(str).str.strip().str.upper()
-        if hoten_col:
-            df[hoten_col] = df[hoten_col].astype(str).str.strip()
-            return dict(zip(df[mssv_col], df[hoten_col]))
-        else:
-            return {m: "" for m in df[mssv_col].tolist()}
-
-    except Exception:
-        return {}
+    return roster_watcher().current().names
 
 def get_student_name(mssv: str) -> str:
     mp = load_student_lookup()
@@ -4889,11 +7976,10 @@ def render_my_badges(df: "pd.DataFrame"):
     - Mỗi phòng 1 card 3D, bên trong 2 badge
     - Badge có progress bar (0-100%) theo số lần nộp (x/3)
     - Khi vừa đạt 3/3: chỉ GLOW đúng badge đó (không balloons, không toast)
-    - Fix lỗi HTML bị render thành code: dùng textwrap.dedent để bỏ indent
+    - CSS nằm ở assets/badges.css (use_stylesheet), không chèn lại nguyên khối mỗi lần rerun
     """
     import pandas as pd
     import streamlit as st
-    from textwrap import dedent
 
     # =========================
     # 0) Catalog huy hiệu
@@ -4944,200 +8030,7 @@ def render_my_badges(df: "pd.DataFrame"):
     # =========================
     # 1) CSS UI (3D card + badge progress + journey + glow)
     # =========================
-    st.markdown(
-        dedent(
-            """
-            <style>
-            /* ===== Journey ===== */
-            .journey-wrap{
-              margin: 10px 0 14px 0;
-              padding: 12px 12px;
-              border-radius: 16px;
-              border: 1px solid rgba(148,163,184,.35);
-              background: linear-gradient(180deg, rgba(255,255,255,.94), rgba(248,250,252,.94));
-              box-shadow: 0 10px 22px rgba(15,23,42,.08);
-            }
-            .journey-title{
-              font-weight: 900; color:#0f172a; margin-bottom: 10px;
-              display:flex; justify-content:space-between; align-items:center; gap:10px;
-            }
-            .journey-bar{ display:flex; gap: 10px; align-items:center; }
-            .j-step{
-              flex:1; height: 36px; position: relative; overflow:hidden;
-              border-radius: 14px;
-              border: 1px solid rgba(148,163,184,.35);
-              background: rgba(148,163,184,.18);
-              box-shadow: inset 0 0 0 1px rgba(255,255,255,.25);
-            }
-            .j-fill{ height:100%; width:0%; background: rgba(59,130,246,.82); }
-            .j-label{
-              position:absolute; inset:0;
-              display:flex; align-items:center; justify-content:center;
-              font-weight: 900; font-size: 13px;
-              color:#0f172a;
-              text-shadow: 0 1px 0 rgba(255,255,255,.65);
-            }
-            .j-done .j-fill{ background: rgba(34,197,94,.85); }
-            .j-done .j-label{ color:#052e16; }
-
-            /* ===== Room Card 3D ===== */
-            .room-card{
-              border: 1px solid rgba(148,163,184,.35);
-              border-radius: 18px;
-              padding: 14px 14px 10px 14px;
-              background: linear-gradient(180deg, rgba(255,255,255,.96), rgba(248,250,252,.96));
-              box-shadow: 0 10px 22px rgba(15,23,42,.10);
-              margin: 12px 0;
-              transition: transform .15s ease, box-shadow .15s ease;
-            }
-            .room-card:hover{
-              transform: translateY(-2px);
-              box-shadow: 0 14px 30px rgba(15,23,42,.14);
-            }
-            .room-head{
-              display:flex; justify-content:space-between; align-items:center;
-              gap: 10px; padding: 8px 10px; border-radius: 14px;
-              background: rgba(219,234,254,.85);
-              border: 1px solid rgba(147,197,253,.55);
-            }
-            .room-title{
-              font-weight: 900; font-size: 18px; color:#0b4aa2;
-              display:flex; align-items:center; gap:10px;
-            }
-            .room-meta{
-              font-weight: 900; font-size: 13px; color:#0f172a;
-              opacity:.85;
-            }
-
-            /* ===== Badges ===== */
-            .badges-grid{
-              display:grid;
-              grid-template-columns: 1fr 1fr;
-              gap: 10px;
-              padding: 12px 4px 6px 4px;
-            }
-            .badge-tile{
-              border-radius: 16px;
-              border: 1px solid rgba(148,163,184,.35);
-              background: #fff;
-              padding: 12px 12px;
-              display:flex; gap: 10px; align-items:flex-start;
-              box-shadow: 0 6px 14px rgba(15,23,42,.06);
-              position: relative;
-            }
-            .badge-ico{ font-size: 22px; line-height: 1; }
-            .badge-name{ font-weight: 900; color:#0f172a; }
-            .badge-code{ font-size: 12px; color:#64748b; margin-left: 6px; }
-            .badge-sub{ font-size: 12px; color:#64748b; margin-top: 2px; }
-
-            .badge-progress{
-              margin-top: 8px;
-              height: 8px;
-              width: 100%;
-              border-radius: 999px;
-              background: rgba(148,163,184,.25);
-              overflow:hidden;
-            }
-            .badge-progress > div{
-              height:100%;
-              width: 0%;
-              border-radius: 999px;
-              background: rgba(59,130,246,.85);
-            }
-
-            /* Locked vs Unlocked */
-            .locked{ opacity:.50; filter: grayscale(1); }
-            .unlocked{
-              opacity:1; filter:none;
-              box-shadow: 0 8px 18px rgba(34,197,94,.12);
-            }
-            .unlocked .badge-progress > div{ background: rgba(34,197,94,.85); }
-
-            /* Glow (run once) */
-            @keyframes glowPulse {
-              0%   { box-shadow: 0 0 0 rgba(34,197,94,.0); transform: translateY(0); }
-              30%  { box-shadow: 0 0 24px rgba(34,197,94,.35); transform: translateY(-1px); }
-              100% { box-shadow: 0 0 0 rgba(34,197,94,.0); transform: translateY(0); }
-            }
-            .glow-once{
-              animation: glowPulse 1.2s ease-out 1;
-            }
-
-            /* Mobile: 1 column badges */
-            @media (max-width: 768px){
-              .badges-grid{ grid-template-columns: 1fr; }
-              .room-title{ font-size: 16px; }
-              .j-label{ font-size: 12px; }
-            }
-
-            /* ===== Journey Pills (Duolingo style) ===== */
-            .jp-wrap{
-            margin: 10px 0 14px 0;
-            padding: 12px 12px;
-            border-radius: 16px;
-            border: 1px solid rgba(148,163,184,.35);
-            background: linear-gradient(180deg, rgba(255,255,255,.94), rgba(248,250,252,.94));
-            box-shadow: 0 10px 22px rgba(15,23,42,.08);
-            }
-            .jp-title{
-            font-weight: 900; color:#0f172a; margin-bottom: 10px;
-            display:flex; justify-content:space-between; align-items:center; gap:10px;
-            }
-            .jp-row{
-            display:flex; gap:10px; align-items:center; flex-wrap:wrap;
-            }
-            .jp-pill{
-            flex: 1 1 120px;
-            min-width: 92px;
-            height: 38px;
-            border-radius: 999px;
-            border: 1px solid rgba(148,163,184,.35);
-            background: rgba(148,163,184,.18);
-            position: relative;
-            overflow:hidden;
-            box-shadow: inset 0 0 0 1px rgba(255,255,255,.25);
-            display:flex; align-items:center; justify-content:center;
-            font-weight: 900;
-            color:#0f172a;
-            user-select:none;
-            }
-            .jp-pill .jp-fill{
-            position:absolute; inset:0;
-            width: 0%;
-            background: rgba(59,130,246,.82);
-            }
-            .jp-pill .jp-text{
-            position:relative;
-            z-index:2;
-            font-size: 13px;
-            text-shadow: 0 1px 0 rgba(255,255,255,.65);
-            display:flex; gap:8px; align-items:center;
-            }
-            .jp-pill .jp-ico{ font-size: 16px; line-height:1; }
-
-            /* states by completion */
-            .jp-0 .jp-fill{ width:0%; background: rgba(148,163,184,.18); }
-            .jp-1 .jp-fill{ width:55%; background: rgba(59,130,246,.65); }
-            .jp-2 .jp-fill{ width:100%; background: rgba(34,197,94,.80); }
-            .jp-2{ border-color: rgba(34,197,94,.45); }
-            .jp-2 .jp-text{ color:#052e16; }
-
-            /* tooltip */
-            .jp-pill[title]{ cursor: help; }
-
-            /* Mobile: icon-only pills */
-            @media (max-width: 768px){
-            .jp-title{ font-size: 14px; }
-            .jp-pill{ flex: 1 1 18%; min-width: 56px; height: 40px; }
-            .jp-pill .jp-text{ font-size: 0px; }   /* hide text */
-            .jp-pill .jp-ico{ font-size: 18px; }   /* show icon */
-            .jp-pill .jp-count{ font-size: 0px; }  /* hide count */
-            }
-            </style>
-            """
-        ),
-        unsafe_allow_html=True,
-    )
+    use_stylesheet("badges.css")  # assets/badges.css
 
     # =========================
     # 2) Progress x/3 cho từng mã bài
@@ -5586,6 +8479,17 @@ def room_6_leaderboard():
         
         st.caption("Xếp hạng dựa trên **tổng điểm best-of-3** của mỗi mã bài.")
 
+        # Kiểm tra danh sách lớp (cho GV): dòng bị loại thì SV đó không đăng nhập được
+        roster = roster_watcher().current()
+        df_roster = roster_report_frame(roster)
+        n_rejected = int(df_roster[["MSSV sai định dạng", "Lớp sai định dạng"]].to_numpy().sum()) if len(df_roster) else 0
+        if n_rejected:
+            st.warning(f"⚠️ Danh sách lớp có **{n_rejected}** dòng bị loại (MSSV/lớp sai định dạng) – các SV này chưa đăng nhập được.")
+        with st.expander("📋 Danh sách lớp đang nạp (GV)", expanded=bool(n_rejected)):
+            st.caption(f"{len(roster.rows):,} SV / {len([c for c in roster.by_class if c])} lớp. "
+                       "MSSV hợp lệ: chữ không dấu, số, '_', '.', '-' (không có dấu cách); tên lớp tối đa 40 ký tự.")
+            st.dataframe(df_roster, hide_index=True, use_container_width=True)
+
         # 1) Ưu tiên view
         data = fetch_class_leaderboard_from_view(limit=300)
 
@@ -5678,6 +8582,22 @@ def room_6_leaderboard():
         # (optional) debug nhanh xem còn trùng không
         # st.caption(f"DEBUG dup_mssv={int(df['mssv'].duplicated().sum())}")
 
+        # Lọc theo lớp: dựa vào phân vùng lớp của danh sách (bài nộp cũ có thể chưa ghi cột lop)
+        classes = sorted(c for c in roster.by_class if c)
+        if classes:
+            options = ["Tất cả"] + classes
+            my_lop = get_student_class(mssv)
+            lop_sel = st.selectbox(
+                "🏫 Lớp", options,
+                index=options.index(my_lop) if my_lop in options else 0,
+                key=f"lb_lop_{mssv}",
+            )
+            if lop_sel != "Tất cả":
+                df = df[df["mssv"].isin(class_members(lop_sel))]
+                if df.empty:
+                    st.warning(f"Lớp {lop_sel} chưa có bài nộp nào.")
+                    return
+
         # 4) Sort + Rank
         sort_cols = ["total_score", "total_correct", "exercises_done"]
         df = df.sort_values(sort_cols, ascending=[False, False, False]).reset_index(drop=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# `import app` từ thư mục gốc repo (app.py chạy được ngoài Streamlit ở bare mode)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
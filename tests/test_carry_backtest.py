@@ -0,0 +1,29 @@
+import numpy as np
+
+import app
+
+DATES = np.array(["2024-01-01", "2024-01-02", "2024-01-03", "2024-01-04", "2024-01-05"], dtype="datetime64[D]")
+ONES = np.ones(DATES.size)
+ZEROS = np.zeros(DATES.size)
+
+
+def test_wipeout_is_final_within_period():
+    # 10x, target 1 -> 0.85 (-150% vốn) -> 1.05: cháy TK ngày 2, giá hồi cũng không cứu được
+    target = np.array([1.0, 0.85, 0.9, 0.95, 1.05])
+    res = app.carry_backtest(DATES, ONES, target, ZEROS, ZEROS, freq="Q", leverage=10.0)
+    np.testing.assert_array_equal(res["equity"], [1.0, 0.0, 0.0, 0.0, 0.0])
+    assert res["total_return"] == -1.0
+    assert res["n_stops"] == 1
+
+
+def test_wipeout_carries_into_later_periods():
+    target = np.array([1.0, 0.85, 0.9, 0.95, 1.05])
+    res = app.carry_backtest(DATES, ONES, target, ZEROS, ZEROS, freq="D", leverage=10.0)
+    np.testing.assert_array_equal(res["equity"][1:], 0.0)
+
+
+def test_no_wipeout_tracks_leveraged_path():
+    target = np.array([1.0, 0.99, 1.0, 1.01, 1.02])
+    res = app.carry_backtest(DATES, ONES, target, ZEROS, ZEROS, freq="Q", leverage=2.0)
+    np.testing.assert_allclose(res["equity"], 1 + 2 * (target - 1))
+    assert res["n_stops"] == 0
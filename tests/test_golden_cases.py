@@ -0,0 +1,9 @@
+import app
+
+
+def test_seeded_cases_match_golden_file():
+    df = app.diff_golden_cases()
+    assert df.empty, (
+        f"Đề sinh lại lệch golden (golden: {df.attrs['golden_meta']}, hiện tại: {df.attrs['runtime']}):\n"
+        + df.to_string(index=False)
+    )
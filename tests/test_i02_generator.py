@@ -0,0 +1,17 @@
+import numpy as np
+
+import app
+
+
+def test_i02_generator_guarantees():
+    df = app.validate_i02_generator(n=200_000, seed=0)
+    assert (df["Trong dải (%)"] == 100.0).all()
+    assert (df["Quyết định đúng dấu (%)"] == 100.0).all()
+    assert (df["Max |NPV(IRR)|"] < 1e-6).all()
+    np.testing.assert_allclose(df["Tần suất"], df["Trọng số"], atol=0.01)
+
+
+def test_i02_generator_respects_custom_weights():
+    df = app.validate_i02_generator(n=50_000, seed=1, difficulty_weights={"EASY": 0.0, "MEDIUM": 0.0, "HARD": 1.0})
+    assert df.set_index("Mức").loc["HARD", "Tần suất"] == 1.0
+    assert (df["Trong dải (%)"].dropna() == 100.0).all()